@@ -231,6 +231,39 @@ block_backend_fs_stat_block (BlockBackend *bend,
     return block_md;
 }
 
+static int
+block_backend_fs_open_block_fd (BlockBackend *bend,
+                                const char *store_id,
+                                int version,
+                                const char *block_id,
+                                gint64 *offset,
+                                gint64 *size)
+{
+    char path[SEAF_PATH_MAX];
+    SeafStat st;
+    int fd;
+
+    get_block_path (bend, block_id, path, store_id, version);
+    fd = g_open (path, O_RDONLY | O_BINARY, 0);
+    if (fd < 0) {
+        seaf_warning ("[block bend] Failed to open block %s at %s: %s.\n",
+                      block_id, path, strerror(errno));
+        return -1;
+    }
+
+    if (seaf_fstat (fd, &st) < 0) {
+        seaf_warning ("[block bend] Failed to stat block %s at %s: %s.\n",
+                      block_id, path, strerror(errno));
+        close (fd);
+        return -1;
+    }
+
+    *offset = 0;
+    *size = st.st_size;
+
+    return fd;
+}
+
 static BMetadata *
 block_backend_fs_stat_block_by_handle (BlockBackend *bend,
                                        BHandle *handle)
@@ -310,6 +343,48 @@ out:
     return ret;
 }
 
+static int
+block_backend_fs_foreach_block_with_prefix (BlockBackend *bend,
+                                            const char *store_id,
+                                            int version,
+                                            const char *prefix,
+                                            SeafBlockFunc process,
+                                            void *user_data)
+{
+    FsPriv *priv = bend->be_priv;
+    char *block_dir = NULL;
+    GDir *dir;
+    const char *dname;
+    char block_id[128];
+
+#if defined MIGRATION
+    if (version > 0)
+        block_dir = g_build_filename (priv->block_dir, store_id, prefix, NULL);
+    else
+        block_dir = g_build_filename (priv->v0_block_dir, prefix, NULL);
+#else
+    block_dir = g_build_filename (priv->block_dir, store_id, prefix, NULL);
+#endif
+
+    /* The prefix dir doesn't exist if there is no block with this prefix. */
+    dir = g_dir_open (block_dir, 0, NULL);
+    if (!dir) {
+        g_free (block_dir);
+        return 0;
+    }
+
+    while ((dname = g_dir_read_name(dir)) != NULL) {
+        snprintf (block_id, sizeof(block_id), "%.2s%s", prefix, dname);
+        if (!process (store_id, version, block_id, user_data))
+            break;
+    }
+
+    g_dir_close (dir);
+    g_free (block_dir);
+
+    return 0;
+}
+
 static int
 block_backend_fs_copy (BlockBackend *bend,
                        const char *src_store_id,
@@ -487,8 +562,10 @@ block_backend_fs_new (const char *seaf_dir, const char *tmp_dir)
     bend->remove_block = block_backend_fs_remove_block;
     bend->stat_block = block_backend_fs_stat_block;
     bend->stat_block_by_handle = block_backend_fs_stat_block_by_handle;
+    bend->open_block_fd = block_backend_fs_open_block_fd;
     bend->block_handle_free = block_backend_fs_block_handle_free;
     bend->foreach_block = block_backend_fs_foreach_block;
+    bend->foreach_block_with_prefix = block_backend_fs_foreach_block_with_prefix;
     bend->remove_store = block_backend_fs_remove_store;
     bend->copy = block_backend_fs_copy;
 
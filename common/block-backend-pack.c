@@ -0,0 +1,2160 @@
+/* -*- Mode: C; tab-width: 4; indent-tabs-mode: nil; c-basic-offset: 4 -*- */
+
+#include "common.h"
+
+#include "utils.h"
+
+#include "log.h"
+
+#include <sys/stat.h>
+#include <sys/mman.h>
+#include <sys/file.h>
+#include <fcntl.h>
+#include <pthread.h>
+
+#include "block-backend.h"
+
+/*
+ * Pack block backend.
+ *
+ * Blocks of a store are appended to pack files under
+ * <seaf_dir>/storage/packs/<store_id>/. Each record in a pack file is a
+ * PackRecordHeader followed by the block content. The newest pack is the
+ * active pack, which is indexed in memory. When it grows over the pack
+ * size, it's sealed: a sorted index file is written next to it and the
+ * index is mmapped for lookups.
+ *
+ * Since blocks are content addressed, a block id appears at most once in a
+ * store. Removed blocks are recorded in the "deleted" journal of the store
+ * and only dropped from pack files by compaction, which rewrites packs
+ * with many removed blocks.
+ *
+ * Several processes (seaf-server, seafserv-gc, seaf-fsck, seaf-fuse) use
+ * the same packs. A process changes a store only while holding an
+ * exclusive flock on the "lock" file of the store, and picks up what other
+ * processes wrote when it takes the lock. Only the lock holder truncates a
+ * broken record at the end of a pack or seals packs left unsealed by a
+ * crash. Other processes open packs read only, stop at the last complete
+ * record, and reload the store when a lookup misses.
+ *
+ * Blocks stored by the fs backend before switching to packs stay readable:
+ * if <seaf_dir>/storage/blocks exists, lookups that miss the packs fall back
+ * to it, and listing a store includes its fs blocks. Compaction moves the
+ * fs blocks of a store into packs, so running seafserv-gc after switching
+ * migrates all existing stores.
+ */
+
+#define PACK_RECORD_MAGIC 0x5350424b    /* "SPBK" */
+#define PACK_INDEX_MAGIC 0x53504958     /* "SPIX" */
+#define PACK_INDEX_VERSION 1
+
+#define DEFAULT_PACK_SIZE (256 * 1024 * 1024)
+
+/* Rewrite a pack when at least this percent of its bytes are removed. */
+#define COMPACT_THRESHOLD 20
+
+/* Reload a store at most this often (in usec) when lookups miss. */
+#define STORE_REFRESH_INTERVAL G_USEC_PER_SEC
+
+#define JOURNAL_OP_DELETE '-'
+#define JOURNAL_OP_UNDELETE '+'
+
+typedef struct PackRecordHeader {
+    guint32 magic;
+    guint8  id[20];
+    guint32 size;
+} __attribute__((gcc_struct, __packed__)) PackRecordHeader;
+
+typedef struct PackIndexHeader {
+    guint32 magic;
+    guint32 version;
+    guint32 n_entries;
+    /* Number of entries whose first id byte is <= i. */
+    guint32 fanout[256];
+} __attribute__((gcc_struct, __packed__)) PackIndexHeader;
+
+typedef struct PackIndexEntry {
+    guint8  id[20];
+    /* Offset of block content in the pack file. */
+    guint64 offset;
+    guint32 size;
+} __attribute__((gcc_struct, __packed__)) PackIndexEntry;
+
+typedef struct JournalRecord {
+    guint8  op;
+    guint8  id[20];
+} __attribute__((gcc_struct, __packed__)) JournalRecord;
+
+/* In memory entry of the active pack, in host byte order. */
+typedef struct ActiveEntry {
+    guint8  id[20];
+    guint64 offset;
+    guint32 size;
+} ActiveEntry;
+
+typedef struct Pack {
+    guint32 pack_no;
+    char   *path;
+    char   *idx_path;
+
+    /* Sealed pack. */
+    void   *idx_map;
+    gsize   idx_len;
+    const PackIndexHeader *idx_hdr;
+    const PackIndexEntry *entries;
+    guint32 n_entries;
+
+    /* Unsealed pack. */
+    int     fd;
+    gboolean writable;
+    /* End of the last complete record. */
+    guint64 size;
+    GHashTable *active_index;
+} Pack;
+
+/*
+ * Changes to a store are made with write_lock held, so that only one
+ * thread of a process holds the flock of the store at a time, and with
+ * lock held, which is what lookups take. Code holding write_lock can read
+ * the store without taking lock.
+ */
+typedef struct PackStore {
+    char       *store_id;
+    char       *dir;
+    guint32     next_pack_no;
+    /* The newest pack, if it's unsealed. */
+    Pack       *active;
+    /* Other packs, the newest first. Packs left unsealed by a crash are
+     * here too until a writer seals them.
+     */
+    GList      *sealed;
+    /* Removed block ids. */
+    GHashTable *deleted;
+    int         journal_fd;
+    /* Part of the journal already applied to deleted. */
+    guint64     journal_len;
+    guint64     journal_ino;
+    gint64      last_refresh;
+    int         lock_fd;
+    pthread_mutex_t lock;
+    pthread_mutex_t write_lock;
+} PackStore;
+
+struct _BHandle {
+    char    *store_id;
+    int     version;
+    char    block_id[41];
+    int     rw_type;
+
+    /* For read. */
+    int     fd;
+    guint64 offset;
+    guint32 size;
+    guint32 pos;
+
+    /* For write. Blocks are small enough to be buffered in memory. */
+    GByteArray *buf;
+
+    /* Handle of the fs backend if the block is not in a pack yet. */
+    BHandle *legacy;
+};
+
+typedef struct {
+    char            *pack_dir;
+    guint64          pack_size;
+    GHashTable      *stores;
+    /* Protects stores. */
+    pthread_mutex_t  lock;
+    /* Blocks stored before switching to packs. NULL if there are none. */
+    BlockBackend    *legacy;
+} PackPriv;
+
+static guint
+raw_id_hash (gconstpointer key)
+{
+    guint h;
+
+    memcpy (&h, key, sizeof(h));
+    return h;
+}
+
+static gboolean
+raw_id_equal (gconstpointer a, gconstpointer b)
+{
+    return (memcmp (a, b, 20) == 0);
+}
+
+static int
+pread_all (int fd, void *buf, size_t len, guint64 offset)
+{
+    char *ptr = buf;
+    ssize_t n;
+
+    while (len > 0) {
+        n = pread (fd, ptr, len, offset);
+        if (n < 0) {
+            if (errno == EINTR)
+                continue;
+            return -1;
+        }
+        if (n == 0) {
+            errno = EIO;
+            return -1;
+        }
+        ptr += n;
+        len -= n;
+        offset += n;
+    }
+
+    return 0;
+}
+
+static int
+pwrite_all (int fd, const void *buf, size_t len, guint64 offset)
+{
+    const char *ptr = buf;
+    ssize_t n;
+
+    while (len > 0) {
+        n = pwrite (fd, ptr, len, offset);
+        if (n < 0) {
+            if (errno == EINTR)
+                continue;
+            return -1;
+        }
+        ptr += n;
+        len -= n;
+        offset += n;
+    }
+
+    return 0;
+}
+
+/* Pack files. */
+
+static Pack *
+pack_new (PackStore *store, guint32 pack_no)
+{
+    Pack *pack = g_new0 (Pack, 1);
+    char name[64];
+
+    pack->pack_no = pack_no;
+    snprintf (name, sizeof(name), "pack-%08x.dat", pack_no);
+    pack->path = g_build_filename (store->dir, name, NULL);
+    snprintf (name, sizeof(name), "pack-%08x.idx", pack_no);
+    pack->idx_path = g_build_filename (store->dir, name, NULL);
+    pack->fd = -1;
+
+    return pack;
+}
+
+static void
+pack_free (Pack *pack)
+{
+    if (pack->idx_map)
+        munmap (pack->idx_map, pack->idx_len);
+    if (pack->fd >= 0)
+        close (pack->fd);
+    if (pack->active_index)
+        g_hash_table_destroy (pack->active_index);
+    g_free (pack->path);
+    g_free (pack->idx_path);
+    g_free (pack);
+}
+
+static int
+pack_load_index (Pack *pack)
+{
+    int fd;
+    SeafStat st;
+    const PackIndexHeader *hdr;
+
+    fd = g_open (pack->idx_path, O_RDONLY | O_BINARY, 0);
+    if (fd < 0) {
+        seaf_warning ("[pack bend] Failed to open %s: %s.\n",
+                      pack->idx_path, strerror(errno));
+        return -1;
+    }
+
+    if (seaf_fstat (fd, &st) < 0 || st.st_size < sizeof(PackIndexHeader)) {
+        seaf_warning ("[pack bend] Invalid pack index %s.\n", pack->idx_path);
+        close (fd);
+        return -1;
+    }
+
+    pack->idx_map = mmap (NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+    close (fd);
+    if (pack->idx_map == MAP_FAILED) {
+        seaf_warning ("[pack bend] Failed to map %s: %s.\n",
+                      pack->idx_path, strerror(errno));
+        pack->idx_map = NULL;
+        return -1;
+    }
+    pack->idx_len = st.st_size;
+
+    hdr = pack->idx_map;
+    pack->n_entries = ntohl (hdr->n_entries);
+    if (ntohl (hdr->magic) != PACK_INDEX_MAGIC ||
+        ntohl (hdr->version) != PACK_INDEX_VERSION ||
+        pack->idx_len != sizeof(PackIndexHeader) +
+                         (gsize)pack->n_entries * sizeof(PackIndexEntry)) {
+        seaf_warning ("[pack bend] Invalid pack index %s.\n", pack->idx_path);
+        munmap (pack->idx_map, pack->idx_len);
+        pack->idx_map = NULL;
+        return -1;
+    }
+
+    pack->idx_hdr = hdr;
+    pack->entries = (const PackIndexEntry *)(hdr + 1);
+
+    return 0;
+}
+
+/* Return the range [*begin, *end) of index entries starting with @byte. */
+static void
+pack_fanout_range (Pack *pack, guint8 byte, guint32 *begin, guint32 *end)
+{
+    *begin = (byte == 0) ? 0 : ntohl (pack->idx_hdr->fanout[byte - 1]);
+    *end = ntohl (pack->idx_hdr->fanout[byte]);
+}
+
+static gboolean
+pack_lookup (Pack *pack, const guint8 *id, guint64 *offset, guint32 *size)
+{
+    ActiveEntry *entry;
+    guint32 lo, hi, mid;
+    int cmp;
+
+    if (pack->active_index) {
+        entry = g_hash_table_lookup (pack->active_index, id);
+        if (!entry)
+            return FALSE;
+        *offset = entry->offset;
+        *size = entry->size;
+        return TRUE;
+    }
+
+    pack_fanout_range (pack, id[0], &lo, &hi);
+    while (lo < hi) {
+        mid = lo + (hi - lo) / 2;
+        cmp = memcmp (pack->entries[mid].id, id, 20);
+        if (cmp == 0) {
+            *offset = ntoh64 (pack->entries[mid].offset);
+            *size = ntohl (pack->entries[mid].size);
+            return TRUE;
+        }
+        if (cmp < 0)
+            lo = mid + 1;
+        else
+            hi = mid;
+    }
+
+    return FALSE;
+}
+
+static void
+active_index_insert (Pack *pack, const guint8 *id, guint64 offset, guint32 size)
+{
+    ActiveEntry *entry = g_new (ActiveEntry, 1);
+
+    memcpy (entry->id, id, 20);
+    entry->offset = offset;
+    entry->size = size;
+    g_hash_table_insert (pack->active_index, entry->id, entry);
+}
+
+/*
+ * Index the records of an unsealed pack from pack->size on. The last
+ * record may still be being written by another process, so scanning stops
+ * at the last complete record. Only a @writer, which holds the store lock,
+ * knows that an incomplete record is left over by a crash and truncates it.
+ */
+static int
+pack_scan (Pack *pack, gboolean writer)
+{
+    PackRecordHeader hdr;
+    SeafStat st;
+    guint64 offset = pack->size;
+    guint32 size;
+
+    if (!pack->active_index)
+        pack->active_index = g_hash_table_new_full (raw_id_hash, raw_id_equal,
+                                                    NULL, g_free);
+
+    if (pack->fd < 0) {
+        pack->fd = g_open (pack->path, O_RDONLY | O_BINARY, 0);
+        if (pack->fd < 0) {
+            seaf_warning ("[pack bend] Failed to open %s: %s.\n",
+                          pack->path, strerror(errno));
+            return -1;
+        }
+    }
+
+    if (seaf_fstat (pack->fd, &st) < 0) {
+        seaf_warning ("[pack bend] Failed to stat %s: %s.\n",
+                      pack->path, strerror(errno));
+        return -1;
+    }
+
+    while (offset + sizeof(hdr) <= st.st_size) {
+        if (pread_all (pack->fd, &hdr, sizeof(hdr), offset) < 0) {
+            seaf_warning ("[pack bend] Failed to read %s: %s.\n",
+                          pack->path, strerror(errno));
+            return -1;
+        }
+        size = ntohl (hdr.size);
+        if (ntohl (hdr.magic) != PACK_RECORD_MAGIC ||
+            offset + sizeof(hdr) + size > st.st_size)
+            break;
+
+        active_index_insert (pack, hdr.id, offset + sizeof(hdr), size);
+        offset += sizeof(hdr) + size;
+    }
+    pack->size = offset;
+
+    if (writer && offset < st.st_size) {
+        seaf_warning ("[pack bend] Truncating broken tail of %s at %"
+                      G_GUINT64_FORMAT".\n", pack->path, offset);
+        if (truncate (pack->path, offset) < 0) {
+            seaf_warning ("[pack bend] Failed to truncate %s: %s.\n",
+                          pack->path, strerror(errno));
+            return -1;
+        }
+    }
+
+    return 0;
+}
+
+/* Switch an unsealed pack to its index file. */
+static void
+pack_drop_active (Pack *pack)
+{
+    if (pack->fd >= 0) {
+        close (pack->fd);
+        pack->fd = -1;
+    }
+    pack->writable = FALSE;
+    if (pack->active_index) {
+        g_hash_table_destroy (pack->active_index);
+        pack->active_index = NULL;
+    }
+}
+
+static int
+compare_index_entries (const void *a, const void *b)
+{
+    return memcmp (((const PackIndexEntry *)a)->id,
+                   ((const PackIndexEntry *)b)->id, 20);
+}
+
+/*
+ * Sync an unsealed pack and write its sorted index file. The pack itself
+ * is not changed, so lookups can go on using the in-memory index.
+ */
+static int
+pack_write_index (Pack *pack)
+{
+    PackIndexHeader hdr;
+    PackIndexEntry *entries, *e;
+    GHashTableIter iter;
+    gpointer key, value;
+    ActiveEntry *entry;
+    guint32 n, i, counts[256] = {0}, total = 0;
+    char *tmp_path;
+    int fd, ret = 0;
+
+    if (fsync (pack->fd) < 0) {
+        seaf_warning ("[pack bend] Failed to sync %s: %s.\n",
+                      pack->path, strerror(errno));
+        return -1;
+    }
+
+    n = g_hash_table_size (pack->active_index);
+    entries = g_new (PackIndexEntry, MAX (n, 1));
+
+    e = entries;
+    g_hash_table_iter_init (&iter, pack->active_index);
+    while (g_hash_table_iter_next (&iter, &key, &value)) {
+        entry = value;
+        memcpy (e->id, entry->id, 20);
+        e->offset = hton64 (entry->offset);
+        e->size = htonl (entry->size);
+        ++counts[entry->id[0]];
+        ++e;
+    }
+    qsort (entries, n, sizeof(PackIndexEntry), compare_index_entries);
+
+    hdr.magic = htonl (PACK_INDEX_MAGIC);
+    hdr.version = htonl (PACK_INDEX_VERSION);
+    hdr.n_entries = htonl (n);
+    for (i = 0; i < 256; ++i) {
+        total += counts[i];
+        hdr.fanout[i] = htonl (total);
+    }
+
+    tmp_path = g_strconcat (pack->idx_path, ".tmp", NULL);
+    fd = g_open (tmp_path, O_WRONLY | O_CREAT | O_TRUNC | O_BINARY, 0666);
+    if (fd < 0) {
+        seaf_warning ("[pack bend] Failed to open %s: %s.\n",
+                      tmp_path, strerror(errno));
+        ret = -1;
+        goto out;
+    }
+
+    if (writen (fd, &hdr, sizeof(hdr)) != sizeof(hdr) ||
+        writen (fd, entries, n * sizeof(PackIndexEntry)) != n * sizeof(PackIndexEntry) ||
+        fsync (fd) < 0) {
+        seaf_warning ("[pack bend] Failed to write %s: %s.\n",
+                      tmp_path, strerror(errno));
+        close (fd);
+        g_unlink (tmp_path);
+        ret = -1;
+        goto out;
+    }
+    close (fd);
+
+    if (g_rename (tmp_path, pack->idx_path) < 0) {
+        seaf_warning ("[pack bend] Failed to rename %s: %s.\n",
+                      tmp_path, strerror(errno));
+        g_unlink (tmp_path);
+        ret = -1;
+    }
+
+out:
+    g_free (tmp_path);
+    g_free (entries);
+    return ret;
+}
+
+/* Stores. */
+
+static void
+pack_store_free (PackStore *store)
+{
+    if (store->active)
+        pack_free (store->active);
+    g_list_foreach (store->sealed, (GFunc)pack_free, NULL);
+    g_list_free (store->sealed);
+    g_hash_table_destroy (store->deleted);
+    if (store->journal_fd >= 0)
+        close (store->journal_fd);
+    if (store->lock_fd >= 0)
+        close (store->lock_fd);
+    pthread_mutex_destroy (&store->lock);
+    pthread_mutex_destroy (&store->write_lock);
+    g_free (store->store_id);
+    g_free (store->dir);
+    g_free (store);
+}
+
+/*
+ * Apply the journal records appended since the last read. Compaction
+ * replaces the journal, in which case it's read again from the start.
+ */
+static int
+store_read_journal (PackStore *store)
+{
+    char *path;
+    SeafStat st;
+    guint64 len, i;
+    char *buf;
+    JournalRecord *rec;
+    guint8 *id;
+    int fd, ret = 0;
+
+    path = g_build_filename (store->dir, "deleted", NULL);
+
+    if (seaf_stat (path, &st) < 0) {
+        if (errno != ENOENT) {
+            seaf_warning ("[pack bend] Failed to stat %s: %s.\n",
+                          path, strerror(errno));
+            g_free (path);
+            return -1;
+        }
+        st.st_ino = 0;
+        st.st_size = 0;
+    }
+
+    if ((guint64)st.st_ino != store->journal_ino ||
+        (guint64)st.st_size < store->journal_len) {
+        g_hash_table_remove_all (store->deleted);
+        store->journal_len = 0;
+        store->journal_ino = st.st_ino;
+        /* Appends must go to the new journal. */
+        if (store->journal_fd >= 0) {
+            close (store->journal_fd);
+            store->journal_fd = -1;
+        }
+    }
+
+    /* A partial record at the end is ignored. */
+    len = (st.st_size - store->journal_len) / sizeof(JournalRecord) *
+          sizeof(JournalRecord);
+    if (len == 0) {
+        g_free (path);
+        return 0;
+    }
+
+    fd = g_open (path, O_RDONLY | O_BINARY, 0);
+    if (fd < 0) {
+        seaf_warning ("[pack bend] Failed to open %s: %s.\n",
+                      path, strerror(errno));
+        g_free (path);
+        return -1;
+    }
+
+    buf = g_malloc (len);
+    if (pread_all (fd, buf, len, store->journal_len) < 0) {
+        seaf_warning ("[pack bend] Failed to read %s: %s.\n",
+                      path, strerror(errno));
+        ret = -1;
+        goto out;
+    }
+
+    for (i = 0; i < len; i += sizeof(JournalRecord)) {
+        rec = (JournalRecord *)(buf + i);
+        if (rec->op == JOURNAL_OP_DELETE) {
+            id = g_memdup (rec->id, 20);
+            g_hash_table_replace (store->deleted, id, GINT_TO_POINTER(1));
+        } else if (rec->op == JOURNAL_OP_UNDELETE) {
+            g_hash_table_remove (store->deleted, rec->id);
+        }
+    }
+    store->journal_len += len;
+
+out:
+    close (fd);
+    g_free (buf);
+    g_free (path);
+    return ret;
+}
+
+static int
+append_journal (PackStore *store, guint8 op, const guint8 *id)
+{
+    JournalRecord rec;
+    char *path;
+
+    if (store->journal_fd < 0) {
+        path = g_build_filename (store->dir, "deleted", NULL);
+        store->journal_fd = g_open (path, O_WRONLY | O_CREAT | O_APPEND | O_BINARY,
+                                    0666);
+        if (store->journal_fd < 0) {
+            seaf_warning ("[pack bend] Failed to open %s: %s.\n",
+                          path, strerror(errno));
+            g_free (path);
+            return -1;
+        }
+        g_free (path);
+    }
+
+    rec.op = op;
+    memcpy (rec.id, id, 20);
+    if (writen (store->journal_fd, &rec, sizeof(rec)) != sizeof(rec)) {
+        seaf_warning ("[pack bend] Failed to write journal of store %s: %s.\n",
+                      store->store_id, strerror(errno));
+        return -1;
+    }
+
+    return 0;
+}
+
+static gint
+compare_pack_no (gconstpointer a, gconstpointer b)
+{
+    guint32 x = GPOINTER_TO_UINT(a), y = GPOINTER_TO_UINT(b);
+
+    return (x < y) ? -1 : (x > y);
+}
+
+/* Return the sorted numbers of the pack files in @dir_path. */
+static GList *
+list_pack_nos (const char *dir_path)
+{
+    GDir *dir;
+    const char *dname;
+    unsigned int pack_no;
+    char suffix[8];
+    GList *pack_nos = NULL;
+
+    dir = g_dir_open (dir_path, 0, NULL);
+    if (!dir)
+        return NULL;
+    while ((dname = g_dir_read_name (dir)) != NULL) {
+        if (sscanf (dname, "pack-%8x.%3s", &pack_no, suffix) == 2 &&
+            strcmp (suffix, "dat") == 0)
+            pack_nos = g_list_prepend (pack_nos, GUINT_TO_POINTER(pack_no));
+    }
+    g_dir_close (dir);
+
+    return g_list_sort (pack_nos, compare_pack_no);
+}
+
+static Pack *
+take_pack (GList **packs, guint32 pack_no)
+{
+    GList *ptr;
+    Pack *pack;
+
+    for (ptr = *packs; ptr; ptr = ptr->next) {
+        pack = ptr->data;
+        if (pack->pack_no == pack_no) {
+            *packs = g_list_delete_link (*packs, ptr);
+            return pack;
+        }
+    }
+
+    return NULL;
+}
+
+static int store_seal_pack (PackStore *store, Pack *pack);
+
+/*
+ * Bring the store up to date with its pack files and journal, which other
+ * processes may have changed. Must be called with write_lock held. A
+ * @writer also holds the flock of the store, and seals packs left
+ * unsealed by a crash.
+ */
+static int
+store_refresh (PackStore *store, gboolean writer)
+{
+    GList *pack_nos, *old, *packs = NULL, *ptr, *unsealed = NULL;
+    Pack *pack;
+    int ret = 0;
+
+    pack_nos = list_pack_nos (store->dir);
+
+    pthread_mutex_lock (&store->lock);
+
+    old = g_list_copy (store->sealed);
+    if (store->active)
+        old = g_list_prepend (old, store->active);
+
+    for (ptr = pack_nos; ptr; ptr = ptr->next) {
+        pack = take_pack (&old, GPOINTER_TO_UINT(ptr->data));
+        if (!pack)
+            pack = pack_new (store, GPOINTER_TO_UINT(ptr->data));
+        store->next_pack_no = MAX (store->next_pack_no, pack->pack_no + 1);
+
+        if (!pack->idx_map &&
+            g_file_test (pack->idx_path, G_FILE_TEST_EXISTS) &&
+            pack_load_index (pack) == 0)
+            pack_drop_active (pack);
+
+        if (!pack->idx_map && pack_scan (pack, writer) < 0)
+            ret = -1;
+
+        packs = g_list_prepend (packs, pack);
+    }
+
+    /* Packs removed by compaction. */
+    g_list_foreach (old, (GFunc)pack_free, NULL);
+    g_list_free (old);
+
+    store->active = NULL;
+    if (packs && !((Pack *)packs->data)->idx_map) {
+        store->active = packs->data;
+        packs = g_list_delete_link (packs, packs);
+    }
+    g_list_free (store->sealed);
+    store->sealed = packs;
+
+    if (store_read_journal (store) < 0)
+        ret = -1;
+
+    store->last_refresh = get_current_time ();
+
+    if (writer) {
+        for (ptr = store->sealed; ptr; ptr = ptr->next) {
+            pack = ptr->data;
+            if (!pack->idx_map)
+                unsealed = g_list_prepend (unsealed, pack);
+        }
+    }
+
+    pthread_mutex_unlock (&store->lock);
+
+    for (ptr = unsealed; ptr; ptr = ptr->next) {
+        if (store_seal_pack (store, ptr->data) < 0)
+            ret = -1;
+    }
+
+    g_list_free (unsealed);
+    g_list_free (pack_nos);
+    return ret;
+}
+
+static PackStore *
+pack_store_load (PackPriv *priv, const char *store_id, gboolean create)
+{
+    PackStore *store;
+
+    store = g_new0 (PackStore, 1);
+    store->store_id = g_strdup (store_id);
+    store->dir = g_build_filename (priv->pack_dir, store_id, NULL);
+    store->deleted = g_hash_table_new_full (raw_id_hash, raw_id_equal,
+                                            g_free, NULL);
+    store->journal_fd = -1;
+    store->lock_fd = -1;
+    pthread_mutex_init (&store->lock, NULL);
+    pthread_mutex_init (&store->write_lock, NULL);
+
+    /* The store dir is created by the first write. */
+    if (!create && !g_file_test (store->dir, G_FILE_TEST_IS_DIR))
+        goto error;
+
+    /* Nobody else has the store yet, so write_lock is not needed. */
+    if (store_refresh (store, FALSE) < 0)
+        goto error;
+
+    return store;
+
+error:
+    pack_store_free (store);
+    return NULL;
+}
+
+/* Stores are loaded without holding priv->lock, and never freed before
+ * the backend, so callers can keep using them after releasing it.
+ */
+static PackStore *
+get_store (PackPriv *priv, const char *store_id, gboolean create)
+{
+    PackStore *store, *loaded;
+
+    pthread_mutex_lock (&priv->lock);
+    store = g_hash_table_lookup (priv->stores, store_id);
+    pthread_mutex_unlock (&priv->lock);
+    if (store)
+        return store;
+
+    loaded = pack_store_load (priv, store_id, create);
+    if (!loaded)
+        return NULL;
+
+    pthread_mutex_lock (&priv->lock);
+    store = g_hash_table_lookup (priv->stores, store_id);
+    if (!store) {
+        g_hash_table_insert (priv->stores, loaded->store_id, loaded);
+        store = loaded;
+        loaded = NULL;
+    }
+    pthread_mutex_unlock (&priv->lock);
+
+    if (loaded)
+        pack_store_free (loaded);
+    return store;
+}
+
+/*
+ * Seal @pack, which must be unsealed, with write_lock held. The pack is
+ * synced and its index written without holding lock, so lookups are not
+ * blocked by the fsyncs.
+ */
+static int
+store_seal_pack (PackStore *store, Pack *pack)
+{
+    int ret = 0;
+
+    if (pack_write_index (pack) < 0)
+        return -1;
+
+    pthread_mutex_lock (&store->lock);
+    if (pack_load_index (pack) < 0) {
+        ret = -1;
+    } else {
+        pack_drop_active (pack);
+        if (store->active == pack) {
+            store->sealed = g_list_prepend (store->sealed, pack);
+            store->active = NULL;
+        }
+    }
+    pthread_mutex_unlock (&store->lock);
+
+    return ret;
+}
+
+/*
+ * Become the writer of a store: take write_lock and the flock of the
+ * store, then pick up changes made by other processes.
+ */
+static int
+store_lock_writer (PackStore *store)
+{
+    char *path;
+
+    pthread_mutex_lock (&store->write_lock);
+
+    if (store->lock_fd < 0) {
+        if (g_mkdir_with_parents (store->dir, 0777) < 0) {
+            seaf_warning ("[pack bend] Failed to create %s: %s.\n",
+                          store->dir, strerror(errno));
+            goto error;
+        }
+        path = g_build_filename (store->dir, "lock", NULL);
+        store->lock_fd = g_open (path, O_RDWR | O_CREAT | O_BINARY, 0666);
+        if (store->lock_fd < 0) {
+            seaf_warning ("[pack bend] Failed to open %s: %s.\n",
+                          path, strerror(errno));
+            g_free (path);
+            goto error;
+        }
+        g_free (path);
+    }
+
+    while (flock (store->lock_fd, LOCK_EX) < 0) {
+        if (errno != EINTR) {
+            seaf_warning ("[pack bend] Failed to lock store %s: %s.\n",
+                          store->store_id, strerror(errno));
+            goto error;
+        }
+    }
+
+    if (store_refresh (store, TRUE) < 0) {
+        flock (store->lock_fd, LOCK_UN);
+        goto error;
+    }
+
+    return 0;
+
+error:
+    pthread_mutex_unlock (&store->write_lock);
+    return -1;
+}
+
+static void
+store_unlock_writer (PackStore *store)
+{
+    if (store->lock_fd >= 0)
+        flock (store->lock_fd, LOCK_UN);
+    pthread_mutex_unlock (&store->write_lock);
+}
+
+/*
+ * Reload a store that this process only reads, at most once per
+ * STORE_REFRESH_INTERVAL unless @force is set. Returns TRUE if it was
+ * reloaded.
+ */
+static gboolean
+store_maybe_refresh (PackStore *store, gboolean force)
+{
+    gboolean refreshed = FALSE;
+    gint64 now;
+
+    /* A writer in this process is bringing the store up to date anyway. */
+    if (pthread_mutex_trylock (&store->write_lock) != 0)
+        return FALSE;
+
+    now = get_current_time ();
+    if (force || now < store->last_refresh ||
+        now - store->last_refresh >= STORE_REFRESH_INTERVAL) {
+        store_refresh (store, FALSE);
+        refreshed = TRUE;
+    }
+
+    pthread_mutex_unlock (&store->write_lock);
+    return refreshed;
+}
+
+/* Look up a live block. If @pack is not NULL, it's set to the pack
+ * containing the block.
+ */
+static gboolean
+store_lookup (PackStore *store, const guint8 *id,
+              Pack **pack, guint64 *offset, guint32 *size)
+{
+    GList *ptr;
+    Pack *p;
+    guint64 off;
+    guint32 sz;
+
+    if (g_hash_table_lookup (store->deleted, id))
+        return FALSE;
+
+    if (store->active && pack_lookup (store->active, id, &off, &sz)) {
+        p = store->active;
+        goto found;
+    }
+
+    for (ptr = store->sealed; ptr; ptr = ptr->next) {
+        p = ptr->data;
+        if (pack_lookup (p, id, &off, &sz))
+            goto found;
+    }
+
+    return FALSE;
+
+found:
+    if (pack)
+        *pack = p;
+    if (offset)
+        *offset = off;
+    if (size)
+        *size = sz;
+    return TRUE;
+}
+
+/*
+ * Look up a live block with lock held, reloading the store on a miss.
+ * If @path is not NULL, it's set to the path of the pack containing it.
+ */
+static gboolean
+store_find (PackStore *store, const guint8 *id,
+            char **path, guint64 *offset, guint32 *size)
+{
+    Pack *pack;
+    gboolean found;
+
+    while (1) {
+        pthread_mutex_lock (&store->lock);
+        found = store_lookup (store, id, &pack, offset, size);
+        if (found && path)
+            *path = g_strdup (pack->path);
+        pthread_mutex_unlock (&store->lock);
+
+        if (found || !store_maybe_refresh (store, FALSE))
+            break;
+    }
+
+    return found;
+}
+
+/* Append a block to the active pack. Must be called as the writer. */
+static int
+store_append (PackPriv *priv, PackStore *store,
+              const guint8 *id, const void *data, guint32 len)
+{
+    PackRecordHeader *hdr;
+    Pack *pack;
+    guint64 offset;
+    char *buf;
+    int fd;
+
+    if (!store->active) {
+        pack = pack_new (store, store->next_pack_no);
+        pack->fd = g_open (pack->path, O_RDWR | O_CREAT | O_EXCL | O_BINARY, 0666);
+        if (pack->fd < 0) {
+            seaf_warning ("[pack bend] Failed to create %s: %s.\n",
+                          pack->path, strerror(errno));
+            pack_free (pack);
+            return -1;
+        }
+        pack->writable = TRUE;
+        pack->active_index = g_hash_table_new_full (raw_id_hash, raw_id_equal,
+                                                    NULL, g_free);
+        ++store->next_pack_no;
+
+        pthread_mutex_lock (&store->lock);
+        store->active = pack;
+        pthread_mutex_unlock (&store->lock);
+    }
+    pack = store->active;
+
+    /* The pack was opened read only when it was found by a refresh. */
+    if (!pack->writable) {
+        fd = g_open (pack->path, O_RDWR | O_BINARY, 0);
+        if (fd < 0) {
+            seaf_warning ("[pack bend] Failed to open %s: %s.\n",
+                          pack->path, strerror(errno));
+            return -1;
+        }
+        close (pack->fd);
+        pack->fd = fd;
+        pack->writable = TRUE;
+    }
+
+    /* Write the record with one call, so that its header never shows up
+     * without its data.
+     */
+    buf = g_malloc (sizeof(PackRecordHeader) + len);
+    hdr = (PackRecordHeader *)buf;
+    hdr->magic = htonl (PACK_RECORD_MAGIC);
+    memcpy (hdr->id, id, 20);
+    hdr->size = htonl (len);
+    memcpy (buf + sizeof(PackRecordHeader), data, len);
+
+    offset = pack->size;
+    if (pwrite_all (pack->fd, buf, sizeof(PackRecordHeader) + len, offset) < 0) {
+        seaf_warning ("[pack bend] Failed to write %s: %s.\n",
+                      pack->path, strerror(errno));
+        if (ftruncate (pack->fd, offset) < 0)
+            seaf_warning ("[pack bend] Failed to truncate %s: %s.\n",
+                          pack->path, strerror(errno));
+        g_free (buf);
+        return -1;
+    }
+    g_free (buf);
+
+    pthread_mutex_lock (&store->lock);
+    active_index_insert (pack, id, offset + sizeof(PackRecordHeader), len);
+    pack->size = offset + sizeof(PackRecordHeader) + len;
+    pthread_mutex_unlock (&store->lock);
+
+    /* If sealing fails, the pack is still usable as the active pack. */
+    if (pack->size >= priv->pack_size)
+        store_seal_pack (store, pack);
+
+    return 0;
+}
+
+static int
+store_put_block (PackPriv *priv, const char *store_id,
+                 const guint8 *id, const void *data, guint32 len)
+{
+    PackStore *store;
+    int ret = 0;
+
+    store = get_store (priv, store_id, TRUE);
+    if (!store)
+        return -1;
+
+    if (store_lock_writer (store) < 0)
+        return -1;
+
+    /* A removed block is still in its pack until compaction. */
+    if (g_hash_table_lookup (store->deleted, id)) {
+        if (append_journal (store, JOURNAL_OP_UNDELETE, id) < 0) {
+            ret = -1;
+        } else {
+            pthread_mutex_lock (&store->lock);
+            g_hash_table_remove (store->deleted, id);
+            pthread_mutex_unlock (&store->lock);
+        }
+        goto out;
+    }
+
+    if (store_lookup (store, id, NULL, NULL, NULL))
+        goto out;
+
+    ret = store_append (priv, store, id, data, len);
+
+out:
+    store_unlock_writer (store);
+    return ret;
+}
+
+/* Find a live block and open its pack file for read. */
+static int
+open_block_for_read (PackPriv *priv, const char *store_id, const char *block_id,
+                     guint64 *offset, guint32 *size)
+{
+    PackStore *store;
+    guint8 id[20];
+    char *path = NULL;
+    int fd;
+
+    if (hex_to_rawdata (block_id, id, 20) < 0)
+        return -1;
+
+    store = get_store (priv, store_id, FALSE);
+    if (!store || !store_find (store, id, &path, offset, size))
+        return -1;
+
+    fd = g_open (path, O_RDONLY | O_BINARY, 0);
+    /* The pack may have been removed by compaction in another process. */
+    if (fd < 0 && errno == ENOENT) {
+        g_free (path);
+        path = NULL;
+        store_maybe_refresh (store, TRUE);
+        if (!store_find (store, id, &path, offset, size))
+            return -1;
+        fd = g_open (path, O_RDONLY | O_BINARY, 0);
+    }
+    if (fd < 0)
+        seaf_warning ("[pack bend] Failed to open %s: %s.\n", path, strerror(errno));
+    g_free (path);
+
+    return fd;
+}
+
+/* Blocks stored by the fs backend. */
+
+static gboolean
+legacy_exists (PackPriv *priv, const char *store_id, int version,
+               const char *block_id)
+{
+    return (priv->legacy != NULL &&
+            priv->legacy->exists (priv->legacy, store_id, version, block_id));
+}
+
+static int
+read_legacy_block (PackPriv *priv, const char *store_id, int version,
+                   const char *block_id, void **data, guint32 *size)
+{
+    BlockBackend *legacy = priv->legacy;
+    BHandle *handle;
+    BMetadata *md;
+    int n, ret = 0;
+
+    if (!legacy)
+        return -1;
+
+    handle = legacy->open_block (legacy, store_id, version, block_id, BLOCK_READ);
+    if (!handle)
+        return -1;
+
+    md = legacy->stat_block_by_handle (legacy, handle);
+    if (!md) {
+        ret = -1;
+        goto out;
+    }
+    *size = md->size;
+    g_free (md);
+
+    *data = g_malloc (MAX (*size, 1));
+    n = legacy->read_block (legacy, handle, *data, *size);
+    if (n != (int)*size) {
+        seaf_warning ("[pack bend] Failed to read fs block %s.\n", block_id);
+        g_free (*data);
+        *data = NULL;
+        ret = -1;
+    }
+
+out:
+    legacy->close_block (legacy, handle);
+    legacy->block_handle_free (legacy, handle);
+    return ret;
+}
+
+/* BlockBackend interface. */
+
+static BHandle *
+block_backend_pack_open_block (BlockBackend *bend,
+                               const char *store_id,
+                               int version,
+                               const char *block_id,
+                               int rw_type)
+{
+    PackPriv *priv = bend->be_priv;
+    BHandle *handle;
+
+    g_return_val_if_fail (block_id != NULL, NULL);
+    g_return_val_if_fail (strlen(block_id) == 40, NULL);
+    g_return_val_if_fail (rw_type == BLOCK_READ || rw_type == BLOCK_WRITE, NULL);
+
+    handle = g_new0 (BHandle, 1);
+    handle->fd = -1;
+
+    if (rw_type == BLOCK_READ) {
+        handle->fd = open_block_for_read (priv, store_id, block_id,
+                                          &handle->offset, &handle->size);
+        if (handle->fd < 0 && priv->legacy)
+            handle->legacy = priv->legacy->open_block (priv->legacy,
+                                                       store_id, version,
+                                                       block_id, BLOCK_READ);
+        if (handle->fd < 0 && !handle->legacy) {
+            seaf_warning ("[pack bend] failed to open block %s for read.\n",
+                          block_id);
+            g_free (handle);
+            return NULL;
+        }
+    } else {
+        handle->buf = g_byte_array_new ();
+    }
+
+    memcpy (handle->block_id, block_id, 41);
+    handle->rw_type = rw_type;
+    handle->store_id = g_strdup (store_id);
+    handle->version = version;
+
+    return handle;
+}
+
+static int
+block_backend_pack_read_block (BlockBackend *bend,
+                               BHandle *handle,
+                               void *buf, int len)
+{
+    PackPriv *priv = bend->be_priv;
+    guint32 n;
+
+    if (handle->legacy)
+        return priv->legacy->read_block (priv->legacy, handle->legacy, buf, len);
+
+    n = MIN ((guint32)len, handle->size - handle->pos);
+    if (n == 0)
+        return 0;
+
+    if (pread_all (handle->fd, buf, n, handle->offset + handle->pos) < 0) {
+        seaf_warning ("[pack bend] Failed to read block %s: %s.\n",
+                      handle->block_id, strerror(errno));
+        return -1;
+    }
+    handle->pos += n;
+
+    return n;
+}
+
+static int
+block_backend_pack_write_block (BlockBackend *bend,
+                                BHandle *handle,
+                                const void *buf, int len)
+{
+    g_byte_array_append (handle->buf, buf, len);
+    return len;
+}
+
+static int
+block_backend_pack_commit_block (BlockBackend *bend,
+                                 BHandle *handle)
+{
+    PackPriv *priv = bend->be_priv;
+    guint8 id[20];
+
+    g_return_val_if_fail (handle->rw_type == BLOCK_WRITE, -1);
+
+    hex_to_rawdata (handle->block_id, id, 20);
+
+    if (store_put_block (priv, handle->store_id, id,
+                         handle->buf->data, handle->buf->len) < 0) {
+        seaf_warning ("[pack bend] failed to commit block %s.\n",
+                      handle->block_id);
+        return -1;
+    }
+
+    return 0;
+}
+
+static int
+block_backend_pack_close_block (BlockBackend *bend,
+                                BHandle *handle)
+{
+    PackPriv *priv = bend->be_priv;
+    int ret = 0;
+
+    if (handle->legacy)
+        return priv->legacy->close_block (priv->legacy, handle->legacy);
+
+    if (handle->fd >= 0) {
+        ret = close (handle->fd);
+        handle->fd = -1;
+    }
+
+    return ret;
+}
+
+static void
+block_backend_pack_block_handle_free (BlockBackend *bend,
+                                      BHandle *handle)
+{
+    PackPriv *priv = bend->be_priv;
+
+    if (handle->legacy)
+        priv->legacy->block_handle_free (priv->legacy, handle->legacy);
+    if (handle->fd >= 0)
+        close (handle->fd);
+    if (handle->buf)
+        g_byte_array_free (handle->buf, TRUE);
+    g_free (handle->store_id);
+    g_free (handle);
+}
+
+static gboolean
+block_backend_pack_block_exists (BlockBackend *bend,
+                                 const char *store_id,
+                                 int version,
+                                 const char *block_sha1)
+{
+    PackPriv *priv = bend->be_priv;
+    PackStore *store;
+    guint8 id[20];
+    gboolean ret = FALSE;
+
+    if (hex_to_rawdata (block_sha1, id, 20) < 0)
+        return FALSE;
+
+    store = get_store (priv, store_id, FALSE);
+    if (store)
+        ret = store_find (store, id, NULL, NULL, NULL);
+
+    if (!ret)
+        ret = legacy_exists (priv, store_id, version, block_sha1);
+
+    return ret;
+}
+
+static int
+block_backend_pack_blocks_exist (BlockBackend *bend,
+                                 const char *store_id,
+                                 int version,
+                                 const guint8 *ids,
+                                 int n,
+                                 gboolean *exists)
+{
+    PackPriv *priv = bend->be_priv;
+    PackStore *store;
+    char block_id[41];
+    gboolean missing = FALSE;
+    int i;
+
+    store = get_store (priv, store_id, FALSE);
+    for (i = 0; i < n; ++i)
+        exists[i] = FALSE;
+
+    /* Look up all ids under one lock, and reload the store at most once. */
+    if (store) {
+        pthread_mutex_lock (&store->lock);
+        for (i = 0; i < n; ++i) {
+            exists[i] = store_lookup (store, ids + i * 20, NULL, NULL, NULL);
+            missing = missing || !exists[i];
+        }
+        pthread_mutex_unlock (&store->lock);
+
+        if (missing && store_maybe_refresh (store, FALSE)) {
+            pthread_mutex_lock (&store->lock);
+            for (i = 0; i < n; ++i) {
+                if (!exists[i])
+                    exists[i] = store_lookup (store, ids + i * 20,
+                                              NULL, NULL, NULL);
+            }
+            pthread_mutex_unlock (&store->lock);
+        }
+    }
+
+    if (!priv->legacy)
+        return 0;
+
+    for (i = 0; i < n; ++i) {
+        if (exists[i])
+            continue;
+        rawdata_to_hex (ids + i * 20, block_id, 20);
+        exists[i] = legacy_exists (priv, store_id, version, block_id);
+    }
+
+    return 0;
+}
+
+static int
+block_backend_pack_remove_block (BlockBackend *bend,
+                                 const char *store_id,
+                                 int version,
+                                 const char *block_id)
+{
+    PackPriv *priv = bend->be_priv;
+    PackStore *store;
+    guint8 id[20];
+    gboolean found = FALSE;
+    int ret = -1;
+
+    if (hex_to_rawdata (block_id, id, 20) < 0)
+        return -1;
+
+    store = get_store (priv, store_id, FALSE);
+    if (store && store_lock_writer (store) == 0) {
+        if (store_lookup (store, id, NULL, NULL, NULL)) {
+            found = TRUE;
+            if (append_journal (store, JOURNAL_OP_DELETE, id) == 0) {
+                pthread_mutex_lock (&store->lock);
+                g_hash_table_insert (store->deleted, g_memdup (id, 20),
+                                     GINT_TO_POINTER(1));
+                pthread_mutex_unlock (&store->lock);
+                ret = 0;
+            }
+        }
+        store_unlock_writer (store);
+    }
+
+    if (!found && legacy_exists (priv, store_id, version, block_id))
+        ret = priv->legacy->remove_block (priv->legacy, store_id,
+                                          version, block_id);
+
+    return ret;
+}
+
+static BMetadata *
+block_backend_pack_stat_block (BlockBackend *bend,
+                               const char *store_id,
+                               int version,
+                               const char *block_id)
+{
+    PackPriv *priv = bend->be_priv;
+    PackStore *store;
+    guint8 id[20];
+    guint32 size;
+    gboolean found = FALSE;
+    BMetadata *block_md;
+
+    if (hex_to_rawdata (block_id, id, 20) < 0)
+        return NULL;
+
+    store = get_store (priv, store_id, FALSE);
+    if (store)
+        found = store_find (store, id, NULL, NULL, &size);
+
+    if (!found) {
+        if (priv->legacy)
+            return priv->legacy->stat_block (priv->legacy, store_id,
+                                             version, block_id);
+        seaf_warning ("[pack bend] Failed to stat block %s.\n", block_id);
+        return NULL;
+    }
+
+    block_md = g_new0 (BMetadata, 1);
+    memcpy (block_md->id, block_id, 40);
+    block_md->size = size;
+
+    return block_md;
+}
+
+static BMetadata *
+block_backend_pack_stat_block_by_handle (BlockBackend *bend,
+                                         BHandle *handle)
+{
+    PackPriv *priv = bend->be_priv;
+    BMetadata *block_md;
+
+    if (handle->legacy)
+        return priv->legacy->stat_block_by_handle (priv->legacy, handle->legacy);
+
+    block_md = g_new0 (BMetadata, 1);
+    memcpy (block_md->id, handle->block_id, 40);
+    if (handle->rw_type == BLOCK_READ)
+        block_md->size = handle->size;
+    else
+        block_md->size = handle->buf->len;
+
+    return block_md;
+}
+
+static int
+block_backend_pack_open_block_fd (BlockBackend *bend,
+                                  const char *store_id,
+                                  int version,
+                                  const char *block_id,
+                                  gint64 *offset,
+                                  gint64 *size)
+{
+    PackPriv *priv = bend->be_priv;
+    guint64 off;
+    guint32 len;
+    int fd;
+
+    fd = open_block_for_read (priv, store_id, block_id, &off, &len);
+    if (fd < 0 && legacy_exists (priv, store_id, version, block_id))
+        return priv->legacy->open_block_fd (priv->legacy, store_id, version,
+                                            block_id, offset, size);
+    if (fd < 0) {
+        seaf_warning ("[pack bend] failed to open block %s for read.\n",
+                      block_id);
+        return -1;
+    }
+
+    *offset = (gint64)off;
+    *size = len;
+
+    return fd;
+}
+
+typedef struct LegacyForeachData {
+    PackPriv *priv;
+    SeafBlockFunc process;
+    void *user_data;
+} LegacyForeachData;
+
+/* Skip fs blocks that have been copied to a pack. */
+static gboolean
+legacy_foreach_cb (const char *store_id, int version,
+                   const char *block_id, void *vdata)
+{
+    LegacyForeachData *data = vdata;
+    PackStore *store;
+    guint8 id[20];
+    gboolean in_pack = FALSE;
+
+    if (hex_to_rawdata (block_id, id, 20) < 0)
+        return TRUE;
+
+    store = get_store (data->priv, store_id, FALSE);
+    if (store) {
+        pthread_mutex_lock (&store->lock);
+        in_pack = store_lookup (store, id, NULL, NULL, NULL);
+        pthread_mutex_unlock (&store->lock);
+    }
+
+    if (in_pack)
+        return TRUE;
+
+    return data->process (store_id, version, block_id, data->user_data);
+}
+
+/* Append the live ids of @pack starting with @byte to @ids. */
+static void
+pack_collect_ids (PackStore *store, Pack *pack, guint8 byte, GArray *ids)
+{
+    GHashTableIter iter;
+    gpointer key, value;
+    guint32 begin, end, i;
+    const guint8 *id;
+
+    if (pack->active_index) {
+        g_hash_table_iter_init (&iter, pack->active_index);
+        while (g_hash_table_iter_next (&iter, &key, &value)) {
+            id = key;
+            if (id[0] == byte && !g_hash_table_lookup (store->deleted, id))
+                g_array_append_vals (ids, id, 1);
+        }
+        return;
+    }
+
+    pack_fanout_range (pack, byte, &begin, &end);
+    for (i = begin; i < end; ++i) {
+        id = pack->entries[i].id;
+        if (!g_hash_table_lookup (store->deleted, id))
+            g_array_append_vals (ids, id, 1);
+    }
+}
+
+/*
+ * Ids are copied out under the lock and processed after releasing it,
+ * so that @process can call into the backend, e.g. to remove blocks.
+ */
+static int
+block_backend_pack_foreach_block_with_prefix (BlockBackend *bend,
+                                              const char *store_id,
+                                              int version,
+                                              const char *prefix,
+                                              SeafBlockFunc process,
+                                              void *user_data)
+{
+    PackPriv *priv = bend->be_priv;
+    PackStore *store;
+    GArray *ids;
+    GList *ptr;
+    guint8 byte;
+    guint32 i;
+    char block_id[41];
+    gboolean stopped;
+
+    if (hex_to_rawdata (prefix, &byte, 1) < 0)
+        return -1;
+
+    ids = g_array_new (FALSE, FALSE, 20);
+
+    store = get_store (priv, store_id, FALSE);
+    if (store) {
+        store_maybe_refresh (store, FALSE);
+
+        pthread_mutex_lock (&store->lock);
+        if (store->active)
+            pack_collect_ids (store, store->active, byte, ids);
+        for (ptr = store->sealed; ptr; ptr = ptr->next)
+            pack_collect_ids (store, ptr->data, byte, ids);
+        pthread_mutex_unlock (&store->lock);
+    }
+
+    for (i = 0; i < ids->len; ++i) {
+        rawdata_to_hex ((guint8 *)ids->data + i * 20, block_id, 20);
+        if (!process (store_id, version, block_id, user_data))
+            break;
+    }
+    stopped = (i < ids->len);
+
+    g_array_free (ids, TRUE);
+
+    if (!stopped && priv->legacy) {
+        LegacyForeachData data;
+
+        data.priv = priv;
+        data.process = process;
+        data.user_data = user_data;
+        return priv->legacy->foreach_block_with_prefix (priv->legacy,
+                                                        store_id, version,
+                                                        prefix,
+                                                        legacy_foreach_cb,
+                                                        &data);
+    }
+
+    return 0;
+}
+
+typedef struct ForeachData {
+    SeafBlockFunc process;
+    void *user_data;
+    gboolean stopped;
+} ForeachData;
+
+static gboolean
+foreach_block_cb (const char *store_id, int version,
+                  const char *block_id, void *vdata)
+{
+    ForeachData *data = vdata;
+
+    if (!data->process (store_id, version, block_id, data->user_data)) {
+        data->stopped = TRUE;
+        return FALSE;
+    }
+    return TRUE;
+}
+
+static int
+block_backend_pack_foreach_block (BlockBackend *bend,
+                                  const char *store_id,
+                                  int version,
+                                  SeafBlockFunc process,
+                                  void *user_data)
+{
+    ForeachData data;
+    char prefix[3];
+    int i;
+
+    data.process = process;
+    data.user_data = user_data;
+    data.stopped = FALSE;
+
+    /* Go through blocks one prefix at a time to bound memory usage. */
+    for (i = 0; i < 256 && !data.stopped; ++i) {
+        snprintf (prefix, sizeof(prefix), "%02x", i);
+        if (block_backend_pack_foreach_block_with_prefix (bend, store_id, version,
+                                                          prefix, foreach_block_cb,
+                                                          &data) < 0)
+            return -1;
+    }
+
+    return 0;
+}
+
+static int
+block_backend_pack_copy (BlockBackend *bend,
+                         const char *src_store_id,
+                         int src_version,
+                         const char *dst_store_id,
+                         int dst_version,
+                         const char *block_id)
+{
+    PackPriv *priv = bend->be_priv;
+    guint64 offset;
+    guint32 size;
+    guint8 id[20];
+    void *data;
+    int fd, ret;
+
+    hex_to_rawdata (block_id, id, 20);
+
+    fd = open_block_for_read (priv, src_store_id, block_id, &offset, &size);
+    if (fd < 0 && read_legacy_block (priv, src_store_id, src_version,
+                                     block_id, &data, &size) == 0) {
+        ret = store_put_block (priv, dst_store_id, id, data, size);
+        g_free (data);
+        return ret;
+    }
+    if (fd < 0) {
+        seaf_warning ("[pack bend] Failed to open block %s in store %s.\n",
+                      block_id, src_store_id);
+        return -1;
+    }
+
+    data = g_malloc (MAX (size, 1));
+    if (pread_all (fd, data, size, offset) < 0) {
+        seaf_warning ("[pack bend] Failed to read block %s: %s.\n",
+                      block_id, strerror(errno));
+        close (fd);
+        g_free (data);
+        return -1;
+    }
+    close (fd);
+
+    ret = store_put_block (priv, dst_store_id, id, data, size);
+
+    g_free (data);
+    return ret;
+}
+
+static int
+block_backend_pack_remove_store (BlockBackend *bend, const char *store_id)
+{
+    PackPriv *priv = bend->be_priv;
+    PackStore *store;
+    GDir *dir;
+    const char *dname;
+    char *path;
+
+    store = get_store (priv, store_id, FALSE);
+    if (!store || store_lock_writer (store) < 0)
+        goto legacy;
+
+    /* The emptied store stays in priv->stores, since other threads may
+     * still be using it.
+     */
+    pthread_mutex_lock (&store->lock);
+    if (store->active)
+        pack_free (store->active);
+    store->active = NULL;
+    g_list_foreach (store->sealed, (GFunc)pack_free, NULL);
+    g_list_free (store->sealed);
+    store->sealed = NULL;
+    g_hash_table_remove_all (store->deleted);
+    store->journal_len = 0;
+    store->journal_ino = 0;
+    if (store->journal_fd >= 0) {
+        close (store->journal_fd);
+        store->journal_fd = -1;
+    }
+    pthread_mutex_unlock (&store->lock);
+
+    dir = g_dir_open (store->dir, 0, NULL);
+    if (dir) {
+        while ((dname = g_dir_read_name (dir)) != NULL) {
+            path = g_build_filename (store->dir, dname, NULL);
+            g_unlink (path);
+            g_free (path);
+        }
+        g_dir_close (dir);
+        g_rmdir (store->dir);
+    }
+
+    /* Closing the lock file releases the flock. */
+    close (store->lock_fd);
+    store->lock_fd = -1;
+    store_unlock_writer (store);
+
+legacy:
+    if (priv->legacy)
+        return priv->legacy->remove_store (priv->legacy, store_id);
+
+    return 0;
+}
+
+/* Compaction. */
+
+/* Check whether @id is in a pack that is not being compacted. */
+static gboolean
+exists_in_kept_pack (PackStore *store, GList *compacted, const guint8 *id)
+{
+    GList *ptr;
+    guint64 offset;
+    guint32 size;
+
+    if (store->active && pack_lookup (store->active, id, &offset, &size))
+        return TRUE;
+
+    for (ptr = store->sealed; ptr; ptr = ptr->next) {
+        if (!g_list_find (compacted, ptr->data) &&
+            pack_lookup (ptr->data, id, &offset, &size))
+            return TRUE;
+    }
+
+    return FALSE;
+}
+
+/* Copy live blocks of @pack to the active pack. */
+static int
+rewrite_pack (PackPriv *priv, PackStore *store, Pack *pack, GList *compacted)
+{
+    const PackIndexEntry *e;
+    guint32 i, size;
+    void *data = NULL;
+    int fd, ret = 0;
+
+    fd = g_open (pack->path, O_RDONLY | O_BINARY, 0);
+    if (fd < 0) {
+        seaf_warning ("[pack bend] Failed to open %s: %s.\n",
+                      pack->path, strerror(errno));
+        return -1;
+    }
+
+    for (i = 0; i < pack->n_entries; ++i) {
+        e = &pack->entries[i];
+        if (g_hash_table_lookup (store->deleted, e->id))
+            continue;
+        /* Already copied, or left over by an interrupted compaction. */
+        if (exists_in_kept_pack (store, compacted, e->id))
+            continue;
+
+        size = ntohl (e->size);
+        data = g_realloc (data, MAX (size, 1));
+        if (pread_all (fd, data, size, ntoh64 (e->offset)) < 0) {
+            seaf_warning ("[pack bend] Failed to read %s: %s.\n",
+                          pack->path, strerror(errno));
+            ret = -1;
+            break;
+        }
+        if (store_append (priv, store, e->id, data, size) < 0) {
+            ret = -1;
+            break;
+        }
+    }
+
+    close (fd);
+    g_free (data);
+    return ret;
+}
+
+static int
+rewrite_journal (PackStore *store)
+{
+    GHashTableIter iter;
+    gpointer key, value;
+    JournalRecord rec;
+    GByteArray *buf;
+    char *path;
+    GError *error = NULL;
+    int ret = 0;
+
+    if (store->journal_fd >= 0) {
+        close (store->journal_fd);
+        store->journal_fd = -1;
+    }
+
+    path = g_build_filename (store->dir, "deleted", NULL);
+
+    buf = g_byte_array_new ();
+    rec.op = JOURNAL_OP_DELETE;
+    g_hash_table_iter_init (&iter, store->deleted);
+    while (g_hash_table_iter_next (&iter, &key, &value)) {
+        memcpy (rec.id, key, 20);
+        g_byte_array_append (buf, (guint8 *)&rec, sizeof(rec));
+    }
+
+    if (!g_file_set_contents (path, (char *)buf->data, buf->len, &error)) {
+        seaf_warning ("[pack bend] Failed to write %s: %s.\n",
+                      path, error->message);
+        g_clear_error (&error);
+        ret = -1;
+    }
+
+    g_byte_array_free (buf, TRUE);
+    g_free (path);
+    return ret;
+}
+
+/* Migration of fs blocks. */
+
+static gboolean
+collect_legacy_block (const char *store_id, int version,
+                      const char *block_id, void *vdata)
+{
+    GList **ids = vdata;
+
+    *ids = g_list_prepend (*ids, g_strdup (block_id));
+    return TRUE;
+}
+
+/*
+ * Copy the fs blocks of a store into packs, then remove the fs copies.
+ * Block data is read one id prefix at a time to bound memory usage. Fs
+ * blocks are only removed after the pack holding them is sealed, so an
+ * interrupted migration loses nothing and is simply run again.
+ */
+static int
+migrate_legacy_store (PackPriv *priv, const char *store_id, int version)
+{
+    BlockBackend *legacy = priv->legacy;
+    PackStore *store;
+    GList *ids = NULL, *ptr;
+    char prefix[3];
+    guint8 id[20];
+    void *data;
+    guint32 size;
+    gint64 n_migrated = 0;
+    int i, ret = 0;
+
+    for (i = 0; i < 256; ++i) {
+        snprintf (prefix, sizeof(prefix), "%02x", i);
+        legacy->foreach_block_with_prefix (legacy, store_id, version, prefix,
+                                           collect_legacy_block, &ids);
+
+        /* Ids of earlier prefixes are at the tail of the list. */
+        for (ptr = ids; ptr && ret == 0; ptr = ptr->next) {
+            if (strncmp (ptr->data, prefix, 2) != 0)
+                break;
+            if (read_legacy_block (priv, store_id, version,
+                                   ptr->data, &data, &size) < 0) {
+                ret = -1;
+                break;
+            }
+            hex_to_rawdata (ptr->data, id, 20);
+            ret = store_put_block (priv, store_id, id, data, size);
+            g_free (data);
+        }
+        if (ret < 0)
+            goto out;
+    }
+
+    if (!ids)
+        return 0;
+
+    store = get_store (priv, store_id, FALSE);
+    if (!store || store_lock_writer (store) < 0) {
+        ret = -1;
+        goto out;
+    }
+    if (store->active && store_seal_pack (store, store->active) < 0)
+        ret = -1;
+    store_unlock_writer (store);
+    if (ret < 0)
+        goto out;
+
+    for (ptr = ids; ptr; ptr = ptr->next) {
+        legacy->remove_block (legacy, store_id, version, ptr->data);
+        ++n_migrated;
+    }
+    /* Drop the now empty block dirs of the store. */
+    legacy->remove_store (legacy, store_id);
+
+    seaf_message ("[pack bend] Moved %"G_GINT64_FORMAT" fs blocks of "
+                  "store %s into packs.\n", n_migrated, store_id);
+
+out:
+    if (ret < 0)
+        seaf_warning ("[pack bend] Failed to move fs blocks of store %s "
+                      "into packs.\n", store_id);
+    string_list_free (ids);
+    return ret;
+}
+
+static int
+block_backend_pack_compact_store (BlockBackend *bend,
+                                  const char *store_id,
+                                  int version)
+{
+    PackPriv *priv = bend->be_priv;
+    PackStore *store;
+    GList *packs = NULL, *ptr;
+    Pack *pack;
+    const PackIndexEntry *e;
+    guint64 total, dead;
+    guint32 i;
+    int ret = 0;
+
+    if (priv->legacy && migrate_legacy_store (priv, store_id, version) < 0)
+        return -1;
+
+    store = get_store (priv, store_id, FALSE);
+    if (!store)
+        return 0;
+
+    /* Writes of other processes wait until compaction is done. */
+    if (store_lock_writer (store) < 0)
+        return -1;
+
+    if (g_hash_table_size (store->deleted) == 0)
+        goto out;
+
+    if (store->active && store_seal_pack (store, store->active) < 0) {
+        ret = -1;
+        goto out;
+    }
+
+    for (ptr = store->sealed; ptr; ptr = ptr->next) {
+        pack = ptr->data;
+        /* Left unsealed because sealing failed. */
+        if (!pack->idx_map)
+            continue;
+        total = dead = 0;
+        for (i = 0; i < pack->n_entries; ++i) {
+            e = &pack->entries[i];
+            total += ntohl (e->size);
+            if (g_hash_table_lookup (store->deleted, e->id))
+                dead += ntohl (e->size);
+        }
+        if (dead > 0 && dead * 100 >= total * COMPACT_THRESHOLD)
+            packs = g_list_prepend (packs, pack);
+    }
+
+    for (ptr = packs; ptr; ptr = ptr->next) {
+        if (rewrite_pack (priv, store, ptr->data, packs) < 0) {
+            ret = -1;
+            goto out;
+        }
+    }
+
+    /* Live blocks must be durable in new packs before old packs go away. */
+    if (store->active && store_seal_pack (store, store->active) < 0) {
+        ret = -1;
+        goto out;
+    }
+
+    for (ptr = packs; ptr; ptr = ptr->next) {
+        pack = ptr->data;
+        seaf_message ("[pack bend] Removing pack %s.\n", pack->path);
+
+        pthread_mutex_lock (&store->lock);
+        for (i = 0; i < pack->n_entries; ++i) {
+            e = &pack->entries[i];
+            if (!exists_in_kept_pack (store, packs, e->id))
+                g_hash_table_remove (store->deleted, e->id);
+        }
+        store->sealed = g_list_remove (store->sealed, pack);
+        pthread_mutex_unlock (&store->lock);
+
+        g_unlink (pack->idx_path);
+        g_unlink (pack->path);
+        pack_free (pack);
+    }
+
+    if (packs)
+        ret = rewrite_journal (store);
+
+out:
+    g_list_free (packs);
+    store_unlock_writer (store);
+    return ret;
+}
+
+extern BlockBackend *
+block_backend_fs_new (const char *block_dir, const char *tmp_dir);
+
+BlockBackend *
+block_backend_pack_new (const char *seaf_dir, const char *tmp_dir,
+                        guint64 pack_size)
+{
+    BlockBackend *bend;
+    PackPriv *priv;
+    char *fs_block_dir;
+
+    bend = g_new0(BlockBackend, 1);
+    priv = g_new0(PackPriv, 1);
+    bend->be_priv = priv;
+
+    priv->pack_dir = g_build_filename (seaf_dir, "storage", "packs", NULL);
+    priv->pack_size = (pack_size > 0) ? pack_size : DEFAULT_PACK_SIZE;
+    priv->stores = g_hash_table_new_full (g_str_hash, g_str_equal,
+                                          NULL, (GDestroyNotify)pack_store_free);
+    pthread_mutex_init (&priv->lock, NULL);
+
+    if (g_mkdir_with_parents (priv->pack_dir, 0777) < 0) {
+        seaf_warning ("Pack dir %s does not exist and"
+                      " is unable to create\n", priv->pack_dir);
+        goto onerror;
+    }
+
+    fs_block_dir = g_build_filename (seaf_dir, "storage", "blocks", NULL);
+    if (g_file_test (fs_block_dir, G_FILE_TEST_IS_DIR)) {
+        seaf_message ("[pack bend] Found fs blocks in %s. They are moved "
+                      "into packs when seafserv-gc runs.\n", fs_block_dir);
+        priv->legacy = block_backend_fs_new (seaf_dir, tmp_dir);
+        if (!priv->legacy) {
+            g_free (fs_block_dir);
+            goto onerror;
+        }
+    }
+    g_free (fs_block_dir);
+
+    bend->open_block = block_backend_pack_open_block;
+    bend->read_block = block_backend_pack_read_block;
+    bend->write_block = block_backend_pack_write_block;
+    bend->commit_block = block_backend_pack_commit_block;
+    bend->close_block = block_backend_pack_close_block;
+    bend->exists = block_backend_pack_block_exists;
+    bend->exists_batch = block_backend_pack_blocks_exist;
+    bend->remove_block = block_backend_pack_remove_block;
+    bend->stat_block = block_backend_pack_stat_block;
+    bend->stat_block_by_handle = block_backend_pack_stat_block_by_handle;
+    bend->open_block_fd = block_backend_pack_open_block_fd;
+    bend->block_handle_free = block_backend_pack_block_handle_free;
+    bend->foreach_block = block_backend_pack_foreach_block;
+    bend->foreach_block_with_prefix = block_backend_pack_foreach_block_with_prefix;
+    bend->remove_store = block_backend_pack_remove_store;
+    bend->copy = block_backend_pack_copy;
+    bend->compact_store = block_backend_pack_compact_store;
+
+    return bend;
+
+onerror:
+    g_hash_table_destroy (priv->stores);
+    g_free (priv->pack_dir);
+    g_free (priv);
+    g_free (bend);
+
+    return NULL;
+}
@@ -25,6 +25,14 @@ struct BlockBackend {
                         const char *store_id, int version,
                         const char *block_id);
 
+    /* Optional. Check existence of @n blocks with raw 20-byte ids packed
+     * in @ids, and set exists[i] for the i-th block.
+     */
+    int      (*exists_batch) (BlockBackend *bend,
+                              const char *store_id, int version,
+                              const guint8 *ids, int n,
+                              gboolean *exists);
+
     int      (*remove_block) (BlockBackend *bend,
                               const char *store_id, int version,
                               const char *block_id);
@@ -35,6 +43,15 @@ struct BlockBackend {
     
     BMetadata* (*stat_block_by_handle) (BlockBackend *bend, BHandle *handle);
 
+    /* Optional. Open the file holding the content of a block, so that it
+     * can be sent with sendfile(). The content is @size bytes starting at
+     * @offset. Returns the fd, which should be closed by the caller.
+     */
+    int      (*open_block_fd) (BlockBackend *bend,
+                               const char *store_id, int version,
+                               const char *block_id,
+                               gint64 *offset, gint64 *size);
+
     void     (*block_handle_free) (BlockBackend *bend, BHandle *handle);
 
     int      (*foreach_block) (BlockBackend *bend,
@@ -43,6 +60,16 @@ struct BlockBackend {
                                SeafBlockFunc process,
                                void *user_data);
 
+    /* Optional. Iterate over blocks whose ids start with the 2 hex digits
+     * in @prefix. Backends that can't list blocks cheaply leave it NULL.
+     */
+    int      (*foreach_block_with_prefix) (BlockBackend *bend,
+                                           const char *store_id,
+                                           int version,
+                                           const char *prefix,
+                                           SeafBlockFunc process,
+                                           void *user_data);
+
     int         (*copy) (BlockBackend *bend,
                          const char *src_store_id,
                          int src_version,
@@ -54,6 +81,11 @@ struct BlockBackend {
     int      (*remove_store) (BlockBackend *bend,
                               const char *store_id);
 
+    /* Optional. Reclaim space taken by removed blocks. */
+    int      (*compact_store) (BlockBackend *bend,
+                               const char *store_id,
+                               int version);
+
     void*    be_priv;           /* backend private field */
 
 };
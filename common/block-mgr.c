@@ -25,6 +25,39 @@
 extern BlockBackend *
 block_backend_fs_new (const char *block_dir, const char *tmp_dir);
 
+#ifdef SEAFILE_SERVER
+extern BlockBackend *
+block_backend_pack_new (const char *seaf_dir, const char *tmp_dir,
+                        guint64 pack_size);
+
+/*
+ * Switching an existing installation to "pack" is supported: blocks already
+ * stored by the fs backend are still read from there, and are moved into
+ * packs by the next seafserv-gc run.
+ */
+static BlockBackend *
+load_backend (struct _SeafileSession *seaf, const char *seaf_dir)
+{
+    char *name;
+    int pack_size;
+    BlockBackend *bend;
+
+    name = g_key_file_get_string (seaf->config, "block_backend", "name", NULL);
+    if (g_strcmp0 (name, "pack") == 0) {
+        /* In MB. */
+        pack_size = g_key_file_get_integer (seaf->config,
+                                            "block_backend", "pack_size", NULL);
+        bend = block_backend_pack_new (seaf_dir, seaf->tmp_file_dir,
+                                       (guint64)MAX(pack_size, 0) << 20);
+    } else {
+        bend = block_backend_fs_new (seaf_dir, seaf->tmp_file_dir);
+    }
+
+    g_free (name);
+    return bend;
+}
+#endif
+
 
 SeafBlockManager *
 seaf_block_manager_new (struct _SeafileSession *seaf,
@@ -35,7 +68,11 @@ seaf_block_manager_new (struct _SeafileSession *seaf,
     mgr = g_new0 (SeafBlockManager, 1);
     mgr->seaf = seaf;
 
+#ifdef SEAFILE_SERVER
+    mgr->backend = load_backend (seaf, seaf_dir);
+#else
     mgr->backend = block_backend_fs_new (seaf_dir, seaf->tmp_file_dir);
+#endif
     if (!mgr->backend) {
         g_warning ("[Block mgr] Failed to load backend.\n");
         goto onerror;
@@ -113,6 +150,29 @@ gboolean seaf_block_manager_block_exists (SeafBlockManager *mgr,
     return mgr->backend->exists (mgr->backend, store_id, version, block_id);
 }
 
+int
+seaf_block_manager_blocks_exist (SeafBlockManager *mgr,
+                                 const char *store_id,
+                                 int version,
+                                 const guint8 *ids,
+                                 int n,
+                                 gboolean *exists)
+{
+    char block_id[41];
+    int i;
+
+    if (mgr->backend->exists_batch)
+        return mgr->backend->exists_batch (mgr->backend, store_id, version,
+                                           ids, n, exists);
+
+    for (i = 0; i < n; ++i) {
+        rawdata_to_hex (ids + i * 20, block_id, 20);
+        exists[i] = mgr->backend->exists (mgr->backend, store_id, version, block_id);
+    }
+
+    return 0;
+}
+
 int
 seaf_block_manager_remove_block (SeafBlockManager *mgr,
                                  const char *store_id,
@@ -138,6 +198,28 @@ seaf_block_manager_stat_block_by_handle (SeafBlockManager *mgr,
     return mgr->backend->stat_block_by_handle (mgr->backend, handle);
 }
 
+int
+seaf_block_manager_open_block_fd (SeafBlockManager *mgr,
+                                  const char *store_id,
+                                  int version,
+                                  const char *block_id,
+                                  gint64 *offset,
+                                  gint64 *size)
+{
+    if (!mgr->backend->open_block_fd)
+        return -1;
+
+    return mgr->backend->open_block_fd (mgr->backend,
+                                        store_id, version, block_id,
+                                        offset, size);
+}
+
+gboolean
+seaf_block_manager_support_block_fd (SeafBlockManager *mgr)
+{
+    return (mgr->backend->open_block_fd != NULL);
+}
+
 int
 seaf_block_manager_foreach_block (SeafBlockManager *mgr,
                                   const char *store_id,
@@ -249,3 +331,136 @@ seaf_block_manager_remove_store (SeafBlockManager *mgr,
 {
     return mgr->backend->remove_store (mgr->backend, store_id);
 }
+
+int
+seaf_block_manager_compact_store (SeafBlockManager *mgr,
+                                  const char *store_id,
+                                  int version)
+{
+    if (!mgr->backend->compact_store)
+        return 0;
+
+    return mgr->backend->compact_store (mgr->backend, store_id, version);
+}
+
+#define N_BLOCK_PREFIXES 256
+
+struct _BlockExistCache {
+    char store_id[37];
+    int version;
+    /* Sets of block id suffixes, indexed by the first byte of block id. */
+    GHashTable *prefixes[N_BLOCK_PREFIXES];
+};
+
+BlockExistCache *
+seaf_block_manager_exist_cache_new (SeafBlockManager *mgr,
+                                    const char *store_id,
+                                    int version)
+{
+    BlockExistCache *cache = g_new0 (BlockExistCache, 1);
+
+    memcpy (cache->store_id, store_id, 36);
+    cache->version = version;
+
+    return cache;
+}
+
+void
+seaf_block_manager_exist_cache_free (BlockExistCache *cache)
+{
+    int i;
+
+    if (!cache)
+        return;
+
+    for (i = 0; i < N_BLOCK_PREFIXES; ++i) {
+        if (cache->prefixes[i])
+            g_hash_table_destroy (cache->prefixes[i]);
+    }
+    g_free (cache);
+}
+
+static gboolean
+add_block_to_prefix_set (const char *store_id,
+                         int version,
+                         const char *block_id,
+                         void *user_data)
+{
+    GHashTable *set = user_data;
+    char *suffix;
+
+    if (strlen (block_id) != 40)
+        return TRUE;
+
+    suffix = g_strdup (block_id + 2);
+    g_hash_table_replace (set, suffix, suffix);
+
+    return TRUE;
+}
+
+static GHashTable *
+load_prefix_set (SeafBlockManager *mgr, BlockExistCache *cache,
+                 const char *block_id)
+{
+    unsigned char first;
+    GHashTable *set;
+    char prefix[3];
+
+    if (hex_to_rawdata (block_id, &first, 1) < 0)
+        return NULL;
+
+    if (cache->prefixes[first])
+        return cache->prefixes[first];
+
+    set = g_hash_table_new_full (g_str_hash, g_str_equal, g_free, NULL);
+
+    memcpy (prefix, block_id, 2);
+    prefix[2] = '\0';
+
+    if (mgr->backend->foreach_block_with_prefix (mgr->backend,
+                                                 cache->store_id,
+                                                 cache->version,
+                                                 prefix,
+                                                 add_block_to_prefix_set,
+                                                 set) < 0) {
+        seaf_warning ("Failed to list blocks with prefix %s in store %.8s.\n",
+                      prefix, cache->store_id);
+        g_hash_table_destroy (set);
+        return NULL;
+    }
+
+    cache->prefixes[first] = set;
+    return set;
+}
+
+gboolean
+seaf_block_manager_block_exists_cached (SeafBlockManager *mgr,
+                                        BlockExistCache *cache,
+                                        const char *block_id)
+{
+    GHashTable *set = NULL;
+
+    if (mgr->backend->foreach_block_with_prefix && strlen (block_id) == 40)
+        set = load_prefix_set (mgr, cache, block_id);
+
+    if (!set)
+        return seaf_block_manager_block_exists (mgr,
+                                                cache->store_id,
+                                                cache->version,
+                                                block_id);
+
+    return (g_hash_table_lookup (set, block_id + 2) != NULL);
+}
+
+void
+seaf_block_manager_exist_cache_remove (BlockExistCache *cache,
+                                       const char *block_id)
+{
+    unsigned char first;
+
+    if (strlen (block_id) != 40 || hex_to_rawdata (block_id, &first, 1) < 0)
+        return;
+
+    if (cache->prefixes[first])
+        g_hash_table_remove (cache->prefixes[first], block_id + 2);
+}
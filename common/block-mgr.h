@@ -103,6 +103,19 @@ seaf_block_manager_block_exists (SeafBlockManager *mgr,
                                  int version,
                                  const char *block_id);
 
+/*
+ * Check existence of @n blocks, whose raw 20-byte ids are packed in @ids.
+ * exists[i] is set for the i-th block. Backends that can look up many
+ * blocks at once do it in one go.
+ */
+int
+seaf_block_manager_blocks_exist (SeafBlockManager *mgr,
+                                 const char *store_id,
+                                 int version,
+                                 const guint8 *ids,
+                                 int n,
+                                 gboolean *exists);
+
 int
 seaf_block_manager_remove_block (SeafBlockManager *mgr,
                                  const char *store_id,
@@ -119,6 +132,25 @@ BlockMetadata *
 seaf_block_manager_stat_block_by_handle (SeafBlockManager *mgr,
                                          BlockHandle *handle);
 
+/*
+ * Open the file holding the content of a block, for sending the block
+ * without copying it through user space, e.g. with evbuffer_add_file().
+ * The content is @size bytes starting at @offset of the returned fd.
+ *
+ * Returns: the fd, or -1 on error or if the backend doesn't support it.
+ * The caller owns the fd.
+ */
+int
+seaf_block_manager_open_block_fd (SeafBlockManager *mgr,
+                                  const char *store_id,
+                                  int version,
+                                  const char *block_id,
+                                  gint64 *offset,
+                                  gint64 *size);
+
+gboolean
+seaf_block_manager_support_block_fd (SeafBlockManager *mgr);
+
 int
 seaf_block_manager_foreach_block (SeafBlockManager *mgr,
                                   const char *store_id,
@@ -139,6 +171,12 @@ int
 seaf_block_manager_remove_store (SeafBlockManager *mgr,
                                  const char *store_id);
 
+/* Reclaim space taken by removed blocks, if the backend supports it. */
+int
+seaf_block_manager_compact_store (SeafBlockManager *mgr,
+                                  const char *store_id,
+                                  int version);
+
 guint64
 seaf_block_manager_get_block_number (SeafBlockManager *mgr,
                                      const char *store_id,
@@ -151,4 +189,36 @@ seaf_block_manager_verify_block (SeafBlockManager *mgr,
                                  const char *block_id,
                                  gboolean *io_error);
 
+/*
+ * Cache for checking existence of many blocks in one block store.
+ *
+ * On first lookup of a block id, all blocks sharing its 2-digit prefix are
+ * listed from the backend in one go, and later lookups with the same prefix
+ * are answered from memory. This replaces one stat per block with at most
+ * 256 directory listings per store. If the backend doesn't support listing,
+ * every lookup falls back to seaf_block_manager_block_exists().
+ *
+ * The cache doesn't see blocks added or removed by others after the
+ * prefix is loaded. Not MT safe.
+ */
+typedef struct _BlockExistCache BlockExistCache;
+
+BlockExistCache *
+seaf_block_manager_exist_cache_new (SeafBlockManager *mgr,
+                                    const char *store_id,
+                                    int version);
+
+void
+seaf_block_manager_exist_cache_free (BlockExistCache *cache);
+
+gboolean
+seaf_block_manager_block_exists_cached (SeafBlockManager *mgr,
+                                        BlockExistCache *cache,
+                                        const char *block_id);
+
+/* Tell the cache that @block_id has been removed. */
+void
+seaf_block_manager_exist_cache_remove (BlockExistCache *cache,
+                                       const char *block_id);
+
 #endif
@@ -227,6 +227,187 @@ int filename_chunk_cdc(const char *filename,
     return ret;
 }
 
+/* Chunking of data that is fed piece by piece. The chunk boundaries are the
+ * same as those found by file_chunk_cdc() for the same content.
+ */
+struct _CDCStream {
+    CDCFileDescriptor *file_descr;
+    SeafileCrypt *crypt;
+    gboolean write_data;
+
+    SHA_CTX file_ctx;
+    CDCDescriptor chunk_descr;
+    char *buf;
+    int buf_sz;
+    /* Same meanings as in file_chunk_cdc(). */
+    int tail, cur;
+    int fingerprint;
+    uint64_t offset;
+};
+
+CDCStream *
+cdc_stream_new (CDCFileDescriptor *file_descr,
+                SeafileCrypt *crypt,
+                gboolean write_data)
+{
+    CDCStream *stream;
+
+    if (file_descr->block_min_sz <= 0)
+        file_descr->block_min_sz = BLOCK_MIN_SZ;
+    if (file_descr->block_max_sz <= 0)
+        file_descr->block_max_sz = BLOCK_MAX_SZ;
+    if (file_descr->block_sz <= 0)
+        file_descr->block_sz = BLOCK_SZ;
+
+    if (file_descr->write_block == NULL)
+        file_descr->write_block = (WriteblockFunc)default_write_chunk;
+
+    /* The file size is not known yet, the block id array is grown
+     * as blocks are cut.
+     */
+    file_descr->block_nr = 0;
+    file_descr->file_size = 0;
+    file_descr->blk_sha1s = NULL;
+    file_descr->max_block_nr = 0;
+
+    stream = g_new0 (CDCStream, 1);
+    stream->buf_sz = file_descr->block_max_sz;
+    stream->buf = malloc (stream->buf_sz);
+    if (!stream->buf) {
+        g_free (stream);
+        return NULL;
+    }
+    stream->chunk_descr.block_buf = stream->buf;
+    stream->file_descr = file_descr;
+    stream->crypt = crypt;
+    stream->write_data = write_data;
+    SHA1_Init (&stream->file_ctx);
+
+    return stream;
+}
+
+static int
+stream_write_block (CDCStream *stream, int block_sz)
+{
+    CDCFileDescriptor *file_descr = stream->file_descr;
+    CDCDescriptor *chunk_descr = &stream->chunk_descr;
+
+    if (file_descr->block_nr == file_descr->max_block_nr) {
+        int max_block_nr = file_descr->max_block_nr ? file_descr->max_block_nr * 2 : 16;
+        uint8_t *blk_sha1s = realloc (file_descr->blk_sha1s,
+                                      max_block_nr * CHECKSUM_LENGTH);
+        if (!blk_sha1s) {
+            g_warning ("CDC: failed to grow block id array.\n");
+            return -1;
+        }
+        file_descr->blk_sha1s = blk_sha1s;
+        file_descr->max_block_nr = max_block_nr;
+    }
+
+    chunk_descr->len = block_sz;
+    chunk_descr->offset = stream->offset;
+    if (file_descr->write_block (file_descr->repo_id,
+                                 file_descr->version,
+                                 chunk_descr,
+                                 stream->crypt, chunk_descr->checksum,
+                                 stream->write_data) < 0) {
+        g_warning ("CDC: failed to write chunk.\n");
+        return -1;
+    }
+    memcpy (file_descr->blk_sha1s +
+            file_descr->block_nr * CHECKSUM_LENGTH,
+            chunk_descr->checksum, CHECKSUM_LENGTH);
+    SHA1_Update (&stream->file_ctx, chunk_descr->checksum, 20);
+    file_descr->block_nr++;
+    stream->offset += block_sz;
+
+    memmove (stream->buf, stream->buf + block_sz, stream->tail - block_sz);
+    stream->tail -= block_sz;
+    stream->cur = 0;
+
+    return 0;
+}
+
+/* Cut as many blocks as possible from the buffered data. The data after
+ * the last cut stays in the buffer until more data arrives.
+ */
+static int
+stream_cut_blocks (CDCStream *stream)
+{
+    CDCFileDescriptor *file_descr = stream->file_descr;
+    int block_min_sz = file_descr->block_min_sz;
+    uint32_t block_mask = file_descr->block_sz - 1;
+    char *buf = stream->buf;
+    int cur;
+
+    while (stream->tail >= block_min_sz) {
+        if (stream->cur < block_min_sz - 1)
+            stream->cur = block_min_sz - 1;
+
+        cur = stream->cur;
+        while (cur < stream->tail) {
+            stream->fingerprint = (cur == block_min_sz - 1) ?
+                finger(buf + cur - BLOCK_WIN_SZ + 1, BLOCK_WIN_SZ) :
+                rolling_finger (stream->fingerprint, BLOCK_WIN_SZ,
+                                *(buf+cur-BLOCK_WIN_SZ), *(buf + cur));
+
+            if (((stream->fingerprint & block_mask) == ((BREAK_VALUE & block_mask)))
+                || cur + 1 >= file_descr->block_max_sz)
+                break;
+            cur++;
+        }
+        stream->cur = cur;
+
+        if (cur == stream->tail)
+            break;
+        if (stream_write_block (stream, cur + 1) < 0)
+            return -1;
+    }
+
+    return 0;
+}
+
+int
+cdc_stream_update (CDCStream *stream, const char *data, size_t len)
+{
+    size_t n;
+
+    while (len > 0) {
+        n = MIN (len, (size_t)(stream->buf_sz - stream->tail));
+        memcpy (stream->buf + stream->tail, data, n);
+        stream->tail += n;
+        stream->file_descr->file_size += n;
+        data += n;
+        len -= n;
+
+        if (stream_cut_blocks (stream) < 0)
+            return -1;
+    }
+
+    return 0;
+}
+
+int
+cdc_stream_finish (CDCStream *stream)
+{
+    if (stream->tail > 0 && stream_write_block (stream, stream->tail) < 0)
+        return -1;
+
+    SHA1_Final (stream->file_descr->file_sum, &stream->file_ctx);
+
+    return 0;
+}
+
+void
+cdc_stream_free (CDCStream *stream)
+{
+    if (!stream)
+        return;
+
+    free (stream->buf);
+    g_free (stream);
+}
+
 void cdc_init ()
 {
     rabin_init (BLOCK_WIN_SZ);
@@ -76,6 +76,27 @@ int filename_chunk_cdc(const char *filename,
                        struct SeafileCrypt *crypt,
                        gboolean write_data);
 
+typedef struct _CDCStream CDCStream;
+
+/* Chunk data that arrives piece by piece, e.g. from network.
+ * file_size and the block ids in @file_descr are updated as blocks
+ * are cut. @file_descr->blk_sha1s is owned by the caller.
+ */
+CDCStream *
+cdc_stream_new (CDCFileDescriptor *file_descr,
+                struct SeafileCrypt *crypt,
+                gboolean write_data);
+
+int
+cdc_stream_update (CDCStream *stream, const char *data, size_t len);
+
+/* Write out the last block and calculate the file checksum. */
+int
+cdc_stream_finish (CDCStream *stream);
+
+void
+cdc_stream_free (CDCStream *stream);
+
 void cdc_init ();
 
 #endif
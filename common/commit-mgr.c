@@ -2,6 +2,7 @@
 
 #include "common.h"
 
+#include <pthread.h>
 #include <jansson.h>
 #include <openssl/sha.h>
 
@@ -12,13 +13,39 @@
 #include "seafile-session.h"
 #include "commit-mgr.h"
 #include "seaf-utils.h"
+#include "lru-cache.h"
 
 #define MAX_TIME_SKEW 259200    /* 3 days */
 
+#define DEFAULT_COMMIT_CACHE_SIZE 32    /* MB */
+#define DEFAULT_PREFETCH_THREADS 2
+
+/* How many generations of parents to read ahead during history traversal. */
+#define PREFETCH_DEPTH 8
+/* Don't queue more prefetch tasks when the pool is this busy. */
+#define MAX_PENDING_PREFETCH 1000
+
 struct _SeafCommitManagerPriv {
-    int dummy;
+    /* Parsed commits, keyed by "<repo_id>/<version>/<commit_id>". */
+    LRUCache        *commit_cache;
+
+    /* Loads parent commits into the cache while the caller of
+     * a history traversal is still processing the current commit.
+     */
+    GThreadPool     *prefetch_pool;
+    /* Keys of commits queued for prefetch. */
+    GHashTable      *prefetching;
+    pthread_mutex_t  prefetch_lock;
 };
 
+typedef struct PrefetchTask {
+    char    key[128];
+    char    repo_id[37];
+    int     version;
+    char    commit_id[41];
+    int     depth;
+} PrefetchTask;
+
 static SeafCommit *
 load_commit (SeafCommitManager *mgr,
              const char *repo_id, int version,
@@ -162,6 +189,7 @@ seaf_commit_free (SeafCommit *commit)
     if (commit->second_parent_id) g_free (commit->second_parent_id);
     if (commit->repo_name) g_free (commit->repo_name);
     if (commit->repo_desc) g_free (commit->repo_desc);
+    g_free (commit->repo_category);
     g_free (commit->magic);
     g_free (commit->random_key);
     g_free (commit);
@@ -183,6 +211,60 @@ seaf_commit_unref (SeafCommit *commit)
         seaf_commit_free (commit);
 }
 
+/* Commit cache. */
+
+static void
+commit_cache_key (char *key, size_t len,
+                  const char *repo_id, int version, const char *commit_id)
+{
+    snprintf (key, len, "%s/%d/%s", repo_id, version, commit_id);
+}
+
+static gsize
+strlen_or_zero (const char *str)
+{
+    return str ? strlen (str) + 1 : 0;
+}
+
+static guint64
+commit_mem_size (SeafCommit *commit)
+{
+    return sizeof(SeafCommit) +
+        strlen_or_zero (commit->desc) +
+        strlen_or_zero (commit->creator_name) +
+        strlen_or_zero (commit->parent_id) +
+        strlen_or_zero (commit->second_parent_id) +
+        strlen_or_zero (commit->repo_name) +
+        strlen_or_zero (commit->repo_desc) +
+        strlen_or_zero (commit->repo_category) +
+        strlen_or_zero (commit->magic) +
+        strlen_or_zero (commit->random_key);
+}
+
+static gpointer
+commit_copy (gpointer data)
+{
+    SeafCommit *commit = data;
+    SeafCommit *copy;
+
+    copy = g_memdup (commit, sizeof(SeafCommit));
+    copy->ref = 1;
+    copy->desc = g_strdup (commit->desc);
+    copy->creator_name = g_strdup (commit->creator_name);
+    copy->parent_id = g_strdup (commit->parent_id);
+    copy->second_parent_id = g_strdup (commit->second_parent_id);
+    copy->repo_name = g_strdup (commit->repo_name);
+    copy->repo_desc = g_strdup (commit->repo_desc);
+    copy->repo_category = g_strdup (commit->repo_category);
+    copy->magic = g_strdup (commit->magic);
+    copy->random_key = g_strdup (commit->random_key);
+
+    return copy;
+}
+
+static void
+prefetch_commit (gpointer data, gpointer user_data);
+
 SeafCommitManager*
 seaf_commit_manager_new (SeafileSession *seaf)
 {
@@ -192,6 +274,42 @@ seaf_commit_manager_new (SeafileSession *seaf)
     mgr->seaf = seaf;
     mgr->obj_store = seaf_obj_store_new (mgr->seaf, "commits");
 
+#ifdef SEAFILE_SERVER
+    int cache_size, n_threads;
+    GError *error = NULL;
+
+    /* In MB. Set to 0 to disable the cache. */
+    cache_size = g_key_file_get_integer (seaf->config,
+                                         "commit_cache", "max_size", &error);
+    if (error) {
+        cache_size = DEFAULT_COMMIT_CACHE_SIZE;
+        g_clear_error (&error);
+    }
+
+    n_threads = g_key_file_get_integer (seaf->config,
+                                        "commit_cache", "prefetch_threads", &error);
+    if (error) {
+        n_threads = DEFAULT_PREFETCH_THREADS;
+        g_clear_error (&error);
+    }
+
+    if (cache_size > 0) {
+        mgr->priv->commit_cache = lru_cache_new ((guint64)cache_size << 20,
+                                                 commit_copy,
+                                                 (GDestroyNotify)seaf_commit_unref);
+
+        /* Prefetched commits are only useful when they can be cached. */
+        if (n_threads > 0) {
+            mgr->priv->prefetch_pool = g_thread_pool_new (prefetch_commit, mgr,
+                                                          n_threads, FALSE, NULL);
+            mgr->priv->prefetching = g_hash_table_new_full (g_str_hash,
+                                                            g_str_equal,
+                                                            g_free, NULL);
+            pthread_mutex_init (&mgr->priv->prefetch_lock, NULL);
+        }
+    }
+#endif
+
     return mgr;
 }
 
@@ -222,31 +340,12 @@ seaf_commit_manager_init (SeafCommitManager *mgr)
     return 0;
 }
 
-#if 0
-inline static void
-add_commit_to_cache (SeafCommitManager *mgr, SeafCommit *commit)
-{
-    g_hash_table_insert (mgr->priv->commit_cache,
-                         g_strdup(commit->commit_id),
-                         commit);
-    seaf_commit_ref (commit);
-}
-
-inline static void
-remove_commit_from_cache (SeafCommitManager *mgr, SeafCommit *commit)
-{
-    g_hash_table_remove (mgr->priv->commit_cache, commit->commit_id);
-    seaf_commit_unref (commit);
-}
-#endif
-
 int
 seaf_commit_manager_add_commit (SeafCommitManager *mgr,
                                 SeafCommit *commit)
 {
     int ret;
 
-    /* add_commit_to_cache (mgr, commit); */
     if ((ret = save_commit (mgr, commit->repo_id, commit->version, commit)) < 0)
         return -1;
     
@@ -259,22 +358,14 @@ seaf_commit_manager_del_commit (SeafCommitManager *mgr,
                                 int version,
                                 const char *id)
 {
-    g_return_if_fail (id != NULL);
+    char key[128];
 
-#if 0
-    commit = g_hash_table_lookup(mgr->priv->commit_cache, id);
-    if (!commit)
-        goto delete;
-
-    /*
-     * Catch ref count bug here. We have bug in commit ref, the
-     * following assert can't pass. TODO: fix the commit ref bug
-     */
-    /* g_assert (commit->ref <= 1); */
-    remove_commit_from_cache (mgr, commit);
+    g_return_if_fail (id != NULL);
 
-delete:
-#endif
+    if (mgr->priv->commit_cache) {
+        commit_cache_key (key, sizeof(key), repo_id, version, id);
+        lru_cache_remove (mgr->priv->commit_cache, key);
+    }
 
     delete_commit (mgr, repo_id, version, id);
 }
@@ -286,24 +377,115 @@ seaf_commit_manager_get_commit (SeafCommitManager *mgr,
                                 const char *id)
 {
     SeafCommit *commit;
+    char key[128];
 
-#if 0
-    commit = g_hash_table_lookup (mgr->priv->commit_cache, id);
-    if (commit != NULL) {
-        seaf_commit_ref (commit);
-        return commit;
+    if (!id || strlen(id) != 40)
+        return NULL;
+
+    if (mgr->priv->commit_cache) {
+        commit_cache_key (key, sizeof(key), repo_id, version, id);
+        commit = lru_cache_lookup (mgr->priv->commit_cache, key);
+        if (commit)
+            return commit;
     }
-#endif
 
     commit = load_commit (mgr, repo_id, version, id);
     if (!commit)
         return NULL;
 
-    /* add_commit_to_cache (mgr, commit); */
+    if (mgr->priv->commit_cache)
+        lru_cache_insert (mgr->priv->commit_cache, key, commit,
+                          commit_mem_size (commit));
 
     return commit;
 }
 
+gboolean
+seaf_commit_manager_get_cache_stats (SeafCommitManager *mgr,
+                                     LRUCacheStats *stats)
+{
+    if (!mgr->priv->commit_cache)
+        return FALSE;
+
+    lru_cache_get_stats (mgr->priv->commit_cache, stats);
+    return TRUE;
+}
+
+/* Read-ahead of parent commits. */
+
+static void
+schedule_prefetch (SeafCommitManager *mgr,
+                   const char *repo_id, int version,
+                   const char *commit_id, int depth)
+{
+    SeafCommitManagerPriv *priv = mgr->priv;
+    PrefetchTask *task;
+
+    if (g_thread_pool_unprocessed (priv->prefetch_pool) >= MAX_PENDING_PREFETCH)
+        return;
+
+    task = g_new0 (PrefetchTask, 1);
+    commit_cache_key (task->key, sizeof(task->key), repo_id, version, commit_id);
+
+    pthread_mutex_lock (&priv->prefetch_lock);
+    if (g_hash_table_lookup (priv->prefetching, task->key) != NULL) {
+        pthread_mutex_unlock (&priv->prefetch_lock);
+        g_free (task);
+        return;
+    }
+    g_hash_table_insert (priv->prefetching, g_strdup(task->key), GINT_TO_POINTER(1));
+    pthread_mutex_unlock (&priv->prefetch_lock);
+
+    g_strlcpy (task->repo_id, repo_id, sizeof(task->repo_id));
+    task->version = version;
+    g_strlcpy (task->commit_id, commit_id, sizeof(task->commit_id));
+    task->depth = depth;
+
+    g_thread_pool_push (priv->prefetch_pool, task, NULL);
+}
+
+/*
+ * Start loading parents of @commit, and their parents up to @depth
+ * generations, into the commit cache.
+ */
+static void
+prefetch_parents (SeafCommitManager *mgr,
+                  const char *repo_id, int version,
+                  SeafCommit *commit, int depth)
+{
+    if (!mgr->priv->prefetch_pool || depth <= 0)
+        return;
+
+    if (commit->parent_id)
+        schedule_prefetch (mgr, repo_id, version, commit->parent_id, depth);
+    if (commit->second_parent_id)
+        schedule_prefetch (mgr, repo_id, version, commit->second_parent_id, depth);
+}
+
+static void
+prefetch_commit (gpointer data, gpointer user_data)
+{
+    PrefetchTask *task = data;
+    SeafCommitManager *mgr = user_data;
+    SeafCommit *commit;
+
+    /* Loading the commit adds it to the cache. */
+    commit = seaf_commit_manager_get_commit (mgr, task->repo_id, task->version,
+                                             task->commit_id);
+
+    pthread_mutex_lock (&mgr->priv->prefetch_lock);
+    g_hash_table_remove (mgr->priv->prefetching, task->key);
+    pthread_mutex_unlock (&mgr->priv->prefetch_lock);
+
+    if (commit) {
+        prefetch_parents (mgr, task->repo_id, task->version,
+                          commit, task->depth - 1);
+        seaf_commit_unref (commit);
+    }
+
+    g_free (task);
+}
+
 SeafCommit *
 seaf_commit_manager_get_commit_compatible (SeafCommitManager *mgr,
                                            const char *repo_id,
@@ -400,6 +582,8 @@ seaf_commit_manager_traverse_commit_tree_with_limit (SeafCommitManager *mgr,
         commit = list->data;
         list = g_list_delete_link (list, list);
 
+        prefetch_parents (mgr, repo_id, version, commit, PREFETCH_DEPTH);
+
         if (!func (commit, data, &stop)) {
             seaf_commit_unref (commit);
             ret = FALSE;
@@ -486,6 +670,8 @@ traverse_commit_tree_common (SeafCommitManager *mgr,
         commit = list->data;
         list = g_list_delete_link (list, list);
 
+        prefetch_parents (mgr, repo_id, version, commit, PREFETCH_DEPTH);
+
         if (!func (commit, data, &stop)) {
             g_warning("[comit-mgr] CommitTraverseFunc failed\n");
 
@@ -10,6 +10,7 @@ typedef struct _SeafCommit SeafCommit;
 #include "db.h"
 
 #include "obj-store.h"
+#include "lru-cache.h"
 
 struct _SeafCommit {
     struct _SeafCommitManager *manager;
@@ -142,6 +143,9 @@ seaf_commit_manager_get_commit_compatible (SeafCommitManager *mgr,
  * Traverse the commits DAG start from head in topological order.
  * The ordering is based on commit time.
  * return FALSE if some commits is missing, TRUE otherwise.
+ *
+ * On server, parents of the commit being processed are read ahead into
+ * the commit cache in background threads.
  */
 gboolean
 seaf_commit_manager_traverse_commit_tree (SeafCommitManager *mgr,
@@ -185,4 +189,12 @@ seaf_commit_manager_commit_exists (SeafCommitManager *mgr,
                                    int version,
                                    const char *id);
 
+/*
+ * Get counters of the commit cache.
+ * Returns FALSE if the cache is disabled.
+ */
+gboolean
+seaf_commit_manager_get_cache_stats (SeafCommitManager *mgr,
+                                     LRUCacheStats *stats);
+
 #endif
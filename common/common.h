@@ -29,6 +29,11 @@
 
 #define CURRENT_REPO_VERSION 1
 
+/* Repos of this version store fs objects in the compact binary format.
+ * It's not the default since older clients can't parse these objects.
+ */
+#define BINARY_FS_REPO_VERSION 2
+
 /* For compatibility with the old protocol, use an UUID for signature.
  * Listen manager on the server will use the new block tx protocol if it
  * receives this signature as "token".
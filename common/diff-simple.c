@@ -255,76 +255,128 @@ free_sub_dirs:
     return ret;
 }
 
-static int
-diff_trees_recursive (int n, SeafDir *trees[],
-                      const char *basedir, DiffOptions *opt)
+/*
+ * Get the entries with the "largest" name of all trees into @dents,
+ * assuming dirents are sorted. Returns FALSE when all trees are done.
+ */
+static gboolean
+next_dents (int n, GList *ptrs[], SeafDirent *dents[])
 {
-    GList *ptrs[3];
-    SeafDirent *dents[3];
     int i;
     SeafDirent *dent;
-    char *first_name;
-    gboolean done;
-    int ret = 0;
+    char *first_name = NULL;
+
+    memset (dents, 0, sizeof(dents[0])*n);
 
     for (i = 0; i < n; ++i) {
-        if (trees[i])
-            ptrs[i] = trees[i]->entries;
-        else
-            ptrs[i] = NULL;
+        if (ptrs[i] != NULL) {
+            dent = ptrs[i]->data;
+            if (!first_name)
+                first_name = dent->name;
+            else if (strcmp(dent->name, first_name) > 0)
+                first_name = dent->name;
+        }
     }
 
-    while (1) {
-        first_name = NULL;
-        memset (dents, 0, sizeof(dents[0])*n);
-        done = TRUE;
+    if (!first_name)
+        return FALSE;
 
-        /* Find the "largest" name, assuming dirents are sorted. */
-        for (i = 0; i < n; ++i) {
-            if (ptrs[i] != NULL) {
-                done = FALSE;
-                dent = ptrs[i]->data;
-                if (!first_name)
-                    first_name = dent->name;
-                else if (strcmp(dent->name, first_name) > 0)
-                    first_name = dent->name;
+    /*
+     * Setup dir entries for all names that equal to first_name
+     */
+    for (i = 0; i < n; ++i) {
+        if (ptrs[i] != NULL) {
+            dent = ptrs[i]->data;
+            if (strcmp(first_name, dent->name) == 0) {
+                dents[i] = dent;
+                ptrs[i] = ptrs[i]->next;
             }
         }
+    }
 
-        if (done)
-            break;
+    return TRUE;
+}
+
+static gboolean
+dents_same (int n, SeafDirent *dents[])
+{
+    if (n == 2 && dents[0] && dents[1] && dirent_same(dents[0], dents[1]))
+        return TRUE;
+
+    if (n == 3 && dents[0] && dents[1] && dents[2] &&
+        dirent_same(dents[0], dents[1]) && dirent_same(dents[0], dents[2]))
+        return TRUE;
+
+    return FALSE;
+}
+
+static void
+dir_prefetch_init (SeafDirPrefetch *prefetch, int n, SeafDir *trees[],
+                   DiffOptions *opt)
+{
+    GList *ptrs[3];
+    SeafDirent *dents[3];
+    int i;
+
+    seaf_dir_prefetch_init (prefetch, seaf->fs_mgr, opt->store_id, opt->version);
 
-        /*
-         * Setup dir entries for all names that equal to first_name
-         */
+    for (i = 0; i < n; ++i)
+        ptrs[i] = trees[i] ? trees[i]->entries : NULL;
+
+    /* Add sub-dirs in the order diff_trees_recursive() visits them. */
+    while (next_dents (n, ptrs, dents)) {
+        if (dents_same (n, dents))
+            continue;
         for (i = 0; i < n; ++i) {
-            if (ptrs[i] != NULL) {
-                dent = ptrs[i]->data;
-                if (strcmp(first_name, dent->name) == 0) {
-                    dents[i] = dent;
-                    ptrs[i] = ptrs[i]->next;
-                }
-            }
+            if (dents[i] && S_ISDIR(dents[i]->mode))
+                seaf_dir_prefetch_add (prefetch, dents[i]->id);
         }
+    }
+}
 
-        if (n == 2 && dents[0] && dents[1] && dirent_same(dents[0], dents[1]))
-            continue;
+static int
+diff_trees_recursive (int n, SeafDir *trees[],
+                      const char *basedir, DiffOptions *opt)
+{
+    GList *ptrs[3];
+    SeafDirent *dents[3];
+    SeafDirPrefetch prefetch;
+    int i, n_dirs;
+    int ret = 0;
 
-        if (n == 3 && dents[0] && dents[1] && dents[2] &&
-            dirent_same(dents[0], dents[1]) && dirent_same(dents[0], dents[2]))
+    for (i = 0; i < n; ++i) {
+        if (trees[i])
+            ptrs[i] = trees[i]->entries;
+        else
+            ptrs[i] = NULL;
+    }
+
+    dir_prefetch_init (&prefetch, n, trees, opt);
+
+    while (next_dents (n, ptrs, dents)) {
+        if (dents_same (n, dents))
             continue;
 
         /* Diff files of this level. */
         ret = diff_files (n, dents, basedir, opt);
         if (ret < 0)
-            return ret;
+            break;
+
+        n_dirs = 0;
+        for (i = 0; i < n; ++i) {
+            if (dents[i] && S_ISDIR(dents[i]->mode))
+                ++n_dirs;
+        }
+        if (n_dirs > 0)
+            seaf_dir_prefetch_visit (&prefetch, n_dirs);
 
         /* Recurse into sub level. */
         ret = diff_directories (n, dents, basedir, opt);
         if (ret < 0)
-            return ret;
+            break;
     }
 
+    seaf_dir_prefetch_clear (&prefetch);
     return ret;
 }
 
@@ -0,0 +1,529 @@
+/* -*- Mode: C; tab-width: 4; indent-tabs-mode: nil; c-basic-offset: 4 -*- */
+
+#include "common.h"
+
+#include <sys/stat.h>
+
+#include "fs-binary.h"
+
+#define HEADER_SIZE (SEAF_BIN_MAGIC_LEN + 3)
+
+/* Varint helpers. */
+
+static void
+put_varint (GByteArray *buf, guint64 val)
+{
+    guint8 b;
+
+    while (val >= 0x80) {
+        b = (guint8)(val | 0x80);
+        g_byte_array_append (buf, &b, 1);
+        val >>= 7;
+    }
+    b = (guint8)val;
+    g_byte_array_append (buf, &b, 1);
+}
+
+static inline guint64
+zigzag_encode (gint64 val)
+{
+    return ((guint64)val << 1) ^ (guint64)(val >> 63);
+}
+
+static inline gint64
+zigzag_decode (guint64 val)
+{
+    return (gint64)(val >> 1) ^ -(gint64)(val & 1);
+}
+
+static int
+get_varint (const guint8 **ptr, const guint8 *end, guint64 *val)
+{
+    const guint8 *p = *ptr;
+    guint64 ret = 0;
+    int shift = 0;
+
+    while (p < end && shift < 64) {
+        ret |= (guint64)(*p & 0x7f) << shift;
+        if (!(*p++ & 0x80)) {
+            *ptr = p;
+            *val = ret;
+            return 0;
+        }
+        shift += 7;
+    }
+
+    return -1;
+}
+
+static void
+put_header (GByteArray *buf, int type, int version, int flags)
+{
+    guint8 hdr[3];
+
+    g_byte_array_append (buf, (const guint8 *)SEAF_BIN_MAGIC, SEAF_BIN_MAGIC_LEN);
+    hdr[0] = (guint8)type;
+    hdr[1] = (guint8)version;
+    hdr[2] = (guint8)flags;
+    g_byte_array_append (buf, hdr, 3);
+}
+
+gboolean
+seaf_bin_is_binary (const guint8 *data, int len)
+{
+    return (len >= HEADER_SIZE &&
+            memcmp (data, SEAF_BIN_MAGIC, SEAF_BIN_MAGIC_LEN) == 0);
+}
+
+int
+seaf_bin_obj_type (const guint8 *data, int len)
+{
+    if (!seaf_bin_is_binary (data, len))
+        return -1;
+
+    return data[SEAF_BIN_MAGIC_LEN];
+}
+
+/* File objects. */
+
+guint8 *
+seaf_bin_file_encode (int version,
+                      guint64 file_size,
+                      const guint8 *block_ids,
+                      guint32 n_blocks,
+                      int *len)
+{
+    GByteArray *buf = g_byte_array_sized_new (HEADER_SIZE + 20 + 20 * n_blocks);
+
+    put_header (buf, SEAF_BIN_TYPE_FILE, version, 0);
+    put_varint (buf, file_size);
+    put_varint (buf, n_blocks);
+    if (n_blocks > 0)
+        g_byte_array_append (buf, block_ids, 20 * n_blocks);
+
+    *len = buf->len;
+    return g_byte_array_free (buf, FALSE);
+}
+
+int
+seaf_bin_file_parse (const guint8 *data, int len,
+                     int *version,
+                     guint64 *file_size,
+                     const guint8 **block_ids,
+                     guint32 *n_blocks)
+{
+    const guint8 *ptr, *end = data + len;
+    guint64 size, n;
+
+    if (seaf_bin_obj_type (data, len) != SEAF_BIN_TYPE_FILE)
+        return -1;
+
+    ptr = data + HEADER_SIZE;
+    if (get_varint (&ptr, end, &size) < 0 || get_varint (&ptr, end, &n) < 0)
+        return -1;
+
+    if (n > G_MAXUINT32 || n * 20 != (guint64)(end - ptr))
+        return -1;
+
+    *version = data[SEAF_BIN_MAGIC_LEN + 1];
+    *file_size = size;
+    *block_ids = ptr;
+    *n_blocks = (guint32)n;
+
+    return 0;
+}
+
+/* Dir objects. */
+
+struct SeafBinDirWriter {
+    int         version;
+    GHashTable *string_idx;
+    GByteArray *strings;
+    GArray     *string_offsets;
+    GByteArray *dirents;
+    GArray     *dirent_offsets;
+    /* String index of the last added name, to check the sort order. */
+    gint64      last_name_idx;
+    gboolean    sorted;
+};
+
+SeafBinDirWriter *
+seaf_bin_dir_writer_new (int version)
+{
+    SeafBinDirWriter *writer = g_new0 (SeafBinDirWriter, 1);
+
+    writer->version = version;
+    writer->string_idx = g_hash_table_new_full (g_str_hash, g_str_equal,
+                                                g_free, NULL);
+    writer->strings = g_byte_array_new ();
+    writer->string_offsets = g_array_new (FALSE, FALSE, sizeof(guint32));
+    writer->dirents = g_byte_array_new ();
+    writer->dirent_offsets = g_array_new (FALSE, FALSE, sizeof(guint32));
+    writer->last_name_idx = -1;
+    writer->sorted = TRUE;
+
+    return writer;
+}
+
+/* Compare names like strcmp() does. */
+static int
+compare_names (const char *a, guint32 a_len, const char *b, guint32 b_len)
+{
+    int rc = memcmp (a, b, MIN (a_len, b_len));
+
+    if (rc != 0)
+        return rc;
+    if (a_len == b_len)
+        return 0;
+    return (a_len < b_len) ? -1 : 1;
+}
+
+static guint32
+add_string (SeafBinDirWriter *writer, const char *str, guint32 len)
+{
+    char *key = g_strndup (str, len);
+    gpointer value;
+    guint32 offset, idx;
+
+    if (g_hash_table_lookup_extended (writer->string_idx, key, NULL, &value)) {
+        g_free (key);
+        return GPOINTER_TO_UINT (value);
+    }
+
+    offset = writer->strings->len;
+    g_array_append_val (writer->string_offsets, offset);
+    put_varint (writer->strings, len);
+    g_byte_array_append (writer->strings, (const guint8 *)str, len);
+
+    idx = writer->string_offsets->len - 1;
+    g_hash_table_insert (writer->string_idx, key, GUINT_TO_POINTER (idx));
+
+    return idx;
+}
+
+void
+seaf_bin_dir_writer_add (SeafBinDirWriter *writer,
+                         guint32 mode,
+                         const guint8 *id,
+                         const char *name,
+                         guint32 name_len,
+                         gint64 mtime,
+                         const char *modifier,
+                         gint64 size)
+{
+    GByteArray *buf = writer->dirents;
+    guint32 offset, name_idx, modifier_idx;
+
+    if (writer->last_name_idx >= 0) {
+        const guint8 *last;
+        guint64 last_len;
+
+        offset = g_array_index (writer->string_offsets, guint32,
+                                writer->last_name_idx);
+        last = writer->strings->data + offset;
+        get_varint (&last, writer->strings->data + writer->strings->len,
+                    &last_len);
+        if (compare_names ((const char *)last, (guint32)last_len,
+                           name, name_len) <= 0)
+            writer->sorted = FALSE;
+    }
+
+    name_idx = add_string (writer, name, name_len);
+    writer->last_name_idx = name_idx;
+
+    offset = buf->len;
+    g_array_append_val (writer->dirent_offsets, offset);
+
+    put_varint (buf, mode);
+    g_byte_array_append (buf, id, 20);
+    put_varint (buf, name_idx);
+    put_varint (buf, zigzag_encode (mtime));
+    if (S_ISREG(mode)) {
+        if (!modifier)
+            modifier = "";
+        modifier_idx = add_string (writer, modifier, strlen(modifier));
+        put_varint (buf, (guint64)size);
+        put_varint (buf, modifier_idx);
+    }
+}
+
+static void
+put_offsets (GByteArray *buf, GArray *offsets)
+{
+    guint8 be[4];
+    guint32 off;
+    int i;
+
+    for (i = 0; i < offsets->len; ++i) {
+        off = g_array_index (offsets, guint32, i);
+        be[0] = (guint8)(off >> 24);
+        be[1] = (guint8)(off >> 16);
+        be[2] = (guint8)(off >> 8);
+        be[3] = (guint8)off;
+        g_byte_array_append (buf, be, 4);
+    }
+}
+
+static inline guint32
+get_offset (const guint8 *table, guint32 i)
+{
+    const guint8 *p = table + 4 * i;
+
+    return ((guint32)p[0] << 24) | ((guint32)p[1] << 16) |
+        ((guint32)p[2] << 8) | (guint32)p[3];
+}
+
+guint8 *
+seaf_bin_dir_writer_finish (SeafBinDirWriter *writer, int *len)
+{
+    GByteArray *buf;
+    guint32 n_strings = writer->string_offsets->len;
+    guint32 n_dirents = writer->dirent_offsets->len;
+    gboolean indexed = writer->sorted;
+
+    buf = g_byte_array_sized_new (HEADER_SIZE + 20 +
+                                  writer->strings->len + writer->dirents->len +
+                                  (indexed ? 4 * (n_strings + n_dirents) : 0));
+
+    put_header (buf, SEAF_BIN_TYPE_DIR, writer->version,
+                indexed ? SEAF_BIN_FLAG_INDEXED : 0);
+
+    put_varint (buf, n_strings);
+    if (indexed) {
+        put_varint (buf, writer->strings->len);
+        put_offsets (buf, writer->string_offsets);
+    }
+    g_byte_array_append (buf, writer->strings->data, writer->strings->len);
+
+    put_varint (buf, n_dirents);
+    if (indexed)
+        put_offsets (buf, writer->dirent_offsets);
+    g_byte_array_append (buf, writer->dirents->data, writer->dirents->len);
+
+    g_hash_table_destroy (writer->string_idx);
+    g_byte_array_free (writer->strings, TRUE);
+    g_array_free (writer->string_offsets, TRUE);
+    g_byte_array_free (writer->dirents, TRUE);
+    g_array_free (writer->dirent_offsets, TRUE);
+    g_free (writer);
+
+    *len = buf->len;
+    return g_byte_array_free (buf, FALSE);
+}
+
+static int
+index_strings (SeafBinDirReader *reader, const guint8 **ptr)
+{
+    const guint8 *end = reader->end;
+    guint64 slen;
+    guint32 i;
+
+    reader->strings = g_new (SeafBinStr, reader->n_strings + 1);
+    for (i = 0; i < reader->n_strings; ++i) {
+        if (get_varint (ptr, end, &slen) < 0 || slen > (guint64)(end - *ptr))
+            return -1;
+        reader->strings[i].str = (const char *)*ptr;
+        reader->strings[i].len = (guint32)slen;
+        *ptr += slen;
+    }
+
+    return 0;
+}
+
+int
+seaf_bin_dir_reader_init (SeafBinDirReader *reader,
+                          const guint8 *data, int len)
+{
+    const guint8 *ptr, *end = data + len;
+    guint64 n, size;
+    gboolean indexed;
+
+    memset (reader, 0, sizeof(SeafBinDirReader));
+
+    if (seaf_bin_obj_type (data, len) != SEAF_BIN_TYPE_DIR)
+        return -1;
+
+    reader->data = data;
+    reader->end = end;
+    reader->version = data[SEAF_BIN_MAGIC_LEN + 1];
+    reader->flags = data[SEAF_BIN_MAGIC_LEN + 2];
+    indexed = ((reader->flags & SEAF_BIN_FLAG_INDEXED) != 0);
+
+    ptr = data + HEADER_SIZE;
+    if (get_varint (&ptr, end, &n) < 0 || n > (guint64)(end - ptr))
+        return -1;
+    reader->n_strings = (guint32)n;
+
+    if (indexed) {
+        if (get_varint (&ptr, end, &size) < 0 ||
+            4 * n > (guint64)(end - ptr) ||
+            size > (guint64)(end - ptr) - 4 * n)
+            return -1;
+        reader->string_offsets = ptr;
+        reader->string_base = ptr + 4 * n;
+        reader->string_end = reader->string_base + size;
+        ptr = reader->string_end;
+    } else if (index_strings (reader, &ptr) < 0) {
+        goto error;
+    }
+
+    if (get_varint (&ptr, end, &n) < 0 || n > (guint64)(end - ptr))
+        goto error;
+    reader->n_dirents = (guint32)n;
+
+    if (indexed) {
+        if (4 * n > (guint64)(end - ptr))
+            goto error;
+        reader->dirent_offsets = ptr;
+        ptr += 4 * n;
+    }
+    reader->dirent_base = ptr;
+    reader->pos = ptr;
+
+    return 0;
+
+error:
+    seaf_bin_dir_reader_clear (reader);
+    return -1;
+}
+
+static int
+get_string (SeafBinDirReader *reader, const guint8 **ptr,
+            const char **str, guint32 *len)
+{
+    const guint8 *p;
+    guint64 idx, slen;
+    guint32 off;
+
+    if (get_varint (ptr, reader->end, &idx) < 0 || idx >= reader->n_strings)
+        return -1;
+
+    if (reader->strings) {
+        *str = reader->strings[idx].str;
+        *len = reader->strings[idx].len;
+        return 0;
+    }
+
+    off = get_offset (reader->string_offsets, (guint32)idx);
+    if (off >= reader->string_end - reader->string_base)
+        return -1;
+    p = reader->string_base + off;
+    if (get_varint (&p, reader->string_end, &slen) < 0 ||
+        slen > (guint64)(reader->string_end - p))
+        return -1;
+
+    *str = (const char *)p;
+    *len = (guint32)slen;
+    return 0;
+}
+
+static int
+read_dirent (SeafBinDirReader *reader, const guint8 **pos, SeafBinDirent *dent)
+{
+    const guint8 *ptr = *pos;
+    const guint8 *end = reader->end;
+    guint64 val;
+
+    memset (dent, 0, sizeof(SeafBinDirent));
+
+    if (get_varint (&ptr, end, &val) < 0 || val > G_MAXUINT32)
+        return -1;
+    dent->mode = (guint32)val;
+
+    if (end - ptr < 20)
+        return -1;
+    dent->id = ptr;
+    ptr += 20;
+
+    if (get_string (reader, &ptr, &dent->name, &dent->name_len) < 0)
+        return -1;
+
+    if (get_varint (&ptr, end, &val) < 0)
+        return -1;
+    dent->mtime = zigzag_decode (val);
+
+    if (S_ISREG(dent->mode)) {
+        if (get_varint (&ptr, end, &val) < 0)
+            return -1;
+        dent->size = (gint64)val;
+        if (get_string (reader, &ptr, &dent->modifier, &dent->modifier_len) < 0)
+            return -1;
+    }
+
+    *pos = ptr;
+    return 0;
+}
+
+int
+seaf_bin_dir_reader_next (SeafBinDirReader *reader, SeafBinDirent *dent)
+{
+    if (reader->next >= reader->n_dirents)
+        return (reader->pos == reader->end) ? 0 : -1;
+
+    if (read_dirent (reader, &reader->pos, dent) < 0)
+        return -1;
+
+    ++reader->next;
+    return 1;
+}
+
+static int
+read_dirent_at (SeafBinDirReader *reader, guint32 i, SeafBinDirent *dent)
+{
+    const guint8 *ptr;
+    guint32 off = get_offset (reader->dirent_offsets, i);
+
+    if (off >= reader->end - reader->dirent_base)
+        return -1;
+    ptr = reader->dirent_base + off;
+
+    return read_dirent (reader, &ptr, dent);
+}
+
+int
+seaf_bin_dir_lookup (SeafBinDirReader *reader,
+                     const char *name,
+                     guint32 name_len,
+                     SeafBinDirent *dent)
+{
+    const guint8 *ptr;
+    guint32 lo, hi, mid, i;
+    int cmp;
+
+    if (!(reader->flags & SEAF_BIN_FLAG_INDEXED)) {
+        ptr = reader->dirent_base;
+        for (i = 0; i < reader->n_dirents; ++i) {
+            if (read_dirent (reader, &ptr, dent) < 0)
+                return -1;
+            if (compare_names (name, name_len, dent->name, dent->name_len) == 0)
+                return 1;
+        }
+        return 0;
+    }
+
+    /* Dirents are sorted in descending order. */
+    lo = 0;
+    hi = reader->n_dirents;
+    while (lo < hi) {
+        mid = lo + (hi - lo) / 2;
+        if (read_dirent_at (reader, mid, dent) < 0)
+            return -1;
+
+        cmp = compare_names (name, name_len, dent->name, dent->name_len);
+        if (cmp == 0)
+            return 1;
+        else if (cmp > 0)
+            hi = mid;
+        else
+            lo = mid + 1;
+    }
+
+    return 0;
+}
+
+void
+seaf_bin_dir_reader_clear (SeafBinDirReader *reader)
+{
+    g_free (reader->strings);
+    reader->strings = NULL;
+}
@@ -0,0 +1,174 @@
+/* -*- Mode: C; tab-width: 4; indent-tabs-mode: nil; c-basic-offset: 4 -*- */
+
+#ifndef SEAF_FS_BINARY_H
+#define SEAF_FS_BINARY_H
+
+#include <glib.h>
+
+/*
+ * Compact binary encoding for fs objects (object version 2).
+ *
+ * All integers are unsigned LEB128 varints, signed values (mtime) are
+ * zigzag encoded first. Ids are stored as 20-byte raw sha1. Objects are
+ * not compressed, so they can be parsed in place.
+ *
+ * Header:
+ *   magic[4] "SFB2", type (1 byte), version (1 byte), flags (1 byte)
+ *
+ * File object:
+ *   file_size, n_blocks, block_ids[20 * n_blocks]
+ *
+ * Dir object:
+ *   n_strings, { len, bytes[len] } * n_strings
+ *   n_dirents, { mode, id[20], name_idx, mtime,
+ *                [size, modifier_idx] (regular files only) } * n_dirents
+ *
+ * Names and modifiers are stored once in the string table and referenced
+ * by index.
+ *
+ * If SEAF_BIN_FLAG_INDEXED is set, dirents are sorted by name in descending
+ * order (the order of all dir objects) and both tables are preceded by an
+ * array of 4-byte big-endian offsets, so single dirents can be binary
+ * searched without parsing the whole dir:
+ *
+ *   n_strings, strings_size, offsets[4 * n_strings], strings[strings_size]
+ *   n_dirents, offsets[4 * n_dirents], dirents
+ *
+ * Offsets are relative to the first string or dirent.
+ *
+ * The magic never appears at the start of a zlib stream or a version 0
+ * object, so binary objects can be detected by content and read side by
+ * side with the other formats.
+ *
+ * The object id is the sha1 of the encoded data.
+ */
+
+#define SEAF_BIN_MAGIC "SFB2"
+#define SEAF_BIN_MAGIC_LEN 4
+
+#define SEAF_BIN_FLAG_INDEXED 0x01
+
+/* Same values as SeafMetadataType. */
+#define SEAF_BIN_TYPE_FILE 1
+#define SEAF_BIN_TYPE_DIR 3
+
+gboolean
+seaf_bin_is_binary (const guint8 *data, int len);
+
+/* Returns the object type, or -1 if @data is not a valid header. */
+int
+seaf_bin_obj_type (const guint8 *data, int len);
+
+/* File objects. */
+
+guint8 *
+seaf_bin_file_encode (int version,
+                      guint64 file_size,
+                      const guint8 *block_ids,
+                      guint32 n_blocks,
+                      int *len);
+
+/*
+ * Parse a file object in place. @block_ids points into @data, so it's only
+ * valid as long as @data is.
+ */
+int
+seaf_bin_file_parse (const guint8 *data, int len,
+                     int *version,
+                     guint64 *file_size,
+                     const guint8 **block_ids,
+                     guint32 *n_blocks);
+
+/* Dir objects. */
+
+typedef struct SeafBinDirWriter SeafBinDirWriter;
+
+SeafBinDirWriter *
+seaf_bin_dir_writer_new (int version);
+
+/* @id is a 20-byte raw sha1. @modifier and @size are ignored for non-files. */
+void
+seaf_bin_dir_writer_add (SeafBinDirWriter *writer,
+                         guint32 mode,
+                         const guint8 *id,
+                         const char *name,
+                         guint32 name_len,
+                         gint64 mtime,
+                         const char *modifier,
+                         gint64 size);
+
+/*
+ * Returns the encoded object and frees @writer. The object is indexed
+ * if dirents were added in descending name order without duplicates.
+ */
+guint8 *
+seaf_bin_dir_writer_finish (SeafBinDirWriter *writer, int *len);
+
+/*
+ * A dirent pointing into the object data. Strings are not nul-terminated.
+ */
+typedef struct SeafBinDirent {
+    guint32         mode;
+    const guint8   *id;
+    const char     *name;
+    guint32         name_len;
+    gint64          mtime;
+    const char     *modifier;
+    guint32         modifier_len;
+    gint64          size;
+} SeafBinDirent;
+
+typedef struct SeafBinStr {
+    const char  *str;
+    guint32      len;
+} SeafBinStr;
+
+typedef struct SeafBinDirReader {
+    const guint8   *data;
+    const guint8   *end;
+    int             version;
+    int             flags;
+
+    guint32         n_strings;
+    /* String index built on init for objects without offset tables. */
+    SeafBinStr     *strings;
+    const guint8   *string_offsets;
+    const guint8   *string_base;
+    const guint8   *string_end;
+
+    guint32         n_dirents;
+    const guint8   *dirent_offsets;
+    const guint8   *dirent_base;
+
+    guint32         next;
+    const guint8   *pos;
+} SeafBinDirReader;
+
+/*
+ * Validate the header of a dir object. Names and ids are never copied.
+ * For objects that are not indexed the string table is scanned and an
+ * index of it is allocated.
+ */
+int
+seaf_bin_dir_reader_init (SeafBinDirReader *reader,
+                          const guint8 *data, int len);
+
+/* Returns 1 if a dirent is read into @dent, 0 at the end, -1 on error. */
+int
+seaf_bin_dir_reader_next (SeafBinDirReader *reader, SeafBinDirent *dent);
+
+/*
+ * Find the dirent named @name. Indexed objects are binary searched,
+ * others are scanned. The iteration position of @reader is not changed.
+ * Returns 1 if found, 0 if not found, -1 on error.
+ */
+int
+seaf_bin_dir_lookup (SeafBinDirReader *reader,
+                     const char *name,
+                     guint32 name_len,
+                     SeafBinDirent *dent);
+
+void
+seaf_bin_dir_reader_clear (SeafBinDirReader *reader);
+
+#endif
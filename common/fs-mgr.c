@@ -22,6 +22,8 @@
 #include "utils.h"
 #include "seaf-utils.h"
 #include "log.h"
+#include "lru-cache.h"
+#include "fs-binary.h"
 #include "../common/seafile-crypt.h"
 
 #ifndef SEAFILE_SERVER
@@ -33,8 +35,11 @@
 
 #define SEAF_TMP_EXT "~"
 
+#define DEFAULT_OBJ_CACHE_SIZE 128  /* MB */
+
 struct _SeafFSManagerPriv {
-    /* GHashTable      *seafile_cache; */
+    /* Parsed SeafDir and Seafile objects, keyed by "<store_id>/<obj_id>". */
+    LRUCache        *obj_cache;
     GHashTable      *bl_cache;
 };
 
@@ -66,6 +71,18 @@ write_seafile (SeafFSManager *fs_mgr,
                unsigned char *obj_sha1);
 #endif  /* SEAFILE_SERVER */
 
+static gpointer
+fs_object_copy (gpointer obj);
+
+static gint
+compare_dirents (gconstpointer a, gconstpointer b);
+
+static gboolean
+is_dirents_sorted (GList *dirents);
+
+static void
+fs_object_cache_free (gpointer obj);
+
 SeafFSManager *
 seaf_fs_manager_new (SeafileSession *seaf,
                      const char *seaf_dir)
@@ -82,6 +99,23 @@ seaf_fs_manager_new (SeafileSession *seaf,
 
     mgr->priv = g_new0(SeafFSManagerPriv, 1);
 
+#ifdef SEAFILE_SERVER
+    int cache_size;
+    GError *error = NULL;
+
+    /* In MB. Set to 0 to disable the cache. */
+    cache_size = g_key_file_get_integer (seaf->config,
+                                         "fs_cache", "max_size", &error);
+    if (error) {
+        cache_size = DEFAULT_OBJ_CACHE_SIZE;
+        g_clear_error (&error);
+    }
+    if (cache_size > 0)
+        mgr->priv->obj_cache = lru_cache_new ((guint64)cache_size << 20,
+                                              fs_object_copy,
+                                              fs_object_cache_free);
+#endif
+
     return mgr;
 }
 
@@ -349,6 +383,27 @@ create_seafile_v0 (CDCFileDescriptor *cdc, int *ondisk_size, char *seafile_id)
     return ondisk;
 }
 
+static void *
+create_seafile_binary (int repo_version,
+                       CDCFileDescriptor *cdc,
+                       int *ondisk_size,
+                       char *seafile_id)
+{
+    guint8 *data;
+    unsigned char sha1[20];
+
+    data = seaf_bin_file_encode (seafile_version_from_repo_version(repo_version),
+                                 cdc->file_size,
+                                 cdc->blk_sha1s, cdc->block_nr,
+                                 ondisk_size);
+
+    /* The seafile object id is sha1 hash of the encoded object. */
+    calculate_sha1 (sha1, (const char *)data, *ondisk_size);
+    rawdata_to_hex (sha1, seafile_id, 20);
+
+    return data;
+}
+
 static void *
 create_seafile_json (int repo_version,
                      CDCFileDescriptor *cdc,
@@ -395,6 +450,15 @@ seaf_fs_manager_calculate_seafile_id_json (int repo_version,
 {
     json_t *object, *block_id_array;
 
+    if (seafile_version_from_repo_version(repo_version) >= BINARY_SEAFILE_OBJ_VERSION) {
+        char seafile_id[41];
+        int len;
+        void *data = create_seafile_binary (repo_version, cdc, &len, seafile_id);
+        hex_to_rawdata (seafile_id, file_id_sha1, 20);
+        g_free (data);
+        return;
+    }
+
     object = json_object ();
 
     json_object_set_int_member (object, "type", SEAF_METADATA_TYPE_FILE);
@@ -436,7 +500,15 @@ write_seafile (SeafFSManager *fs_mgr,
     void *ondisk;
     int ondisk_size;
 
-    if (version > 0) {
+    if (seafile_version_from_repo_version(version) >= BINARY_SEAFILE_OBJ_VERSION) {
+        /* Binary objects are not compressed. */
+        ondisk = create_seafile_binary (version, cdc, &ondisk_size, seafile_id);
+
+        if (seaf_obj_store_write_obj (fs_mgr->obj_store, repo_id, version, seafile_id,
+                                      ondisk, ondisk_size, FALSE) < 0)
+            ret = -1;
+        g_free (ondisk);
+    } else if (version > 0) {
         ondisk = create_seafile_json (version, cdc, &ondisk_size, seafile_id);
 
         guint8 *compressed;
@@ -633,6 +705,87 @@ seaf_fs_manager_index_blocks (SeafFSManager *mgr,
     return 0;
 }
 
+struct _SeafFileIndexer {
+    SeafFSManager *mgr;
+    CDCFileDescriptor cdc;
+    CDCStream *stream;
+};
+
+SeafFileIndexer *
+seaf_fs_manager_file_indexer_new (SeafFSManager *mgr,
+                                  const char *repo_id,
+                                  int version,
+                                  gint64 size_hint,
+                                  SeafileCrypt *crypt)
+{
+    SeafFileIndexer *indexer = g_new0 (SeafFileIndexer, 1);
+
+    indexer->mgr = mgr;
+    indexer->cdc.block_sz = calculate_chunk_size (MAX (size_hint, 0));
+    indexer->cdc.block_min_sz = indexer->cdc.block_sz >> 2;
+    indexer->cdc.block_max_sz = indexer->cdc.block_sz << 2;
+    indexer->cdc.write_block = seafile_write_chunk;
+    memcpy (indexer->cdc.repo_id, repo_id, 36);
+    indexer->cdc.version = version;
+
+    indexer->stream = cdc_stream_new (&indexer->cdc, crypt, TRUE);
+    if (!indexer->stream) {
+        g_free (indexer);
+        return NULL;
+    }
+
+    return indexer;
+}
+
+int
+seaf_file_indexer_feed (SeafFileIndexer *indexer, const char *buf, size_t len)
+{
+    if (cdc_stream_update (indexer->stream, buf, len) < 0) {
+        g_warning ("Failed to chunk file with CDC.\n");
+        return -1;
+    }
+    return 0;
+}
+
+int
+seaf_file_indexer_finish (SeafFileIndexer *indexer,
+                          unsigned char sha1[],
+                          gint64 *size)
+{
+    CDCFileDescriptor *cdc = &indexer->cdc;
+
+    if (cdc->file_size == 0) {
+        /* Same as seaf_fs_manager_index_blocks() for empty files. */
+        memset (sha1, 0, 20);
+        *size = 0;
+        return 0;
+    }
+
+    if (cdc_stream_finish (indexer->stream) < 0) {
+        g_warning ("Failed to chunk file with CDC.\n");
+        return -1;
+    }
+
+    if (write_seafile (indexer->mgr, cdc->repo_id, cdc->version, cdc, sha1) < 0) {
+        g_warning ("Failed to write seafile.\n");
+        return -1;
+    }
+
+    *size = (gint64)cdc->file_size;
+    return 0;
+}
+
+void
+seaf_file_indexer_free (SeafFileIndexer *indexer)
+{
+    if (!indexer)
+        return;
+
+    cdc_stream_free (indexer->stream);
+    free (indexer->cdc.blk_sha1s);
+    g_free (indexer);
+}
+
 static int
 check_and_write_block (const char *repo_id, int version,
                        const char *path, unsigned char *sha1, const char *block_id)
@@ -934,15 +1087,149 @@ seafile_from_json (const char *id, void *data, int len)
     return seafile;
 }
 
+static Seafile *
+seafile_from_binary (const char *id, const guint8 *data, int len)
+{
+    int version;
+    guint64 file_size;
+    const guint8 *block_ids;
+    guint32 n_blocks;
+    Seafile *seafile;
+    int i;
+
+    if (seaf_bin_file_parse (data, len, &version, &file_size,
+                             &block_ids, &n_blocks) < 0) {
+        seaf_warning ("Corrupt binary seafile object %s.\n", id);
+        return NULL;
+    }
+
+    seafile = g_new0 (Seafile, 1);
+
+    seafile->object.type = SEAF_METADATA_TYPE_FILE;
+
+    memcpy (seafile->file_id, id, 40);
+    seafile->version = version;
+    seafile->file_size = file_size;
+    seafile->n_blocks = n_blocks;
+    seafile->blk_sha1s = g_new0 (char *, n_blocks);
+    for (i = 0; i < n_blocks; ++i) {
+        seafile->blk_sha1s[i] = g_new0 (char, 41);
+        rawdata_to_hex (block_ids + i * 20, seafile->blk_sha1s[i], 20);
+    }
+
+    seafile->ref_count = 1;
+
+    return seafile;
+}
+
+/*
+ * Binary objects are detected by content, so they can be read no matter
+ * what format the repo version implies.
+ */
 static Seafile *
 seafile_from_data (const char *id, void *data, int len, gboolean is_json)
 {
-    if (is_json)
+    if (seaf_bin_is_binary (data, len))
+        return seafile_from_binary (id, data, len);
+    else if (is_json)
         return seafile_from_json (id, data, len);
     else
         return seafile_from_v0_data (id, data, len);
 }
 
+/* Object cache. */
+
+static void
+obj_cache_key (char *key, size_t len, const char *store_id, const char *obj_id)
+{
+    snprintf (key, len, "%s/%s", store_id, obj_id);
+}
+
+static guint64
+seafile_mem_size (Seafile *seafile)
+{
+    return sizeof(Seafile) + (guint64)seafile->n_blocks * (sizeof(char *) + 41);
+}
+
+static guint64
+seaf_dir_mem_size (SeafDir *dir)
+{
+    guint64 size = sizeof(SeafDir) + dir->ondisk_size;
+    SeafDirent *dent;
+    GList *ptr;
+
+    for (ptr = dir->entries; ptr; ptr = ptr->next) {
+        dent = ptr->data;
+        size += sizeof(GList) + sizeof(SeafDirent) + dent->name_len + 1;
+        if (dent->modifier)
+            size += strlen (dent->modifier) + 1;
+    }
+
+    return size;
+}
+
+static Seafile *
+seafile_copy (Seafile *seafile)
+{
+    Seafile *copy;
+    int i;
+
+    copy = g_memdup (seafile, sizeof(Seafile));
+    copy->ref_count = 1;
+    copy->blk_sha1s = g_new0 (char *, seafile->n_blocks);
+    for (i = 0; i < seafile->n_blocks; ++i)
+        copy->blk_sha1s[i] = g_strdup (seafile->blk_sha1s[i]);
+
+    return copy;
+}
+
+static SeafDir *
+seaf_dir_copy (SeafDir *dir)
+{
+    SeafDir *copy;
+    GList *ptr;
+
+    /* Don't use seaf_dir_new(), which serializes the dir again. */
+    copy = g_memdup (dir, sizeof(SeafDir));
+    copy->entries = NULL;
+    for (ptr = dir->entries; ptr; ptr = ptr->next)
+        copy->entries = g_list_prepend (copy->entries,
+                                        seaf_dirent_dup (ptr->data));
+    copy->entries = g_list_reverse (copy->entries);
+    if (dir->ondisk)
+        copy->ondisk = g_memdup (dir->ondisk, dir->ondisk_size);
+
+    return copy;
+}
+
+static gpointer
+fs_object_copy (gpointer obj)
+{
+    if (((SeafFSObject *)obj)->type == SEAF_METADATA_TYPE_FILE)
+        return seafile_copy (obj);
+    else
+        return seaf_dir_copy (obj);
+}
+
+static void
+fs_object_cache_free (gpointer obj)
+{
+    if (((SeafFSObject *)obj)->type == SEAF_METADATA_TYPE_FILE)
+        seafile_unref (obj);
+    else
+        seaf_dir_free (obj);
+}
+
+gboolean
+seaf_fs_manager_get_cache_stats (SeafFSManager *mgr, LRUCacheStats *stats)
+{
+    if (!mgr->priv->obj_cache)
+        return FALSE;
+
+    lru_cache_get_stats (mgr->priv->obj_cache, stats);
+    return TRUE;
+}
+
 Seafile *
 seaf_fs_manager_get_seafile (SeafFSManager *mgr,
                              const char *repo_id,
@@ -952,14 +1239,7 @@ seaf_fs_manager_get_seafile (SeafFSManager *mgr,
     void *data;
     int len;
     Seafile *seafile;
-
-#if 0
-    seafile = g_hash_table_lookup (mgr->priv->seafile_cache, file_id);
-    if (seafile) {
-        seafile_ref (seafile);
-        return seafile;
-    }
-#endif
+    char key[128];
 
     if (memcmp (file_id, EMPTY_SHA1, 40) == 0) {
         seafile = g_new0 (Seafile, 1);
@@ -968,6 +1248,13 @@ seaf_fs_manager_get_seafile (SeafFSManager *mgr,
         return seafile;
     }
 
+    if (mgr->priv->obj_cache) {
+        obj_cache_key (key, sizeof(key), repo_id, file_id);
+        seafile = lru_cache_lookup (mgr->priv->obj_cache, key);
+        if (seafile)
+            return seafile;
+    }
+
     if (seaf_obj_store_read_obj (mgr->obj_store, repo_id, version,
                                  file_id, &data, &len) < 0) {
         g_warning ("[fs mgr] Failed to read file %s.\n", file_id);
@@ -977,13 +1264,9 @@ seaf_fs_manager_get_seafile (SeafFSManager *mgr,
     seafile = seafile_from_data (file_id, data, len, (version > 0));
     g_free (data);
 
-#if 0
-    /*
-     * Add to cache. Also increase ref count.
-     */
-    seafile_ref (seafile);
-    g_hash_table_insert (mgr->priv->seafile_cache, g_strdup(file_id), seafile);
-#endif
+    if (seafile && mgr->priv->obj_cache)
+        lru_cache_insert (mgr->priv->obj_cache, key, seafile,
+                          seafile_mem_size (seafile));
 
     return seafile;
 }
@@ -1039,10 +1322,34 @@ seafile_to_json (Seafile *file, int *len)
     return (guint8 *)data;
 }
 
+static guint8 *
+seafile_to_binary (Seafile *file, int *len)
+{
+    guint8 *block_ids;
+    guint8 *data;
+    unsigned char sha1[20];
+    int i;
+
+    block_ids = g_new (guint8, file->n_blocks * 20);
+    for (i = 0; i < file->n_blocks; ++i)
+        hex_to_rawdata (file->blk_sha1s[i], block_ids + i * 20, 20);
+
+    data = seaf_bin_file_encode (file->version, file->file_size,
+                                 block_ids, file->n_blocks, len);
+    g_free (block_ids);
+
+    calculate_sha1 (sha1, (const char *)data, *len);
+    rawdata_to_hex (sha1, file->file_id, 20);
+
+    return data;
+}
+
 static guint8 *
 seafile_to_data (Seafile *file, int *len)
 {
-    if (file->version > 0) {
+    if (file->version >= BINARY_SEAFILE_OBJ_VERSION) {
+        return seafile_to_binary (file, len);
+    } else if (file->version > 0) {
         guint8 *data;
         int orig_len;
         guint8 *compressed;
@@ -1396,11 +1703,71 @@ seaf_dir_from_json (const char *dir_id, uint8_t *data, int len)
     return dir;
 }
 
+static SeafDirent *
+dirent_from_binary (int version, SeafBinDirent *bin_dent)
+{
+    SeafDirent *dirent = g_new0 (SeafDirent, 1);
+
+    dirent->version = version;
+    dirent->mode = bin_dent->mode;
+    rawdata_to_hex (bin_dent->id, dirent->id, 20);
+    dirent->name_len = bin_dent->name_len;
+    dirent->name = g_strndup (bin_dent->name, bin_dent->name_len);
+    dirent->mtime = bin_dent->mtime;
+    if (S_ISREG(bin_dent->mode)) {
+        dirent->modifier = g_strndup (bin_dent->modifier,
+                                      bin_dent->modifier_len);
+        dirent->size = bin_dent->size;
+    }
+
+    return dirent;
+}
+
+static SeafDir *
+seaf_dir_from_binary (const char *dir_id, const uint8_t *data, int len)
+{
+    SeafBinDirReader reader;
+    SeafBinDirent bin_dent;
+    SeafDirent *dirent;
+    SeafDir *dir;
+    int rc;
+
+    if (seaf_bin_dir_reader_init (&reader, data, len) < 0) {
+        seaf_warning ("Corrupt binary dir object %s.\n", dir_id);
+        return NULL;
+    }
+
+    dir = g_new0 (SeafDir, 1);
+
+    dir->object.type = SEAF_METADATA_TYPE_DIR;
+
+    memcpy (dir->dir_id, dir_id, 40);
+    dir->version = reader.version;
+
+    while ((rc = seaf_bin_dir_reader_next (&reader, &bin_dent)) > 0) {
+        dirent = dirent_from_binary (reader.version, &bin_dent);
+        dir->entries = g_list_prepend (dir->entries, dirent);
+    }
+    dir->entries = g_list_reverse (dir->entries);
+
+    seaf_bin_dir_reader_clear (&reader);
+
+    if (rc < 0) {
+        seaf_warning ("Corrupt binary dir object %s.\n", dir_id);
+        seaf_dir_free (dir);
+        return NULL;
+    }
+
+    return dir;
+}
+
 SeafDir *
 seaf_dir_from_data (const char *dir_id, uint8_t *data, int len,
                     gboolean is_json)
 {
-    if (is_json)
+    if (seaf_bin_is_binary (data, len))
+        return seaf_dir_from_binary (dir_id, data, len);
+    else if (is_json)
         return seaf_dir_from_json (dir_id, data, len);
     else
         return seaf_dir_from_v0_data (dir_id, data, len);
@@ -1497,10 +1864,45 @@ seaf_dir_to_json (SeafDir *dir, int *len)
     return data;
 }
 
+static void *
+seaf_dir_to_binary (SeafDir *dir, int *len)
+{
+    SeafBinDirWriter *writer;
+    GList *ptr;
+    SeafDirent *dirent;
+    guint8 raw_id[20];
+    guint8 *data;
+    unsigned char sha1[20];
+
+    /* Binary dirs are indexed for lookup by name, which requires sorted
+     * dirents.
+     */
+    if (!is_dirents_sorted (dir->entries))
+        dir->entries = g_list_sort (dir->entries, compare_dirents);
+
+    writer = seaf_bin_dir_writer_new (dir->version);
+    for (ptr = dir->entries; ptr; ptr = ptr->next) {
+        dirent = ptr->data;
+        hex_to_rawdata (dirent->id, raw_id, 20);
+        seaf_bin_dir_writer_add (writer, dirent->mode, raw_id,
+                                 dirent->name, dirent->name_len,
+                                 dirent->mtime, dirent->modifier, dirent->size);
+    }
+    data = seaf_bin_dir_writer_finish (writer, len);
+
+    /* The dir object id is sha1 hash of the encoded object. */
+    calculate_sha1 (sha1, (const char *)data, *len);
+    rawdata_to_hex (sha1, dir->dir_id, 20);
+
+    return data;
+}
+
 void *
 seaf_dir_to_data (SeafDir *dir, int *len)
 {
-    if (dir->version > 0) {
+    if (dir->version >= BINARY_DIR_OBJ_VERSION) {
+        return seaf_dir_to_binary (dir, len);
+    } else if (dir->version > 0) {
         guint8 *data;
         int orig_len;
         guint8 *compressed;
@@ -1549,8 +1951,7 @@ seaf_fs_manager_get_seafdir (SeafFSManager *mgr,
     void *data;
     int len;
     SeafDir *dir;
-
-    /* TODO: add hash cache */
+    char key[128];
 
     if (memcmp (dir_id, EMPTY_SHA1, 40) == 0) {
         dir = g_new0 (SeafDir, 1);
@@ -1558,6 +1959,13 @@ seaf_fs_manager_get_seafdir (SeafFSManager *mgr,
         return dir;
     }
 
+    if (mgr->priv->obj_cache) {
+        obj_cache_key (key, sizeof(key), repo_id, dir_id);
+        dir = lru_cache_lookup (mgr->priv->obj_cache, key);
+        if (dir)
+            return dir;
+    }
+
     if (seaf_obj_store_read_obj (mgr->obj_store, repo_id, version,
                                  dir_id, &data, &len) < 0) {
         g_warning ("[fs mgr] Failed to read dir %s.\n", dir_id);
@@ -1567,9 +1975,139 @@ seaf_fs_manager_get_seafdir (SeafFSManager *mgr,
     dir = seaf_dir_from_data (dir_id, data, len, (version > 0));
     g_free (data);
 
+    if (dir && mgr->priv->obj_cache)
+        lru_cache_insert (mgr->priv->obj_cache, key, dir, seaf_dir_mem_size (dir));
+
     return dir;
 }
 
+static void
+prefetch_objects (SeafFSManager *mgr,
+                  const char *repo_id,
+                  int version,
+                  const char **obj_ids,
+                  int n_ids,
+                  gboolean is_dir)
+{
+    OSBatchRead *batch;
+    OSAsyncResult res;
+    SeafDir *dir;
+    Seafile *file;
+    char key[128];
+    int i;
+
+    if (!mgr->priv->obj_cache || n_ids < 2)
+        return;
+
+    batch = seaf_obj_store_batch_read_new (mgr->obj_store, repo_id, version);
+
+    for (i = 0; i < n_ids; ++i) {
+        if (memcmp (obj_ids[i], EMPTY_SHA1, 40) == 0)
+            continue;
+        obj_cache_key (key, sizeof(key), repo_id, obj_ids[i]);
+        if (lru_cache_contains (mgr->priv->obj_cache, key))
+            continue;
+        seaf_obj_store_batch_read_add (batch, obj_ids[i]);
+    }
+
+    while (seaf_obj_store_batch_read_next (batch, &res)) {
+        if (!res.success) {
+            g_free (res.data);
+            continue;
+        }
+
+        obj_cache_key (key, sizeof(key), repo_id, res.obj_id);
+        if (is_dir) {
+            dir = seaf_dir_from_data (res.obj_id, res.data, res.len,
+                                      (version > 0));
+            if (dir) {
+                lru_cache_insert (mgr->priv->obj_cache, key, dir,
+                                  seaf_dir_mem_size (dir));
+                seaf_dir_free (dir);
+            }
+        } else {
+            file = seafile_from_data (res.obj_id, res.data, res.len,
+                                      (version > 0));
+            if (file) {
+                lru_cache_insert (mgr->priv->obj_cache, key, file,
+                                  seafile_mem_size (file));
+                seafile_unref (file);
+            }
+        }
+        g_free (res.data);
+    }
+
+    seaf_obj_store_batch_read_free (batch);
+}
+
+void
+seaf_fs_manager_prefetch_dirs (SeafFSManager *mgr,
+                               const char *repo_id,
+                               int version,
+                               const char **dir_ids,
+                               int n_ids)
+{
+    prefetch_objects (mgr, repo_id, version, dir_ids, n_ids, TRUE);
+}
+
+void
+seaf_fs_manager_prefetch_files (SeafFSManager *mgr,
+                                const char *repo_id,
+                                int version,
+                                const char **file_ids,
+                                int n_ids)
+{
+    prefetch_objects (mgr, repo_id, version, file_ids, n_ids, FALSE);
+}
+
+/* Number of dirs read ahead concurrently by SeafDirPrefetch. */
+#define PREFETCH_WINDOW 32
+
+void
+seaf_dir_prefetch_init (SeafDirPrefetch *prefetch,
+                        SeafFSManager *mgr,
+                        const char *repo_id,
+                        int version)
+{
+    memset (prefetch, 0, sizeof(SeafDirPrefetch));
+    prefetch->mgr = mgr;
+    memcpy (prefetch->repo_id, repo_id, 36);
+    prefetch->version = version;
+    prefetch->ids = g_ptr_array_new ();
+}
+
+void
+seaf_dir_prefetch_add (SeafDirPrefetch *prefetch, const char *dir_id)
+{
+    g_ptr_array_add (prefetch->ids, (gpointer)dir_id);
+}
+
+void
+seaf_dir_prefetch_visit (SeafDirPrefetch *prefetch, int n_dirs)
+{
+    guint n;
+
+    prefetch->n_visited += n_dirs;
+    if (prefetch->n_visited <= prefetch->n_fetched ||
+        prefetch->n_fetched >= prefetch->ids->len)
+        return;
+
+    n = MIN (PREFETCH_WINDOW, prefetch->ids->len - prefetch->n_fetched);
+    seaf_fs_manager_prefetch_dirs (prefetch->mgr,
+                                   prefetch->repo_id, prefetch->version,
+                                   (const char **)prefetch->ids->pdata +
+                                   prefetch->n_fetched,
+                                   n);
+    prefetch->n_fetched += n;
+}
+
+void
+seaf_dir_prefetch_clear (SeafDirPrefetch *prefetch)
+{
+    g_ptr_array_free (prefetch->ids, TRUE);
+    prefetch->ids = NULL;
+}
+
 static gint
 compare_dirents (gconstpointer a, gconstpointer b)
 {
@@ -1667,7 +2205,9 @@ int
 seaf_metadata_type_from_data (const char *obj_id,
                               uint8_t *data, int len, gboolean is_json)
 {
-    if (is_json)
+    if (seaf_bin_is_binary (data, len))
+        return seaf_bin_obj_type (data, len);
+    else if (is_json)
         return parse_metadata_type_json (obj_id, data, len);
     else
         return parse_metadata_type_v0 (data, len);
@@ -1735,7 +2275,17 @@ seaf_fs_object_from_data (const char *obj_id,
                           uint8_t *data, int len,
                           gboolean is_json)
 {
-    if (is_json)
+    int type;
+
+    if (seaf_bin_is_binary (data, len)) {
+        type = seaf_bin_obj_type (data, len);
+        if (type == SEAF_METADATA_TYPE_FILE)
+            return (SeafFSObject *)seafile_from_binary (obj_id, data, len);
+        else if (type == SEAF_METADATA_TYPE_DIR)
+            return (SeafFSObject *)seaf_dir_from_binary (obj_id, data, len);
+        seaf_warning ("Invalid fs type %d.\n", type);
+        return NULL;
+    } else if (is_json)
         return fs_object_from_json (obj_id, data, len);
     else
         return fs_object_from_v0_data (obj_id, data, len);
@@ -1808,6 +2358,97 @@ block_list_difference (BlockList *bl1, BlockList *bl2)
     return bl;
 }
 
+/* Number of ids stored in one slab of FsObjSet. */
+#define FS_OBJ_SET_SLAB_IDS 4096
+
+struct _FsObjSet {
+    GHashTable *hash;
+    GPtrArray  *slabs;
+    guint       slab_used;
+};
+
+static guint
+raw_obj_id_hash (gconstpointer key)
+{
+    guint h;
+
+    /* Sha1 values are already uniformly distributed. */
+    memcpy (&h, key, sizeof(h));
+    return h;
+}
+
+static gboolean
+raw_obj_id_equal (gconstpointer a, gconstpointer b)
+{
+    return (memcmp (a, b, 20) == 0);
+}
+
+FsObjSet *
+fs_obj_set_new ()
+{
+    FsObjSet *set = g_new0 (FsObjSet, 1);
+
+    set->hash = g_hash_table_new (raw_obj_id_hash, raw_obj_id_equal);
+    set->slabs = g_ptr_array_new_with_free_func (g_free);
+    set->slab_used = FS_OBJ_SET_SLAB_IDS;
+
+    return set;
+}
+
+void
+fs_obj_set_free (FsObjSet *set)
+{
+    if (!set)
+        return;
+
+    g_hash_table_destroy (set->hash);
+    g_ptr_array_free (set->slabs, TRUE);
+    g_free (set);
+}
+
+gboolean
+fs_obj_set_contains (FsObjSet *set, const char *obj_id)
+{
+    unsigned char raw[20];
+
+    if (hex_to_rawdata (obj_id, raw, 20) < 0)
+        return FALSE;
+
+    return (g_hash_table_lookup (set->hash, raw) != NULL);
+}
+
+gboolean
+fs_obj_set_add (FsObjSet *set, const char *obj_id)
+{
+    unsigned char raw[20];
+    unsigned char *key, *slab;
+
+    if (hex_to_rawdata (obj_id, raw, 20) < 0)
+        return FALSE;
+
+    if (g_hash_table_lookup (set->hash, raw) != NULL)
+        return FALSE;
+
+    if (set->slab_used == FS_OBJ_SET_SLAB_IDS) {
+        slab = g_new (unsigned char, FS_OBJ_SET_SLAB_IDS * 20);
+        g_ptr_array_add (set->slabs, slab);
+        set->slab_used = 0;
+    }
+    slab = g_ptr_array_index (set->slabs, set->slabs->len - 1);
+    key = slab + (set->slab_used++) * 20;
+    memcpy (key, raw, 20);
+
+    g_hash_table_insert (set->hash, key, key);
+
+    return TRUE;
+}
+
+guint
+fs_obj_set_size (FsObjSet *set)
+{
+    return g_hash_table_size (set->hash);
+}
+
 static int
 traverse_file (SeafFSManager *mgr,
                const char *repo_id,
@@ -1815,17 +2456,24 @@ traverse_file (SeafFSManager *mgr,
                const char *id,
                TraverseFSTreeCallback callback,
                void *user_data,
-               gboolean skip_errors)
+               gboolean skip_errors,
+               FsObjSet *visited)
 {
     gboolean stop = FALSE;
 
     if (memcmp (id, EMPTY_SHA1, 40) == 0)
         return 0;
 
+    if (visited && fs_obj_set_contains (visited, id))
+        return 0;
+
     if (!callback (mgr, repo_id, version, id, SEAF_METADATA_TYPE_FILE, user_data, &stop) &&
         !skip_errors)
         return -1;
 
+    if (visited)
+        fs_obj_set_add (visited, id);
+
     return 0;
 }
 
@@ -1836,13 +2484,17 @@ traverse_dir (SeafFSManager *mgr,
               const char *id,
               TraverseFSTreeCallback callback,
               void *user_data,
-              gboolean skip_errors)
+              gboolean skip_errors,
+              FsObjSet *visited)
 {
     SeafDir *dir;
     GList *p;
     SeafDirent *seaf_dent;
     gboolean stop = FALSE;
 
+    if (visited && fs_obj_set_contains (visited, id))
+        return 0;
+
     if (!callback (mgr, repo_id, version,
                    id, SEAF_METADATA_TYPE_DIR, user_data, &stop) &&
         !skip_errors)
@@ -1863,7 +2515,7 @@ traverse_dir (SeafFSManager *mgr,
 
         if (S_ISREG(seaf_dent->mode)) {
             if (traverse_file (mgr, repo_id, version, seaf_dent->id,
-                               callback, user_data, skip_errors) < 0) {
+                               callback, user_data, skip_errors, visited) < 0) {
                 if (!skip_errors) {
                     seaf_dir_free (dir);
                     return -1;
@@ -1871,7 +2523,7 @@ traverse_dir (SeafFSManager *mgr,
             }
         } else if (S_ISDIR(seaf_dent->mode)) {
             if (traverse_dir (mgr, repo_id, version, seaf_dent->id,
-                              callback, user_data, skip_errors) < 0) {
+                              callback, user_data, skip_errors, visited) < 0) {
                 if (!skip_errors) {
                     seaf_dir_free (dir);
                     return -1;
@@ -1880,6 +2532,10 @@ traverse_dir (SeafFSManager *mgr,
         }
     }
 
+    /* The whole subtree has been traversed, it's safe to skip it next time. */
+    if (visited)
+        fs_obj_set_add (visited, id);
+
     seaf_dir_free (dir);
     return 0;
 }
@@ -1896,7 +2552,25 @@ seaf_fs_manager_traverse_tree (SeafFSManager *mgr,
     if (strcmp (root_id, EMPTY_SHA1) == 0) {
         return 0;
     }
-    return traverse_dir (mgr, repo_id, version, root_id, callback, user_data, skip_errors);
+    return traverse_dir (mgr, repo_id, version, root_id, callback, user_data,
+                         skip_errors, NULL);
+}
+
+int
+seaf_fs_manager_traverse_tree_visited (SeafFSManager *mgr,
+                                       const char *repo_id,
+                                       int version,
+                                       const char *root_id,
+                                       TraverseFSTreeCallback callback,
+                                       void *user_data,
+                                       gboolean skip_errors,
+                                       FsObjSet *visited)
+{
+    if (strcmp (root_id, EMPTY_SHA1) == 0) {
+        return 0;
+    }
+    return traverse_dir (mgr, repo_id, version, root_id, callback, user_data,
+                         skip_errors, visited);
 }
 
 static int
@@ -2148,60 +2822,176 @@ seaf_fs_manager_count_fs_files (SeafFSManager *mgr,
      return count_dir_files (mgr, repo_id, version, root_id);
 }
 
-SeafDir *
-seaf_fs_manager_get_seafdir_by_path (SeafFSManager *mgr,
-                                     const char *repo_id,
-                                     int version,
-                                     const char *root_id,
-                                     const char *path,
-                                     GError **error)
+static SeafDirent *
+find_dirent (SeafDir *dir, const char *name)
+{
+    GList *ptr;
+    SeafDirent *dent;
+
+    for (ptr = dir->entries; ptr; ptr = ptr->next) {
+        dent = ptr->data;
+        if (strcmp (dent->name, name) == 0)
+            return seaf_dirent_dup (dent);
+    }
+
+    return NULL;
+}
+
+static SeafDirent *
+lookup_dirent_in_data (const char *dir_id, uint8_t *data, int len,
+                       const char *name, GError **error)
+{
+    SeafBinDirReader reader;
+    SeafBinDirent bin_dent;
+    SeafDirent *dent = NULL;
+    SeafDir *dir;
+    int rc;
+
+    if (!seaf_bin_is_binary (data, len)) {
+        dir = seaf_dir_from_data (dir_id, data, len, TRUE);
+        if (!dir) {
+            g_set_error (error, SEAFILE_DOMAIN, SEAF_ERR_GENERAL,
+                         "Corrupt dir object %s", dir_id);
+            return NULL;
+        }
+        dent = find_dirent (dir, name);
+        seaf_dir_free (dir);
+        return dent;
+    }
+
+    if (seaf_bin_dir_reader_init (&reader, data, len) < 0) {
+        seaf_warning ("Corrupt binary dir object %s.\n", dir_id);
+        g_set_error (error, SEAFILE_DOMAIN, SEAF_ERR_GENERAL,
+                     "Corrupt dir object %s", dir_id);
+        return NULL;
+    }
+
+    rc = seaf_bin_dir_lookup (&reader, name, strlen(name), &bin_dent);
+    if (rc > 0) {
+        dent = dirent_from_binary (reader.version, &bin_dent);
+    } else if (rc < 0) {
+        seaf_warning ("Corrupt binary dir object %s.\n", dir_id);
+        g_set_error (error, SEAFILE_DOMAIN, SEAF_ERR_GENERAL,
+                     "Corrupt dir object %s", dir_id);
+    }
+
+    seaf_bin_dir_reader_clear (&reader);
+    return dent;
+}
+
+SeafDirent *
+seaf_fs_manager_lookup_dirent (SeafFSManager *mgr,
+                               const char *repo_id,
+                               int version,
+                               const char *dir_id,
+                               const char *name,
+                               GError **error)
 {
     SeafDir *dir;
     SeafDirent *dent;
-    const char *dir_id = root_id;
-    char *name, *saveptr;
-    char *tmp_path = g_strdup(path);
+    void *data;
+    int len;
 
-    dir = seaf_fs_manager_get_seafdir (mgr, repo_id, version, dir_id);
-    if (!dir) {
-        g_set_error (error, SEAFILE_DOMAIN, SEAF_ERR_DIR_MISSING, "directory is missing");
+    if (memcmp (dir_id, EMPTY_SHA1, 40) == 0)
+        return NULL;
+
+    /* Dirs in older formats have to be parsed anyway, so use the
+     * object cache for them.
+     */
+    if (dir_version_from_repo_version (version) < BINARY_DIR_OBJ_VERSION) {
+        dir = seaf_fs_manager_get_seafdir (mgr, repo_id, version, dir_id);
+        if (!dir) {
+            g_set_error (error, SEAFILE_DOMAIN, SEAF_ERR_DIR_MISSING,
+                         "directory is missing");
+            return NULL;
+        }
+        dent = find_dirent (dir, name);
+        seaf_dir_free (dir);
+        return dent;
+    }
+
+    if (seaf_obj_store_read_obj (mgr->obj_store, repo_id, version,
+                                 dir_id, &data, &len) < 0) {
+        g_warning ("[fs mgr] Failed to read dir %s.\n", dir_id);
+        g_set_error (error, SEAFILE_DOMAIN, SEAF_ERR_DIR_MISSING,
+                     "directory is missing");
         return NULL;
     }
 
+    dent = lookup_dirent_in_data (dir_id, data, len, name, error);
+    g_free (data);
+
+    return dent;
+}
+
+/*
+ * Resolve @path to a dir id one path component at a time, so that the
+ * dirs along the path don't have to be parsed completely.
+ */
+static char *
+get_dir_id_by_path (SeafFSManager *mgr,
+                    const char *repo_id,
+                    int version,
+                    const char *root_id,
+                    const char *path,
+                    GError **error)
+{
+    char *dir_id = g_strdup (root_id);
+    char *name, *saveptr;
+    char *tmp_path = g_strdup(path);
+    SeafDirent *dent;
+    GError *tmp_error = NULL;
+
     name = strtok_r (tmp_path, "/", &saveptr);
     while (name != NULL) {
-        GList *l;
-        for (l = dir->entries; l != NULL; l = l->next) {
-            dent = l->data;
+        dent = seaf_fs_manager_lookup_dirent (mgr, repo_id, version,
+                                              dir_id, name, &tmp_error);
+        g_free (dir_id);
+        dir_id = NULL;
 
-            if (strcmp(dent->name, name) == 0 && S_ISDIR(dent->mode)) {
-                dir_id = dent->id;
-                break;
-            }
+        if (tmp_error) {
+            g_propagate_error (error, tmp_error);
+            break;
         }
 
-        if (!l) {
+        if (!dent || !S_ISDIR(dent->mode)) {
             g_set_error (error, SEAFILE_DOMAIN, SEAF_ERR_PATH_NO_EXIST,
                          "Path does not exists %s", path);
-            seaf_dir_free (dir);
-            dir = NULL;
+            if (dent)
+                seaf_dirent_free (dent);
             break;
         }
 
-        SeafDir *prev = dir;
-        dir = seaf_fs_manager_get_seafdir (mgr, repo_id, version, dir_id);
-        seaf_dir_free (prev);
-
-        if (!dir) {
-            g_set_error (error, SEAFILE_DOMAIN, SEAF_ERR_DIR_MISSING,
-                         "directory is missing");
-            break;
-        }
+        dir_id = g_strdup (dent->id);
+        seaf_dirent_free (dent);
 
         name = strtok_r (NULL, "/", &saveptr);
     }
 
     g_free (tmp_path);
+    return dir_id;
+}
+
+SeafDir *
+seaf_fs_manager_get_seafdir_by_path (SeafFSManager *mgr,
+                                     const char *repo_id,
+                                     int version,
+                                     const char *root_id,
+                                     const char *path,
+                                     GError **error)
+{
+    SeafDir *dir;
+    char *dir_id;
+
+    dir_id = get_dir_id_by_path (mgr, repo_id, version, root_id, path, error);
+    if (!dir_id)
+        return NULL;
+
+    dir = seaf_fs_manager_get_seafdir (mgr, repo_id, version, dir_id);
+    if (!dir)
+        g_set_error (error, SEAFILE_DOMAIN, SEAF_ERR_DIR_MISSING, "directory is missing");
+
+    g_free (dir_id);
     return dir;
 }
 
@@ -2217,10 +3007,10 @@ seaf_fs_manager_path_to_obj_id (SeafFSManager *mgr,
     char *copy = g_strdup (path);
     int off = strlen(copy) - 1;
     char *slash, *name;
-    SeafDir *base_dir = NULL;
+    char *base_dir_id = NULL;
     SeafDirent *dent;
-    GList *p;
     char *obj_id = NULL;
+    GError *tmp_error = NULL;
 
     while (off >= 0 && copy[off] == '/')
         copy[off--] = 0;
@@ -2236,23 +3026,13 @@ seaf_fs_manager_path_to_obj_id (SeafFSManager *mgr,
 
     slash = strrchr (copy, '/');
     if (!slash) {
-        base_dir = seaf_fs_manager_get_seafdir (mgr, repo_id, version, root_id);
-        if (!base_dir) {
-            g_warning ("Failed to find root dir %s.\n", root_id);
-            g_set_error (error, SEAFILE_DOMAIN, SEAF_ERR_GENERAL, " ");
-            goto out;
-        }
+        base_dir_id = g_strdup (root_id);
         name = copy;
     } else {
         *slash = 0;
         name = slash + 1;
-        GError *tmp_error = NULL;
-        base_dir = seaf_fs_manager_get_seafdir_by_path (mgr,
-                                                        repo_id,
-                                                        version,
-                                                        root_id,
-                                                        copy,
-                                                        &tmp_error);
+        base_dir_id = get_dir_id_by_path (mgr, repo_id, version,
+                                          root_id, copy, &tmp_error);
         if (tmp_error &&
             !g_error_matches(tmp_error,
                              SEAFILE_DOMAIN,
@@ -2263,24 +3043,30 @@ seaf_fs_manager_path_to_obj_id (SeafFSManager *mgr,
         }
 
         /* The path doesn't exist in this commit. */
-        if (!base_dir)
+        if (!base_dir_id) {
+            g_clear_error (&tmp_error);
             goto out;
+        }
     }
 
-    for (p = base_dir->entries; p != NULL; p = p->next) {
-        dent = p->data;
-        if (strcmp (dent->name, name) == 0) {
-            obj_id = g_strdup (dent->id);
-            if (mode) {
-                *mode = dent->mode;
-            }
-            break;
+    dent = seaf_fs_manager_lookup_dirent (mgr, repo_id, version,
+                                          base_dir_id, name, &tmp_error);
+    if (tmp_error) {
+        g_warning ("Failed to find dir %s.\n", base_dir_id);
+        g_propagate_error (error, tmp_error);
+        goto out;
+    }
+
+    if (dent) {
+        obj_id = g_strdup (dent->id);
+        if (mode) {
+            *mode = dent->mode;
         }
+        seaf_dirent_free (dent);
     }
 
 out:
-    if (base_dir)
-        seaf_dir_free (base_dir);
+    g_free (base_dir_id);
     g_free (copy);
     return obj_id;
 }
@@ -2343,7 +3129,7 @@ seaf_fs_manager_get_dirent_by_path (SeafFSManager *mgr,
                                     const char *path)
 {
     SeafDirent *dent = NULL;
-    SeafDir *dir = NULL;
+    char *dir_id = NULL;
     char *parent_dir = NULL;
     char *file_name = NULL;
 
@@ -2351,28 +3137,23 @@ seaf_fs_manager_get_dirent_by_path (SeafFSManager *mgr,
     file_name = g_path_get_basename(path);
 
     if (strcmp (parent_dir, ".") == 0)
-        dir = seaf_fs_manager_get_seafdir (mgr, repo_id, version, root_id);
+        dir_id = g_strdup (root_id);
     else
-        dir = seaf_fs_manager_get_seafdir_by_path (mgr, repo_id, version,
-                                                   root_id, parent_dir, NULL);
+        dir_id = get_dir_id_by_path (mgr, repo_id, version,
+                                     root_id, parent_dir, NULL);
 
-    if (!dir) {
+    if (!dir_id) {
         seaf_warning ("dir %s doesn't exist in repo %.8s.\n", parent_dir, repo_id);
         goto out;
     }
 
-    GList *p;
-    for (p = dir->entries; p; p = p->next) {
-        SeafDirent *d = p->data;
-        if (strcmp (d->name, file_name) == 0) {
-            dent = seaf_dirent_dup(d);
-            break;
-        }
-    }
+    dent = seaf_fs_manager_lookup_dirent (mgr, repo_id, version,
+                                          dir_id, file_name, NULL);
 
 out:
-    if (dir)
-        seaf_dir_free (dir);
+    g_free (dir_id);
+    g_free (parent_dir);
+    g_free (file_name);
 
     return dent;
 }
@@ -2472,11 +3253,35 @@ verify_fs_object_json (const char *obj_id, uint8_t *data, int len)
     return (strcmp(hex, obj_id) == 0);
 }
 
+static gboolean
+verify_fs_object_binary (const char *obj_id, uint8_t *data, int len,
+                         gboolean verify_id)
+{
+    SeafFSObject *obj;
+    unsigned char sha1[20];
+    char hex[41];
+
+    if (verify_id) {
+        calculate_sha1 (sha1, (const char *)data, len);
+        rawdata_to_hex (sha1, hex, 20);
+        return (strcmp(hex, obj_id) == 0);
+    }
+
+    obj = seaf_fs_object_from_data (obj_id, data, len, TRUE);
+    if (!obj)
+        return FALSE;
+    seaf_fs_object_free (obj);
+    return TRUE;
+}
+
 static gboolean
 verify_seafdir (const char *dir_id, uint8_t *data, int len,
                 gboolean verify_id, gboolean is_json)
 {
-    if (is_json)
+    if (seaf_bin_is_binary (data, len))
+        return (seaf_bin_obj_type (data, len) == SEAF_METADATA_TYPE_DIR &&
+                verify_fs_object_binary (dir_id, data, len, verify_id));
+    else if (is_json)
         return verify_fs_object_json (dir_id, data, len);
     else
         return verify_seafdir_v0 (dir_id, data, len, verify_id);
@@ -2553,7 +3358,10 @@ static gboolean
 verify_seafile (const char *id, void *data, int len,
                 gboolean verify_id, gboolean is_json)
 {
-    if (is_json)
+    if (seaf_bin_is_binary (data, len))
+        return (seaf_bin_obj_type (data, len) == SEAF_METADATA_TYPE_FILE &&
+                verify_fs_object_binary (id, data, len, verify_id));
+    else if (is_json)
         return verify_fs_object_json (id, data, len);
     else
         return verify_seafile_v0 (id, data, len, verify_id);
@@ -2634,7 +3442,9 @@ seaf_fs_manager_verify_object (SeafFSManager *mgr,
         return FALSE;
     }
 
-    if (version == 0)
+    if (seaf_bin_is_binary (data, len))
+        ret = verify_fs_object_binary (obj_id, data, len, verify_id);
+    else if (version == 0)
         ret = verify_fs_object_v0 (obj_id, data, len, verify_id);
     else
         ret = verify_fs_object_json (obj_id, data, len);
@@ -2648,6 +3458,8 @@ dir_version_from_repo_version (int repo_version)
 {
     if (repo_version == 0)
         return 0;
+    else if (repo_version >= BINARY_FS_REPO_VERSION)
+        return BINARY_DIR_OBJ_VERSION;
     else
         return CURRENT_DIR_OBJ_VERSION;
 }
@@ -2657,6 +3469,8 @@ seafile_version_from_repo_version (int repo_version)
 {
     if (repo_version == 0)
         return 0;
+    else if (repo_version >= BINARY_FS_REPO_VERSION)
+        return BINARY_SEAFILE_OBJ_VERSION;
     else
         return CURRENT_SEAFILE_OBJ_VERSION;
 }
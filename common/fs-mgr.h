@@ -8,6 +8,7 @@
 #include "seafile-object.h"
 
 #include "obj-store.h"
+#include "lru-cache.h"
 
 #include "cdc/cdc.h"
 #include "../common/seafile-crypt.h"
@@ -15,6 +16,12 @@
 #define CURRENT_DIR_OBJ_VERSION 1
 #define CURRENT_SEAFILE_OBJ_VERSION 1
 
+/* Objects in compact binary format, used by repos of BINARY_FS_REPO_VERSION.
+ * See fs-binary.h.
+ */
+#define BINARY_DIR_OBJ_VERSION 2
+#define BINARY_SEAFILE_OBJ_VERSION 2
+
 typedef struct _SeafFSManager SeafFSManager;
 typedef struct _SeafFSObject SeafFSObject;
 typedef struct _Seafile Seafile;
@@ -146,6 +153,30 @@ block_list_insert (BlockList *bl, const char *block_id);
 BlockList *
 block_list_difference (BlockList *bl1, BlockList *bl2);
 
+/*
+ * A compact set of fs object ids. Ids are stored as 20-byte raw sha1
+ * in large slabs, so it's much cheaper than a string hash table when
+ * tracking millions of objects during GC or fsck.
+ * Not MT safe.
+ */
+typedef struct _FsObjSet FsObjSet;
+
+FsObjSet *
+fs_obj_set_new ();
+
+void
+fs_obj_set_free (FsObjSet *set);
+
+/* Return FALSE if @obj_id is already in the set, TRUE otherwise. */
+gboolean
+fs_obj_set_add (FsObjSet *set, const char *obj_id);
+
+gboolean
+fs_obj_set_contains (FsObjSet *set, const char *obj_id);
+
+guint
+fs_obj_set_size (FsObjSet *set);
+
 struct _SeafileSession;
 
 typedef struct _SeafFSManagerPriv SeafFSManagerPriv;
@@ -206,6 +237,32 @@ seaf_fs_manager_index_blocks (SeafFSManager *mgr,
                               SeafileCrypt *crypt,
                               gboolean write_data);
 
+/*
+ * Index a file whose content arrives piece by piece, e.g. from an upload.
+ * Blocks are written as soon as they're cut, so no temp file is needed.
+ * @size_hint is the expected file size, used to choose the block size.
+ */
+typedef struct _SeafFileIndexer SeafFileIndexer;
+
+SeafFileIndexer *
+seaf_fs_manager_file_indexer_new (SeafFSManager *mgr,
+                                  const char *repo_id,
+                                  int version,
+                                  gint64 size_hint,
+                                  SeafileCrypt *crypt);
+
+int
+seaf_file_indexer_feed (SeafFileIndexer *indexer, const char *buf, size_t len);
+
+/* Write the last block and the seafile object. Returns the file id in @sha1. */
+int
+seaf_file_indexer_finish (SeafFileIndexer *indexer,
+                          unsigned char sha1[],
+                          gint64 *size);
+
+void
+seaf_file_indexer_free (SeafFileIndexer *indexer);
+
 Seafile *
 seaf_fs_manager_get_seafile (SeafFSManager *mgr,
                              const char *repo_id,
@@ -218,6 +275,66 @@ seaf_fs_manager_get_seafdir (SeafFSManager *mgr,
                              int version,
                              const char *dir_id);
 
+/*
+ * Get counters of the parsed object cache.
+ * Returns FALSE if the cache is disabled.
+ */
+gboolean
+seaf_fs_manager_get_cache_stats (SeafFSManager *mgr, LRUCacheStats *stats);
+
+/*
+ * Read dirs @dir_ids concurrently into the object cache, so that a tree
+ * traversal doesn't wait for them one at a time. Dirs already cached are
+ * skipped. Does nothing if the object cache is disabled.
+ */
+void
+seaf_fs_manager_prefetch_dirs (SeafFSManager *mgr,
+                               const char *repo_id,
+                               int version,
+                               const char **dir_ids,
+                               int n_ids);
+
+/* Same as seaf_fs_manager_prefetch_dirs(), for file objects. */
+void
+seaf_fs_manager_prefetch_files (SeafFSManager *mgr,
+                                const char *repo_id,
+                                int version,
+                                const char **file_ids,
+                                int n_ids);
+
+/*
+ * Read ahead the sub-dirs a traversal is going to visit, a window of them
+ * at a time. Add dir ids in the order they'll be visited, then call
+ * seaf_dir_prefetch_visit() before visiting each of them.
+ */
+typedef struct SeafDirPrefetch {
+    SeafFSManager  *mgr;
+    char            repo_id[37];
+    int             version;
+    /* Ids are not copied, they must stay valid until the prefetch is
+     * cleared.
+     */
+    GPtrArray      *ids;
+    guint           n_fetched;
+    guint           n_visited;
+} SeafDirPrefetch;
+
+void
+seaf_dir_prefetch_init (SeafDirPrefetch *prefetch,
+                        SeafFSManager *mgr,
+                        const char *repo_id,
+                        int version);
+
+void
+seaf_dir_prefetch_add (SeafDirPrefetch *prefetch, const char *dir_id);
+
+/* Called before visiting the next @n_dirs sub-dirs. */
+void
+seaf_dir_prefetch_visit (SeafDirPrefetch *prefetch, int n_dirs);
+
+void
+seaf_dir_prefetch_clear (SeafDirPrefetch *prefetch);
+
 /* Make sure entries in the returned dir is sorted in descending order.
  */
 SeafDir *
@@ -226,6 +343,20 @@ seaf_fs_manager_get_seafdir_sorted (SeafFSManager *mgr,
                                     int version,
                                     const char *dir_id);
 
+/*
+ * Find the dirent named @name in dir @dir_id. Dirs in the indexed binary
+ * format are binary searched without parsing the whole dir.
+ * Returns NULL if the name is not found, or with @error set if the dir
+ * can't be read.
+ */
+SeafDirent *
+seaf_fs_manager_lookup_dirent (SeafFSManager *mgr,
+                               const char *repo_id,
+                               int version,
+                               const char *dir_id,
+                               const char *name,
+                               GError **error);
+
 int
 seaf_fs_manager_populate_blocklist (SeafFSManager *mgr,
                                     const char *repo_id,
@@ -253,6 +384,26 @@ seaf_fs_manager_traverse_tree (SeafFSManager *mgr,
                                void *user_data,
                                gboolean skip_errors);
 
+/*
+ * Same as seaf_fs_manager_traverse_tree(), but objects already in @visited
+ * are skipped together with their subtrees. A dir is added to @visited
+ * only after its whole subtree has been traversed successfully (or with
+ * errors skipped), so a failed traversal never hides a broken subtree
+ * from a later one.
+ *
+ * Pass the same set for all commits of a repo to traverse each unique
+ * object in the history only once.
+ */
+int
+seaf_fs_manager_traverse_tree_visited (SeafFSManager *mgr,
+                                       const char *repo_id,
+                                       int version,
+                                       const char *root_id,
+                                       TraverseFSTreeCallback callback,
+                                       void *user_data,
+                                       gboolean skip_errors,
+                                       FsObjSet *visited);
+
 typedef gboolean (*TraverseFSPathCallback) (SeafFSManager *mgr,
                                             const char *path,
                                             SeafDirent *dent,
@@ -0,0 +1,203 @@
+/* -*- Mode: C; tab-width: 4; indent-tabs-mode: nil; c-basic-offset: 4 -*- */
+
+#include "common.h"
+
+#include <pthread.h>
+
+#include "lru-cache.h"
+
+typedef struct CacheNode {
+    char       *key;
+    gpointer    value;
+    guint64     size;
+    /* Link in the LRU list. NULL after the node is evicted. */
+    GList      *link;
+    /* Held by the cache and by lookups copying the value. */
+    int         ref;
+} CacheNode;
+
+struct LRUCache {
+    guint64             max_bytes;
+    LRUCacheCopyFunc    copy_value;
+    GDestroyNotify      free_value;
+
+    pthread_mutex_t     lock;
+    GHashTable         *nodes;
+    /* Most recently used first. */
+    GQueue             *lru;
+    guint64             bytes;
+
+    guint64             hits;
+    guint64             misses;
+    guint64             evictions;
+};
+
+static void
+node_unref (LRUCache *cache, CacheNode *node)
+{
+    if (--node->ref > 0)
+        return;
+
+    cache->free_value (node->value);
+    g_free (node->key);
+    g_free (node);
+}
+
+/* Remove the least recently used node. Must be called with lock held. */
+static void
+evict_one (LRUCache *cache)
+{
+    CacheNode *node = g_queue_pop_tail (cache->lru);
+
+    g_hash_table_remove (cache->nodes, node->key);
+    node->link = NULL;
+    cache->bytes -= node->size;
+    ++cache->evictions;
+
+    node_unref (cache, node);
+}
+
+LRUCache *
+lru_cache_new (guint64 max_bytes,
+               LRUCacheCopyFunc copy_value,
+               GDestroyNotify free_value)
+{
+    LRUCache *cache = g_new0 (LRUCache, 1);
+
+    cache->max_bytes = max_bytes;
+    cache->copy_value = copy_value;
+    cache->free_value = free_value;
+    pthread_mutex_init (&cache->lock, NULL);
+    cache->nodes = g_hash_table_new (g_str_hash, g_str_equal);
+    cache->lru = g_queue_new ();
+
+    return cache;
+}
+
+void
+lru_cache_free (LRUCache *cache)
+{
+    if (!cache)
+        return;
+
+    while (!g_queue_is_empty (cache->lru))
+        evict_one (cache);
+
+    g_hash_table_destroy (cache->nodes);
+    g_queue_free (cache->lru);
+    pthread_mutex_destroy (&cache->lock);
+    g_free (cache);
+}
+
+gpointer
+lru_cache_lookup (LRUCache *cache, const char *key)
+{
+    CacheNode *node;
+    gpointer copy;
+
+    pthread_mutex_lock (&cache->lock);
+
+    node = g_hash_table_lookup (cache->nodes, key);
+    if (!node) {
+        ++cache->misses;
+        pthread_mutex_unlock (&cache->lock);
+        return NULL;
+    }
+
+    ++cache->hits;
+    ++node->ref;
+    g_queue_unlink (cache->lru, node->link);
+    g_queue_push_head_link (cache->lru, node->link);
+
+    pthread_mutex_unlock (&cache->lock);
+
+    /* The value is immutable, so it's safe to copy it without the lock. */
+    copy = cache->copy_value (node->value);
+
+    pthread_mutex_lock (&cache->lock);
+    node_unref (cache, node);
+    pthread_mutex_unlock (&cache->lock);
+
+    return copy;
+}
+
+gboolean
+lru_cache_contains (LRUCache *cache, const char *key)
+{
+    gboolean ret;
+
+    pthread_mutex_lock (&cache->lock);
+    ret = (g_hash_table_lookup (cache->nodes, key) != NULL);
+    pthread_mutex_unlock (&cache->lock);
+
+    return ret;
+}
+
+void
+lru_cache_insert (LRUCache *cache, const char *key,
+                  gpointer value, guint64 size)
+{
+    CacheNode *node;
+
+    if (size > cache->max_bytes)
+        return;
+
+    node = g_new0 (CacheNode, 1);
+    node->key = g_strdup (key);
+    node->value = cache->copy_value (value);
+    node->size = size;
+    node->ref = 1;
+
+    pthread_mutex_lock (&cache->lock);
+
+    /* Another thread may have cached the same object. */
+    if (g_hash_table_lookup (cache->nodes, key) != NULL) {
+        node_unref (cache, node);
+        pthread_mutex_unlock (&cache->lock);
+        return;
+    }
+
+    while (cache->bytes + size > cache->max_bytes)
+        evict_one (cache);
+
+    g_queue_push_head (cache->lru, node);
+    node->link = g_queue_peek_head_link (cache->lru);
+    g_hash_table_insert (cache->nodes, node->key, node);
+    cache->bytes += size;
+
+    pthread_mutex_unlock (&cache->lock);
+}
+
+void
+lru_cache_remove (LRUCache *cache, const char *key)
+{
+    CacheNode *node;
+
+    pthread_mutex_lock (&cache->lock);
+
+    node = g_hash_table_lookup (cache->nodes, key);
+    if (node) {
+        g_hash_table_remove (cache->nodes, node->key);
+        g_queue_delete_link (cache->lru, node->link);
+        node->link = NULL;
+        cache->bytes -= node->size;
+        node_unref (cache, node);
+    }
+
+    pthread_mutex_unlock (&cache->lock);
+}
+
+void
+lru_cache_get_stats (LRUCache *cache, LRUCacheStats *stats)
+{
+    pthread_mutex_lock (&cache->lock);
+
+    stats->hits = cache->hits;
+    stats->misses = cache->misses;
+    stats->evictions = cache->evictions;
+    stats->n_items = g_hash_table_size (cache->nodes);
+    stats->bytes = cache->bytes;
+    stats->max_bytes = cache->max_bytes;
+
+    pthread_mutex_unlock (&cache->lock);
+}
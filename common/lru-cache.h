@@ -0,0 +1,61 @@
+/* -*- Mode: C; tab-width: 4; indent-tabs-mode: nil; c-basic-offset: 4 -*- */
+
+#ifndef LRU_CACHE_H
+#define LRU_CACHE_H
+
+#include <glib.h>
+
+/*
+ * A thread-safe LRU cache bounded by the total size of cached values.
+ *
+ * Values are owned by the cache. They're never handed out directly:
+ * lookup returns a copy made with @copy_value, so callers are free to
+ * modify or free what they get.
+ */
+
+typedef struct LRUCache LRUCache;
+
+typedef gpointer (*LRUCacheCopyFunc) (gpointer value);
+
+typedef struct LRUCacheStats {
+    guint64     hits;
+    guint64     misses;
+    guint64     evictions;
+    guint64     n_items;
+    guint64     bytes;
+    guint64     max_bytes;
+} LRUCacheStats;
+
+LRUCache *
+lru_cache_new (guint64 max_bytes,
+               LRUCacheCopyFunc copy_value,
+               GDestroyNotify free_value);
+
+void
+lru_cache_free (LRUCache *cache);
+
+/* Returns a copy of the cached value, or NULL if @key is not cached. */
+gpointer
+lru_cache_lookup (LRUCache *cache, const char *key);
+
+/* Check for @key without copying the value or counting a hit. */
+gboolean
+lru_cache_contains (LRUCache *cache, const char *key);
+
+/*
+ * Add a copy of @value to the cache. @size is the memory taken by the value.
+ * Nothing is done if @key is already cached or @value is larger than the
+ * whole cache.
+ */
+void
+lru_cache_insert (LRUCache *cache, const char *key,
+                  gpointer value, guint64 size);
+
+/* Drop @key from the cache, e.g. when the object is deleted. */
+void
+lru_cache_remove (LRUCache *cache, const char *key);
+
+void
+lru_cache_get_stats (LRUCache *cache, LRUCacheStats *stats);
+
+#endif
@@ -0,0 +1,678 @@
+/* -*- Mode: C; tab-width: 4; indent-tabs-mode: nil; c-basic-offset: 4 -*- */
+
+/*
+ * A backend keeping copies of objects on local disk in front of another
+ * (usually remote) backend.
+ *
+ * Reads are served from the local copy if there is one, otherwise the
+ * object is read from the remote backend and copied to local disk.
+ * Writes go to the remote backend first and then to local disk, so the
+ * remote backend always has every object and the local copies can be
+ * dropped at any time.
+ *
+ * Local copies are stored as <cache_dir>/<repo_id>/<xx>/<rest of id>.
+ * Total size is bounded, the least recently used copies are removed first.
+ * The index is kept in memory and rebuilt from the cache dir on start.
+ *
+ * The cache dir is owned by one process. Other processes sharing it are
+ * read-only users: they read local copies directly from disk, but never
+ * add, remove or scan copies, so the size budget is only applied once.
+ */
+
+#include "common.h"
+
+#include <pthread.h>
+
+#include "utils.h"
+#include "obj-backend.h"
+#include "lru-cache.h"
+
+#define DEBUG_FLAG SEAFILE_DEBUG_OTHER
+#include "log.h"
+
+typedef struct CacheEntry {
+    /* Path relative to cache_dir. */
+    char       *key;
+    guint64     size;
+    GList      *link;
+} CacheEntry;
+
+typedef struct CachePriv {
+    ObjBackend         *remote;
+    char               *cache_dir;
+    guint64             max_bytes;
+    gboolean            read_only;
+
+    pthread_mutex_t     lock;
+    GHashTable         *entries;
+    /* Most recently used first. */
+    GQueue             *lru;
+    guint64             bytes;
+
+    guint64             hits;
+    guint64             misses;
+    guint64             evictions;
+} CachePriv;
+
+static void
+make_key (char key[], const char *repo_id, const char *obj_id)
+{
+    snprintf (key, SEAF_PATH_MAX, "%s/%.2s/%s", repo_id, obj_id, obj_id + 2);
+}
+
+static char *
+key_to_path (CachePriv *priv, const char *key)
+{
+    return g_build_filename (priv->cache_dir, key, NULL);
+}
+
+static void
+entry_free (CacheEntry *entry)
+{
+    g_free (entry->key);
+    g_free (entry);
+}
+
+/*
+ * Unlink the entry from the index. The caller is responsible for
+ * removing the file. Must be called with lock held.
+ */
+static void
+remove_entry (CachePriv *priv, CacheEntry *entry)
+{
+    g_hash_table_remove (priv->entries, entry->key);
+    g_queue_delete_link (priv->lru, entry->link);
+    priv->bytes -= entry->size;
+}
+
+static void
+unlink_entries (CachePriv *priv, GList *evicted)
+{
+    GList *ptr;
+    CacheEntry *entry;
+    char *path;
+
+    for (ptr = evicted; ptr; ptr = ptr->next) {
+        entry = ptr->data;
+        path = key_to_path (priv, entry->key);
+        g_unlink (path);
+        g_free (path);
+        entry_free (entry);
+    }
+    g_list_free (evicted);
+}
+
+/*
+ * Add an entry and evict least recently used ones to make room.
+ * Returns the evicted entries, to be removed with unlink_entries() after
+ * the lock is released. Must be called with lock held.
+ */
+static GList *
+add_entry (CachePriv *priv, const char *key, guint64 size)
+{
+    CacheEntry *entry;
+    GList *evicted = NULL;
+
+    entry = g_hash_table_lookup (priv->entries, key);
+    if (entry) {
+        /* Rewritten by another thread, the contents are the same. */
+        g_queue_unlink (priv->lru, entry->link);
+        g_queue_push_head_link (priv->lru, entry->link);
+        return NULL;
+    }
+
+    while (priv->bytes + size > priv->max_bytes &&
+           !g_queue_is_empty (priv->lru)) {
+        entry = g_queue_peek_tail (priv->lru);
+        remove_entry (priv, entry);
+        evicted = g_list_prepend (evicted, entry);
+        ++priv->evictions;
+    }
+
+    entry = g_new0 (CacheEntry, 1);
+    entry->key = g_strdup (key);
+    entry->size = size;
+    g_queue_push_head (priv->lru, entry);
+    entry->link = g_queue_peek_head_link (priv->lru);
+    g_hash_table_insert (priv->entries, entry->key, entry);
+    priv->bytes += size;
+
+    return evicted;
+}
+
+static void
+cache_insert (CachePriv *priv, const char *key, void *data, int len)
+{
+    char *path, *dir;
+    GError *error = NULL;
+    GList *evicted;
+
+    if (priv->read_only || (guint64)len > priv->max_bytes)
+        return;
+
+    path = key_to_path (priv, key);
+    dir = g_path_get_dirname (path);
+    if (g_mkdir_with_parents (dir, 0777) < 0) {
+        seaf_warning ("[obj cache] Failed to create %s: %s.\n",
+                      dir, strerror(errno));
+        goto out;
+    }
+
+    /* Written to a temp file and renamed, so readers never see partial
+     * contents. No need to sync, the remote backend has the object.
+     */
+    if (!g_file_set_contents (path, data, len, &error)) {
+        seaf_warning ("[obj cache] Failed to write %s: %s.\n",
+                      path, error->message);
+        g_clear_error (&error);
+        goto out;
+    }
+
+    pthread_mutex_lock (&priv->lock);
+    evicted = add_entry (priv, key, (guint64)len);
+    pthread_mutex_unlock (&priv->lock);
+
+    unlink_entries (priv, evicted);
+
+out:
+    g_free (dir);
+    g_free (path);
+}
+
+static void
+cache_remove (CachePriv *priv, const char *key)
+{
+    CacheEntry *entry;
+
+    if (priv->read_only)
+        return;
+
+    pthread_mutex_lock (&priv->lock);
+    entry = g_hash_table_lookup (priv->entries, key);
+    if (entry)
+        remove_entry (priv, entry);
+    pthread_mutex_unlock (&priv->lock);
+
+    if (entry)
+        unlink_entries (priv, g_list_prepend (NULL, entry));
+}
+
+/* Read-only users have no index, the local copy is read if it's there. */
+static int
+cache_read_file (CachePriv *priv, const char *key, void **data, int *len)
+{
+    char *path;
+    gsize tmp_len;
+    gboolean ret;
+
+    path = key_to_path (priv, key);
+    ret = g_file_get_contents (path, (gchar **)data, &tmp_len, NULL);
+    g_free (path);
+
+    pthread_mutex_lock (&priv->lock);
+    if (ret)
+        ++priv->hits;
+    else
+        ++priv->misses;
+    pthread_mutex_unlock (&priv->lock);
+
+    if (!ret)
+        return -1;
+
+    *len = (int)tmp_len;
+    return 0;
+}
+
+/* Returns 0 if @key is cached and could be read. */
+static int
+cache_read (CachePriv *priv, const char *key, void **data, int *len)
+{
+    CacheEntry *entry;
+    char *path;
+    gsize tmp_len;
+
+    if (priv->read_only)
+        return cache_read_file (priv, key, data, len);
+
+    pthread_mutex_lock (&priv->lock);
+    entry = g_hash_table_lookup (priv->entries, key);
+    if (!entry) {
+        ++priv->misses;
+        pthread_mutex_unlock (&priv->lock);
+        return -1;
+    }
+    g_queue_unlink (priv->lru, entry->link);
+    g_queue_push_head_link (priv->lru, entry->link);
+    pthread_mutex_unlock (&priv->lock);
+
+    path = key_to_path (priv, key);
+    if (!g_file_get_contents (path, (gchar **)data, &tmp_len, NULL)) {
+        /* Removed from disk, or evicted by another thread meanwhile. */
+        g_free (path);
+        cache_remove (priv, key);
+
+        pthread_mutex_lock (&priv->lock);
+        ++priv->misses;
+        pthread_mutex_unlock (&priv->lock);
+        return -1;
+    }
+    g_free (path);
+
+    pthread_mutex_lock (&priv->lock);
+    ++priv->hits;
+    pthread_mutex_unlock (&priv->lock);
+
+    *len = (int)tmp_len;
+    return 0;
+}
+
+static int
+obj_backend_cache_read (ObjBackend *bend,
+                        const char *repo_id,
+                        int version,
+                        const char *obj_id,
+                        void **data,
+                        int *len)
+{
+    CachePriv *priv = bend->priv;
+    char key[SEAF_PATH_MAX];
+
+    make_key (key, repo_id, obj_id);
+
+    if (cache_read (priv, key, data, len) == 0)
+        return 0;
+
+    if (priv->remote->read (priv->remote, repo_id, version,
+                            obj_id, data, len) < 0)
+        return -1;
+
+    cache_insert (priv, key, *data, *len);
+    return 0;
+}
+
+/* Objects missing in the cache are read from the remote backend at once. */
+static int
+obj_backend_cache_read_batch (ObjBackend *bend,
+                              const char *repo_id,
+                              int version,
+                              const char **obj_ids,
+                              int n,
+                              void **data,
+                              int *lens)
+{
+    CachePriv *priv = bend->priv;
+    char key[SEAF_PATH_MAX];
+    const char **missing_ids;
+    int *missing;
+    void **missing_data;
+    int *missing_lens;
+    int n_missing = 0, n_read = 0;
+    int i;
+
+    missing = g_new (int, n);
+    missing_ids = g_new (const char *, n);
+
+    for (i = 0; i < n; ++i) {
+        make_key (key, repo_id, obj_ids[i]);
+        if (cache_read (priv, key, &data[i], &lens[i]) == 0) {
+            ++n_read;
+            continue;
+        }
+        data[i] = NULL;
+        lens[i] = 0;
+        missing[n_missing] = i;
+        missing_ids[n_missing] = obj_ids[i];
+        ++n_missing;
+    }
+
+    if (n_missing > 0) {
+        missing_data = g_new (void *, n_missing);
+        missing_lens = g_new (int, n_missing);
+
+        n_read += priv->remote->read_batch (priv->remote, repo_id, version,
+                                            missing_ids, n_missing,
+                                            missing_data, missing_lens);
+
+        for (i = 0; i < n_missing; ++i) {
+            if (!missing_data[i])
+                continue;
+            make_key (key, repo_id, missing_ids[i]);
+            cache_insert (priv, key, missing_data[i], missing_lens[i]);
+            data[missing[i]] = missing_data[i];
+            lens[missing[i]] = missing_lens[i];
+        }
+
+        g_free (missing_data);
+        g_free (missing_lens);
+    }
+
+    g_free (missing);
+    g_free (missing_ids);
+    return n_read;
+}
+
+static int
+obj_backend_cache_write (ObjBackend *bend,
+                         const char *repo_id,
+                         int version,
+                         const char *obj_id,
+                         void *data,
+                         int len,
+                         gboolean need_sync)
+{
+    CachePriv *priv = bend->priv;
+    char key[SEAF_PATH_MAX];
+
+    if (priv->remote->write (priv->remote, repo_id, version,
+                             obj_id, data, len, need_sync) < 0)
+        return -1;
+
+    /* Newly written objects are likely to be read soon. */
+    make_key (key, repo_id, obj_id);
+    cache_insert (priv, key, data, len);
+    return 0;
+}
+
+static gboolean
+obj_backend_cache_exists (ObjBackend *bend,
+                          const char *repo_id,
+                          int version,
+                          const char *obj_id)
+{
+    CachePriv *priv = bend->priv;
+    char key[SEAF_PATH_MAX];
+    char *path;
+    gboolean cached;
+
+    make_key (key, repo_id, obj_id);
+
+    if (priv->read_only) {
+        path = key_to_path (priv, key);
+        cached = g_file_test (path, G_FILE_TEST_EXISTS);
+        g_free (path);
+    } else {
+        pthread_mutex_lock (&priv->lock);
+        cached = (g_hash_table_lookup (priv->entries, key) != NULL);
+        pthread_mutex_unlock (&priv->lock);
+    }
+
+    if (cached)
+        return TRUE;
+
+    return priv->remote->exists (priv->remote, repo_id, version, obj_id);
+}
+
+static void
+obj_backend_cache_delete (ObjBackend *bend,
+                          const char *repo_id,
+                          int version,
+                          const char *obj_id)
+{
+    CachePriv *priv = bend->priv;
+    char key[SEAF_PATH_MAX];
+
+    make_key (key, repo_id, obj_id);
+    cache_remove (priv, key);
+
+    priv->remote->delete (priv->remote, repo_id, version, obj_id);
+}
+
+static int
+obj_backend_cache_foreach_obj (ObjBackend *bend,
+                               const char *repo_id,
+                               int version,
+                               SeafObjFunc process,
+                               void *user_data)
+{
+    CachePriv *priv = bend->priv;
+
+    return priv->remote->foreach_obj (priv->remote, repo_id, version,
+                                      process, user_data);
+}
+
+static int
+obj_backend_cache_copy (ObjBackend *bend,
+                        const char *src_repo_id,
+                        int src_version,
+                        const char *dst_repo_id,
+                        int dst_version,
+                        const char *obj_id)
+{
+    CachePriv *priv = bend->priv;
+
+    /* The copy is cached when it's read. */
+    return priv->remote->copy (priv->remote, src_repo_id, src_version,
+                               dst_repo_id, dst_version, obj_id);
+}
+
+/*
+ * Batches go to the remote backend directly. Objects are cached when
+ * they're read.
+ */
+
+static void *
+obj_backend_cache_batch_new (ObjBackend *bend)
+{
+    CachePriv *priv = bend->priv;
+
+    return priv->remote->batch_new (priv->remote);
+}
+
+static int
+obj_backend_cache_batch_add (ObjBackend *bend,
+                             void *batch,
+                             const char *repo_id,
+                             int version,
+                             const char *obj_id,
+                             void *data,
+                             int len)
+{
+    CachePriv *priv = bend->priv;
+
+    return priv->remote->batch_add (priv->remote, batch, repo_id, version,
+                                    obj_id, data, len);
+}
+
+static int
+obj_backend_cache_batch_commit (ObjBackend *bend, void *batch)
+{
+    CachePriv *priv = bend->priv;
+
+    return priv->remote->batch_commit (priv->remote, batch);
+}
+
+static void
+obj_backend_cache_batch_free (ObjBackend *bend, void *batch)
+{
+    CachePriv *priv = bend->priv;
+
+    priv->remote->batch_free (priv->remote, batch);
+}
+
+typedef struct ScannedObj {
+    char       *key;
+    guint64     size;
+    time_t      atime;
+} ScannedObj;
+
+static gint
+compare_atime (gconstpointer a, gconstpointer b)
+{
+    const ScannedObj *obj_a = a, *obj_b = b;
+
+    if (obj_a->atime < obj_b->atime)
+        return -1;
+    if (obj_a->atime > obj_b->atime)
+        return 1;
+    return 0;
+}
+
+static void
+scan_obj_dir (const char *dir_path, const char *prefix, GArray *objs)
+{
+    GDir *dir;
+    const char *name;
+    char *path;
+    SeafStat st;
+    ScannedObj obj;
+
+    dir = g_dir_open (dir_path, 0, NULL);
+    if (!dir)
+        return;
+
+    while ((name = g_dir_read_name (dir)) != NULL) {
+        /* Temp files of g_file_set_contents(), which may still be
+         * being written.
+         */
+        if (strlen (name) != 38)
+            continue;
+
+        path = g_build_filename (dir_path, name, NULL);
+
+        if (seaf_stat (path, &st) < 0 || !S_ISREG(st.st_mode)) {
+            g_free (path);
+            continue;
+        }
+
+        obj.key = g_strconcat (prefix, "/", name, NULL);
+        obj.size = (guint64)st.st_size;
+        obj.atime = st.st_atime;
+        g_array_append_val (objs, obj);
+
+        g_free (path);
+    }
+
+    g_dir_close (dir);
+}
+
+/* Rebuild the index from local copies left by the last run. */
+static void
+load_cached_objects (CachePriv *priv)
+{
+    GDir *repo_dir, *dir;
+    const char *repo_id, *name;
+    char *repo_path, *path, *prefix;
+    GArray *objs;
+    ScannedObj *obj;
+    GList *evicted = NULL;
+    guint i;
+
+    repo_dir = g_dir_open (priv->cache_dir, 0, NULL);
+    if (!repo_dir)
+        return;
+
+    objs = g_array_new (FALSE, FALSE, sizeof(ScannedObj));
+
+    while ((repo_id = g_dir_read_name (repo_dir)) != NULL) {
+        repo_path = g_build_filename (priv->cache_dir, repo_id, NULL);
+        dir = g_dir_open (repo_path, 0, NULL);
+        if (!dir) {
+            g_free (repo_path);
+            continue;
+        }
+
+        while ((name = g_dir_read_name (dir)) != NULL) {
+            path = g_build_filename (repo_path, name, NULL);
+            prefix = g_strconcat (repo_id, "/", name, NULL);
+            scan_obj_dir (path, prefix, objs);
+            g_free (prefix);
+            g_free (path);
+        }
+
+        g_dir_close (dir);
+        g_free (repo_path);
+    }
+    g_dir_close (repo_dir);
+
+    /* Least recently used first, so they end up at the tail of the list. */
+    g_array_sort (objs, compare_atime);
+
+    for (i = 0; i < objs->len; ++i) {
+        obj = &g_array_index (objs, ScannedObj, i);
+        evicted = g_list_concat (evicted,
+                                 add_entry (priv, obj->key, obj->size));
+        g_free (obj->key);
+    }
+    g_array_free (objs, TRUE);
+
+    /* The cache may have been shrunk since the last run. */
+    unlink_entries (priv, evicted);
+    priv->evictions = 0;
+
+    seaf_message ("[obj cache] Loaded %u objects (%"G_GUINT64_FORMAT
+                  " bytes) from %s.\n",
+                  g_hash_table_size (priv->entries), priv->bytes,
+                  priv->cache_dir);
+}
+
+gboolean
+obj_backend_cache_get_stats (ObjBackend *bend, LRUCacheStats *stats)
+{
+    CachePriv *priv = bend->priv;
+
+    pthread_mutex_lock (&priv->lock);
+
+    stats->hits = priv->hits;
+    stats->misses = priv->misses;
+    stats->evictions = priv->evictions;
+    stats->n_items = g_hash_table_size (priv->entries);
+    stats->bytes = priv->bytes;
+    stats->max_bytes = priv->max_bytes;
+
+    pthread_mutex_unlock (&priv->lock);
+
+    return TRUE;
+}
+
+ObjBackend *
+obj_backend_cache_new (ObjBackend *remote,
+                       const char *cache_dir,
+                       const char *obj_type,
+                       guint64 max_bytes,
+                       gboolean read_only)
+{
+    ObjBackend *bend;
+    CachePriv *priv;
+
+    bend = g_new0 (ObjBackend, 1);
+    priv = g_new0 (CachePriv, 1);
+    bend->priv = priv;
+
+    priv->remote = remote;
+    priv->cache_dir = g_build_filename (cache_dir, obj_type, NULL);
+    priv->max_bytes = max_bytes;
+    priv->read_only = read_only;
+
+    if (g_mkdir_with_parents (priv->cache_dir, 0777) < 0) {
+        seaf_warning ("[obj cache] Cache dir %s does not exist and"
+                      " is unable to create\n", priv->cache_dir);
+        g_free (priv->cache_dir);
+        g_free (priv);
+        g_free (bend);
+        return NULL;
+    }
+
+    pthread_mutex_init (&priv->lock, NULL);
+    priv->entries = g_hash_table_new (g_str_hash, g_str_equal);
+    priv->lru = g_queue_new ();
+
+    if (!read_only)
+        load_cached_objects (priv);
+
+    bend->read = obj_backend_cache_read;
+    bend->write = obj_backend_cache_write;
+    bend->exists = obj_backend_cache_exists;
+    bend->delete = obj_backend_cache_delete;
+    bend->foreach_obj = obj_backend_cache_foreach_obj;
+    bend->copy = obj_backend_cache_copy;
+    if (remote->read_batch)
+        bend->read_batch = obj_backend_cache_read_batch;
+    if (remote->batch_new) {
+        bend->batch_new = obj_backend_cache_batch_new;
+        bend->batch_add = obj_backend_cache_batch_add;
+        bend->batch_commit = obj_backend_cache_batch_commit;
+        bend->batch_free = obj_backend_cache_batch_free;
+    }
+
+    return bend;
+}
@@ -2,6 +2,11 @@
 #define _WIN32_WINNT 0x500
 #endif
 
+#ifdef __linux__
+/* For syncfs(). */
+#define _GNU_SOURCE
+#endif
+
 #include "common.h"
 #include "utils.h"
 #include "obj-backend.h"
@@ -150,24 +155,18 @@ fsync_obj_contents (int fd)
  * This also makes sure the changes to @obj_path's parent folder
  * is flushed to disk.
  */
+#ifdef __linux__
+/*
+ * Flush changes to the entries of @dir to disk.
+ */
 static int
-rename_and_sync (const char *tmp_path, const char *obj_path)
+fsync_dir (const char *dir)
 {
-#ifdef __linux__
-    char *parent_dir;
     int ret = 0;
-
-    if (rename (tmp_path, obj_path) < 0) {
-        seaf_warning ("Failed to rename from %s to %s: %s.\n",
-                      tmp_path, obj_path, strerror(errno));
-        return -1;
-    }
-
-    parent_dir = g_path_get_dirname (obj_path);
-    int dir_fd = open (parent_dir, O_RDONLY);
+    int dir_fd = open (dir, O_RDONLY);
     if (dir_fd < 0) {
-        seaf_warning ("Failed to open dir %s: %s.\n", parent_dir, strerror(errno));
-        goto out;
+        seaf_warning ("Failed to open dir %s: %s.\n", dir, strerror(errno));
+        return 0;
     }
 
     /* Some file systems don't support fsyncing a directory. Just ignore the error.
@@ -175,16 +174,32 @@ rename_and_sync (const char *tmp_path, const char *obj_path)
     if (fsync (dir_fd) < 0) {
         if (errno != EINVAL) {
             seaf_warning ("Failed to fsync dir %s: %s.\n",
-                          parent_dir, strerror(errno));
+                          dir, strerror(errno));
             ret = -1;
         }
-        goto out;
     }
 
-out:
+    close (dir_fd);
+    return ret;
+}
+#endif
+
+static int
+rename_and_sync (const char *tmp_path, const char *obj_path)
+{
+#ifdef __linux__
+    char *parent_dir;
+    int ret;
+
+    if (rename (tmp_path, obj_path) < 0) {
+        seaf_warning ("Failed to rename from %s to %s: %s.\n",
+                      tmp_path, obj_path, strerror(errno));
+        return -1;
+    }
+
+    parent_dir = g_path_get_dirname (obj_path);
+    ret = fsync_dir (parent_dir);
     g_free (parent_dir);
-    if (dir_fd >= 0)
-        close (dir_fd);
     return ret;
 #endif
 
@@ -220,10 +235,14 @@ out:
 #endif
 }
 
+/*
+ * Write @data to a temp file next to @path. The name of the temp file
+ * is returned in @tmp_path.
+ */
 static int
-save_obj_contents (const char *path, const void *data, int len, gboolean need_sync)
+write_tmp_file (const char *path, const void *data, int len,
+                gboolean need_sync, char tmp_path[])
 {
-    char tmp_path[SEAF_PATH_MAX];
     int fd;
 
     snprintf (tmp_path, SEAF_PATH_MAX, "%s.XXXXXX", path);
@@ -237,13 +256,28 @@ save_obj_contents (const char *path, const void *data, int len, gboolean need_sy
     if (writen (fd, data, len) < 0) {
         seaf_warning ("[obj backend] Failed to write obj %s: %s.\n",
                       tmp_path, strerror(errno));
-        return -1;
+        goto error;
     }
 
     if (need_sync && fsync_obj_contents (fd) < 0)
-        return -1;
+        goto error;
+
+    close (fd);
+    return 0;
 
+error:
     close (fd);
+    g_unlink (tmp_path);
+    return -1;
+}
+
+static int
+save_obj_contents (const char *path, const void *data, int len, gboolean need_sync)
+{
+    char tmp_path[SEAF_PATH_MAX];
+
+    if (write_tmp_file (path, data, len, need_sync, tmp_path) < 0)
+        return -1;
 
     if (need_sync) {
         if (rename_and_sync (tmp_path, path) < 0)
@@ -316,6 +350,255 @@ obj_backend_fs_write (ObjBackend *bend,
     return 0;
 }
 
+/*
+ * Group commit.
+ *
+ * Objects added to a batch are written to temp files without syncing.
+ * On commit, the temp files are flushed, then renamed to the object paths,
+ * and then each parent dir is flushed once for all renames in it. This
+ * keeps the guarantees of writing each object with need_sync: an object
+ * path never refers to incomplete contents, and all objects are on disk
+ * when commit returns.
+ *
+ * Temp files are flushed one by one with fsync(). Only a large batch is
+ * flushed with one syncfs() per file system, since syncfs() also flushes
+ * everything else written to the file system.
+ */
+
+#define SYNCFS_BATCH_SIZE (32 << 20) /* 32MB */
+
+typedef struct PendingObj {
+    char *tmp_path;
+    char *path;
+} PendingObj;
+
+typedef struct FsWriteBatch {
+    GList *objs;
+    /* Total size of the objects. */
+    gint64 size;
+    /* Parent dirs of the objects. */
+    GHashTable *dirs;
+} FsWriteBatch;
+
+static void
+pending_obj_free (PendingObj *obj)
+{
+    g_free (obj->tmp_path);
+    g_free (obj->path);
+    g_free (obj);
+}
+
+static void *
+obj_backend_fs_batch_new (ObjBackend *bend)
+{
+    FsWriteBatch *batch = g_new0 (FsWriteBatch, 1);
+
+    batch->dirs = g_hash_table_new_full (g_str_hash, g_str_equal,
+                                         g_free, NULL);
+    return batch;
+}
+
+static int
+obj_backend_fs_batch_add (ObjBackend *bend,
+                          void *vbatch,
+                          const char *repo_id,
+                          int version,
+                          const char *obj_id,
+                          void *data,
+                          int len)
+{
+    FsWriteBatch *batch = vbatch;
+    char path[SEAF_PATH_MAX];
+    char tmp_path[SEAF_PATH_MAX];
+    PendingObj *obj;
+
+    id_to_path (bend->priv, obj_id, path, repo_id, version);
+
+    if (create_parent_path (path) < 0) {
+        seaf_warning ("[obj backend] Failed to create path for obj %s.\n", obj_id);
+        return -1;
+    }
+
+    if (write_tmp_file (path, data, len, FALSE, tmp_path) < 0) {
+        seaf_warning ("[obj backend] Failed to write obj %s.\n", obj_id);
+        return -1;
+    }
+
+    obj = g_new0 (PendingObj, 1);
+    obj->tmp_path = g_strdup (tmp_path);
+    obj->path = g_strdup (path);
+    batch->objs = g_list_prepend (batch->objs, obj);
+    batch->size += len;
+
+    g_hash_table_insert (batch->dirs, g_path_get_dirname (path), NULL);
+
+    return 0;
+}
+
+#ifdef HAVE_SYNCFS
+/* Flush every file system containing one of the dirs in @batch. */
+static int
+syncfs_batch_dirs (FsWriteBatch *batch)
+{
+    GHashTableIter iter;
+    gpointer key;
+    GList *devs = NULL;
+    SeafStat st;
+    int fd, ret = 0;
+
+    g_hash_table_iter_init (&iter, batch->dirs);
+    while (g_hash_table_iter_next (&iter, &key, NULL)) {
+        fd = open ((char *)key, O_RDONLY);
+        if (fd < 0) {
+            seaf_warning ("Failed to open dir %s: %s.\n",
+                          (char *)key, strerror(errno));
+            ret = -1;
+            break;
+        }
+
+        if (seaf_fstat (fd, &st) < 0)
+            st.st_dev = 0;
+        else if (g_list_find (devs, GUINT_TO_POINTER((guint)st.st_dev))) {
+            /* Already flushed. */
+            close (fd);
+            continue;
+        }
+
+        if (syncfs (fd) < 0) {
+            seaf_warning ("Failed to syncfs %s: %s.\n",
+                          (char *)key, strerror(errno));
+            close (fd);
+            ret = -1;
+            break;
+        }
+        if (st.st_dev != 0)
+            devs = g_list_prepend (devs, GUINT_TO_POINTER((guint)st.st_dev));
+        close (fd);
+    }
+
+    g_list_free (devs);
+    return ret;
+}
+#endif
+
+#ifdef __linux__
+/* One fsync per dir, instead of one per object. */
+static int
+fsync_batch_dirs (FsWriteBatch *batch)
+{
+    GHashTableIter iter;
+    gpointer key;
+
+    g_hash_table_iter_init (&iter, batch->dirs);
+    while (g_hash_table_iter_next (&iter, &key, NULL)) {
+        if (fsync_dir ((char *)key) < 0)
+            return -1;
+    }
+    return 0;
+}
+#endif
+
+static int
+sync_batch_contents (FsWriteBatch *batch)
+{
+    GList *ptr;
+    PendingObj *obj;
+    int fd, ret = 0;
+
+#ifdef HAVE_SYNCFS
+    if (batch->size >= SYNCFS_BATCH_SIZE)
+        return syncfs_batch_dirs (batch);
+#endif
+
+    for (ptr = batch->objs; ptr; ptr = ptr->next) {
+        obj = ptr->data;
+        fd = g_open (obj->tmp_path, O_RDWR | O_BINARY, 0);
+        if (fd < 0) {
+            seaf_warning ("Failed to open %s: %s.\n",
+                          obj->tmp_path, strerror(errno));
+            return -1;
+        }
+        ret = fsync_obj_contents (fd);
+        close (fd);
+        if (ret < 0)
+            return -1;
+    }
+
+    return 0;
+}
+
+static int
+publish_batch (FsWriteBatch *batch)
+{
+    PendingObj *obj;
+
+    while (batch->objs) {
+        obj = batch->objs->data;
+
+#ifdef __linux__
+        /* Renames are flushed together below. */
+        if (rename (obj->tmp_path, obj->path) < 0) {
+            seaf_warning ("Failed to rename from %s to %s: %s.\n",
+                          obj->tmp_path, obj->path, strerror(errno));
+            return -1;
+        }
+#else
+        if (rename_and_sync (obj->tmp_path, obj->path) < 0)
+            return -1;
+#endif
+
+        batch->objs = g_list_delete_link (batch->objs, batch->objs);
+        pending_obj_free (obj);
+    }
+
+#ifdef __linux__
+    return fsync_batch_dirs (batch);
+#else
+    return 0;
+#endif
+}
+
+static int
+obj_backend_fs_batch_commit (ObjBackend *bend, void *vbatch)
+{
+    FsWriteBatch *batch = vbatch;
+
+    if (!batch->objs)
+        return 0;
+
+    if (sync_batch_contents (batch) < 0) {
+        seaf_warning ("[obj backend] Failed to sync objects.\n");
+        return -1;
+    }
+
+    if (publish_batch (batch) < 0) {
+        seaf_warning ("[obj backend] Failed to publish objects.\n");
+        return -1;
+    }
+
+    g_hash_table_remove_all (batch->dirs);
+    batch->size = 0;
+    return 0;
+}
+
+/* Objects not committed are discarded. */
+static void
+obj_backend_fs_batch_free (ObjBackend *bend, void *vbatch)
+{
+    FsWriteBatch *batch = vbatch;
+    GList *ptr;
+    PendingObj *obj;
+
+    for (ptr = batch->objs; ptr; ptr = ptr->next) {
+        obj = ptr->data;
+        g_unlink (obj->tmp_path);
+        pending_obj_free (obj);
+    }
+    g_list_free (batch->objs);
+    g_hash_table_destroy (batch->dirs);
+    g_free (batch);
+}
+
 static gboolean
 obj_backend_fs_exists (ObjBackend *bend,
                        const char *repo_id,
@@ -481,6 +764,10 @@ obj_backend_fs_new (const char *seaf_dir, const char *obj_type)
     bend->delete = obj_backend_fs_delete;
     bend->foreach_obj = obj_backend_fs_foreach_obj;
     bend->copy = obj_backend_fs_copy;
+    bend->batch_new = obj_backend_fs_batch_new;
+    bend->batch_add = obj_backend_fs_batch_add;
+    bend->batch_commit = obj_backend_fs_batch_commit;
+    bend->batch_free = obj_backend_fs_batch_free;
 
     return bend;
 
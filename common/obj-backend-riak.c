@@ -8,14 +8,31 @@
 
 #include <pthread.h>
 
+/*
+ * Objects are content addressed, so objects of all repos share one bucket
+ * and are keyed by object id only.
+ */
+
 typedef struct RiakPriv {
     const char *host;
     const char *port;
     const char *bucket;
     int n_write;
 
+    int max_conns;
+    long timeout_ms;
+
+    /* Idle connections. Connections are kept open between requests. */
     GQueue *conn_pool;
+    int n_conns;
     pthread_mutex_t lock;
+    pthread_cond_t cond;
+
+    /* Batch reads share one client, so that they open at most max_conns
+     * connections in total, instead of max_conns per pooled connection.
+     */
+    SeafRiakClient *mget_conn;
+    pthread_mutex_t mget_lock;
 } RiakPriv;
 
 static SeafRiakClient *
@@ -25,9 +42,19 @@ get_connection (RiakPriv *priv)
 
     pthread_mutex_lock (&priv->lock);
 
+    /* Wait for an idle connection once max_conns connections are open. */
+    while (g_queue_is_empty (priv->conn_pool) &&
+           priv->n_conns >= priv->max_conns)
+        pthread_cond_wait (&priv->cond, &priv->lock);
+
     connection = g_queue_pop_head (priv->conn_pool);
-    if (!connection)
+    if (!connection) {
         connection = seaf_riak_client_new (priv->host, priv->port);
+        seaf_riak_client_set_timeout (connection,
+                                      RIAK_DEFAULT_CONNECT_TIMEOUT,
+                                      priv->timeout_ms);
+        ++(priv->n_conns);
+    }
     pthread_mutex_unlock (&priv->lock);
     return connection;
 }
@@ -36,12 +63,18 @@ static void
 return_connection (RiakPriv *priv, SeafRiakClient *connection)
 {
     pthread_mutex_lock (&priv->lock);
-    g_queue_push_tail (priv->conn_pool, connection);
+    /* Most recently used connections are least likely to be closed
+     * by the server.
+     */
+    g_queue_push_head (priv->conn_pool, connection);
+    pthread_cond_signal (&priv->cond);
     pthread_mutex_unlock (&priv->lock);
 }
 
 static int
 obj_backend_riak_read (ObjBackend *bend,
+                       const char *repo_id,
+                       int version,
                        const char *obj_id,
                        void **data,
                        int *len)
@@ -56,11 +89,34 @@ obj_backend_riak_read (ObjBackend *bend,
     return ret;
 }
 
+static int
+obj_backend_riak_read_batch (ObjBackend *bend,
+                             const char *repo_id,
+                             int version,
+                             const char **obj_ids,
+                             int n,
+                             void **data,
+                             int *lens)
+{
+    RiakPriv *priv = bend->priv;
+    int ret;
+
+    pthread_mutex_lock (&priv->mget_lock);
+    ret = seaf_riak_client_mget (priv->mget_conn, priv->bucket,
+                                 obj_ids, n, data, lens);
+    pthread_mutex_unlock (&priv->mget_lock);
+
+    return ret;
+}
+
 static int
 obj_backend_riak_write (ObjBackend *bend,
+                        const char *repo_id,
+                        int version,
                         const char *obj_id,
                         void *data,
-                        int len)
+                        int len,
+                        gboolean need_sync)
 {
     SeafRiakClient *conn = get_connection (bend->priv);
     RiakPriv *priv = bend->priv;
@@ -75,6 +131,8 @@ obj_backend_riak_write (ObjBackend *bend,
 
 static gboolean
 obj_backend_riak_exists (ObjBackend *bend,
+                         const char *repo_id,
+                         int version,
                          const char *obj_id)
 {
     SeafRiakClient *conn = get_connection (bend->priv);
@@ -89,6 +147,8 @@ obj_backend_riak_exists (ObjBackend *bend,
 
 static void
 obj_backend_riak_delete (ObjBackend *bend,
+                         const char *repo_id,
+                         int version,
                          const char *obj_id)
 {
     SeafRiakClient *conn = get_connection (bend->priv);
@@ -99,11 +159,36 @@ obj_backend_riak_delete (ObjBackend *bend,
     return_connection (priv, conn);
 }
 
+static int
+obj_backend_riak_foreach_obj (ObjBackend *bend,
+                              const char *repo_id,
+                              int version,
+                              SeafObjFunc process,
+                              void *user_data)
+{
+    seaf_warning ("Listing objects is not supported by riak backend.\n");
+    return -1;
+}
+
+static int
+obj_backend_riak_copy (ObjBackend *bend,
+                       const char *src_repo_id,
+                       int src_version,
+                       const char *dst_repo_id,
+                       int dst_version,
+                       const char *obj_id)
+{
+    /* The bucket is shared by all repos. */
+    return 0;
+}
+
 ObjBackend *
 obj_backend_riak_new (const char *host,
                       const char *port,
                       const char *bucket,
-                      const char *write_policy)
+                      const char *write_policy,
+                      int max_conns,
+                      int timeout_ms)
 {
     ObjBackend *bend;
     RiakPriv *priv;
@@ -122,13 +207,27 @@ obj_backend_riak_new (const char *host,
     else
         g_return_val_if_reached (NULL);
 
+    priv->max_conns = (max_conns > 0) ? max_conns : RIAK_DEFAULT_MAX_CONNECTIONS;
+    priv->timeout_ms = (timeout_ms >= 0) ? timeout_ms : RIAK_DEFAULT_TIMEOUT;
+
     priv->conn_pool = g_queue_new ();
     pthread_mutex_init (&priv->lock, NULL);
+    pthread_cond_init (&priv->cond, NULL);
+
+    priv->mget_conn = seaf_riak_client_new (priv->host, priv->port);
+    seaf_riak_client_set_timeout (priv->mget_conn,
+                                  RIAK_DEFAULT_CONNECT_TIMEOUT,
+                                  priv->timeout_ms);
+    seaf_riak_client_set_max_connections (priv->mget_conn, priv->max_conns);
+    pthread_mutex_init (&priv->mget_lock, NULL);
 
     bend->read = obj_backend_riak_read;
     bend->write = obj_backend_riak_write;
     bend->exists = obj_backend_riak_exists;
     bend->delete = obj_backend_riak_delete;
+    bend->foreach_obj = obj_backend_riak_foreach_obj;
+    bend->copy = obj_backend_riak_copy;
+    bend->read_batch = obj_backend_riak_read_batch;
 
     return bend;
 }
@@ -139,7 +238,9 @@ ObjBackend *
 obj_backend_riak_new (const char *host,
                       const char *port,
                       const char *bucket,
-                      const char *write_policy)
+                      const char *write_policy,
+                      int max_conns,
+                      int timeout_ms)
 {
     seaf_warning ("Riak backend is not enabled.\n");
     return NULL;
@@ -45,6 +45,40 @@ struct ObjBackend {
                          int dst_version,
                          const char *obj_id);
 
+    /*
+     * Read many objects at once, optional. For remote backends this saves
+     * a round trip per object. @data and @lens must have room for @n
+     * elements; objects that can't be read are set to NULL.
+     * Returns the number of objects read.
+     */
+    int         (*read_batch) (ObjBackend *bend,
+                               const char *repo_id,
+                               int version,
+                               const char **obj_ids,
+                               int n,
+                               void **data,
+                               int *lens);
+
+    /*
+     * Group commit, optional. Objects added to a batch become visible and
+     * durable together when the batch is committed, at the cost of far
+     * fewer syncs than writing each of them with need_sync.
+     * batch_free() discards objects that have not been committed.
+     */
+    void *      (*batch_new) (ObjBackend *bend);
+
+    int         (*batch_add) (ObjBackend *bend,
+                              void *batch,
+                              const char *repo_id,
+                              int version,
+                              const char *obj_id,
+                              void *data,
+                              int len);
+
+    int         (*batch_commit) (ObjBackend *bend, void *batch);
+
+    void        (*batch_free) (ObjBackend *bend, void *batch);
+
     void *priv;
 };
 
@@ -5,12 +5,36 @@
 
 #include "obj-backend.h"
 #include "obj-store.h"
+#include "lru-cache.h"
 
-#define MAX_READER_THREADS 2
+/* The reader threads also serve batch reads. */
+#define MAX_READER_THREADS 8
 #define MAX_WRITER_THREADS 2
 #define MAX_STAT_THREADS 2
 
+/* Max number of objects passed to one read_batch() call of the backend. */
+#define READ_BATCH_SIZE 64
+
+struct OSBatchRead {
+    struct SeafObjStore *obj_store;
+    char        repo_id[37];
+    int         version;
+    /* Finished tasks. */
+    GAsyncQueue *done;
+    int         n_pending;
+    /* Tasks not handed to the reader threads yet. Only used if the
+     * backend can read many objects at once.
+     */
+    GPtrArray   *queued;
+};
+
 typedef struct AsyncTask {
+    /* Set for batch reads, which don't go through the event loop. */
+    OSBatchRead *batch;
+    /* Tasks to read with one read_batch() call. A task with a group
+     * only carries it to a reader thread and is freed there.
+     */
+    GPtrArray *group;
     guint32 rw_id;
     char    obj_id[41];
     void    *data;
@@ -28,6 +52,8 @@ typedef struct OSCallbackStruct {
 
 struct SeafObjStore {
     ObjBackend   *bend;
+    /* Whether bend is a local cache in front of the configured backend. */
+    gboolean     cached;
 
     CEventManager *ev_mgr;
 
@@ -68,6 +94,153 @@ on_stat_done (CEvent *event, void *data);
 extern ObjBackend *
 obj_backend_fs_new (const char *seaf_dir, const char *obj_type);
 
+#ifdef SEAFILE_SERVER
+extern ObjBackend *
+obj_backend_riak_new (const char *host,
+                      const char *port,
+                      const char *bucket,
+                      const char *write_policy,
+                      int max_conns,
+                      int timeout_ms);
+
+extern ObjBackend *
+obj_backend_cache_new (ObjBackend *remote,
+                       const char *cache_dir,
+                       const char *obj_type,
+                       guint64 max_bytes,
+                       gboolean read_only);
+
+extern gboolean
+obj_backend_cache_get_stats (ObjBackend *bend, LRUCacheStats *stats);
+
+#define DEFAULT_RIAK_PORT "8098"
+#define DEFAULT_RIAK_TIMEOUT 30 /* seconds */
+
+/*
+ * Objects of each type are stored in a bucket with the same name as
+ * the type ("fs" or "commits").
+ *
+ * [object_backend]
+ * name = riak
+ * host = 127.0.0.1
+ * port = 8098
+ * write_policy = quorum
+ * max_connections = 4
+ * timeout = 30
+ */
+static ObjBackend *
+load_riak_backend (SeafileSession *seaf, const char *obj_type)
+{
+    char *host, *port, *write_policy;
+    int max_conns, timeout;
+    ObjBackend *bend;
+
+    host = g_key_file_get_string (seaf->config, "object_backend", "host", NULL);
+    if (!host) {
+        g_warning ("[Object store] Riak host is not set.\n");
+        return NULL;
+    }
+    port = g_key_file_get_string (seaf->config, "object_backend", "port", NULL);
+    if (!port)
+        port = g_strdup (DEFAULT_RIAK_PORT);
+    write_policy = g_key_file_get_string (seaf->config,
+                                          "object_backend", "write_policy",
+                                          NULL);
+    if (!write_policy)
+        write_policy = g_strdup ("quorum");
+
+    max_conns = g_key_file_get_integer (seaf->config,
+                                        "object_backend", "max_connections",
+                                        NULL);
+    timeout = g_key_file_get_integer (seaf->config,
+                                      "object_backend", "timeout", NULL);
+    if (timeout <= 0)
+        timeout = DEFAULT_RIAK_TIMEOUT;
+
+    bend = obj_backend_riak_new (host, port, obj_type, write_policy,
+                                 max_conns, timeout * 1000);
+
+    g_free (host);
+    g_free (port);
+    g_free (write_policy);
+    return bend;
+}
+
+/*
+ * Keep local copies of objects in front of a remote backend.
+ *
+ * [object_cache]
+ * dir = /ssd/seafile-object-cache
+ * # In MB.
+ * max_size = 10240
+ *
+ * The cache is owned by seaf-server. Other programs sharing the config,
+ * e.g. gc and fuse, only read the local copies.
+ */
+static ObjBackend *
+load_backend_cache (SeafileSession *seaf,
+                    ObjBackend *remote,
+                    const char *obj_type,
+                    gboolean *cached)
+{
+    char *cache_dir;
+    int max_size;
+    gboolean read_only;
+    ObjBackend *bend;
+
+    *cached = FALSE;
+
+    cache_dir = g_key_file_get_string (seaf->config, "object_cache", "dir", NULL);
+    if (!cache_dir)
+        return remote;
+
+    max_size = g_key_file_get_integer (seaf->config,
+                                       "object_cache", "max_size", NULL);
+    if (max_size <= 0) {
+        g_warning ("[Object store] Object cache size is not set.\n");
+        g_free (cache_dir);
+        return remote;
+    }
+
+#ifdef FULL_FEATURE
+    read_only = FALSE;
+#else
+    read_only = TRUE;
+#endif
+
+    bend = obj_backend_cache_new (remote, cache_dir, obj_type,
+                                  (guint64)max_size << 20, read_only);
+    g_free (cache_dir);
+
+    if (!bend)
+        return remote;
+
+    *cached = TRUE;
+    return bend;
+}
+
+static ObjBackend *
+load_backend (SeafileSession *seaf, const char *obj_type, gboolean *cached)
+{
+    char *name;
+    ObjBackend *bend;
+
+    *cached = FALSE;
+
+    name = g_key_file_get_string (seaf->config, "object_backend", "name", NULL);
+    if (g_strcmp0 (name, "riak") == 0)
+        bend = load_riak_backend (seaf, obj_type);
+    else
+        bend = obj_backend_fs_new (seaf->seaf_dir, obj_type);
+    g_free (name);
+
+    if (!bend)
+        return NULL;
+
+    return load_backend_cache (seaf, bend, obj_type, cached);
+}
+#endif
+
 struct SeafObjStore *
 seaf_obj_store_new (SeafileSession *seaf, const char *obj_type)
 {
@@ -76,7 +249,11 @@ seaf_obj_store_new (SeafileSession *seaf, const char *obj_type)
     if (!store)
         return NULL;
 
+#ifdef SEAFILE_SERVER
+    store->bend = load_backend (seaf, obj_type, &store->cached);
+#else
     store->bend = obj_backend_fs_new (seaf->seaf_dir, obj_type);
+#endif
     if (!store->bend) {
         g_warning ("[Object store] Failed to load backend.\n");
         g_free (store);
@@ -87,12 +264,10 @@ seaf_obj_store_new (SeafileSession *seaf, const char *obj_type)
 }
 
 static int
-async_init (SeafObjStore *obj_store, CEventManager *ev_mgr)
+read_pool_init (SeafObjStore *obj_store)
 {
     GError *error = NULL;
 
-    obj_store->ev_mgr = ev_mgr;
-
     obj_store->read_tpool = g_thread_pool_new (reader_thread,
                                                obj_store,
                                                MAX_READER_THREADS,
@@ -104,6 +279,16 @@ async_init (SeafObjStore *obj_store, CEventManager *ev_mgr)
         return -1;
     }
 
+    return 0;
+}
+
+static int
+async_init (SeafObjStore *obj_store, CEventManager *ev_mgr)
+{
+    GError *error = NULL;
+
+    obj_store->ev_mgr = ev_mgr;
+
     obj_store->readers = g_hash_table_new_full (g_direct_hash, g_direct_equal,
                                                 NULL, g_free);
     obj_store->read_ev_id = cevent_manager_register (ev_mgr,
@@ -152,6 +337,10 @@ seaf_obj_store_init (SeafObjStore *obj_store,
                      gboolean enable_async,
                      CEventManager *ev_mgr)
 {
+    /* The reader thread pool is always needed for batch reads. */
+    if (read_pool_init (obj_store) < 0)
+        return -1;
+
     if (enable_async && async_init (obj_store, ev_mgr) < 0)
         return -1;
 
@@ -235,6 +424,124 @@ seaf_obj_store_copy_obj (struct SeafObjStore *obj_store,
     return bend->copy (bend, src_repo_id, src_version, dst_repo_id, dst_version, obj_id);
 }
 
+struct OSWriteBatch {
+    SeafObjStore *obj_store;
+    char        repo_id[37];
+    int         version;
+    /* NULL if the backend doesn't support batches. */
+    void        *bend_batch;
+};
+
+OSWriteBatch *
+seaf_obj_store_write_batch_new (struct SeafObjStore *obj_store,
+                                const char *repo_id,
+                                int version)
+{
+    ObjBackend *bend = obj_store->bend;
+    OSWriteBatch *batch = g_new0 (OSWriteBatch, 1);
+
+    batch->obj_store = obj_store;
+    memcpy (batch->repo_id, repo_id, 36);
+    batch->version = version;
+    if (bend->batch_new)
+        batch->bend_batch = bend->batch_new (bend);
+
+    return batch;
+}
+
+int
+seaf_obj_store_write_batch_add (OSWriteBatch *batch,
+                                const char *obj_id,
+                                void *data,
+                                int len)
+{
+    ObjBackend *bend = batch->obj_store->bend;
+
+    if (!batch->bend_batch)
+        return bend->write (bend, batch->repo_id, batch->version,
+                            obj_id, data, len, TRUE);
+
+    return bend->batch_add (bend, batch->bend_batch,
+                            batch->repo_id, batch->version,
+                            obj_id, data, len);
+}
+
+int
+seaf_obj_store_write_batch_commit (OSWriteBatch *batch)
+{
+    ObjBackend *bend = batch->obj_store->bend;
+
+    if (!batch->bend_batch)
+        return 0;
+
+    return bend->batch_commit (bend, batch->bend_batch);
+}
+
+void
+seaf_obj_store_write_batch_free (OSWriteBatch *batch)
+{
+    ObjBackend *bend;
+
+    if (!batch)
+        return;
+
+    bend = batch->obj_store->bend;
+    if (batch->bend_batch)
+        bend->batch_free (bend, batch->bend_batch);
+    g_free (batch);
+}
+
+gboolean
+seaf_obj_store_get_cache_stats (struct SeafObjStore *obj_store,
+                                LRUCacheStats *stats)
+{
+#ifdef SEAFILE_SERVER
+    if (obj_store->cached)
+        return obj_backend_cache_get_stats (obj_store->bend, stats);
+#endif
+    return FALSE;
+}
+
+gboolean
+seaf_obj_store_is_cached (struct SeafObjStore *obj_store)
+{
+    return obj_store->cached;
+}
+
+static void
+read_group (ObjBackend *bend, OSBatchRead *batch, GPtrArray *group)
+{
+    const char **obj_ids;
+    void **data;
+    int *lens;
+    AsyncTask *task;
+    guint i;
+
+    obj_ids = g_new (const char *, group->len);
+    data = g_new (void *, group->len);
+    lens = g_new (int, group->len);
+
+    for (i = 0; i < group->len; ++i) {
+        task = g_ptr_array_index (group, i);
+        obj_ids[i] = task->obj_id;
+    }
+
+    bend->read_batch (bend, batch->repo_id, batch->version,
+                      obj_ids, group->len, data, lens);
+
+    for (i = 0; i < group->len; ++i) {
+        task = g_ptr_array_index (group, i);
+        task->data = data[i];
+        task->len = lens[i];
+        task->success = (data[i] != NULL);
+        g_async_queue_push (batch->done, task);
+    }
+
+    g_free (obj_ids);
+    g_free (data);
+    g_free (lens);
+}
+
 static void
 reader_thread (void *data, void *user_data)
 {
@@ -242,6 +549,24 @@ reader_thread (void *data, void *user_data)
     SeafObjStore *obj_store = user_data;
     ObjBackend *bend = obj_store->bend;
     OSCallbackStruct *callback;
+    OSBatchRead *batch = task->batch;
+
+    if (task->group) {
+        read_group (bend, batch, task->group);
+        g_ptr_array_free (task->group, TRUE);
+        g_free (task);
+        return;
+    }
+
+    if (batch) {
+        task->success = TRUE;
+        if (bend->read (bend, batch->repo_id, batch->version,
+                        task->obj_id, &task->data, &task->len) < 0)
+            task->success = FALSE;
+
+        g_async_queue_push (batch->done, task);
+        return;
+    }
 
     callback = g_hash_table_lookup (obj_store->readers,
                                     (gpointer)(long)(task->rw_id));
@@ -518,3 +843,120 @@ seaf_obj_store_async_write (struct SeafObjStore *obj_store,
 
     return 0;
 }
+
+OSBatchRead *
+seaf_obj_store_batch_read_new (struct SeafObjStore *obj_store,
+                               const char *repo_id,
+                               int version)
+{
+    OSBatchRead *batch = g_new0 (OSBatchRead, 1);
+
+    batch->obj_store = obj_store;
+    memcpy (batch->repo_id, repo_id, 36);
+    batch->version = version;
+    batch->done = g_async_queue_new ();
+    if (obj_store->bend->read_batch)
+        batch->queued = g_ptr_array_new ();
+
+    return batch;
+}
+
+/* Hand the queued tasks to a reader thread as one group. */
+static void
+batch_read_flush (OSBatchRead *batch)
+{
+    AsyncTask *task, *queued;
+    GError *error = NULL;
+    guint i;
+
+    if (batch->queued->len == 0)
+        return;
+
+    task = g_new0 (AsyncTask, 1);
+    task->batch = batch;
+    task->group = batch->queued;
+    batch->queued = g_ptr_array_new ();
+
+    g_thread_pool_push (batch->obj_store->read_tpool, task, &error);
+    if (error) {
+        g_warning ("Failed to start batch read of %u objects.\n",
+                   task->group->len);
+        g_clear_error (&error);
+        /* The tasks are already counted as pending, report them as failed. */
+        for (i = 0; i < task->group->len; ++i) {
+            queued = g_ptr_array_index (task->group, i);
+            queued->success = FALSE;
+            g_async_queue_push (batch->done, queued);
+        }
+        g_ptr_array_free (task->group, TRUE);
+        g_free (task);
+    }
+}
+
+int
+seaf_obj_store_batch_read_add (OSBatchRead *batch, const char *obj_id)
+{
+    AsyncTask *task = g_new0 (AsyncTask, 1);
+    GError *error = NULL;
+
+    task->batch = batch;
+    memcpy (task->obj_id, obj_id, 41);
+
+    if (batch->queued) {
+        g_ptr_array_add (batch->queued, task);
+        ++batch->n_pending;
+        if (batch->queued->len >= READ_BATCH_SIZE)
+            batch_read_flush (batch);
+        return 0;
+    }
+
+    g_thread_pool_push (batch->obj_store->read_tpool, task, &error);
+    if (error) {
+        g_warning ("Failed to start batch read of %s.\n", obj_id);
+        g_clear_error (&error);
+        g_free (task);
+        return -1;
+    }
+
+    ++batch->n_pending;
+    return 0;
+}
+
+gboolean
+seaf_obj_store_batch_read_next (OSBatchRead *batch, OSAsyncResult *res)
+{
+    AsyncTask *task;
+
+    if (batch->n_pending == 0)
+        return FALSE;
+
+    if (batch->queued)
+        batch_read_flush (batch);
+
+    task = g_async_queue_pop (batch->done);
+    --batch->n_pending;
+
+    res->rw_id = 0;
+    memcpy (res->obj_id, task->obj_id, 41);
+    res->data = task->data;
+    res->len = task->len;
+    res->success = task->success;
+
+    g_free (task);
+    return TRUE;
+}
+
+void
+seaf_obj_store_batch_read_free (OSBatchRead *batch)
+{
+    OSAsyncResult res;
+
+    /* Tasks still in the thread pool refer to the batch. */
+    while (seaf_obj_store_batch_read_next (batch, &res))
+        g_free (res.data);
+
+    if (batch->queued)
+        g_ptr_array_free (batch->queued, TRUE);
+    g_async_queue_unref (batch->done);
+    g_free (batch);
+}
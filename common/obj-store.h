@@ -67,6 +67,48 @@ seaf_obj_store_copy_obj (struct SeafObjStore *obj_store,
                          int dst_version,
                          const char *obj_id);
 
+/*
+ * Group commit: write many objects and make them durable together.
+ * Objects added to a batch are only visible after
+ * seaf_obj_store_write_batch_commit() returns successfully, which gives
+ * the same guarantees as writing each object with need_sync.
+ * A batch must only be used by one thread.
+ */
+
+typedef struct OSWriteBatch OSWriteBatch;
+
+OSWriteBatch *
+seaf_obj_store_write_batch_new (struct SeafObjStore *obj_store,
+                                const char *repo_id,
+                                int version);
+
+int
+seaf_obj_store_write_batch_add (OSWriteBatch *batch,
+                                const char *obj_id,
+                                void *data,
+                                int len);
+
+int
+seaf_obj_store_write_batch_commit (OSWriteBatch *batch);
+
+/* Objects not committed are discarded. */
+void
+seaf_obj_store_write_batch_free (OSWriteBatch *batch);
+
+struct LRUCacheStats;
+
+/*
+ * Whether objects are cached on local disk in front of the configured
+ * backend (see [object_cache] in the config).
+ */
+gboolean
+seaf_obj_store_is_cached (struct SeafObjStore *obj_store);
+
+/* Returns FALSE if objects are not cached on local disk. */
+gboolean
+seaf_obj_store_get_cache_stats (struct SeafObjStore *obj_store,
+                                struct LRUCacheStats *stats);
+
 /* Asynchronous I/O interface. */
 
 typedef struct OSAsyncResult {
@@ -134,4 +176,35 @@ seaf_obj_store_async_stat (struct SeafObjStore *obj_store,
                            guint32 stat_id,
                            const char *obj_id);
 
+/*
+ * Batch read: read many objects concurrently with the reader thread pool
+ * and get them back in completion order. If the backend can read many
+ * objects at once (e.g. riak), objects are read in groups. The results
+ * are collected by the calling thread, so it doesn't need the event loop
+ * and can be used by tree traversals in any thread. A batch must only be
+ * used by one thread.
+ */
+
+typedef struct OSBatchRead OSBatchRead;
+
+OSBatchRead *
+seaf_obj_store_batch_read_new (struct SeafObjStore *obj_store,
+                               const char *repo_id,
+                               int version);
+
+int
+seaf_obj_store_batch_read_add (OSBatchRead *batch, const char *obj_id);
+
+/*
+ * Wait for the next finished read. Returns FALSE if no read is pending.
+ * Unlike async reads, @res->data is owned by the caller and must be freed
+ * with g_free().
+ */
+gboolean
+seaf_obj_store_batch_read_next (OSBatchRead *batch, OSAsyncResult *res);
+
+/* Wait for pending reads and discard their results. */
+void
+seaf_obj_store_batch_read_free (OSBatchRead *batch);
+
 #endif
@@ -6,6 +6,10 @@
 #define RIAK_QUORUM -1
 #define RIAK_ALL -2
 
+#define RIAK_DEFAULT_CONNECT_TIMEOUT 5000 /* milliseconds */
+#define RIAK_DEFAULT_TIMEOUT 30000        /* milliseconds */
+#define RIAK_DEFAULT_MAX_CONNECTIONS 4
+
 struct SeafRiakClient;
 typedef struct SeafRiakClient SeafRiakClient;
 
@@ -15,6 +19,24 @@ seaf_riak_client_new (const char *host, const char *port);
 void
 seaf_riak_client_free (SeafRiakClient *client);
 
+/*
+ * Set timeouts for every following request, in milliseconds.
+ * A request that can't be completed within @timeout_ms fails.
+ * 0 means no timeout.
+ */
+void
+seaf_riak_client_set_timeout (SeafRiakClient *client,
+                              long connect_timeout_ms,
+                              long timeout_ms);
+
+/*
+ * Max number of connections opened by seaf_riak_client_mget(), in total.
+ * Single requests always use one keep-alive connection per client, so
+ * a pool of clients should share one client for mget.
+ */
+void
+seaf_riak_client_set_max_connections (SeafRiakClient *client, int max_conns);
+
 int
 seaf_riak_client_get (SeafRiakClient *client,
                       const char *bucket,
@@ -22,6 +44,24 @@ seaf_riak_client_get (SeafRiakClient *client,
                       void **value,
                       int *size);
 
+/*
+ * Get @n_keys objects from @bucket. Requests are pipelined over up to
+ * max connections (see seaf_riak_client_set_max_connections()), which are
+ * kept open for later calls.
+ *
+ * @values and @sizes must have room for @n_keys elements. Objects that
+ * can't be read are set to NULL.
+ *
+ * Returns the number of objects read.
+ */
+int
+seaf_riak_client_mget (SeafRiakClient *client,
+                       const char *bucket,
+                       const char **keys,
+                       int n_keys,
+                       void **values,
+                       int *sizes);
+
 int
 seaf_riak_client_put (SeafRiakClient *client,
                       const char *bucket,
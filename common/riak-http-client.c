@@ -4,6 +4,7 @@
 
 #include <stdlib.h>
 #include <string.h>
+#include <sys/select.h>
 #include <curl/curl.h>
 #include <glib.h>
 
@@ -15,10 +16,22 @@
 #define seaf_warning g_warning
 #endif
 
+/* Number of requests queued on each connection in mget. */
+#define RIAK_PIPELINE_DEPTH 8
+
 struct SeafRiakClient {
+    /* Connection of single requests. libcurl keeps it open between
+     * requests, curl_easy_reset() doesn't close it.
+     */
     CURL *curl;
+    /* Connections of mget, created on first use. */
+    CURLM *multi;
     char *host;
     char *port;
+
+    long connect_timeout_ms;
+    long timeout_ms;
+    int max_conns;
 };
 
 typedef struct RiakObject {
@@ -35,6 +48,10 @@ seaf_riak_client_new (const char *host, const char *port)
     client->port = g_strdup(port);
     client->curl = curl_easy_init();
 
+    client->connect_timeout_ms = RIAK_DEFAULT_CONNECT_TIMEOUT;
+    client->timeout_ms = RIAK_DEFAULT_TIMEOUT;
+    client->max_conns = RIAK_DEFAULT_MAX_CONNECTIONS;
+
     return client;
 }
 
@@ -42,11 +59,64 @@ void
 seaf_riak_client_free (SeafRiakClient *client)
 {
     curl_easy_cleanup (client->curl);
+    if (client->multi)
+        curl_multi_cleanup (client->multi);
     g_free (client->host);
     g_free (client->port);
     g_free (client);
 }
 
+void
+seaf_riak_client_set_timeout (SeafRiakClient *client,
+                              long connect_timeout_ms,
+                              long timeout_ms)
+{
+    client->connect_timeout_ms = connect_timeout_ms;
+    client->timeout_ms = timeout_ms;
+}
+
+void
+seaf_riak_client_set_max_connections (SeafRiakClient *client, int max_conns)
+{
+    if (max_conns <= 0)
+        max_conns = RIAK_DEFAULT_MAX_CONNECTIONS;
+    client->max_conns = max_conns;
+}
+
+/*
+ * Options shared by all requests. Must be set again after curl_easy_reset().
+ *
+ * CURLOPT_FAILONERROR is not used since libcurl closes the connection
+ * on errors. Check the status with request_failed() instead, so that
+ * looking up missing objects doesn't cost a new connection.
+ */
+static void
+set_common_options (SeafRiakClient *client, CURL *curl)
+{
+    /* Signals can't be used for timeouts in multi-threaded programs. */
+    curl_easy_setopt (curl, CURLOPT_NOSIGNAL, 1L);
+    curl_easy_setopt (curl, CURLOPT_CONNECTTIMEOUT_MS, client->connect_timeout_ms);
+    curl_easy_setopt (curl, CURLOPT_TIMEOUT_MS, client->timeout_ms);
+#if LIBCURL_VERSION_NUM >= 0x071900
+    /* Detect dead idle connections. */
+    curl_easy_setopt (curl, CURLOPT_TCP_KEEPALIVE, 1L);
+#endif
+#ifdef RIAK_TEST
+    curl_easy_setopt (curl, CURLOPT_VERBOSE, 1L);
+#endif
+}
+
+static gboolean
+request_failed (CURL *curl, int rc, long *status)
+{
+    *status = 0;
+    if (rc != 0)
+        return TRUE;
+
+    curl_easy_getinfo (curl, CURLINFO_RESPONSE_CODE, status);
+    return (*status >= 400);
+}
+
 static size_t
 recv_object (void *contents, size_t size, size_t nmemb, void *userp)
 {
@@ -66,6 +136,20 @@ recv_object (void *contents, size_t size, size_t nmemb, void *userp)
     return realsize;
 }
 
+static void
+setup_get (SeafRiakClient *client,
+           CURL *curl,
+           const char *url,
+           RiakObject *object)
+{
+    curl_easy_setopt (curl, CURLOPT_URL, url);
+
+    /* Setup callback for receiving http message body. */
+    curl_easy_setopt (curl, CURLOPT_WRITEFUNCTION, recv_object);
+    curl_easy_setopt (curl, CURLOPT_WRITEDATA, object);
+    set_common_options (client, curl);
+}
+
 int
 seaf_riak_client_get (SeafRiakClient *client,
                       const char *bucket,
@@ -77,21 +161,17 @@ seaf_riak_client_get (SeafRiakClient *client,
     GString *url = g_string_new (NULL);
     RiakObject *object = g_new0 (RiakObject, 1);
     int rc, ret = 0;
+    long status;
 
     g_string_append_printf (url, "http://%s:%s/riak/%s/%s?r=1",
                             client->host, client->port, bucket, key);
-    curl_easy_setopt (curl, CURLOPT_URL, url->str);
-
-    /* Setup callback for receiving http message body. */
-    curl_easy_setopt (curl, CURLOPT_WRITEFUNCTION, recv_object);
-    curl_easy_setopt (curl, CURLOPT_WRITEDATA, object);
-    curl_easy_setopt (curl, CURLOPT_FAILONERROR, 1L);
-#ifdef RIAK_TEST
-    curl_easy_setopt (curl, CURLOPT_VERBOSE, 1L);
-#endif
+    setup_get (client, curl, url->str, object);
 
     rc = curl_easy_perform (curl);
-    if (rc != 0) {
+    if (request_failed (curl, rc, &status)) {
+        if (rc == CURLE_OPERATION_TIMEDOUT)
+            seaf_warning ("[riak http] Timeout getting object [%s:%s].\n",
+                          bucket, key);
         ret = -1;
         g_free (object->data);
         goto out;
@@ -108,6 +188,174 @@ out:
     return ret;
 }
 
+typedef struct MGetRequest {
+    int idx;
+    char *url;
+    RiakObject object;
+} MGetRequest;
+
+static CURLM *
+get_multi_handle (SeafRiakClient *client)
+{
+    if (client->multi)
+        return client->multi;
+
+    client->multi = curl_multi_init ();
+    /* Send requests one after another on the same connection, without
+     * waiting for the responses. Newer libcurl ignores this and queues the
+     * requests on the keep-alive connections instead.
+     */
+    curl_multi_setopt (client->multi, CURLMOPT_PIPELINING, 1L);
+    /* Don't keep more idle connections than that. */
+    curl_multi_setopt (client->multi, CURLMOPT_MAXCONNECTS,
+                       (long)client->max_conns);
+#if LIBCURL_VERSION_NUM >= 0x071e00
+    curl_multi_setopt (client->multi, CURLMOPT_MAX_HOST_CONNECTIONS,
+                       (long)client->max_conns);
+    curl_multi_setopt (client->multi, CURLMOPT_MAX_TOTAL_CONNECTIONS,
+                       (long)client->max_conns);
+#endif
+
+    return client->multi;
+}
+
+static void
+mget_start (SeafRiakClient *client,
+            CURLM *multi,
+            const char *bucket,
+            const char *key,
+            MGetRequest *req)
+{
+    CURL *curl = curl_easy_init ();
+
+    req->url = g_strdup_printf ("http://%s:%s/riak/%s/%s?r=1",
+                                client->host, client->port, bucket, key);
+    setup_get (client, curl, req->url, &req->object);
+    curl_easy_setopt (curl, CURLOPT_PRIVATE, req);
+
+    curl_multi_add_handle (multi, curl);
+}
+
+/* Returns the number of requests finished. */
+static int
+mget_collect (CURLM *multi,
+              const char *bucket,
+              const char **keys,
+              void **values,
+              int *sizes,
+              int *n_read)
+{
+    CURLMsg *msg;
+    CURL *curl;
+    int msgs_left;
+    MGetRequest *req;
+    long status;
+    int n_done = 0;
+
+    while ((msg = curl_multi_info_read (multi, &msgs_left)) != NULL) {
+        if (msg->msg != CURLMSG_DONE)
+            continue;
+
+        curl = msg->easy_handle;
+        curl_easy_getinfo (curl, CURLINFO_PRIVATE, (char **)&req);
+
+        if (!request_failed (curl, msg->data.result, &status)) {
+            values[req->idx] = req->object.data;
+            sizes[req->idx] = (int)req->object.size;
+            ++(*n_read);
+        } else {
+            if (msg->data.result != CURLE_OK)
+                seaf_warning ("[riak http] Failed to get object [%s:%s]: %s.\n",
+                              bucket, keys[req->idx],
+                              curl_easy_strerror(msg->data.result));
+            else if (status != 404)
+                seaf_warning ("[riak http] Failed to get object [%s:%s]: "
+                              "status %ld.\n", bucket, keys[req->idx], status);
+            g_free (req->object.data);
+        }
+        req->object.data = NULL;
+
+        /* The connection stays in the multi handle's cache. */
+        curl_multi_remove_handle (multi, curl);
+        curl_easy_cleanup (curl);
+        ++n_done;
+    }
+
+    return n_done;
+}
+
+static void
+mget_wait (CURLM *multi)
+{
+    fd_set rfds, wfds, efds;
+    int maxfd = -1;
+    long timeout_ms = -1;
+    struct timeval tv;
+
+    FD_ZERO (&rfds);
+    FD_ZERO (&wfds);
+    FD_ZERO (&efds);
+
+    curl_multi_timeout (multi, &timeout_ms);
+    if (timeout_ms < 0 || timeout_ms > 100)
+        timeout_ms = 100;
+    tv.tv_sec = timeout_ms / 1000;
+    tv.tv_usec = (timeout_ms % 1000) * 1000;
+
+    curl_multi_fdset (multi, &rfds, &wfds, &efds, &maxfd);
+    /* If there are no sockets yet (e.g. still resolving), this just sleeps. */
+    select (maxfd + 1, &rfds, &wfds, &efds, &tv);
+}
+
+int
+seaf_riak_client_mget (SeafRiakClient *client,
+                       const char *bucket,
+                       const char **keys,
+                       int n_keys,
+                       void **values,
+                       int *sizes)
+{
+    CURLM *multi = get_multi_handle (client);
+    MGetRequest *reqs;
+    int window = client->max_conns * RIAK_PIPELINE_DEPTH;
+    int next = 0, in_flight = 0, n_read = 0;
+    int running, i;
+
+    memset (values, 0, sizeof(void *) * n_keys);
+    memset (sizes, 0, sizeof(int) * n_keys);
+
+    if (n_keys <= 0)
+        return 0;
+
+    reqs = g_new0 (MGetRequest, n_keys);
+
+    /* Only keep a limited number of requests in flight, so that requests
+     * queued behind slow ones don't run out of time.
+     */
+    while (next < n_keys || in_flight > 0) {
+        while (next < n_keys && in_flight < window) {
+            reqs[next].idx = next;
+            mget_start (client, multi, bucket, keys[next], &reqs[next]);
+            ++next;
+            ++in_flight;
+        }
+
+        while (curl_multi_perform (multi, &running) == CURLM_CALL_MULTI_PERFORM)
+            ;
+
+        in_flight -= mget_collect (multi, bucket, keys, values, sizes, &n_read);
+
+        if (running > 0)
+            mget_wait (multi);
+    }
+
+    for (i = 0; i < n_keys; ++i)
+        g_free (reqs[i].url);
+    g_free (reqs);
+
+    return n_read;
+}
+
 static size_t
 send_object (void *ptr, size_t size, size_t nmemb, void *userp)
 {
@@ -138,6 +386,7 @@ seaf_riak_client_put (SeafRiakClient *client,
     GString *url = g_string_new (NULL);
     RiakObject *object = g_new0 (RiakObject, 1);
     int rc, ret = 0;
+    long status;
     struct curl_slist *headers = NULL;
 
     g_string_append_printf (url, "http://%s:%s/riak/%s/%s",
@@ -156,23 +405,28 @@ seaf_riak_client_put (SeafRiakClient *client,
     curl_easy_setopt (curl, CURLOPT_URL, url->str);
     /* Ask libcurl to send a PUT request. */
     curl_easy_setopt (curl, CURLOPT_UPLOAD, 1L);
-    curl_easy_setopt (curl, CURLOPT_FAILONERROR, 1L);
-#ifdef RIAK_TEST
-    curl_easy_setopt (curl, CURLOPT_VERBOSE, 1L);
-#endif
+    set_common_options (client, curl);
 
     headers = curl_slist_append (headers, "Content-type: application/binary");
+    /* Objects are small, don't wait a round trip for "100 Continue". */
+    headers = curl_slist_append (headers, "Expect:");
     curl_easy_setopt (curl, CURLOPT_HTTPHEADER, headers);
 
     object->data = value;
     object->size = (size_t)size;
     curl_easy_setopt (curl, CURLOPT_READFUNCTION, send_object);
     curl_easy_setopt (curl, CURLOPT_READDATA, object);
+    /* Send Content-Length instead of a chunked body. */
+    curl_easy_setopt (curl, CURLOPT_INFILESIZE_LARGE, (curl_off_t)size);
 
     rc = curl_easy_perform (curl);
-    if (rc != 0) {
-        seaf_warning ("[riak http] Failed to put object [%s:%s]: %s.\n",
-                      bucket, key, curl_easy_strerror(rc));
+    if (request_failed (curl, rc, &status)) {
+        if (rc != 0)
+            seaf_warning ("[riak http] Failed to put object [%s:%s]: %s.\n",
+                          bucket, key, curl_easy_strerror(rc));
+        else
+            seaf_warning ("[riak http] Failed to put object [%s:%s]: "
+                          "status %ld.\n", bucket, key, status);
         ret = -1;
     }
 
@@ -192,21 +446,19 @@ seaf_riak_client_query (SeafRiakClient *client,
     CURL *curl = client->curl;
     GString *url = g_string_new (NULL);
     int rc;
+    long status;
     gboolean ret;
 
     g_string_append_printf (url, "http://%s:%s/riak/%s/%s?r=1",
                             client->host, client->port, bucket, key);
     curl_easy_setopt (curl, CURLOPT_URL, url->str);
-    curl_easy_setopt (curl, CURLOPT_FAILONERROR, 1L);
-#ifdef RIAK_TEST
-    curl_easy_setopt (curl, CURLOPT_VERBOSE, 1L);
-#endif
+    set_common_options (client, curl);
 
     /* Ask libcurl to send a HEAD request. */
     curl_easy_setopt (curl, CURLOPT_NOBODY, 1L);
 
     rc = curl_easy_perform (curl);
-    if (rc != 0)
+    if (request_failed (curl, rc, &status))
         ret = FALSE;
     else
         ret = TRUE;
@@ -244,16 +496,16 @@ seaf_riak_client_delete (SeafRiakClient *client,
     curl_easy_setopt (curl, CURLOPT_URL, url->str);
     /* Ask libcurl to send a DELETE request. */
     curl_easy_setopt (curl, CURLOPT_CUSTOMREQUEST, "DELETE");
-    curl_easy_setopt (curl, CURLOPT_FAILONERROR, 1L);
-#ifdef RIAK_TEST
-    curl_easy_setopt (curl, CURLOPT_VERBOSE, 1L);
-#endif
+    set_common_options (client, curl);
 
     rc = curl_easy_perform (curl);
-    status = curl_easy_getinfo (curl, CURLINFO_RESPONSE_CODE, &status);
-    if (rc != 0 && status != 404) {
-        seaf_warning ("[riak http] Failed to delete object [%s:%s]: %s.\n",
-                      bucket, key, curl_easy_strerror(rc));
+    if (request_failed (curl, rc, &status) && status != 404) {
+        if (rc != 0)
+            seaf_warning ("[riak http] Failed to delete object [%s:%s]: %s.\n",
+                          bucket, key, curl_easy_strerror(rc));
+        else
+            seaf_warning ("[riak http] Failed to delete object [%s:%s]: "
+                          "status %ld.\n", bucket, key, status);
         ret = -1;
     }
 
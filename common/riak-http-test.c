@@ -1,34 +1,374 @@
+/*
+ * Tests the riak http client, and batch reads of the object store with
+ * the riak backend, against a minimal local stand-in for riak's http
+ * interface. Objects are kept in memory, GET requests for keys starting
+ * with "slow" are answered after 2 seconds.
+ */
+
 #include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <signal.h>
+#include <pthread.h>
+#include <sys/socket.h>
+#include <netinet/in.h>
+#include <arpa/inet.h>
 
 #include "riak-client.h"
+#include "seafile-session.h"
+#include "obj-store.h"
 
-int main (int argc, char **argv)
+SeafileSession *seaf;
+
+static GHashTable *objects;
+static pthread_mutex_t lock = PTHREAD_MUTEX_INITIALIZER;
+static int n_accepted;
+
+static void
+send_response (int fd, int status, const char *body, int len)
 {
-    SeafRiakClient *client = seaf_riak_client_new ("127.0.0.1", "8098");
-    int ret;
-    char *value;
-    int size;
-
-    if (!seaf_riak_client_query (client, "test", "http-test")) {
-        printf ("Writing value.\n");
-        ret = seaf_riak_client_put (client, "test", "http-test",
-                                    "test1", 6, 1);
-        if (ret < 0) {
-            g_error ("Failed to write.\n");
+    char header[256];
+    const char *reason;
+
+    switch (status) {
+    case 200: reason = "OK"; break;
+    case 204: reason = "No Content"; break;
+    case 404: reason = "Not Found"; break;
+    default: reason = "Bad Request";
+    }
+
+    snprintf (header, sizeof(header),
+              "HTTP/1.1 %d %s\r\nContent-Length: %d\r\n\r\n",
+              status, reason, len);
+    if (write (fd, header, strlen(header)) < 0)
+        return;
+    if (len > 0 && write (fd, body, len) < 0)
+        return;
+}
+
+/* Handles the first request in @buf. Returns its length, or 0 if the
+ * request is not complete yet.
+ */
+static int
+handle_request (int fd, GString *buf)
+{
+    char *end, *p, *q;
+    char method[16], path[512];
+    int content_length = 0;
+    int header_len;
+    GString *value;
+
+    end = strstr (buf->str, "\r\n\r\n");
+    if (!end)
+        return 0;
+    header_len = end - buf->str + 4;
+
+    p = strstr (buf->str, "\r\nContent-Length:");
+    if (p && p < end)
+        content_length = atoi (p + strlen("\r\nContent-Length:"));
+    if (buf->len < header_len + content_length)
+        return 0;
+
+    if (sscanf (buf->str, "%15s %511s", method, path) != 2) {
+        send_response (fd, 400, NULL, 0);
+        return header_len + content_length;
+    }
+    q = strchr (path, '?');
+    if (q)
+        *q = '\0';
+
+    if (strcmp (method, "GET") == 0 && strstr (path, "/slow"))
+        sleep (2);
+
+    pthread_mutex_lock (&lock);
+    if (strcmp (method, "GET") == 0 || strcmp (method, "HEAD") == 0) {
+        value = g_hash_table_lookup (objects, path);
+        if (!value)
+            send_response (fd, 404, NULL, 0);
+        else if (strcmp (method, "GET") == 0)
+            send_response (fd, 200, value->str, value->len);
+        else {
+            /* HEAD responses have no body. */
+            char header[128];
+            snprintf (header, sizeof(header),
+                      "HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n",
+                      (int)value->len);
+            if (write (fd, header, strlen(header)) < 0)
+                perror ("write");
         }
+    } else if (strcmp (method, "PUT") == 0) {
+        value = g_string_new_len (buf->str + header_len, content_length);
+        g_hash_table_replace (objects, g_strdup(path), value);
+        send_response (fd, 204, NULL, 0);
+    } else if (strcmp (method, "DELETE") == 0) {
+        if (g_hash_table_remove (objects, path))
+            send_response (fd, 204, NULL, 0);
+        else
+            send_response (fd, 404, NULL, 0);
+    } else
+        send_response (fd, 400, NULL, 0);
+    pthread_mutex_unlock (&lock);
+
+    return header_len + content_length;
+}
+
+static void *
+connection_thread (void *vdata)
+{
+    int fd = (int)(long)vdata;
+    GString *buf = g_string_new (NULL);
+    char tmp[4096];
+    int n, len;
+
+    while ((n = read (fd, tmp, sizeof(tmp))) > 0) {
+        g_string_append_len (buf, tmp, n);
+        /* Pipelined requests may arrive in one read. */
+        while ((len = handle_request (fd, buf)) > 0)
+            g_string_erase (buf, 0, len);
     }
 
-    ret = seaf_riak_client_get (client, "test", "http-test", (void**)&value, &size);
-    if (ret < 0) {
-        g_error ("Failed to read.\n");
+    close (fd);
+    g_string_free (buf, TRUE);
+    return NULL;
+}
+
+static void *
+server_thread (void *vdata)
+{
+    int listen_fd = (int)(long)vdata;
+    pthread_t tid;
+    int fd;
+
+    while ((fd = accept (listen_fd, NULL, NULL)) >= 0) {
+        pthread_mutex_lock (&lock);
+        ++n_accepted;
+        pthread_mutex_unlock (&lock);
+
+        pthread_create (&tid, NULL, connection_thread, (void *)(long)fd);
+        pthread_detach (tid);
+    }
+
+    return NULL;
+}
+
+static int
+start_server ()
+{
+    struct sockaddr_in addr;
+    socklen_t addrlen = sizeof(addr);
+    pthread_t tid;
+    int fd;
+
+    fd = socket (AF_INET, SOCK_STREAM, 0);
+    memset (&addr, 0, sizeof(addr));
+    addr.sin_family = AF_INET;
+    addr.sin_addr.s_addr = htonl (INADDR_LOOPBACK);
+    addr.sin_port = 0;
+
+    if (bind (fd, (struct sockaddr *)&addr, sizeof(addr)) < 0 ||
+        listen (fd, 64) < 0 ||
+        getsockname (fd, (struct sockaddr *)&addr, &addrlen) < 0)
+        g_error ("Failed to start server.\n");
+
+    pthread_create (&tid, NULL, server_thread, (void *)(long)fd);
+
+    return ntohs (addr.sin_port);
+}
+
+static int
+get_n_accepted ()
+{
+    int n;
+
+    pthread_mutex_lock (&lock);
+    n = n_accepted;
+    pthread_mutex_unlock (&lock);
+    return n;
+}
+
+#define N_KEYS 100
+
+/* More than one group of the object store's batch reads. */
+#define N_OBJS 150
+
+static void
+test_obj_store_batch_read (const char *port)
+{
+    struct SeafObjStore *obj_store;
+    OSBatchRead *batch;
+    OSAsyncResult res;
+    char *obj_ids[N_OBJS + 1];
+    GHashTable *seen;
+    const char *repo_id = "b1f2ad61-9164-418a-a47f-ab805dbd5694";
+    int i, n_read = 0;
+
+    seaf = g_new0 (SeafileSession, 1);
+    seaf->config = g_key_file_new ();
+    g_key_file_set_string (seaf->config, "object_backend", "name", "riak");
+    g_key_file_set_string (seaf->config, "object_backend", "host", "127.0.0.1");
+    g_key_file_set_string (seaf->config, "object_backend", "port", port);
+    g_key_file_set_integer (seaf->config, "object_backend",
+                            "max_connections", 4);
+
+    obj_store = seaf_obj_store_new (seaf, "fs");
+    if (!obj_store || seaf_obj_store_init (obj_store, FALSE, NULL) < 0)
+        g_error ("Failed to create object store.\n");
+
+    /* Every third object is missing, plus one at the end. */
+    for (i = 0; i <= N_OBJS; ++i) {
+        obj_ids[i] = g_compute_checksum_for_data (G_CHECKSUM_SHA1,
+                                                  (guchar *)&i, sizeof(i));
+        if (i % 3 != 0 && i < N_OBJS &&
+            seaf_obj_store_write_obj (obj_store, repo_id, 1, obj_ids[i],
+                                      obj_ids[i], 40, FALSE) < 0)
+            g_error ("Failed to write object %s.\n", obj_ids[i]);
+    }
+
+    batch = seaf_obj_store_batch_read_new (obj_store, repo_id, 1);
+    for (i = 0; i <= N_OBJS; ++i)
+        seaf_obj_store_batch_read_add (batch, obj_ids[i]);
+
+    seen = g_hash_table_new_full (g_str_hash, g_str_equal, g_free, NULL);
+    while (seaf_obj_store_batch_read_next (batch, &res)) {
+        if (g_hash_table_lookup (seen, res.obj_id))
+            g_error ("Object %s is returned twice.\n", res.obj_id);
+        g_hash_table_insert (seen, g_strdup (res.obj_id), GINT_TO_POINTER(1));
+
+        if (res.success) {
+            if (res.len != 40 || memcmp (res.data, res.obj_id, 40) != 0)
+                g_error ("Wrong data for object %s.\n", res.obj_id);
+            ++n_read;
+        }
+        g_free (res.data);
     }
+    seaf_obj_store_batch_read_free (batch);
+
+    if (g_hash_table_size (seen) != N_OBJS + 1)
+        g_error ("Got %u results, expected %d.\n",
+                 g_hash_table_size (seen), N_OBJS + 1);
+    if (n_read != N_OBJS - (N_OBJS + 2) / 3)
+        g_error ("Read %d objects, expected %d.\n",
+                 n_read, N_OBJS - (N_OBJS + 2) / 3);
+
+    g_hash_table_destroy (seen);
+    for (i = 0; i <= N_OBJS; ++i)
+        g_free (obj_ids[i]);
+}
+
+int main (int argc, char **argv)
+{
+    SeafRiakClient *client;
+    char port[16];
+    char *keys[N_KEYS + 1];
+    void *values[N_KEYS + 1];
+    int sizes[N_KEYS + 1];
+    char *value;
+    int size, ret, i, n_conns;
+    GTimer *timer;
+
+    /* The server writes to connections closed by timed out requests. */
+    signal (SIGPIPE, SIG_IGN);
+
+    objects = g_hash_table_new_full (g_str_hash, g_str_equal, g_free,
+                                     (GDestroyNotify)g_string_free);
+    snprintf (port, sizeof(port), "%d", start_server ());
+
+    client = seaf_riak_client_new ("127.0.0.1", port);
+
+    /* Single requests. */
 
-    printf ("Read value is %s.\n\n", value);
+    if (seaf_riak_client_query (client, "test", "http-test"))
+        g_error ("Object should not exist.\n");
+
+    ret = seaf_riak_client_put (client, "test", "http-test", "test1", 6, 1);
+    if (ret < 0)
+        g_error ("Failed to write.\n");
+
+    if (!seaf_riak_client_query (client, "test", "http-test"))
+        g_error ("Object should exist.\n");
+
+    ret = seaf_riak_client_get (client, "test", "http-test",
+                                (void**)&value, &size);
+    if (ret < 0 || size != 6 || strcmp (value, "test1") != 0)
+        g_error ("Failed to read.\n");
+    g_free (value);
 
     ret = seaf_riak_client_delete (client, "test", "http-test", 1);
-    if (ret < 0) {
+    if (ret < 0)
         g_error ("Failed to delete.\n");
+
+    if (seaf_riak_client_get (client, "test", "http-test",
+                              (void**)&value, &size) == 0)
+        g_error ("Object should be deleted.\n");
+
+    if (get_n_accepted () != 1)
+        g_error ("Connection is not kept alive: %d connections.\n",
+                 get_n_accepted ());
+
+    /* Multi-get. Every other key is missing, plus one at the end. */
+
+    for (i = 0; i < N_KEYS; ++i) {
+        keys[i] = g_strdup_printf ("key-%d", i);
+        if (i % 2 == 0 &&
+            seaf_riak_client_put (client, "test", keys[i],
+                                  keys[i], strlen(keys[i]), 1) < 0)
+            g_error ("Failed to write %s.\n", keys[i]);
     }
+    keys[N_KEYS] = "missing";
+
+    seaf_riak_client_set_max_connections (client, 4);
+    n_conns = get_n_accepted ();
+
+    ret = seaf_riak_client_mget (client, "test", (const char **)keys,
+                                 N_KEYS + 1, values, sizes);
+    if (ret != N_KEYS / 2)
+        g_error ("Read %d objects, expected %d.\n", ret, N_KEYS / 2);
+
+    for (i = 0; i <= N_KEYS; ++i) {
+        if (i % 2 == 0 && i < N_KEYS) {
+            if (!values[i] || sizes[i] != (int)strlen(keys[i]) ||
+                memcmp (values[i], keys[i], sizes[i]) != 0)
+                g_error ("Wrong value for %s.\n", keys[i]);
+        } else if (values[i] != NULL)
+            g_error ("%s should not be read.\n", keys[i]);
+        g_free (values[i]);
+    }
+
+    /* Connections are reused by later batches. */
+    ret = seaf_riak_client_mget (client, "test", (const char **)keys,
+                                 N_KEYS, values, sizes);
+    if (ret != N_KEYS / 2)
+        g_error ("Read %d objects, expected %d.\n", ret, N_KEYS / 2);
+    for (i = 0; i < N_KEYS; ++i)
+        g_free (values[i]);
+
+    if (get_n_accepted () - n_conns > 4)
+        g_error ("Too many connections for mget: %d.\n",
+                 get_n_accepted () - n_conns);
+
+    /* Timeouts. */
+
+    seaf_riak_client_put (client, "test", "slow", "slow", 4, 1);
+    seaf_riak_client_set_timeout (client, 1000, 500);
+
+    timer = g_timer_new ();
+    if (seaf_riak_client_get (client, "test", "slow",
+                              (void**)&value, &size) == 0)
+        g_error ("Request should time out.\n");
+    if (g_timer_elapsed (timer, NULL) > 1.5)
+        g_error ("Request took too long to time out.\n");
+    g_timer_destroy (timer);
+
+    /* Batch reads of the object store. */
+
+    test_obj_store_batch_read (port);
+
+    for (i = 0; i < N_KEYS; ++i)
+        g_free (keys[i]);
+    seaf_riak_client_free (client);
+
+    printf ("All tests passed.\n");
 
     return 0;
 }
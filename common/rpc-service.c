@@ -3780,4 +3780,52 @@ seafile_clean_up_repo_history (const char *repo_id, int keep_days, GError **erro
     return ret;
 }
 
+/* Cache statistics */
+
+static json_t *
+cache_stats_to_json (LRUCacheStats *stats)
+{
+    json_t *object = json_object ();
+
+    json_object_set_int_member (object, "hits", stats->hits);
+    json_object_set_int_member (object, "misses", stats->misses);
+    json_object_set_int_member (object, "evictions", stats->evictions);
+    json_object_set_int_member (object, "items", stats->n_items);
+    json_object_set_int_member (object, "bytes", stats->bytes);
+    json_object_set_int_member (object, "max_bytes", stats->max_bytes);
+
+    return object;
+}
+
+char *
+seafile_get_cache_stats (GError **error)
+{
+    json_t *object;
+    LRUCacheStats stats;
+    char *json_str, *ret;
+
+    object = json_object ();
+
+    if (seaf_fs_manager_get_cache_stats (seaf->fs_mgr, &stats))
+        json_object_set_new (object, "fs_cache", cache_stats_to_json (&stats));
+
+    if (seaf_commit_manager_get_cache_stats (seaf->commit_mgr, &stats))
+        json_object_set_new (object, "commit_cache", cache_stats_to_json (&stats));
+
+    if (seaf_obj_store_get_cache_stats (seaf->fs_mgr->obj_store, &stats))
+        json_object_set_new (object, "fs_disk_cache",
+                             cache_stats_to_json (&stats));
+
+    if (seaf_obj_store_get_cache_stats (seaf->commit_mgr->obj_store, &stats))
+        json_object_set_new (object, "commit_disk_cache",
+                             cache_stats_to_json (&stats));
+
+    json_str = json_dumps (object, JSON_COMPACT);
+    ret = g_strdup (json_str);
+
+    free (json_str);
+    json_decref (object);
+    return ret;
+}
+
 #endif  /* SEAFILE_SERVER */
@@ -469,7 +469,8 @@ out:
 static int
 http_post (CURL *curl, const char *url, const char *token,
            const char *req_content, gint64 req_size,
-           int *rsp_status, char **rsp_content, gint64 *rsp_size)
+           int *rsp_status, char **rsp_content, gint64 *rsp_size,
+           HttpRecvCallback callback, void *cb_data)
 {
     char *token_header;
     struct curl_slist *headers = NULL;
@@ -511,6 +512,9 @@ http_post (CURL *curl, const char *url, const char *token,
     if (rsp_content) {
         curl_easy_setopt(curl, CURLOPT_WRITEFUNCTION, recv_response);
         curl_easy_setopt(curl, CURLOPT_WRITEDATA, &rsp);
+    } else if (callback) {
+        curl_easy_setopt(curl, CURLOPT_WRITEFUNCTION, callback);
+        curl_easy_setopt(curl, CURLOPT_WRITEDATA, cb_data);
     }
 
     int rc = curl_easy_perform (curl);
@@ -1142,7 +1146,7 @@ get_folder_perms_thread (void *vdata)
         goto out;
 
     if (http_post (curl, url, NULL, req_content, strlen(req_content),
-                   &status, &rsp_content, &rsp_size) < 0)
+                   &status, &rsp_content, &rsp_size, NULL, NULL) < 0)
         goto out;
 
     if (status == HTTP_OK) {
@@ -1684,7 +1688,7 @@ upload_check_id_list_segment (HttpTxTask *task, Connection *conn, const char *ur
 
     if (http_post (curl, url, task->token,
                    data, len,
-                   &status, &rsp_content, &rsp_size) < 0) {
+                   &status, &rsp_content, &rsp_size, NULL, NULL) < 0) {
         task->error = HTTP_TASK_ERR_NET;
         ret = -1;
         goto out;
@@ -1804,7 +1808,7 @@ send_fs_objects (HttpTxTask *task, Connection *conn, GList **send_fs_list)
 
     if (http_post (curl, url, task->token,
                    package, evbuffer_get_length(buf),
-                   &status, NULL, NULL) < 0) {
+                   &status, NULL, NULL, NULL, NULL) < 0) {
         task->error = HTTP_TASK_ERR_NET;
         ret = -1;
         goto out;
@@ -2618,7 +2622,7 @@ get_fs_objects (HttpTxTask *task, Connection *conn, GList **fs_list)
 
     if (http_post (curl, url, task->token,
                    data, len,
-                   &status, &rsp_content, &rsp_size) < 0) {
+                   &status, &rsp_content, &rsp_size, NULL, NULL) < 0) {
         task->error = HTTP_TASK_ERR_NET;
         ret = -1;
         goto out;
@@ -2704,6 +2708,28 @@ typedef struct {
     HttpTxTask *task;
 } GetBlockData;
 
+static void
+add_recv_bytes (size_t n)
+{
+    /* Update global transferred bytes. */
+    g_atomic_int_add (&(seaf->sync_mgr->recv_bytes), n);
+
+    /* If uploaded bytes exceeds the limit, wait until the counter
+     * is reset. We check the counter every 100 milliseconds, so we
+     * can waste up to 100 milliseconds without sending data after
+     * the counter is reset.
+     */
+    while (1) {
+        gint sent = g_atomic_int_get(&(seaf->sync_mgr->recv_bytes));
+        if (seaf->sync_mgr->download_limit > 0 &&
+            sent > seaf->sync_mgr->download_limit)
+            /* 100 milliseconds */
+            g_usleep (100000);
+        else
+            break;
+    }
+}
+
 static size_t
 get_block_callback (void *ptr, size_t size, size_t nmemb, void *userp)
 {
@@ -2725,23 +2751,7 @@ get_block_callback (void *ptr, size_t size, size_t nmemb, void *userp)
         return n;
     }
 
-    /* Update global transferred bytes. */
-    g_atomic_int_add (&(seaf->sync_mgr->recv_bytes), n);
-
-    /* If uploaded bytes exceeds the limit, wait until the counter
-     * is reset. We check the counter every 100 milliseconds, so we
-     * can waste up to 100 milliseconds without sending data after
-     * the counter is reset.
-     */
-    while (1) {
-        gint sent = g_atomic_int_get(&(seaf->sync_mgr->recv_bytes));
-        if (seaf->sync_mgr->download_limit > 0 &&
-            sent > seaf->sync_mgr->download_limit)
-            /* 100 milliseconds */
-            g_usleep (100000);
-        else
-            break;
-    }
+    add_recv_bytes (n);
 
     return n;
 }
@@ -2816,6 +2826,240 @@ error:
     return ret;
 }
 
+#define GET_BLOCKS_N 64
+
+typedef struct {
+    HttpTxTask *task;
+    CURL *curl;
+    gboolean status_checked;
+    gboolean status_ok;
+    /* Header of the block being received. */
+    ObjectHeader hdr;
+    int hdr_len;
+    char block_id[41];
+    guint32 remain;
+    BlockHandle *block;
+    GHashTable *requested;
+} GetBlocksData;
+
+static int
+commit_packed_block (GetBlocksData *data)
+{
+    HttpTxTask *task = data->task;
+    int ret = 0;
+
+    seaf_block_manager_close_block (seaf->block_mgr, data->block);
+
+    if (seaf_block_manager_commit_block (seaf->block_mgr, data->block) < 0) {
+        seaf_warning ("Failed to commit block %s in repo %.8s.\n",
+                      data->block_id, task->repo_id);
+        task->error = HTTP_TASK_ERR_WRITE_LOCAL_DATA;
+        ret = -1;
+    } else
+        g_hash_table_remove (data->requested, data->block_id);
+
+    seaf_block_manager_block_handle_free (seaf->block_mgr, data->block);
+    data->block = NULL;
+
+    return ret;
+}
+
+/*
+ * Split the pack-blocks response into blocks as it arrives, so that
+ * the blocks don't have to be held in memory.
+ */
+static size_t
+get_blocks_callback (void *ptr, size_t size, size_t nmemb, void *userp)
+{
+    size_t realsize = size *nmemb;
+    GetBlocksData *data = userp;
+    HttpTxTask *task = data->task;
+    char *p = ptr;
+    size_t left = realsize;
+    size_t n;
+
+    if (task->state == HTTP_TASK_STATE_CANCELED)
+        return 0;
+
+    /* The body of an error response is not a block pack. */
+    if (!data->status_checked) {
+        long status = 0;
+        curl_easy_getinfo (data->curl, CURLINFO_RESPONSE_CODE, &status);
+        data->status_ok = (status == HTTP_OK);
+        data->status_checked = TRUE;
+    }
+    if (!data->status_ok)
+        return realsize;
+
+    while (left > 0) {
+        if (!data->block) {
+            n = MIN (left, sizeof(ObjectHeader) - data->hdr_len);
+            memcpy ((char *)&data->hdr + data->hdr_len, p, n);
+            data->hdr_len += n;
+            p += n;
+            left -= n;
+            if (data->hdr_len < sizeof(ObjectHeader))
+                break;
+
+            data->hdr_len = 0;
+            memcpy (data->block_id, data->hdr.obj_id, 40);
+            data->block_id[40] = 0;
+            data->remain = ntohl (data->hdr.obj_size);
+
+            if (!g_hash_table_lookup (data->requested, data->block_id)) {
+                seaf_warning ("Received unexpected block %s in repo %.8s.\n",
+                              data->block_id, task->repo_id);
+                task->error = HTTP_TASK_ERR_SERVER;
+                return 0;
+            }
+
+            data->block = seaf_block_manager_open_block (seaf->block_mgr,
+                                                         task->repo_id,
+                                                         task->repo_version,
+                                                         data->block_id,
+                                                         BLOCK_WRITE);
+            if (!data->block) {
+                seaf_warning ("Failed to open block %s in repo %.8s.\n",
+                              data->block_id, task->repo_id);
+                task->error = HTTP_TASK_ERR_WRITE_LOCAL_DATA;
+                return 0;
+            }
+        } else {
+            n = MIN (left, data->remain);
+            if (seaf_block_manager_write_block (seaf->block_mgr, data->block,
+                                                p, n) < (int)n) {
+                seaf_warning ("Failed to write block %s in repo %.8s.\n",
+                              data->block_id, task->repo_id);
+                task->error = HTTP_TASK_ERR_BAD_LOCAL_DATA;
+                return 0;
+            }
+            p += n;
+            left -= n;
+            data->remain -= n;
+
+            add_recv_bytes (n);
+        }
+
+        if (data->block && data->remain == 0 &&
+            commit_packed_block (data) < 0)
+            return 0;
+    }
+
+    return realsize;
+}
+
+/*
+ * Download a batch of blocks from the head of @block_list with one
+ * pack-blocks request. Blocks not returned by the server are left in
+ * the list. If the server doesn't support pack-blocks, task->no_pack_blocks
+ * is set and the whole batch is left in the list.
+ */
+static int
+get_blocks (HttpTxTask *task, Connection *conn, GList **block_list)
+{
+    json_t *array;
+    GList *batch = NULL, *ptr;
+    char *block_id;
+    int n_sent = 0;
+    char *data = NULL;
+    CURL *curl;
+    char *url = NULL;
+    int status;
+    int ret = 0;
+    GetBlocksData gdata;
+
+    memset (&gdata, 0, sizeof(gdata));
+    gdata.requested = g_hash_table_new (g_str_hash, g_str_equal);
+
+    array = json_array ();
+
+    while (*block_list != NULL && n_sent < GET_BLOCKS_N) {
+        block_id = (*block_list)->data;
+        *block_list = g_list_delete_link (*block_list, *block_list);
+
+        /* A block may be used more than once in a file. */
+        if (g_hash_table_lookup (gdata.requested, block_id))
+            continue;
+
+        json_array_append_new (array, json_string(block_id));
+        g_hash_table_insert (gdata.requested, block_id, block_id);
+        batch = g_list_prepend (batch, block_id);
+        ++n_sent;
+    }
+
+    data = json_dumps (array, 0);
+    json_decref (array);
+
+    curl = conn->curl;
+
+    url = g_strdup_printf ("%s/seafhttp/repo/%s/pack-blocks/",
+                           task->host, task->repo_id);
+
+    gdata.task = task;
+    gdata.curl = curl;
+
+    if (http_post (curl, url, task->token,
+                   data, strlen(data),
+                   &status, NULL, NULL,
+                   get_blocks_callback, &gdata) < 0) {
+        if (task->state == HTTP_TASK_STATE_CANCELED)
+            goto out;
+
+        if (task->error == HTTP_TASK_OK)
+            task->error = HTTP_TASK_ERR_NET;
+        ret = -1;
+        goto out;
+    }
+
+    if (status == HTTP_NOT_FOUND) {
+        seaf_message ("Server %s doesn't support pack-blocks, "
+                      "download blocks one by one.\n", task->host);
+        task->no_pack_blocks = TRUE;
+        goto out;
+    }
+
+    if (status != HTTP_OK) {
+        seaf_warning ("Bad response code for POST %s: %d.\n", url, status);
+        handle_http_errors (task, status);
+        ret = -1;
+        goto out;
+    }
+
+    if (gdata.block != NULL || gdata.hdr_len > 0) {
+        seaf_warning ("Incomplete block package received for repo %.8s.\n",
+                      task->repo_id);
+        task->error = HTTP_TASK_ERR_SERVER;
+        ret = -1;
+        goto out;
+    }
+
+    if (g_hash_table_size (gdata.requested) == n_sent) {
+        seaf_warning ("No block returned for POST %s.\n", url);
+        task->error = HTTP_TASK_ERR_SERVER;
+        ret = -1;
+    }
+
+out:
+    if (gdata.block) {
+        seaf_block_manager_close_block (seaf->block_mgr, gdata.block);
+        seaf_block_manager_block_handle_free (seaf->block_mgr, gdata.block);
+    }
+
+    /* Put back the blocks that were not received, in the original order. */
+    for (ptr = batch; ptr; ptr = ptr->next) {
+        if (g_hash_table_lookup (gdata.requested, ptr->data))
+            *block_list = g_list_prepend (*block_list, ptr->data);
+    }
+    g_list_free (batch);
+    g_hash_table_destroy (gdata.requested);
+
+    g_free (url);
+    g_free (data);
+    curl_easy_reset (curl);
+
+    return ret;
+}
+
 int
 http_tx_task_download_file_blocks (HttpTxTask *task, const char *file_id)
 {
@@ -2853,17 +3097,30 @@ http_tx_task_download_file_blocks (HttpTxTask *task, const char *file_id)
 
     int i;
     char *block_id;
-    for (i = 0; i < file->n_blocks; ++i) {
+    GList *missing = NULL;
+    for (i = file->n_blocks - 1; i >= 0; --i) {
         block_id = file->blk_sha1s[i];
         if (!seaf_block_manager_block_exists (seaf->block_mgr,
                                               task->repo_id,
                                               task->repo_version,
-                                              block_id)) {
-            ret = get_block (task, conn, block_id);
-            if (ret < 0 || task->state == HTTP_TASK_STATE_CANCELED)
-                break;
+                                              block_id))
+            missing = g_list_prepend (missing, block_id);
+    }
+
+    /* Download missing blocks in batches, unless there is only one
+     * block left or the server is too old to support it.
+     */
+    while (missing != NULL) {
+        if (task->no_pack_blocks || missing->next == NULL) {
+            ret = get_block (task, conn, missing->data);
+            missing = g_list_delete_link (missing, missing);
+        } else {
+            ret = get_blocks (task, conn, &missing);
         }
+        if (ret < 0 || task->state == HTTP_TASK_STATE_CANCELED)
+            break;
     }
+    g_list_free (missing);
 
     connection_pool_return_connection (pool, conn);
 
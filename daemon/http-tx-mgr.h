@@ -84,6 +84,8 @@ struct _HttpTxTask {
     /* For download progress */
     int n_files;
     int done_files;
+    /* Set if the server doesn't support downloading packed blocks. */
+    gboolean no_pack_blocks;
 
     gint tx_bytes;              /* bytes transferred in this second. */
     gint last_tx_bytes;         /* bytes transferred in the last second. */
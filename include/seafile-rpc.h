@@ -845,6 +845,14 @@ seafile_get_virtual_repo (const char *origin_repo,
 char *
 seafile_get_system_default_repo_id (GError **error);
 
+/*
+ * Return counters of in-memory caches as a json object, e.g.
+ * {"fs_cache": {"hits": 10, "misses": 2, "evictions": 0, ...},
+ *  "commit_cache": {...}}.
+ */
+char *
+seafile_get_cache_stats (GError **error);
+
 /* Clean trash */
 
 int
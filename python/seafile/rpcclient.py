@@ -833,6 +833,11 @@ class SeafServerThreadedRpcClient(ccnet.RpcClientBase):
     def get_system_default_repo_id():
         pass
 
+    # monitoring
+    @searpc_func("string", [])
+    def get_cache_stats():
+        pass
+
     # Change password
     @searpc_func("int", ["string", "string", "string", "string"])
     def seafile_change_repo_passwd(repo_id, old_passwd, new_passwd, user):
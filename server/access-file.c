@@ -27,9 +27,22 @@
 #include "seafile-session.h"
 #include "access-file.h"
 #include "pack-dir.h"
+#include "lru-cache.h"
 
 #define FILE_TYPE_MAP_DEFAULT_LEN 1
 
+/* When blocks are sent straight from block files, keep at most this many
+ * bytes of block content queued in the output buffer. Only file segments
+ * are queued, the content is never read into memory.
+ */
+#define SENDFILE_QUEUE_SIZE (8 * 1024 * 1024)
+
+/* Requests with more ranges than this are answered with the whole file. */
+#define MAX_RANGES 16
+
+/* Memory for caching block offsets of files served with ranges. */
+#define BLOCK_INDEX_CACHE_SIZE (16 * 1024 * 1024)
+
 struct file_type_map {
     char *suffix;
     char *type;
@@ -41,6 +54,7 @@ typedef struct SendBlockData {
     BlockHandle *handle;
     uint32_t bsize;
     uint32_t remain;
+    gboolean queued;
 
     char store_id[37];
     int repo_version;
@@ -70,12 +84,49 @@ typedef struct SendfileData {
     void *saved_cb_arg;
 } SendfileData;
 
+/* Offsets of the blocks of a file, for locating ranges. */
+typedef struct BlockIndex {
+    guint32 n_blocks;
+    /* offsets[i] is the offset of block i in the file, offsets[n_blocks]
+     * is the file size.
+     */
+    guint64 *offsets;
+} BlockIndex;
+
+typedef struct ByteRange {
+    guint64 start;
+    guint64 end;                /* inclusive */
+} ByteRange;
+
+typedef struct SendRangeData {
+    evhtp_request_t *req;
+    Seafile *file;
+    BlockIndex *index;
+    ByteRange *ranges;
+    int n_ranges;
+    int cur;                    /* range being sent */
+    guint64 pos;                /* next byte of the file to send */
+    gboolean zero_copy;
+
+    /* For multipart/byteranges responses. */
+    char *boundary;
+    char *content_type;
+
+    char store_id[37];
+    int repo_version;
+
+    bufferevent_data_cb saved_read_cb;
+    bufferevent_data_cb saved_write_cb;
+    bufferevent_event_cb saved_event_cb;
+    void *saved_cb_arg;
+} SendRangeData;
+
 typedef struct SendDirData {
     evhtp_request_t *req;
-    size_t remain;
 
-    int zipfd;
-    char *zipfile;
+    PackDirStream *stream;
+    /* For waiting for more data from the stream. */
+    struct event *read_ev;
 
     bufferevent_data_cb saved_read_cb;
     bufferevent_data_cb saved_write_cb;
@@ -87,6 +138,9 @@ typedef struct SendDirData {
 
 extern SeafileSession *seaf;
 
+/* file id -> BlockIndex */
+static LRUCache *block_index_cache;
+
 static struct file_type_map ftmap[] = {
     { "txt", "text/plain" },
     { "html", "text/html" },
@@ -141,10 +195,10 @@ free_sendfile_data (SendfileData *data)
 static void
 free_senddir_data (SendDirData *data)
 {
-    close (data->zipfd);
-    g_unlink (data->zipfile);
+    if (data->read_ev)
+        event_free (data->read_ev);
+    pack_dir_stream_free (data->stream);
 
-    g_free (data->zipfile);
     g_free (data);
 }
 
@@ -210,6 +264,74 @@ err:
     return;
 }
 
+/*
+ * Queue the content of a block to @out as a file segment. libevent sends
+ * it with sendfile() and closes the fd after that.
+ */
+static int
+add_block_file (struct evbuffer *out,
+                const char *store_id, int version, const char *blk_id)
+{
+    gint64 offset, size;
+    int fd;
+
+    fd = seaf_block_manager_open_block_fd (seaf->block_mgr,
+                                           store_id, version, blk_id,
+                                           &offset, &size);
+    if (fd < 0) {
+        seaf_warning ("Failed to open block %s\n", blk_id);
+        return -1;
+    }
+
+    if (size == 0) {
+        close (fd);
+        return 0;
+    }
+
+    /* Depending on libevent version, the fd may have been closed on
+     * failure. So don't close it here.
+     */
+    if (evbuffer_add_file (out, fd, offset, size) < 0) {
+        seaf_warning ("Failed to add block %s to output buffer.\n", blk_id);
+        return -1;
+    }
+
+    return 0;
+}
+
+static void
+write_block_file_cb (struct bufferevent *bev, void *ctx)
+{
+    SendBlockData *data = ctx;
+
+    if (data->queued) {
+        /* The block has been sent out, finish. */
+
+        /* Recover evhtp's callbacks */
+        bev->readcb = data->saved_read_cb;
+        bev->writecb = data->saved_write_cb;
+        bev->errorcb = data->saved_event_cb;
+        bev->cbarg = data->saved_cb_arg;
+
+        /* Resume reading incomming requests. */
+        evhtp_request_resume (data->req);
+
+        evhtp_send_reply_end (data->req);
+
+        free_sendblock_data (data);
+        return;
+    }
+
+    if (add_block_file (bufferevent_get_output (bev),
+                        data->store_id, data->repo_version,
+                        data->block_id) < 0) {
+        evhtp_connection_free (evhtp_request_get_connection (data->req));
+        free_sendblock_data (data);
+        return;
+    }
+    data->queued = TRUE;
+}
+
 static void
 write_data_cb (struct bufferevent *bev, void *ctx)
 {
@@ -349,40 +471,108 @@ err:
     return;
 }
 
+/*
+ * Send blocks of an unencrypted file without copying them through user
+ * space. Blocks are queued as file segments and chained one after another,
+ * this callback is called again each time the output buffer is drained.
+ */
+static void
+write_file_data_cb (struct bufferevent *bev, void *ctx)
+{
+    SendfileData *data = ctx;
+    struct evbuffer *out = bufferevent_get_output (bev);
+
+    if (data->idx == data->file->n_blocks) {
+        /* All blocks have been sent out, finish. */
+
+        /* Recover evhtp's callbacks */
+        bev->readcb = data->saved_read_cb;
+        bev->writecb = data->saved_write_cb;
+        bev->errorcb = data->saved_event_cb;
+        bev->cbarg = data->saved_cb_arg;
+
+        /* Resume reading incomming requests. */
+        evhtp_request_resume (data->req);
+
+        evhtp_send_reply_end (data->req);
+
+        free_sendfile_data (data);
+        return;
+    }
+
+    while (data->idx < data->file->n_blocks &&
+           evbuffer_get_length (out) < SENDFILE_QUEUE_SIZE) {
+        if (add_block_file (out, data->store_id, data->repo_version,
+                            data->file->blk_sha1s[data->idx]) < 0) {
+            evhtp_connection_free (evhtp_request_get_connection (data->req));
+            free_sendfile_data (data);
+            return;
+        }
+        ++(data->idx);
+    }
+}
+
+/*
+ * Blocks can be sent straight from block files if they don't need to be
+ * decrypted and the backend supports it. On TLS connections the content
+ * has to be encrypted in user space anyway.
+ */
+static gboolean
+can_send_block_file (evhtp_request_t *req, SeafileCrypt *crypt)
+{
+    return (crypt == NULL && req->htp->ssl_cfg == NULL &&
+            seaf_block_manager_support_block_fd (seaf->block_mgr));
+}
+
 static void
 write_dir_data_cb (struct bufferevent *bev, void *ctx)
 {
     SendDirData *data = ctx;
     char buf[64 * 1024];
+    struct evbuffer *chunk;
     int n;
 
-    n = readn (data->zipfd, buf, sizeof(buf));
-    if (n < 0) {
-        seaf_warning ("failed to read zipfile %s\n", data->zipfile);
-        evhtp_connection_free (evhtp_request_get_connection (data->req));
-        free_senddir_data (data);
-    } else if (n > 0) {
-        bufferevent_write (bev, buf, n);
-        data->remain -= n;
-
-        if (data->remain == 0) {
-            /* Recover evhtp's callbacks */
-            bev->readcb = data->saved_read_cb;
-            bev->writecb = data->saved_write_cb;
-            bev->errorcb = data->saved_event_cb;
-            bev->cbarg = data->saved_cb_arg;
+    n = pack_dir_stream_read (data->stream, buf, sizeof(buf));
+    if (n > 0) {
+        /* Read more after the output buffer is drained. */
+        chunk = evbuffer_new ();
+        evbuffer_add (chunk, buf, n);
+        evhtp_send_reply_chunk (data->req, chunk);
+        evbuffer_free (chunk);
+    } else if (n == 0) {
+        /* Recover evhtp's callbacks */
+        bev->readcb = data->saved_read_cb;
+        bev->writecb = data->saved_write_cb;
+        bev->errorcb = data->saved_event_cb;
+        bev->cbarg = data->saved_cb_arg;
 
-            /* Resume reading incomming requests. */
-            evhtp_request_resume (data->req);
+        /* Resume reading incomming requests. */
+        evhtp_request_resume (data->req);
 
-            evhtp_send_reply_end (data->req);
+        evhtp_send_reply_chunk_end (data->req);
 
-            free_senddir_data (data);
-            return;
-        }
+        free_senddir_data (data);
+    } else if (errno == EAGAIN || errno == EWOULDBLOCK) {
+        /* The archive is still being generated. */
+        event_add (data->read_ev, NULL);
+    } else {
+        /* Headers are already sent, the client can only tell the
+         * error by the closed connection.
+         */
+        seaf_warning ("Failed to read zip stream: %s.\n", strerror(errno));
+        evhtp_connection_free (evhtp_request_get_connection (data->req));
+        free_senddir_data (data);
     }
 }
 
+static void
+dir_stream_readable_cb (evutil_socket_t fd, short what, void *ctx)
+{
+    SendDirData *data = ctx;
+
+    write_dir_data_cb (evhtp_request_get_bev (data->req), data);
+}
+
 static void
 my_block_event_cb (struct bufferevent *bev, short events, void *ctx)
 {
@@ -470,6 +660,463 @@ test_firefox (evhtp_request_t *req)
     }
 }
 
+static BlockIndex *
+block_index_copy (BlockIndex *index)
+{
+    BlockIndex *copy = g_new0 (BlockIndex, 1);
+
+    copy->n_blocks = index->n_blocks;
+    copy->offsets = g_memdup (index->offsets,
+                              (index->n_blocks + 1) * sizeof(guint64));
+    return copy;
+}
+
+static void
+block_index_free (BlockIndex *index)
+{
+    if (!index)
+        return;
+    g_free (index->offsets);
+    g_free (index);
+}
+
+/*
+ * Block sizes are not recorded in file objects, so the index is built by
+ * stating every block of the file. Since the index only depends on the
+ * file id, it's cached across requests.
+ */
+static BlockIndex *
+get_block_index (const char *store_id, int version, Seafile *file)
+{
+    BlockIndex *index;
+    BlockMetadata *bmd;
+    guint32 i;
+
+    index = lru_cache_lookup (block_index_cache, file->file_id);
+    if (index)
+        return index;
+
+    index = g_new0 (BlockIndex, 1);
+    index->n_blocks = file->n_blocks;
+    index->offsets = g_new0 (guint64, file->n_blocks + 1);
+
+    for (i = 0; i < file->n_blocks; ++i) {
+        bmd = seaf_block_manager_stat_block (seaf->block_mgr,
+                                             store_id, version,
+                                             file->blk_sha1s[i]);
+        if (!bmd) {
+            block_index_free (index);
+            return NULL;
+        }
+        index->offsets[i + 1] = index->offsets[i] + bmd->size;
+        g_free (bmd);
+    }
+
+    if (index->offsets[file->n_blocks] != file->file_size) {
+        seaf_warning ("Size of blocks doesn't match size of file %s.\n",
+                      file->file_id);
+        block_index_free (index);
+        return NULL;
+    }
+
+    lru_cache_insert (block_index_cache, file->file_id, index,
+                      sizeof(BlockIndex) +
+                      (file->n_blocks + 1) * sizeof(guint64));
+    return index;
+}
+
+/* Find the block containing byte @pos of the file. */
+static guint32
+block_index_find (BlockIndex *index, guint64 pos)
+{
+    guint32 lo = 0, hi = index->n_blocks - 1, mid;
+
+    while (lo < hi) {
+        mid = lo + (hi - lo) / 2;
+        if (index->offsets[mid + 1] <= pos)
+            lo = mid + 1;
+        else
+            hi = mid;
+    }
+
+    return lo;
+}
+
+static gboolean
+parse_range_number (const char *str, const char *end, guint64 *value)
+{
+    const char *p;
+    char *endptr;
+
+    if (str == end)
+        return FALSE;
+    for (p = str; p < end; ++p)
+        if (!g_ascii_isdigit (*p))
+            return FALSE;
+
+    *value = g_ascii_strtoull (str, &endptr, 10);
+    return (endptr == end);
+}
+
+/*
+ * Parse the value of a Range header, e.g. "bytes=0-499,1000-,-500".
+ * Unsatisfiable ranges are dropped, the others are clamped to the file.
+ *
+ * Returns the number of satisfiable ranges, or -1 if the header is invalid
+ * or has too many ranges, in which case it should be ignored.
+ */
+static int
+parse_range_header (const char *value, guint64 file_size, ByteRange **ranges)
+{
+    char **specs = NULL;
+    char *spec, *dash;
+    guint64 start, end;
+    int n_specs, i, n = 0;
+
+    if (strncmp (value, "bytes=", 6) != 0)
+        return -1;
+
+    specs = g_strsplit (value + 6, ",", 0);
+    n_specs = g_strv_length (specs);
+    if (n_specs == 0 || n_specs > MAX_RANGES) {
+        g_strfreev (specs);
+        return -1;
+    }
+
+    *ranges = g_new0 (ByteRange, n_specs);
+
+    for (i = 0; i < n_specs; ++i) {
+        spec = g_strstrip (specs[i]);
+        dash = strchr (spec, '-');
+        if (!dash)
+            goto error;
+
+        if (dash == spec) {
+            /* Suffix range, the last N bytes. */
+            if (!parse_range_number (dash + 1, dash + strlen(dash), &end))
+                goto error;
+            if (end == 0 || file_size == 0)
+                continue;
+            start = (end >= file_size) ? 0 : file_size - end;
+            end = file_size - 1;
+        } else {
+            if (!parse_range_number (spec, dash, &start))
+                goto error;
+            if (dash[1] == '\0') {
+                end = file_size - 1;
+            } else {
+                if (!parse_range_number (dash + 1, dash + strlen(dash), &end))
+                    goto error;
+                if (end < start)
+                    goto error;
+                if (end >= file_size)
+                    end = file_size - 1;
+            }
+            if (start >= file_size)
+                continue;
+        }
+
+        (*ranges)[n].start = start;
+        (*ranges)[n].end = end;
+        ++n;
+    }
+
+    g_strfreev (specs);
+    return n;
+
+error:
+    g_strfreev (specs);
+    g_free (*ranges);
+    *ranges = NULL;
+    return -1;
+}
+
+static char *
+format_part_header (SendRangeData *data, ByteRange *range)
+{
+    return g_strdup_printf ("\r\n--%s\r\n"
+                            "Content-Type: %s\r\n"
+                            "Content-Range: bytes %"G_GUINT64_FORMAT"-"
+                            "%"G_GUINT64_FORMAT"/%"G_GUINT64_FORMAT"\r\n\r\n",
+                            data->boundary, data->content_type,
+                            range->start, range->end,
+                            (guint64)data->file->file_size);
+}
+
+static char *
+format_multipart_end (SendRangeData *data)
+{
+    return g_strdup_printf ("\r\n--%s--\r\n", data->boundary);
+}
+
+static void
+free_sendrange_data (SendRangeData *data)
+{
+    seafile_unref (data->file);
+    block_index_free (data->index);
+    g_free (data->ranges);
+    g_free (data->boundary);
+    g_free (data->content_type);
+    g_free (data);
+}
+
+/* Read @len bytes at @offset of a block into @out. */
+static int
+add_block_data (struct evbuffer *out,
+                const char *store_id, int version, const char *blk_id,
+                guint64 offset, guint64 len)
+{
+    BlockHandle *handle;
+    char *buf;
+    int n, ret = 0;
+
+    handle = seaf_block_manager_open_block (seaf->block_mgr,
+                                            store_id, version,
+                                            blk_id, BLOCK_READ);
+    if (!handle) {
+        seaf_warning ("Failed to open block %s\n", blk_id);
+        return -1;
+    }
+
+    /* Block handles can't seek, read and drop the bytes before @offset. */
+    buf = g_malloc (offset + len);
+    n = seaf_block_manager_read_block (seaf->block_mgr, handle,
+                                       buf, offset + len);
+    if (n < 0 || (guint64)n != offset + len) {
+        seaf_warning ("Error when reading from block %s.\n", blk_id);
+        ret = -1;
+    } else {
+        evbuffer_add (out, buf + offset, len);
+    }
+
+    g_free (buf);
+    seaf_block_manager_close_block (seaf->block_mgr, handle);
+    seaf_block_manager_block_handle_free (seaf->block_mgr, handle);
+    return ret;
+}
+
+/* Queue the next piece of the current range, which lies in one block. */
+static int
+add_range_piece (SendRangeData *data, struct evbuffer *out)
+{
+    ByteRange *range = &data->ranges[data->cur];
+    BlockIndex *index = data->index;
+    const char *blk_id;
+    guint32 i;
+    guint64 offset, len;
+    gint64 fd_offset, size;
+    char *str;
+    int fd;
+
+    if (data->boundary && data->pos == range->start) {
+        str = format_part_header (data, range);
+        evbuffer_add (out, str, strlen(str));
+        g_free (str);
+    }
+
+    i = block_index_find (index, data->pos);
+    blk_id = data->file->blk_sha1s[i];
+    offset = data->pos - index->offsets[i];
+    len = MIN (index->offsets[i + 1], range->end + 1) - data->pos;
+
+    if (data->zero_copy) {
+        fd = seaf_block_manager_open_block_fd (seaf->block_mgr,
+                                               data->store_id,
+                                               data->repo_version,
+                                               blk_id, &fd_offset, &size);
+        if (fd < 0) {
+            seaf_warning ("Failed to open block %s\n", blk_id);
+            return -1;
+        }
+        if (offset + len > size) {
+            seaf_warning ("Block %s is smaller than expected.\n", blk_id);
+            close (fd);
+            return -1;
+        }
+        /* See add_block_file() for why fd is not closed on failure. */
+        if (evbuffer_add_file (out, fd, fd_offset + offset, len) < 0) {
+            seaf_warning ("Failed to add block %s to output buffer.\n", blk_id);
+            return -1;
+        }
+    } else if (add_block_data (out, data->store_id, data->repo_version,
+                               blk_id, offset, len) < 0) {
+        return -1;
+    }
+
+    data->pos += len;
+    if (data->pos > range->end) {
+        ++(data->cur);
+        if (data->cur < data->n_ranges) {
+            data->pos = data->ranges[data->cur].start;
+        } else if (data->boundary) {
+            str = format_multipart_end (data);
+            evbuffer_add (out, str, strlen(str));
+            g_free (str);
+        }
+    }
+
+    return 0;
+}
+
+static void
+write_range_data_cb (struct bufferevent *bev, void *ctx)
+{
+    SendRangeData *data = ctx;
+    struct evbuffer *out = bufferevent_get_output (bev);
+
+    if (data->cur == data->n_ranges) {
+        /* All ranges have been sent out, finish. */
+
+        /* Recover evhtp's callbacks */
+        bev->readcb = data->saved_read_cb;
+        bev->writecb = data->saved_write_cb;
+        bev->errorcb = data->saved_event_cb;
+        bev->cbarg = data->saved_cb_arg;
+
+        /* Resume reading incomming requests. */
+        evhtp_request_resume (data->req);
+
+        evhtp_send_reply_end (data->req);
+
+        free_sendrange_data (data);
+        return;
+    }
+
+    /* Without zero-copy, read one piece (at most a block) at a time. */
+    do {
+        if (add_range_piece (data, out) < 0) {
+            evhtp_connection_free (evhtp_request_get_connection (data->req));
+            free_sendrange_data (data);
+            return;
+        }
+    } while (data->zero_copy && data->cur < data->n_ranges &&
+             evbuffer_get_length (out) < SENDFILE_QUEUE_SIZE);
+}
+
+static void
+my_range_event_cb (struct bufferevent *bev, short events, void *ctx)
+{
+    SendRangeData *data = ctx;
+
+    data->saved_event_cb (bev, events, data->saved_cb_arg);
+
+    /* Free aux data. */
+    free_sendrange_data (data);
+}
+
+/*
+ * Answer a Range request for an unencrypted file with a 206 response.
+ * Multiple ranges are sent as multipart/byteranges.
+ *
+ * Returns 1 if the request is handled, 0 if the whole file should be
+ * sent instead, or -1 on error. Takes over @file if the request is handled.
+ */
+static int
+do_file_range (evhtp_request_t *req, SeafRepo *repo, Seafile *file,
+               const char *range_header, const char *content_type)
+{
+    SendRangeData *data;
+    ByteRange *ranges = NULL;
+    BlockIndex *index;
+    guint64 content_len = 0;
+    char buf[256];
+    char *str;
+    int n_ranges, i;
+
+    n_ranges = parse_range_header (range_header, file->file_size, &ranges);
+    if (n_ranges < 0)
+        return 0;
+
+    if (n_ranges == 0) {
+        g_free (ranges);
+        snprintf (buf, sizeof(buf), "bytes */%"G_GUINT64_FORMAT,
+                  (guint64)file->file_size);
+        evhtp_headers_add_header (req->headers_out,
+                                  evhtp_header_new("Content-Range", buf, 1, 1));
+        evhtp_send_reply (req, EVHTP_RES_RANGENOTSC);
+        seafile_unref (file);
+        return 1;
+    }
+
+    index = get_block_index (repo->store_id, repo->version, file);
+    if (!index) {
+        g_free (ranges);
+        return -1;
+    }
+
+    data = g_new0 (SendRangeData, 1);
+    data->req = req;
+    data->file = file;
+    data->index = index;
+    data->ranges = ranges;
+    data->n_ranges = n_ranges;
+    data->pos = ranges[0].start;
+    data->zero_copy = can_send_block_file (req, NULL);
+    memcpy (data->store_id, repo->store_id, 36);
+    data->repo_version = repo->version;
+
+    if (n_ranges == 1) {
+        snprintf (buf, sizeof(buf),
+                  "bytes %"G_GUINT64_FORMAT"-%"G_GUINT64_FORMAT"/%"G_GUINT64_FORMAT,
+                  ranges[0].start, ranges[0].end, (guint64)file->file_size);
+        evhtp_headers_add_header (req->headers_out,
+                                  evhtp_header_new("Content-Range", buf, 1, 1));
+        evhtp_headers_add_header (req->headers_out,
+                                  evhtp_header_new("Content-Type",
+                                                   content_type, 1, 1));
+        content_len = ranges[0].end - ranges[0].start + 1;
+    } else {
+        data->boundary = gen_uuid ();
+        data->content_type = g_strdup (content_type);
+
+        for (i = 0; i < n_ranges; ++i) {
+            str = format_part_header (data, &ranges[i]);
+            content_len += strlen(str) + ranges[i].end - ranges[i].start + 1;
+            g_free (str);
+        }
+        str = format_multipart_end (data);
+        content_len += strlen(str);
+        g_free (str);
+
+        str = g_strdup_printf ("multipart/byteranges; boundary=%s",
+                               data->boundary);
+        evhtp_headers_add_header (req->headers_out,
+                                  evhtp_header_new("Content-Type", str, 1, 1));
+        g_free (str);
+    }
+
+    snprintf (buf, sizeof(buf), "%"G_GUINT64_FORMAT, content_len);
+    evhtp_headers_add_header (req->headers_out,
+                              evhtp_header_new("Content-Length", buf, 1, 1));
+
+    /* We need to overwrite evhtp's callback functions to
+     * write file data piece by piece.
+     */
+    struct bufferevent *bev = evhtp_request_get_bev (req);
+    data->saved_read_cb = bev->readcb;
+    data->saved_write_cb = bev->writecb;
+    data->saved_event_cb = bev->errorcb;
+    data->saved_cb_arg = bev->cbarg;
+    bufferevent_setcb (bev,
+                       NULL,
+                       write_range_data_cb,
+                       my_range_event_cb,
+                       data);
+    /* Block any new request from this connection before finish
+     * handling this request.
+     */
+    evhtp_request_pause (req);
+
+    /* Avoid recursive call of write_range_data_cb(). */
+    if (req->htp->ssl_cfg != NULL)
+        evbuffer_defer_callbacks (bev->output, bev->ev_base);
+
+    /* Kick start data transfer by sending out http headers. */
+    evhtp_send_reply_start (req, EVHTP_RES_PARTIAL);
+
+    return 1;
+}
+
 static int
 do_file(evhtp_request_t *req, SeafRepo *repo, const char *file_id,
         const char *filename, const char *operation,
@@ -517,19 +1164,8 @@ do_file(evhtp_request_t *req, SeafRepo *repo, const char *file_id,
         } else {
             content_type = g_strdup (type);
         }
-
-        evhtp_headers_add_header(req->headers_out,
-                                 evhtp_header_new("Content-Type",
-                                                  content_type, 1, 1));
-        g_free (content_type);
     } else
-        evhtp_headers_add_header (req->headers_out,
-                                  evhtp_header_new("Content-Type",
-                                                   "application/octet-stream", 1, 1));
-
-    snprintf(file_size, sizeof(file_size), "%"G_GINT64_FORMAT"", file->file_size);
-    evhtp_headers_add_header (req->headers_out,
-                              evhtp_header_new("Content-Length", file_size, 1, 1));
+        content_type = g_strdup ("application/octet-stream");
 
     if (strcmp(operation, "download") == 0) {
         if (test_firefox (req)) {
@@ -552,6 +1188,45 @@ do_file(evhtp_request_t *req, SeafRepo *repo, const char *file_id,
                              evhtp_header_new("Content-Disposition", cont_filename,
                                               1, 1));
 
+    /* Ranges of encrypted files would have to be decrypted from the start
+     * of their blocks, so only unencrypted files support ranges.
+     */
+    if (crypt == NULL) {
+        const char *range = evhtp_kv_find (req->headers_in, "Range");
+        const char *if_range = evhtp_kv_find (req->headers_in, "If-Range");
+        char etag[64];
+
+        snprintf (etag, sizeof(etag), "\"%s\"", file->file_id);
+        evhtp_headers_add_header (req->headers_out,
+                                  evhtp_header_new("ETag", etag, 1, 1));
+        evhtp_headers_add_header (req->headers_out,
+                                  evhtp_header_new("Accept-Ranges", "bytes", 1, 1));
+
+        /* Send the whole file if it's changed since the client got
+         * the first part.
+         */
+        if (range && (!if_range || strcmp (if_range, etag) == 0)) {
+            int rc = do_file_range (req, repo, file, range, content_type);
+            if (rc != 0) {
+                g_free (content_type);
+                if (rc < 0) {
+                    seafile_unref (file);
+                    return -1;
+                }
+                return 0;
+            }
+        }
+    }
+
+    evhtp_headers_add_header(req->headers_out,
+                             evhtp_header_new("Content-Type",
+                                              content_type, 1, 1));
+    g_free (content_type);
+
+    snprintf(file_size, sizeof(file_size), "%"G_GINT64_FORMAT"", file->file_size);
+    evhtp_headers_add_header (req->headers_out,
+                              evhtp_header_new("Content-Length", file_size, 1, 1));
+
     /* If it's an empty file, send an empty reply. */
     if (file->n_blocks == 0) {
         evhtp_send_reply (req, EVHTP_RES_OK);
@@ -577,7 +1252,8 @@ do_file(evhtp_request_t *req, SeafRepo *repo, const char *file_id,
     data->saved_cb_arg = bev->cbarg;
     bufferevent_setcb (bev,
                        NULL,
-                       write_data_cb,
+                       can_send_block_file (req, crypt) ?
+                       write_file_data_cb : write_data_cb,
                        my_event_cb,
                        data);
     /* Block any new request from this connection before finish
@@ -600,29 +1276,14 @@ do_dir (evhtp_request_t *req, SeafRepo *repo, const char *dir_id,
         const char *filename, const char *operation,
         SeafileCryptKey *crypt_key)
 {
-    char *zipfile = NULL;
+    PackDirStream *stream = NULL;
     char *filename_escaped = NULL;
     char cont_filename[SEAF_PATH_MAX];
-    char file_size[255];
-    SeafStat st;
     char *key_hex, *iv_hex;
     unsigned char enc_key[32], enc_iv[16];
     SeafileCrypt *crypt = NULL;
-    int zipfd = 0;
     int ret = 0;
-    gint64 dir_size = 0;
-
-    /* ensure file size does not exceed limit */
-    dir_size = seaf_fs_manager_get_fs_size (seaf->fs_mgr,
-                                            repo->store_id, repo->version,
-                                            dir_id);
-    if (dir_size < 0 || dir_size > seaf->http_server->max_download_dir_size) {
-        seaf_warning ("invalid dir size: %"G_GINT64_FORMAT"\n", dir_size);
-        ret = -1;
-        goto out;
-    }
 
-    /* Let's zip the directory first */
     filename_escaped = g_uri_unescape_string (filename, NULL);
     if (!filename_escaped) {
         seaf_warning ("failed to unescape string %s\n", filename);
@@ -645,26 +1306,22 @@ do_dir (evhtp_request_t *req, SeafRepo *repo, const char *dir_id,
         g_free (iv_hex);
     }
 
-    zipfile = pack_dir (repo->store_id, repo->version,
-                        filename_escaped, dir_id, crypt, test_windows(req));
-    if (!zipfile) {
+    /* The zip archive is sent while it's being generated. The size limit
+     * is checked while packing, so that the first byte goes out without
+     * traversing the whole dir.
+     */
+    stream = pack_dir_stream_start (repo->store_id, repo->version,
+                                    filename_escaped, dir_id, crypt,
+                                    test_windows(req),
+                                    seaf->http_server->max_download_dir_size);
+    if (!stream) {
         ret = -1;
         goto out;
     }
 
-    /* OK, the dir is zipped */
     evhtp_headers_add_header(req->headers_out,
                 evhtp_header_new("Content-Type", "application/zip", 1, 1));
 
-    if (seaf_stat(zipfile, &st) < 0) {
-        ret = -1;
-        goto out;
-    }
-
-    snprintf (file_size, sizeof(file_size), "%"G_GUINT64_FORMAT"", st.st_size);
-    evhtp_headers_add_header (req->headers_out,
-            evhtp_header_new("Content-Length", file_size, 1, 1));
-
     if (test_firefox (req)) {
         snprintf(cont_filename, SEAF_PATH_MAX,
                  "attachment;filename*=\"utf8\' \'%s.zip\"", filename);
@@ -676,24 +1333,21 @@ do_dir (evhtp_request_t *req, SeafRepo *repo, const char *dir_id,
     evhtp_headers_add_header(req->headers_out,
             evhtp_header_new("Content-Disposition", cont_filename, 1, 1));
 
-    zipfd = g_open (zipfile, O_RDONLY | O_BINARY, 0);
-    if (zipfd < 0) {
-        seaf_warning ("failed to open zipfile %s\n", zipfile);
-        ret = -1;
-        goto out;
-    }
-
     SendDirData *data;
     data = g_new0 (SendDirData, 1);
     data->req = req;
-    data->zipfd = zipfd;
-    data->zipfile = zipfile;
-    data->remain = st.st_size;
+    data->stream = stream;
 
     /* We need to overwrite evhtp's callback functions to
      * write file data piece by piece.
      */
     struct bufferevent *bev = evhtp_request_get_bev (req);
+    int fd = pack_dir_stream_get_fd (stream);
+    data->read_ev = event_new (bev->ev_base,
+                               fd,
+                               fd >= 0 ? EV_READ : 0,
+                               dir_stream_readable_cb,
+                               data);
     data->saved_read_cb = bev->readcb;
     data->saved_write_cb = bev->writecb;
     data->saved_event_cb = bev->errorcb;
@@ -712,21 +1366,14 @@ do_dir (evhtp_request_t *req, SeafRepo *repo, const char *dir_id,
     if (req->htp->ssl_cfg != NULL)
         evbuffer_defer_callbacks (bev->output, bev->ev_base);
 
-    /* Kick start data transfer by sending out http headers. */
-    evhtp_send_reply_start(req, EVHTP_RES_OK);
+    /* Kick start data transfer by sending out http headers. The size of
+     * the archive is not known in advance, so it's sent in chunks.
+     */
+    evhtp_send_reply_chunk_start(req, EVHTP_RES_OK);
 
 out:
     g_free (filename_escaped);
-    if (ret < 0) {
-        if (zipfile != NULL) {
-            g_unlink (zipfile);
-            g_free (zipfile);
-        }
-
-        if (zipfd > 0) {
-            close (zipfd);
-        }
-    }
+    g_free (crypt);
 
     return ret;
 }
@@ -931,7 +1578,8 @@ do_block(evhtp_request_t *req, SeafRepo *repo, const char *file_id,
     data->bsize = bsize;
     bufferevent_setcb (bev,
                        NULL,
-                       write_block_data_cb,
+                       can_send_block_file (req, NULL) ?
+                       write_block_file_cb : write_block_data_cb,
                        my_block_event_cb,
                        data);
     /* Block any new request from this connection before finish
@@ -1054,6 +1702,10 @@ bad_req:
 int
 access_file_init (evhtp_t *htp)
 {
+    block_index_cache = lru_cache_new (BLOCK_INDEX_CACHE_SIZE,
+                                       (LRUCacheCopyFunc)block_index_copy,
+                                       (GDestroyNotify)block_index_free);
+
     evhtp_set_regex_cb (htp, "^/files/.*", access_cb, NULL);
     evhtp_set_regex_cb (htp, "^/blks/.*", access_blks_cb, NULL);
 
@@ -0,0 +1,863 @@
+#include "common.h"
+
+#include <sys/types.h>
+#include <sys/wait.h>
+
+#include <ccnet.h>
+
+#include "seafile-session.h"
+#include "utils.h"
+#include "log.h"
+
+#include "dedup-stat.h"
+
+/*
+ * The analysis runs in two phases, each in @n_workers forked processes.
+ *
+ * 1. Repos are sharded among workers. A worker traverses the history of
+ *    each of its repos (and their virtual repos) to find referenced blocks,
+ *    then scans the repo's block store once. Per-repo numbers are written
+ *    to a stats file, and every block found is streamed to one of 256
+ *    partition files by the first byte of its id.
+ *
+ * 2. Partitions are sharded among workers. A worker loads one partition
+ *    at a time from all phase 1 workers, sorts it by block id, and counts
+ *    blocks stored in more than one repo.
+ *
+ * Memory usage is bounded by the block count of the largest repo in phase 1
+ * and by 1/256 of all blocks in phase 2.
+ */
+
+#define N_PARTITIONS 256
+#define N_SIZE_BUCKETS 32
+
+typedef struct BlockRecord {
+    guint8  id[20];
+    guint32 size;
+} __attribute__((gcc_struct, __packed__)) BlockRecord;
+
+typedef struct RepoStat {
+    char    repo_id[37];
+    /* Total size of files in the head commit. */
+    gint64  logical_bytes;
+    /* Size of unique blocks referenced by the head commit. */
+    gint64  head_block_bytes;
+    /* All blocks in the repo's block store. */
+    gint64  n_blocks;
+    gint64  physical_bytes;
+    /* Blocks not referenced by any commit. */
+    gint64  n_orphan_blocks;
+    gint64  orphan_bytes;
+    /* Number of blocks whose size is in [2^(i-1), 2^i). */
+    gint64  size_hist[N_SIZE_BUCKETS];
+} RepoStat;
+
+typedef struct SharedStat {
+    gint64  n_distinct_blocks;
+    gint64  distinct_bytes;
+    /* Blocks stored in more than one repo. */
+    gint64  n_shared_blocks;
+    /* Bytes taken by the extra copies of shared blocks. */
+    gint64  shared_extra_bytes;
+} SharedStat;
+
+typedef struct DedupStatContext {
+    const char *seafile_dir;
+    CcnetClient *ccnet_client;
+    GPtrArray *repo_ids;
+    int n_workers;
+    char *work_dir;
+} DedupStatContext;
+
+static char *
+partition_path (DedupStatContext *ctx, int part, int worker)
+{
+    char name[64];
+
+    snprintf (name, sizeof(name), "part-%02x-%d", part, worker);
+    return g_build_filename (ctx->work_dir, name, NULL);
+}
+
+static char *
+stats_path (DedupStatContext *ctx, const char *phase, int worker)
+{
+    char name[64];
+
+    snprintf (name, sizeof(name), "%s-%d", phase, worker);
+    return g_build_filename (ctx->work_dir, name, NULL);
+}
+
+/* Phase 1: scan repos. */
+
+static gboolean
+add_file_blocks (SeafFSManager *mgr,
+                 const char *store_id,
+                 int version,
+                 const char *obj_id,
+                 int type,
+                 void *user_data,
+                 gboolean *stop)
+{
+    FsObjSet *blocks = user_data;
+    Seafile *seafile;
+    int i;
+
+    if (type != SEAF_METADATA_TYPE_FILE)
+        return TRUE;
+
+    seafile = seaf_fs_manager_get_seafile (mgr, store_id, version, obj_id);
+    if (!seafile) {
+        seaf_warning ("Failed to find file %s.\n", obj_id);
+        return FALSE;
+    }
+
+    for (i = 0; i < seafile->n_blocks; ++i)
+        fs_obj_set_add (blocks, seafile->blk_sha1s[i]);
+
+    seafile_unref (seafile);
+
+    return TRUE;
+}
+
+typedef struct HistoryData {
+    SeafRepo *repo;
+    FsObjSet *visited;
+    FsObjSet *blocks;
+} HistoryData;
+
+static gboolean
+add_commit_blocks (SeafCommit *commit, void *vdata, gboolean *stop)
+{
+    HistoryData *data = vdata;
+
+    seaf_fs_manager_traverse_tree_visited (seaf->fs_mgr,
+                                           data->repo->store_id,
+                                           data->repo->version,
+                                           commit->root_id,
+                                           add_file_blocks,
+                                           data->blocks, TRUE,
+                                           data->visited);
+    return TRUE;
+}
+
+static void
+add_history_blocks (SeafRepo *repo, FsObjSet *visited, FsObjSet *blocks)
+{
+    GList *branches, *ptr;
+    SeafBranch *branch;
+    HistoryData data;
+
+    data.repo = repo;
+    data.visited = visited;
+    data.blocks = blocks;
+
+    branches = seaf_branch_manager_get_branch_list (seaf->branch_mgr, repo->id);
+    for (ptr = branches; ptr; ptr = ptr->next) {
+        branch = ptr->data;
+        seaf_commit_manager_traverse_commit_tree (seaf->commit_mgr,
+                                                  repo->id, repo->version,
+                                                  branch->commit_id,
+                                                  add_commit_blocks,
+                                                  &data, TRUE);
+        seaf_branch_unref (branch);
+    }
+    g_list_free (branches);
+}
+
+typedef struct ScanData {
+    RepoStat *stat;
+    FsObjSet *head_blocks;
+    FsObjSet *all_blocks;
+    FILE **parts;
+} ScanData;
+
+static int
+size_bucket (guint32 size)
+{
+    return MIN (g_bit_storage (size), N_SIZE_BUCKETS - 1);
+}
+
+static gboolean
+scan_block (const char *store_id, int version,
+            const char *block_id, void *vdata)
+{
+    ScanData *data = vdata;
+    RepoStat *stat = data->stat;
+    BlockMetadata *bmd;
+    BlockRecord rec;
+
+    if (hex_to_rawdata (block_id, rec.id, 20) < 0)
+        return TRUE;
+
+    bmd = seaf_block_manager_stat_block (seaf->block_mgr,
+                                         store_id, version, block_id);
+    if (!bmd)
+        return TRUE;
+    rec.size = bmd->size;
+    g_free (bmd);
+
+    ++stat->n_blocks;
+    stat->physical_bytes += rec.size;
+    ++stat->size_hist[size_bucket (rec.size)];
+
+    if (fs_obj_set_contains (data->head_blocks, block_id))
+        stat->head_block_bytes += rec.size;
+
+    if (!fs_obj_set_contains (data->all_blocks, block_id)) {
+        ++stat->n_orphan_blocks;
+        stat->orphan_bytes += rec.size;
+    }
+
+    if (fwrite (&rec, sizeof(rec), 1, data->parts[rec.id[0]]) != 1) {
+        seaf_warning ("Failed to write block record: %s.\n", strerror(errno));
+        return FALSE;
+    }
+
+    return TRUE;
+}
+
+static int
+scan_repo (SeafRepo *repo, FILE **parts, RepoStat *stat)
+{
+    SeafCommit *head;
+    FsObjSet *head_blocks, *all_blocks, *visited;
+    GList *vrepo_ids, *ptr;
+    SeafRepo *vrepo;
+    ScanData data;
+    gint64 size;
+
+    head = seaf_commit_manager_get_commit (seaf->commit_mgr,
+                                           repo->id, repo->version,
+                                           repo->head->commit_id);
+    if (!head) {
+        seaf_warning ("Failed to get head commit of repo %.8s.\n", repo->id);
+        return -1;
+    }
+
+    memcpy (stat->repo_id, repo->id, 36);
+
+    size = seaf_fs_manager_get_fs_size (seaf->fs_mgr, repo->store_id,
+                                        repo->version, head->root_id);
+    if (size > 0)
+        stat->logical_bytes = size;
+
+    head_blocks = fs_obj_set_new ();
+    seaf_fs_manager_traverse_tree (seaf->fs_mgr, repo->store_id, repo->version,
+                                   head->root_id, add_file_blocks,
+                                   head_blocks, TRUE);
+    seaf_commit_unref (head);
+
+    /* Virtual repos share the block store with their origin repo. */
+    all_blocks = fs_obj_set_new ();
+    visited = fs_obj_set_new ();
+    add_history_blocks (repo, visited, all_blocks);
+
+    vrepo_ids = seaf_repo_manager_get_virtual_repo_ids_by_origin (seaf->repo_mgr,
+                                                                  repo->id);
+    for (ptr = vrepo_ids; ptr; ptr = ptr->next) {
+        vrepo = seaf_repo_manager_get_repo (seaf->repo_mgr, ptr->data);
+        if (!vrepo) {
+            seaf_warning ("Failed to get virtual repo %.8s of repo %.8s, "
+                          "its history is not scanned.\n",
+                          (char *)ptr->data, repo->id);
+            continue;
+        }
+        add_history_blocks (vrepo, visited, all_blocks);
+        seaf_repo_unref (vrepo);
+    }
+    string_list_free (vrepo_ids);
+    fs_obj_set_free (visited);
+
+    data.stat = stat;
+    data.head_blocks = head_blocks;
+    data.all_blocks = all_blocks;
+    data.parts = parts;
+
+    seaf_block_manager_foreach_block (seaf->block_mgr,
+                                      repo->store_id, repo->version,
+                                      scan_block, &data);
+
+    fs_obj_set_free (head_blocks);
+    fs_obj_set_free (all_blocks);
+
+    return 0;
+}
+
+static json_t *
+repo_stat_to_json (RepoStat *stat)
+{
+    json_t *object, *hist;
+    int i;
+
+    object = json_object ();
+    json_object_set_string_member (object, "repo_id", stat->repo_id);
+    json_object_set_int_member (object, "logical_bytes", stat->logical_bytes);
+    json_object_set_int_member (object, "head_block_bytes", stat->head_block_bytes);
+    json_object_set_int_member (object, "blocks", stat->n_blocks);
+    json_object_set_int_member (object, "physical_bytes", stat->physical_bytes);
+    json_object_set_int_member (object, "orphan_blocks", stat->n_orphan_blocks);
+    json_object_set_int_member (object, "orphan_bytes", stat->orphan_bytes);
+
+    hist = json_array ();
+    for (i = 0; i < N_SIZE_BUCKETS; ++i)
+        json_array_append_new (hist, json_integer (stat->size_hist[i]));
+    json_object_set_new (object, "size_hist", hist);
+
+    return object;
+}
+
+static int
+write_json_line (FILE *fp, json_t *object)
+{
+    char *line = json_dumps (object, JSON_COMPACT);
+    int ret = 0;
+
+    if (fprintf (fp, "%s\n", line) < 0)
+        ret = -1;
+
+    free (line);
+    return ret;
+}
+
+/*
+ * Repos that are not in the per-repo stats are recorded with the reason,
+ * so that they show up in the report.
+ */
+static int
+record_skipped_repo (FILE *fp, const char *repo_id, const char *reason)
+{
+    json_t *object = json_object ();
+    int ret;
+
+    json_object_set_string_member (object, "repo_id", repo_id);
+    json_object_set_string_member (object, "reason", reason);
+    ret = write_json_line (fp, object);
+    json_decref (object);
+
+    return ret;
+}
+
+static int
+run_scan_worker (DedupStatContext *ctx, int worker)
+{
+    FILE *parts[N_PARTITIONS] = {0};
+    FILE *stats_fp = NULL;
+    FILE *skipped_fp = NULL;
+    char *path;
+    int i, ret = 0;
+    const char *repo_id;
+    SeafRepo *repo;
+    RepoStat stat;
+    json_t *object;
+
+    /* Database connections can't be shared with the parent process. */
+    seaf = seafile_session_new (ctx->seafile_dir, ctx->ccnet_client);
+    if (!seaf) {
+        seaf_warning ("Failed to create seafile session.\n");
+        return -1;
+    }
+
+    for (i = 0; i < N_PARTITIONS; ++i) {
+        path = partition_path (ctx, i, worker);
+        parts[i] = g_fopen (path, "wb");
+        if (!parts[i]) {
+            seaf_warning ("Failed to open %s: %s.\n", path, strerror(errno));
+            g_free (path);
+            ret = -1;
+            goto out;
+        }
+        g_free (path);
+    }
+
+    path = stats_path (ctx, "repos", worker);
+    stats_fp = g_fopen (path, "w");
+    if (!stats_fp) {
+        seaf_warning ("Failed to open %s: %s.\n", path, strerror(errno));
+        g_free (path);
+        ret = -1;
+        goto out;
+    }
+    g_free (path);
+
+    path = stats_path (ctx, "skipped", worker);
+    skipped_fp = g_fopen (path, "w");
+    if (!skipped_fp) {
+        seaf_warning ("Failed to open %s: %s.\n", path, strerror(errno));
+        g_free (path);
+        ret = -1;
+        goto out;
+    }
+    g_free (path);
+
+    for (i = worker; i < ctx->repo_ids->len; i += ctx->n_workers) {
+        repo_id = g_ptr_array_index (ctx->repo_ids, i);
+
+        repo = seaf_repo_manager_get_repo (seaf->repo_mgr, repo_id);
+        if (!repo) {
+            seaf_warning ("Failed to get repo %.8s, skip.\n", repo_id);
+            if (record_skipped_repo (skipped_fp, repo_id, "not found") < 0) {
+                ret = -1;
+                break;
+            }
+            continue;
+        }
+
+        /* Virtual repos are counted with their origin repos. */
+        if (repo->is_virtual) {
+            seaf_message ("Repo %.8s is a virtual repo, "
+                          "counted with its origin repo.\n", repo_id);
+            seaf_repo_unref (repo);
+            if (record_skipped_repo (skipped_fp, repo_id, "virtual") < 0) {
+                ret = -1;
+                break;
+            }
+            continue;
+        }
+
+        seaf_message ("Scanning repo %.8s.\n", repo_id);
+
+        memset (&stat, 0, sizeof(stat));
+        if (scan_repo (repo, parts, &stat) == 0) {
+            object = repo_stat_to_json (&stat);
+            if (write_json_line (stats_fp, object) < 0)
+                ret = -1;
+            json_decref (object);
+        } else {
+            seaf_warning ("Failed to scan repo %.8s, skip.\n", repo_id);
+            if (record_skipped_repo (skipped_fp, repo_id, "scan failed") < 0)
+                ret = -1;
+        }
+
+        seaf_repo_unref (repo);
+        if (ret < 0)
+            break;
+    }
+
+out:
+    for (i = 0; i < N_PARTITIONS; ++i) {
+        if (parts[i] && fclose (parts[i]) != 0)
+            ret = -1;
+    }
+    if (stats_fp && fclose (stats_fp) != 0)
+        ret = -1;
+    if (skipped_fp && fclose (skipped_fp) != 0)
+        ret = -1;
+
+    return ret;
+}
+
+/* Phase 2: count blocks shared by repos. */
+
+static int
+compare_block_records (const void *a, const void *b)
+{
+    return memcmp (((const BlockRecord *)a)->id, ((const BlockRecord *)b)->id, 20);
+}
+
+static int
+count_partition (DedupStatContext *ctx, int part, SharedStat *stat)
+{
+    GArray *records;
+    char *path, *contents;
+    gsize len;
+    GError *error = NULL;
+    BlockRecord *rec, *group;
+    guint i, n;
+    int worker;
+
+    records = g_array_new (FALSE, FALSE, sizeof(BlockRecord));
+
+    for (worker = 0; worker < ctx->n_workers; ++worker) {
+        path = partition_path (ctx, part, worker);
+        if (!g_file_get_contents (path, &contents, &len, &error)) {
+            seaf_warning ("Failed to read %s: %s.\n", path, error->message);
+            g_clear_error (&error);
+            g_free (path);
+            g_array_free (records, TRUE);
+            return -1;
+        }
+        g_array_append_vals (records, contents, len / sizeof(BlockRecord));
+        g_free (contents);
+        g_free (path);
+    }
+
+    if (records->len > 0)
+        qsort (records->data, records->len, sizeof(BlockRecord),
+               compare_block_records);
+
+    /* Each repo lists a block at most once, so the size of a group of
+     * equal ids is the number of repos storing that block.
+     */
+    for (i = 0; i < records->len; i += n) {
+        group = &g_array_index (records, BlockRecord, i);
+        for (n = 1; i + n < records->len; ++n) {
+            rec = &g_array_index (records, BlockRecord, i + n);
+            if (memcmp (rec->id, group->id, 20) != 0)
+                break;
+        }
+
+        ++stat->n_distinct_blocks;
+        stat->distinct_bytes += group->size;
+        if (n > 1) {
+            ++stat->n_shared_blocks;
+            stat->shared_extra_bytes += (gint64)group->size * (n - 1);
+        }
+    }
+
+    g_array_free (records, TRUE);
+    return 0;
+}
+
+static json_t *
+shared_stat_to_json (SharedStat *stat)
+{
+    json_t *object = json_object ();
+
+    json_object_set_int_member (object, "distinct_blocks", stat->n_distinct_blocks);
+    json_object_set_int_member (object, "distinct_bytes", stat->distinct_bytes);
+    json_object_set_int_member (object, "shared_blocks", stat->n_shared_blocks);
+    json_object_set_int_member (object, "shared_extra_bytes",
+                                stat->shared_extra_bytes);
+
+    return object;
+}
+
+static int
+run_count_worker (DedupStatContext *ctx, int worker)
+{
+    SharedStat stat;
+    FILE *fp;
+    char *path;
+    json_t *object;
+    int part, ret = 0;
+
+    memset (&stat, 0, sizeof(stat));
+
+    for (part = worker; part < N_PARTITIONS; part += ctx->n_workers) {
+        if (count_partition (ctx, part, &stat) < 0)
+            return -1;
+    }
+
+    path = stats_path (ctx, "shared", worker);
+    fp = g_fopen (path, "w");
+    if (!fp) {
+        seaf_warning ("Failed to open %s: %s.\n", path, strerror(errno));
+        g_free (path);
+        return -1;
+    }
+    g_free (path);
+
+    object = shared_stat_to_json (&stat);
+    if (write_json_line (fp, object) < 0)
+        ret = -1;
+    json_decref (object);
+
+    if (fclose (fp) != 0)
+        ret = -1;
+
+    return ret;
+}
+
+typedef int (*WorkerFunc) (DedupStatContext *ctx, int worker);
+
+static int
+run_workers (DedupStatContext *ctx, WorkerFunc func)
+{
+    pid_t *pids;
+    int i, status, ret = 0;
+
+    pids = g_new0 (pid_t, ctx->n_workers);
+
+    for (i = 0; i < ctx->n_workers; ++i) {
+        pids[i] = fork ();
+        if (pids[i] < 0) {
+            seaf_warning ("Failed to fork worker: %s.\n", strerror(errno));
+            ret = -1;
+            break;
+        }
+        if (pids[i] == 0)
+            _exit (func (ctx, i) < 0 ? 1 : 0);
+    }
+
+    for (i = 0; i < ctx->n_workers; ++i) {
+        if (pids[i] <= 0)
+            continue;
+        if (waitpid (pids[i], &status, 0) < 0 ||
+            !WIFEXITED(status) || WEXITSTATUS(status) != 0) {
+            seaf_warning ("Worker %d failed.\n", i);
+            ret = -1;
+        }
+    }
+
+    g_free (pids);
+    return ret;
+}
+
+/* Aggregate results. */
+
+static GList *
+load_json_lines (DedupStatContext *ctx, const char *phase)
+{
+    GList *objects = NULL;
+    char *path, *contents;
+    char **lines, **ptr;
+    json_t *object;
+    json_error_t jerror;
+    int worker;
+
+    for (worker = 0; worker < ctx->n_workers; ++worker) {
+        path = stats_path (ctx, phase, worker);
+        if (!g_file_get_contents (path, &contents, NULL, NULL)) {
+            g_free (path);
+            continue;
+        }
+
+        lines = g_strsplit (contents, "\n", -1);
+        for (ptr = lines; *ptr != NULL; ++ptr) {
+            if (**ptr == '\0')
+                continue;
+            object = json_loads (*ptr, 0, &jerror);
+            if (object)
+                objects = g_list_prepend (objects, object);
+        }
+
+        g_strfreev (lines);
+        g_free (contents);
+        g_free (path);
+    }
+
+    return g_list_reverse (objects);
+}
+
+static void
+free_json_list (GList *objects)
+{
+    GList *ptr;
+
+    for (ptr = objects; ptr; ptr = ptr->next)
+        json_decref ((json_t *)ptr->data);
+    g_list_free (objects);
+}
+
+static gint64
+sum_member (GList *objects, const char *key)
+{
+    GList *ptr;
+    gint64 sum = 0;
+
+    for (ptr = objects; ptr; ptr = ptr->next)
+        sum += json_object_get_int_member (ptr->data, key);
+
+    return sum;
+}
+
+static json_t *
+build_report (GList *repo_stats, GList *shared_stats, GList *skipped_repos)
+{
+    json_t *report, *repos, *skipped, *total, *hist;
+    gint64 size_hist[N_SIZE_BUCKETS] = {0};
+    json_t *repo_hist;
+    GList *ptr;
+    int i;
+
+    repos = json_array ();
+    for (ptr = repo_stats; ptr; ptr = ptr->next) {
+        json_array_append (repos, ptr->data);
+
+        repo_hist = json_object_get (ptr->data, "size_hist");
+        for (i = 0; i < N_SIZE_BUCKETS && i < json_array_size (repo_hist); ++i)
+            size_hist[i] += json_integer_value (json_array_get (repo_hist, i));
+    }
+
+    total = json_object ();
+    json_object_set_int_member (total, "logical_bytes",
+                                sum_member (repo_stats, "logical_bytes"));
+    json_object_set_int_member (total, "head_block_bytes",
+                                sum_member (repo_stats, "head_block_bytes"));
+    json_object_set_int_member (total, "blocks",
+                                sum_member (repo_stats, "blocks"));
+    json_object_set_int_member (total, "physical_bytes",
+                                sum_member (repo_stats, "physical_bytes"));
+    json_object_set_int_member (total, "orphan_blocks",
+                                sum_member (repo_stats, "orphan_blocks"));
+    json_object_set_int_member (total, "orphan_bytes",
+                                sum_member (repo_stats, "orphan_bytes"));
+    json_object_set_int_member (total, "distinct_blocks",
+                                sum_member (shared_stats, "distinct_blocks"));
+    json_object_set_int_member (total, "distinct_bytes",
+                                sum_member (shared_stats, "distinct_bytes"));
+    json_object_set_int_member (total, "shared_blocks",
+                                sum_member (shared_stats, "shared_blocks"));
+    json_object_set_int_member (total, "shared_extra_bytes",
+                                sum_member (shared_stats, "shared_extra_bytes"));
+
+    hist = json_array ();
+    for (i = 0; i < N_SIZE_BUCKETS; ++i)
+        json_array_append_new (hist, json_integer (size_hist[i]));
+    json_object_set_new (total, "size_hist", hist);
+
+    skipped = json_array ();
+    for (ptr = skipped_repos; ptr; ptr = ptr->next)
+        json_array_append (skipped, ptr->data);
+
+    report = json_object ();
+    json_object_set_new (report, "repos", repos);
+    json_object_set_new (report, "skipped_repos", skipped);
+    json_object_set_new (report, "total", total);
+
+    return report;
+}
+
+static void
+print_summary (json_t *report)
+{
+    json_t *total = json_object_get (report, "total");
+    json_t *hist = json_object_get (total, "size_hist");
+    json_t *repos = json_object_get (report, "repos");
+    json_t *skipped = json_object_get (report, "skipped_repos");
+    json_t *object;
+    gint64 n;
+    int i;
+
+    seaf_message ("Scanned %u repos, skipped %u.\n",
+                  (guint)json_array_size (repos), (guint)json_array_size (skipped));
+    for (i = 0; i < json_array_size (skipped); ++i) {
+        object = json_array_get (skipped, i);
+        seaf_message ("  Skipped repo %s: %s.\n",
+                      json_object_get_string_member (object, "repo_id"),
+                      json_object_get_string_member (object, "reason"));
+    }
+
+    seaf_message ("Total logical size of head commits: %"G_GINT64_FORMAT" bytes.\n",
+                  json_object_get_int_member (total, "logical_bytes"));
+    seaf_message ("Unique blocks referenced by head commits: %"G_GINT64_FORMAT" bytes.\n",
+                  json_object_get_int_member (total, "head_block_bytes"));
+    seaf_message ("Stored blocks: %"G_GINT64_FORMAT", %"G_GINT64_FORMAT" bytes.\n",
+                  json_object_get_int_member (total, "blocks"),
+                  json_object_get_int_member (total, "physical_bytes"));
+    seaf_message ("Orphan blocks: %"G_GINT64_FORMAT", %"G_GINT64_FORMAT" bytes.\n",
+                  json_object_get_int_member (total, "orphan_blocks"),
+                  json_object_get_int_member (total, "orphan_bytes"));
+    seaf_message ("Distinct blocks across repos: %"G_GINT64_FORMAT", "
+                  "%"G_GINT64_FORMAT" bytes.\n",
+                  json_object_get_int_member (total, "distinct_blocks"),
+                  json_object_get_int_member (total, "distinct_bytes"));
+    seaf_message ("Blocks stored in more than one repo: %"G_GINT64_FORMAT", "
+                  "%"G_GINT64_FORMAT" bytes in extra copies.\n",
+                  json_object_get_int_member (total, "shared_blocks"),
+                  json_object_get_int_member (total, "shared_extra_bytes"));
+
+    seaf_message ("Block size distribution:\n");
+    for (i = 0; i < json_array_size (hist); ++i) {
+        n = json_integer_value (json_array_get (hist, i));
+        if (n == 0)
+            continue;
+        seaf_message ("  < %"G_GUINT64_FORMAT" bytes: %"G_GINT64_FORMAT"\n",
+                      ((guint64)1) << i, n);
+    }
+}
+
+static void
+remove_work_dir (DedupStatContext *ctx)
+{
+    GDir *dir;
+    const char *dname;
+    char *path;
+
+    dir = g_dir_open (ctx->work_dir, 0, NULL);
+    if (dir) {
+        while ((dname = g_dir_read_name (dir)) != NULL) {
+            path = g_build_filename (ctx->work_dir, dname, NULL);
+            g_unlink (path);
+            g_free (path);
+        }
+        g_dir_close (dir);
+    }
+    g_rmdir (ctx->work_dir);
+}
+
+int
+seaf_dedup_stat (const char *seafile_dir,
+                 CcnetClient *ccnet_client,
+                 GList *repo_id_list,
+                 int n_workers,
+                 const char *tmp_dir,
+                 const char *report_file)
+{
+    DedupStatContext ctx;
+    GList *ptr;
+    GList *all_repos = NULL;
+    GList *repo_stats = NULL, *shared_stats = NULL, *skipped_repos = NULL;
+    json_t *report = NULL;
+    char *data;
+    int ret = 0;
+
+    memset (&ctx, 0, sizeof(ctx));
+    ctx.seafile_dir = seafile_dir;
+    ctx.ccnet_client = ccnet_client;
+    ctx.n_workers = n_workers;
+
+    if (!repo_id_list) {
+        all_repos = seaf_repo_manager_get_repo_id_list (seaf->repo_mgr);
+        repo_id_list = all_repos;
+    }
+
+    ctx.repo_ids = g_ptr_array_new ();
+    for (ptr = repo_id_list; ptr; ptr = ptr->next)
+        g_ptr_array_add (ctx.repo_ids, ptr->data);
+
+    ctx.work_dir = g_build_filename (tmp_dir ? tmp_dir : seaf->tmp_file_dir,
+                                     "dedup-stat-XXXXXX", NULL);
+    if (!mkdtemp (ctx.work_dir)) {
+        seaf_warning ("Failed to create work dir %s: %s.\n",
+                      ctx.work_dir, strerror(errno));
+        g_free (ctx.work_dir);
+        g_ptr_array_free (ctx.repo_ids, TRUE);
+        string_list_free (all_repos);
+        return -1;
+    }
+
+    seaf_message ("Scanning %u repos with %d workers.\n",
+                  ctx.repo_ids->len, n_workers);
+
+    if (run_workers (&ctx, run_scan_worker) < 0) {
+        ret = -1;
+        goto out;
+    }
+
+    seaf_message ("Counting blocks shared by repos.\n");
+
+    if (run_workers (&ctx, run_count_worker) < 0) {
+        ret = -1;
+        goto out;
+    }
+
+    repo_stats = load_json_lines (&ctx, "repos");
+    shared_stats = load_json_lines (&ctx, "shared");
+    skipped_repos = load_json_lines (&ctx, "skipped");
+
+    report = build_report (repo_stats, shared_stats, skipped_repos);
+    print_summary (report);
+
+    if (report_file) {
+        data = json_dumps (report, JSON_INDENT(2));
+        if (!g_file_set_contents (report_file, data, -1, NULL)) {
+            seaf_warning ("Failed to write report to %s.\n", report_file);
+            ret = -1;
+        }
+        free (data);
+    }
+
+out:
+    if (report)
+        json_decref (report);
+    free_json_list (repo_stats);
+    free_json_list (shared_stats);
+    free_json_list (skipped_repos);
+    remove_work_dir (&ctx);
+    g_free (ctx.work_dir);
+    g_ptr_array_free (ctx.repo_ids, TRUE);
+    string_list_free (all_repos);
+
+    return ret;
+}
@@ -0,0 +1,22 @@
+#ifndef SEAF_DEDUP_STAT_H
+#define SEAF_DEDUP_STAT_H
+
+struct _CcnetClient;
+
+/*
+ * Analyze deduplication and storage usage of the block store.
+ *
+ * @repo_id_list: repos to analyze, or NULL for all repos.
+ * @n_workers: number of worker processes.
+ * @tmp_dir: dir for intermediate files, the seafile tmp dir if NULL.
+ * @report_file: if not NULL, write a json report to it.
+ */
+int
+seaf_dedup_stat (const char *seafile_dir,
+                 struct _CcnetClient *ccnet_client,
+                 GList *repo_id_list,
+                 int n_workers,
+                 const char *tmp_dir,
+                 const char *report_file);
+
+#endif
@@ -1,16 +1,117 @@
 #include "common.h"
 
+#include <pthread.h>
+
 #include "seafile-session.h"
+#include "utils.h"
 #include "log.h"
 
 #include "fsck.h"
 
+#define FSCK_JOURNAL_NAME "fsck-progress.journal"
+
+/* Results of checking a single repo, which make up the final report. */
+typedef struct FsckRepoReport {
+    char repo_id[37];
+    gboolean failed;
+    /* Commits whose fs tree is inconsistent. */
+    GList *corrupted_commits;
+    GHashTable *missing_blocks;
+    GHashTable *corrupted_blocks;
+    /* New head commit id if the head has been reset. */
+    char *repaired_head;
+    gint64 time_used;           /* in microseconds */
+} FsckRepoReport;
+
 typedef struct FsckRes {
     SeafRepo *repo;
     char *consistent_head;
     GHashTable *existing_blocks;
+    /* Fs objects already verified in previously checked commits. */
+    FsObjSet *visited;
+    BlockExistCache *block_cache;
+    FsckRepoReport *report;
 } FsckRes;
 
+static FsckRepoReport *
+fsck_repo_report_new (const char *repo_id)
+{
+    FsckRepoReport *report = g_new0 (FsckRepoReport, 1);
+
+    memcpy (report->repo_id, repo_id, 36);
+    report->missing_blocks = g_hash_table_new_full (g_str_hash, g_str_equal,
+                                                    g_free, NULL);
+    report->corrupted_blocks = g_hash_table_new_full (g_str_hash, g_str_equal,
+                                                      g_free, NULL);
+
+    return report;
+}
+
+static void
+fsck_repo_report_free (FsckRepoReport *report)
+{
+    string_list_free (report->corrupted_commits);
+    g_hash_table_destroy (report->missing_blocks);
+    g_hash_table_destroy (report->corrupted_blocks);
+    g_free (report->repaired_head);
+    g_free (report);
+}
+
+static json_t *
+id_set_to_json (GHashTable *set)
+{
+    json_t *array = json_array ();
+    GHashTableIter iter;
+    gpointer key, value;
+
+    g_hash_table_iter_init (&iter, set);
+    while (g_hash_table_iter_next (&iter, &key, &value))
+        json_array_append_new (array, json_string ((const char *)key));
+
+    return array;
+}
+
+static json_t *
+fsck_repo_report_to_json (FsckRepoReport *report)
+{
+    json_t *object, *commits;
+    GList *ptr;
+
+    object = json_object ();
+    json_object_set_string_member (object, "repo_id", report->repo_id);
+    json_object_set_string_member (object, "status",
+                                   report->failed ? "failed" :
+                                   (report->repaired_head ? "repaired" : "ok"));
+
+    commits = json_array ();
+    for (ptr = report->corrupted_commits; ptr; ptr = ptr->next)
+        json_array_append_new (commits, json_string ((const char *)ptr->data));
+    json_object_set_new (object, "corrupted_commits", commits);
+
+    json_object_set_new (object, "missing_blocks",
+                         id_set_to_json (report->missing_blocks));
+    json_object_set_new (object, "corrupted_blocks",
+                         id_set_to_json (report->corrupted_blocks));
+
+    if (report->repaired_head)
+        json_object_set_string_member (object, "repaired_head",
+                                       report->repaired_head);
+    else
+        json_object_set_new (object, "repaired_head", json_null ());
+
+    json_object_set_new (object, "time",
+                         json_real ((double)report->time_used / 1000000));
+
+    return object;
+}
+
+static void
+add_corrupted_commit (FsckRepoReport *report, const char *commit_id)
+{
+    report->corrupted_commits = g_list_append (report->corrupted_commits,
+                                               g_strdup (commit_id));
+}
+
 static int
 check_blocks (SeafFSManager *mgr, FsckRes *res, const char *file_id)
 {
@@ -36,10 +137,17 @@ check_blocks (SeafFSManager *mgr, FsckRes *res, const char *file_id)
         if (g_hash_table_lookup (res->existing_blocks, block_id))
             continue;
 
-        if (!seaf_block_manager_block_exists (seaf->block_mgr,
-                                              repo->store_id, repo->version,
-                                              block_id)) {
+        if (!res->block_cache)
+            res->block_cache = seaf_block_manager_exist_cache_new (seaf->block_mgr,
+                                                                   repo->store_id,
+                                                                   repo->version);
+
+        if (!seaf_block_manager_block_exists_cached (seaf->block_mgr,
+                                                     res->block_cache,
+                                                     block_id)) {
             seaf_message ("Block %s is missing.\n", block_id);
+            g_hash_table_replace (res->report->missing_blocks,
+                                  g_strdup (block_id), &dummy);
             ret = -1;
             break;
         }
@@ -53,6 +161,9 @@ check_blocks (SeafFSManager *mgr, FsckRes *res, const char *file_id)
             seaf_block_manager_remove_block (seaf->block_mgr,
                                              repo->store_id, repo->version,
                                              block_id);
+            seaf_block_manager_exist_cache_remove (res->block_cache, block_id);
+            g_hash_table_replace (res->report->corrupted_blocks,
+                                  g_strdup (block_id), &dummy);
             ret = -1;
             break;
         }
@@ -93,15 +204,18 @@ check_fs_integrity (SeafCommit *commit, void *vdata, gboolean *stop)
         return TRUE;
     }
 
-    int rc = seaf_fs_manager_traverse_tree (seaf->fs_mgr,
-                                            res->repo->store_id,
-                                            res->repo->version,
-                                            commit->root_id,
-                                            fs_callback,
-                                            res, FALSE);
+    int rc = seaf_fs_manager_traverse_tree_visited (seaf->fs_mgr,
+                                                    res->repo->store_id,
+                                                    res->repo->version,
+                                                    commit->root_id,
+                                                    fs_callback,
+                                                    res, FALSE,
+                                                    res->visited);
     if (rc == 0) {
         *stop = TRUE;
         res->consistent_head = g_strdup (commit->commit_id);
+    } else {
+        add_corrupted_commit (res->report, commit->commit_id);
     }
 
     return TRUE;
@@ -167,7 +281,7 @@ cre_commit_from_parent (char *repo_id, SeafCommit *parent)
 }
 
 static int
-recover_corrupted_repo_head (char *repo_id)
+recover_corrupted_repo_head (char *repo_id, FsckRepoReport *report)
 {
     GList *commit_list = NULL;
     GList *temp_list = NULL;
@@ -190,6 +304,8 @@ recover_corrupted_repo_head (char *repo_id)
     memset (&res, 0, sizeof(res));
     res.existing_blocks = g_hash_table_new_full (g_str_hash, g_str_equal,
                                                  g_free, NULL);
+    res.visited = fs_obj_set_new ();
+    res.report = report;
 
 
     for (temp_list = commit_list; temp_list; temp_list = temp_list->next) {
@@ -217,15 +333,18 @@ recover_corrupted_repo_head (char *repo_id)
         seaf_virtual_repo_info_free (vinfo);
 
         res.repo = repo;
-        rc = seaf_fs_manager_traverse_tree (seaf->fs_mgr,
-                                            repo->store_id,
-                                            repo->version,
-                                            temp_commit->root_id,
-                                            fs_callback,
-                                            &res, FALSE);
+        rc = seaf_fs_manager_traverse_tree_visited (seaf->fs_mgr,
+                                                    repo->store_id,
+                                                    repo->version,
+                                                    temp_commit->root_id,
+                                                    fs_callback,
+                                                    &res, FALSE,
+                                                    res.visited);
 
         if (rc < 0) {
+            add_corrupted_commit (report, temp_commit->commit_id);
             seaf_repo_unref (repo);
+            repo = NULL;
         } else {
             break;
         }
@@ -246,6 +365,7 @@ recover_corrupted_repo_head (char *repo_id)
                 seaf_commit_manager_add_commit (seaf->commit_mgr, temp_commit);
                 seaf_message ("Head commit of repo %.8s has been fixed to commit %.8s.\n",
                               repo_id, temp_commit->commit_id);
+                report->repaired_head = g_strdup (temp_commit->commit_id);
             }
             seaf_commit_unref (temp_commit);
         } else {
@@ -255,6 +375,8 @@ recover_corrupted_repo_head (char *repo_id)
     }
 
     g_hash_table_destroy (res.existing_blocks);
+    fs_obj_set_free (res.visited);
+    seaf_block_manager_exist_cache_free (res.block_cache);
     seaf_repo_unref (repo);
     for (temp_list = commit_list; temp_list; temp_list = temp_list->next) {
         temp_commit = temp_list->data;
@@ -270,12 +392,13 @@ recover_corrupted_repo_head (char *repo_id)
  * if not, find and reset its head to the last consistent commit.
  * Note that this procedure will not work with a corrupted commit object.
  */
-static void
-check_and_reset_consistent_state (SeafRepo *repo)
+static int
+check_and_reset_consistent_state (SeafRepo *repo, FsckRepoReport *report)
 {
     FsckRes res;
     SeafCommit *rep_commit;
     SeafCommit *new_commit;
+    int ret = 0;
 
     seaf_message ("Checking file system integrity of repo %s(%.8s)...\n",
                   repo->name, repo->id);
@@ -284,6 +407,8 @@ check_and_reset_consistent_state (SeafRepo *repo)
     res.repo = repo;
     res.existing_blocks = g_hash_table_new_full (g_str_hash, g_str_equal,
                                                  g_free, NULL);
+    res.visited = fs_obj_set_new ();
+    res.report = report;
 
     seaf_commit_manager_traverse_commit_tree (seaf->commit_mgr,
                                               repo->id, repo->version,
@@ -293,11 +418,11 @@ check_and_reset_consistent_state (SeafRepo *repo)
                                               TRUE);
 
     g_hash_table_destroy (res.existing_blocks);
+    fs_obj_set_free (res.visited);
+    seaf_block_manager_exist_cache_free (res.block_cache);
 
-    if (!res.consistent_head) {
-        recover_corrupted_repo_head (repo->id);
-        return;
-    }
+    if (!res.consistent_head)
+        return recover_corrupted_repo_head (repo->id, report);
 
     /* If the current head is not consistent, reset it. */
     if (strcmp (res.consistent_head, repo->head->commit_id) != 0) {
@@ -307,55 +432,364 @@ check_and_reset_consistent_state (SeafRepo *repo)
             new_commit = cre_commit_from_parent (repo->id, rep_commit);
             if (new_commit == NULL) {
                 seaf_warning ("Failed to update branch head.\n");
+                ret = -1;
             } else {
                 seaf_message ("Resetting head of repo %.8s to commit %.8s.\n",
                               repo->id, new_commit->commit_id);
                 seaf_branch_set_commit (repo->head, new_commit->commit_id);
                 if (seaf_branch_manager_update_branch (seaf->branch_mgr, repo->head) < 0) {
                     seaf_warning ("Failed to update branch head.\n");
+                    ret = -1;
                 } else {
                     seaf_commit_manager_add_commit (seaf->commit_mgr, new_commit);
+                    report->repaired_head = g_strdup (new_commit->commit_id);
                 }
                 seaf_commit_unref (new_commit);
             }
             seaf_commit_unref (rep_commit);
         } else {
             seaf_warning ("Failed to update branch head.\n");
+            ret = -1;
         }
     }
 
     g_free (res.consistent_head);
+    return ret;
 }
 
-int
-seaf_fsck (GList *repo_id_list)
+static void
+fsck_repo (const char *repo_id, FsckRepoReport *report)
+{
+    SeafRepo *repo;
+    int rc;
+
+    seaf_message ("Running fsck for repo %.8s.\n", repo_id);
+
+    repo = seaf_repo_manager_get_repo (seaf->repo_mgr, repo_id);
+    if (!repo) {
+        rc = recover_corrupted_repo_head ((char *)repo_id, report);
+        if (rc < 0) {
+            seaf_warning ("Failed to recover repo %.8s.\n\n", repo_id);
+            report->failed = TRUE;
+        } else
+            seaf_message ("Fsck finished for repo %.8s.\n\n", repo_id);
+        return;
+    }
+
+    if (check_and_reset_consistent_state (repo, report) < 0)
+        report->failed = TRUE;
+
+    seaf_message ("Fsck finished for repo %.8s.\n\n", repo_id);
+
+    seaf_repo_unref (repo);
+}
+
+/*
+ * State shared by all fsck workers.
+ *
+ * Each finished repo is appended to the progress journal as one line of
+ * json. If fsck is interrupted, the next run loads the journal and skips
+ * the repos that have been checked. The journal is removed after all repos
+ * are checked.
+ *
+ * The first line of the journal records which repos were requested, as
+ * {"repo_list": <key>}. A journal written for another repo list is
+ * discarded, so that repos requested now are never skipped because of an
+ * earlier run.
+ */
+typedef struct FsckContext {
+    pthread_mutex_t lock;
+    char *journal_path;
+    FILE *journal;
+    char *repo_list_key;
+    /* repo id -> json report of checked repos, including resumed ones. */
+    GHashTable *results;
+    GList *result_order;
+} FsckContext;
+
+static int
+compare_repo_id (gconstpointer a, gconstpointer b)
+{
+    return strcmp ((const char *)a, (const char *)b);
+}
+
+/*
+ * "all" if all repos are checked, otherwise sha1 of the sorted repo ids.
+ */
+static char *
+compute_repo_list_key (GList *repo_id_list)
 {
+    GList *sorted, *ptr;
+    GString *buf;
+    char *key;
+
     if (!repo_id_list)
-        repo_id_list = seaf_repo_manager_get_repo_id_list (seaf->repo_mgr);
+        return g_strdup ("all");
+
+    sorted = g_list_sort (g_list_copy (repo_id_list), compare_repo_id);
+    buf = g_string_new (NULL);
+    for (ptr = sorted; ptr; ptr = ptr->next) {
+        g_string_append (buf, ptr->data);
+        g_string_append_c (buf, '\n');
+    }
+    key = g_compute_checksum_for_string (G_CHECKSUM_SHA1, buf->str, buf->len);
 
+    g_string_free (buf, TRUE);
+    g_list_free (sorted);
+    return key;
+}
+
+static gboolean
+journal_header_matches (FsckContext *ctx, const char *line)
+{
+    json_t *object;
+    json_error_t jerror;
+    const char *key;
+    gboolean ret;
+
+    object = json_loads (line, 0, &jerror);
+    if (!object)
+        return FALSE;
+
+    key = json_object_get_string_member (object, "repo_list");
+    ret = (key != NULL && strcmp (key, ctx->repo_list_key) == 0);
+
+    json_decref (object);
+    return ret;
+}
+
+/*
+ * Returns TRUE if the journal exists and belongs to the current repo list.
+ */
+static gboolean
+load_journal (FsckContext *ctx)
+{
+    char *contents = NULL;
+    gsize len;
+    char **lines, **ptr;
+    json_t *object;
+    json_error_t jerror;
+    const char *repo_id;
+
+    if (!g_file_get_contents (ctx->journal_path, &contents, &len, NULL))
+        return FALSE;
+
+    lines = g_strsplit (contents, "\n", -1);
+    if (!lines[0] || !journal_header_matches (ctx, lines[0])) {
+        seaf_message ("Fsck journal %s was written for other repos, "
+                      "starting from scratch.\n", ctx->journal_path);
+        g_strfreev (lines);
+        g_free (contents);
+        return FALSE;
+    }
+
+    for (ptr = lines + 1; *ptr != NULL; ++ptr) {
+        if (**ptr == '\0')
+            continue;
+
+        /* The last line may be partially written if fsck was killed. */
+        object = json_loads (*ptr, 0, &jerror);
+        if (!object)
+            continue;
+
+        repo_id = json_object_get_string_member (object, "repo_id");
+        if (!repo_id || strlen(repo_id) != 36 ||
+            g_hash_table_lookup (ctx->results, repo_id) != NULL) {
+            json_decref (object);
+            continue;
+        }
+
+        g_hash_table_insert (ctx->results, g_strdup(repo_id), object);
+        ctx->result_order = g_list_prepend (ctx->result_order, g_strdup(repo_id));
+    }
+
+    if (g_hash_table_size (ctx->results) > 0)
+        seaf_message ("Resuming fsck, %u repos have been checked before.\n",
+                      g_hash_table_size (ctx->results));
+
+    g_strfreev (lines);
+    g_free (contents);
+    return TRUE;
+}
+
+static FILE *
+open_journal (FsckContext *ctx, gboolean resume)
+{
+    FILE *journal;
+    json_t *header;
+    char *line;
+
+    if (resume)
+        return g_fopen (ctx->journal_path, "a");
+
+    journal = g_fopen (ctx->journal_path, "w");
+    if (!journal)
+        return NULL;
+
+    header = json_object ();
+    json_object_set_string_member (header, "repo_list", ctx->repo_list_key);
+    line = json_dumps (header, JSON_COMPACT);
+    json_decref (header);
+
+    if (fprintf (journal, "%s\n", line) < 0 || fflush (journal) != 0) {
+        free (line);
+        fclose (journal);
+        return NULL;
+    }
+
+    free (line);
+    return journal;
+}
+
+static void
+record_repo_report (FsckContext *ctx, FsckRepoReport *report)
+{
+    json_t *object = fsck_repo_report_to_json (report);
+    char *line;
+
+    pthread_mutex_lock (&ctx->lock);
+
+    if (ctx->journal) {
+        line = json_dumps (object, JSON_COMPACT);
+        if (fprintf (ctx->journal, "%s\n", line) < 0 ||
+            fflush (ctx->journal) != 0 ||
+            fsync (fileno (ctx->journal)) < 0)
+            seaf_warning ("Failed to write fsck journal %s: %s.\n",
+                          ctx->journal_path, strerror(errno));
+        free (line);
+    }
+
+    g_hash_table_replace (ctx->results, g_strdup(report->repo_id), object);
+    ctx->result_order = g_list_prepend (ctx->result_order,
+                                        g_strdup(report->repo_id));
+
+    pthread_mutex_unlock (&ctx->lock);
+}
+
+static void
+fsck_worker (gpointer data, gpointer user_data)
+{
+    const char *repo_id = data;
+    FsckContext *ctx = user_data;
+    FsckRepoReport *report;
+    gint64 start;
+
+    report = fsck_repo_report_new (repo_id);
+
+    start = get_current_time ();
+    fsck_repo (repo_id, report);
+    report->time_used = get_current_time () - start;
+
+    record_repo_report (ctx, report);
+    fsck_repo_report_free (report);
+}
+
+static int
+write_report (FsckContext *ctx, const char *report_file)
+{
+    json_t *report, *repos;
     GList *ptr;
+    json_t *object;
+    char *data;
+    int ret = 0;
+
+    repos = json_array ();
+    for (ptr = g_list_last (ctx->result_order); ptr; ptr = ptr->prev) {
+        object = g_hash_table_lookup (ctx->results, ptr->data);
+        if (object)
+            json_array_append (repos, object);
+    }
+
+    report = json_object ();
+    json_object_set_new (report, "repos", repos);
+
+    data = json_dumps (report, JSON_INDENT(2));
+    json_decref (report);
+
+    if (!g_file_set_contents (report_file, data, -1, NULL)) {
+        seaf_warning ("Failed to write fsck report to %s.\n", report_file);
+        ret = -1;
+    }
+
+    free (data);
+    return ret;
+}
+
+int
+seaf_fsck (GList *repo_id_list, int n_jobs, const char *report_file)
+{
+    FsckContext ctx;
+    GThreadPool *pool = NULL;
+    GError *error = NULL;
+    GList *ptr;
+    GList *all_repos = NULL;
     char *repo_id;
-    SeafRepo *repo;
+    gboolean resume;
+    int ret = 0;
+
+    memset (&ctx, 0, sizeof(ctx));
+    pthread_mutex_init (&ctx.lock, NULL);
+    ctx.results = g_hash_table_new_full (g_str_hash, g_str_equal,
+                                         g_free, (GDestroyNotify)json_decref);
+    ctx.journal_path = g_build_filename (seaf->seaf_dir, FSCK_JOURNAL_NAME, NULL);
+    ctx.repo_list_key = compute_repo_list_key (repo_id_list);
+
+    if (!repo_id_list) {
+        all_repos = seaf_repo_manager_get_repo_id_list (seaf->repo_mgr);
+        repo_id_list = all_repos;
+    }
+
+    resume = load_journal (&ctx);
+
+    ctx.journal = open_journal (&ctx, resume);
+    if (!ctx.journal)
+        seaf_warning ("Failed to open fsck journal %s: %s. "
+                      "Progress won't be saved.\n",
+                      ctx.journal_path, strerror(errno));
+
+    if (n_jobs > 1) {
+        pool = g_thread_pool_new (fsck_worker, &ctx, n_jobs, FALSE, &error);
+        if (!pool) {
+            seaf_warning ("Failed to create fsck thread pool: %s. "
+                          "Checking repos one by one.\n",
+                          error ? error->message : "");
+            g_clear_error (&error);
+        }
+    }
 
     for (ptr = repo_id_list; ptr; ptr = ptr->next) {
         repo_id = ptr->data;
 
-        seaf_message ("Running fsck for repo %.8s.\n", repo_id);
-
-        repo = seaf_repo_manager_get_repo (seaf->repo_mgr, repo_id);
-        if (!repo) {
-            if (recover_corrupted_repo_head (repo_id) < 0) {
-                seaf_warning ("Failed to recover repo %.8s.\n\n", repo_id);
-            } else
-                seaf_message ("Fsck finished for repo %.8s.\n\n", repo_id);
+        if (g_hash_table_lookup (ctx.results, repo_id) != NULL) {
+            seaf_message ("Repo %.8s has been checked, skip.\n", repo_id);
             continue;
         }
 
-        check_and_reset_consistent_state (repo);
+        if (pool)
+            g_thread_pool_push (pool, repo_id, NULL);
+        else
+            fsck_worker (repo_id, &ctx);
+    }
 
-        seaf_message ("Fsck finished for repo %.8s.\n\n", repo_id);
+    /* Wait for all queued repos to finish. */
+    if (pool)
+        g_thread_pool_free (pool, FALSE, TRUE);
 
-        seaf_repo_unref (repo);
-    }
-    return 0;
+    if (ctx.journal)
+        fclose (ctx.journal);
+
+    /* All repos are checked, next run should start from scratch. */
+    g_unlink (ctx.journal_path);
+
+    if (report_file)
+        ret = write_report (&ctx, report_file);
+
+    g_hash_table_destroy (ctx.results);
+    string_list_free (ctx.result_order);
+    g_free (ctx.journal_path);
+    g_free (ctx.repo_list_key);
+    pthread_mutex_destroy (&ctx.lock);
+    string_list_free (all_repos);
+
+    return ret;
 }
@@ -1,7 +1,13 @@
 #ifndef SEAF_FSCK_H
 #define SEAF_FSCK_H
 
+/*
+ * Check and repair repos in @repo_id_list, or all repos if it's NULL.
+ * @n_jobs: number of repos checked concurrently.
+ * @report_file: if not NULL, write a json report of the results to it.
+ * Returns -1 if the report can't be written.
+ */
 int
-seaf_fsck (GList *repo_id_list);
+seaf_fsck (GList *repo_id_list, int n_jobs, const char *report_file);
 
 #endif
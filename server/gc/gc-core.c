@@ -51,7 +51,7 @@ alloc_gc_index ()
 typedef struct {
     SeafRepo *repo;
     Bloom *index;
-    GHashTable *visited;
+    FsObjSet *visited;
 
     /* > 0: keep a period of history;
      * == 0: only keep data in head commit;
@@ -100,16 +100,6 @@ fs_callback (SeafFSManager *mgr,
 {
     GCData *data = user_data;
 
-    if (data->visited != NULL) {
-        if (g_hash_table_lookup (data->visited, obj_id) != NULL) {
-            *stop = TRUE;
-            return TRUE;
-        }
-
-        char *key = g_strdup(obj_id);
-        g_hash_table_replace (data->visited, key, key);
-    }
-
     if (type == SEAF_METADATA_TYPE_FILE &&
         add_blocks_to_index (mgr, data, obj_id) < 0)
         return FALSE;
@@ -146,11 +136,13 @@ traverse_commit (SeafCommit *commit, void *vdata, gboolean *stop)
     seaf_debug ("Traversed commit %.8s.\n", commit->commit_id);
     ++data->traversed_commits;
 
-    ret = seaf_fs_manager_traverse_tree (seaf->fs_mgr,
-                                         data->repo->store_id, data->repo->version,
-                                         commit->root_id,
-                                         fs_callback,
-                                         data, data->ignore_errors);
+    ret = seaf_fs_manager_traverse_tree_visited (seaf->fs_mgr,
+                                                 data->repo->store_id,
+                                                 data->repo->version,
+                                                 commit->root_id,
+                                                 fs_callback,
+                                                 data, data->ignore_errors,
+                                                 data->visited);
     if (ret < 0 && !data->ignore_errors)
         return FALSE;
 
@@ -158,7 +150,8 @@ traverse_commit (SeafCommit *commit, void *vdata, gboolean *stop)
 }
 
 static int
-populate_gc_index_for_repo (SeafRepo *repo, Bloom *index, gboolean ignore_errors)
+populate_gc_index_for_repo (SeafRepo *repo, Bloom *index,
+                            FsObjSet *visited, gboolean ignore_errors)
 {
     GList *branches, *ptr;
     SeafBranch *branch;
@@ -176,7 +169,7 @@ populate_gc_index_for_repo (SeafRepo *repo, Bloom *index, gboolean ignore_errors
     data = g_new0(GCData, 1);
     data->repo = repo;
     data->index = index;
-    data->visited = g_hash_table_new_full (g_str_hash, g_str_equal, g_free, NULL);
+    data->visited = visited;
 
     gint64 truncate_time = seaf_repo_manager_get_repo_truncate_time (repo->manager,
                                                                      repo->id);
@@ -220,7 +213,6 @@ populate_gc_index_for_repo (SeafRepo *repo, Bloom *index, gboolean ignore_errors
     reachable_blocks += data->traversed_blocks;
 
     g_list_free (branches);
-    g_hash_table_destroy (data->visited);
     g_free (data);
 
     return ret;
@@ -250,7 +242,8 @@ check_block_liveness (const char *store_id, int version,
 }
 
 static int
-populate_gc_index_for_virtual_repos (SeafRepo *repo, Bloom *index, int ignore_errors)
+populate_gc_index_for_virtual_repos (SeafRepo *repo, Bloom *index,
+                                     FsObjSet *visited, int ignore_errors)
 {
     GList *vrepo_ids = NULL, *ptr;
     char *repo_id;
@@ -271,7 +264,7 @@ populate_gc_index_for_virtual_repos (SeafRepo *repo, Bloom *index, int ignore_er
                 continue;
         }
 
-        ret = populate_gc_index_for_repo (vrepo, index, ignore_errors);
+        ret = populate_gc_index_for_repo (vrepo, index, visited, ignore_errors);
         seaf_repo_unref (vrepo);
         if (ret < 0 && !ignore_errors)
             goto out;
@@ -286,6 +279,7 @@ int
 gc_v1_repo (SeafRepo *repo, int dry_run, int ignore_errors)
 {
     Bloom *index;
+    FsObjSet *visited;
     int ret;
 
     total_blocks = seaf_block_manager_get_block_number (seaf->block_mgr,
@@ -314,14 +308,20 @@ gc_v1_repo (SeafRepo *repo, int dry_run, int ignore_errors)
 
     seaf_message ("Populating index.\n");
 
-    ret = populate_gc_index_for_repo (repo, index, ignore_errors);
+    /* Fs objects already traversed in any commit of the origin repo or its
+     * virtual repos don't need to be traversed again, since they share
+     * the same fs and block store.
+     */
+    visited = fs_obj_set_new ();
+
+    ret = populate_gc_index_for_repo (repo, index, visited, ignore_errors);
     if (ret < 0 && !ignore_errors)
         goto out;
 
     /* Since virtual repos share fs and block store with the origin repo,
      * it's necessary to do GC for them together.
      */
-    ret = populate_gc_index_for_virtual_repos (repo, index, ignore_errors);
+    ret = populate_gc_index_for_virtual_repos (repo, index, visited, ignore_errors);
     if (ret < 0 && !ignore_errors)
         goto out;
 
@@ -343,6 +343,19 @@ gc_v1_repo (SeafRepo *repo, int dry_run, int ignore_errors)
         goto out;
     }
 
+    /* Compaction also moves blocks left by the fs backend into packs,
+     * so it runs even if no block is removed.
+     */
+    if (!dry_run) {
+        seaf_message ("Compacting block store.\n");
+        ret = seaf_block_manager_compact_store (seaf->block_mgr,
+                                                repo->store_id, repo->version);
+        if (ret < 0) {
+            seaf_warning ("GC: Failed to compact block store.\n");
+            goto out;
+        }
+    }
+
     if (!dry_run)
         seaf_message ("GC finished. %"G_GUINT64_FORMAT" blocks total, "
                       "about %"G_GUINT64_FORMAT" reachable blocks, "
@@ -355,6 +368,7 @@ gc_v1_repo (SeafRepo *repo, int dry_run, int ignore_errors)
                       total_blocks, reachable_blocks, removed_blocks);
 
 out:
+    fs_obj_set_free (visited);
     bloom_destroy (index);
     return ret;
 }
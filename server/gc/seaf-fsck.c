@@ -16,19 +16,27 @@ static char *seafile_dir = NULL;
 CcnetClient *ccnet_client;
 SeafileSession *seaf;
 
-static const char *short_opts = "hvc:d:Ds";
+static const char *short_opts = "hvc:d:Dsj:r:";
 static const struct option long_opts[] = {
     { "help", no_argument, NULL, 'h', },
     { "version", no_argument, NULL, 'v', },
     { "config-file", required_argument, NULL, 'c', },
     { "seafdir", required_argument, NULL, 'd', },
+    { "jobs", required_argument, NULL, 'j', },
+    { "report", required_argument, NULL, 'r', },
+    { 0, 0, 0, 0, },
 };
 
 static void usage ()
 {
     fprintf (stderr,
              "usage: seaf-fsck [-c config_dir] [-d seafile_dir] "
-             "[repo_id_1 [repo_id_2 ...]]\n");
+             "[-j jobs] [-r report_file] "
+             "[repo_id_1 [repo_id_2 ...]]\n"
+             "Additional options:\n"
+             "-j, --jobs: number of repos to check concurrently\n"
+             "-r, --report: write a json report to the file\n"
+             "If fsck is interrupted, the next run resumes from where it stopped.\n");
 }
 
 #ifdef WIN32
@@ -61,6 +69,8 @@ int
 main(int argc, char *argv[])
 {
     int c;
+    int n_jobs = 1;
+    char *report_file = NULL;
 
 #ifdef WIN32
     argv = get_argv_utf8 (&argc);
@@ -83,6 +93,16 @@ main(int argc, char *argv[])
         case 'd':
             seafile_dir = strdup(optarg);
             break;
+        case 'j':
+            n_jobs = atoi(optarg);
+            if (n_jobs <= 0) {
+                usage();
+                exit(-1);
+            }
+            break;
+        case 'r':
+            report_file = strdup(optarg);
+            break;
         default:
             usage();
             exit(-1);
@@ -118,7 +138,8 @@ main(int argc, char *argv[])
     for (i = optind; i < argc; i++)
         repo_id_list = g_list_append (repo_id_list, g_strdup(argv[i]));
 
-    seaf_fsck (repo_id_list);
+    if (seaf_fsck (repo_id_list, n_jobs, report_file) < 0)
+        return 1;
 
     return 0;
 }
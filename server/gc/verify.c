@@ -5,6 +5,8 @@ typedef struct VerifyData {
     SeafRepo *repo;
     gint64 truncate_time;
     gboolean traversed_head;
+    FsObjSet *visited;
+    BlockExistCache *block_cache;
 } VerifyData;
 
 static int
@@ -24,10 +26,9 @@ check_blocks (VerifyData *data, const char *file_id)
     }
 
     for (i = 0; i < seafile->n_blocks; ++i) {
-        if (!seaf_block_manager_block_exists (seaf->block_mgr,
-                                              repo->store_id,
-                                              repo->version,
-                                              seafile->blk_sha1s[i]))
+        if (!seaf_block_manager_block_exists_cached (seaf->block_mgr,
+                                                     data->block_cache,
+                                                     seafile->blk_sha1s[i]))
             g_message ("Block %s is missing.\n", seafile->blk_sha1s[i]);
     }
 
@@ -76,12 +77,13 @@ traverse_commit (SeafCommit *commit, void *vdata, gboolean *stop)
     if (!data->traversed_head)
         data->traversed_head = TRUE;
 
-    ret = seaf_fs_manager_traverse_tree (seaf->fs_mgr,
-                                         repo->store_id,
-                                         repo->version,
-                                         commit->root_id,
-                                         fs_callback,
-                                         vdata, FALSE);
+    ret = seaf_fs_manager_traverse_tree_visited (seaf->fs_mgr,
+                                                 repo->store_id,
+                                                 repo->version,
+                                                 commit->root_id,
+                                                 fs_callback,
+                                                 vdata, FALSE,
+                                                 data->visited);
     if (ret < 0)
         return FALSE;
 
@@ -106,6 +108,11 @@ verify_repo (SeafRepo *repo)
         return -1;
     }
 
+    data.visited = fs_obj_set_new ();
+    data.block_cache = seaf_block_manager_exist_cache_new (seaf->block_mgr,
+                                                           repo->store_id,
+                                                           repo->version);
+
     for (ptr = branches; ptr != NULL; ptr = ptr->next) {
         branch = ptr->data;
         gboolean res = seaf_commit_manager_traverse_commit_tree (seaf->commit_mgr,
@@ -122,6 +129,8 @@ verify_repo (SeafRepo *repo)
     }
 
     g_list_free (branches);
+    fs_obj_set_free (data.visited);
+    seaf_block_manager_exist_cache_free (data.block_cache);
 
     return ret;
 }
@@ -3,6 +3,8 @@
 #include <jansson.h>
 #include <locale.h>
 #include <sys/types.h>
+#include <event2/bufferevent.h>
+#include <event2/bufferevent_struct.h>
 
 #include "common.h"
 #include "utils.h"
@@ -14,8 +16,12 @@
 #include "seaf-db.h"
 
 #include "access-file.h"
+#include "seafile-crypt.h"
+#include "pack-dir.h"
 #include "upload-file.h"
+#include "upload-session.h"
 #include "fileserver-config.h"
+#include "ttl-cache.h"
 
 #include "http-status-codes.h"
 
@@ -23,6 +29,7 @@
 #define DEFAULT_BIND_PORT 8082
 #define DEFAULT_THREADS 50
 #define DEFAULT_MAX_DOWNLOAD_DIR_SIZE 100 * ((gint64)1 << 20) /* 100MB */
+#define DEFAULT_ZIP_CACHE_SIZE 1024 * ((gint64)1 << 20) /* 1GB */
 
 #define HOST "host"
 #define PORT "port"
@@ -30,26 +37,27 @@
 #define INIT_INFO "If you see this page, Seafile HTTP syncing component works."
 #define PROTO_VERSION "{\"version\": 1}"
 
+/* Ids in a bitmap existence check are split into slices of this size,
+ * which are checked in parallel by the check exist thread pool.
+ */
+#define CHECK_EXIST_SLICE_SIZE 1024
+#define CHECK_EXIST_THREADS 8
+/* Max number of ids in one bitmap existence check. */
+#define CHECK_EXIST_MAX_IDS 100000
+
+/* Total size of the cached fs id lists. */
+#define FS_ID_LIST_CACHE_SIZE (64 << 20) /* 64MB */
+/* Ids are added to a list being calculated in pieces of this size. */
+#define FS_ID_LIST_FLUSH_SIZE (64 << 10) /* 64KB */
+#define FS_ID_LIST_THREADS 4
+
 #define CLEANING_INTERVAL_SEC 300	/* 5 minutes */
 #define TOKEN_EXPIRE_TIME 7200	    /* 2 hours */
 #define PERM_EXPIRE_TIME 7200       /* 2 hours */
 #define VIRINFO_EXPIRE_TIME 7200       /* 2 hours */
-
-typedef struct TokenInfo {
-    char *repo_id;
-    char *email;
-    gint64 expire_time;
-} TokenInfo;
-
-typedef struct PermInfo {
-    char *perm;
-    gint64 expire_time;
-} PermInfo;
-
-typedef struct VirRepoInfo {
-    char *store_id;
-    gint64 expire_time;
-} VirRepoInfo;
+#define DEFAULT_TOKEN_CACHE_SIZE 100000
+#define DEFAULT_PERM_CACHE_SIZE 100000
+#define DEFAULT_VIRINFO_CACHE_SIZE 100000
 
 typedef struct FsHdr {
     char obj_id[40];
@@ -61,6 +69,36 @@ typedef enum CheckExistType {
     CHECK_BLOCK_EXIST
 } CheckExistType;
 
+typedef struct CheckExistBatch {
+    /* Held by the request and by each slice being checked. */
+    gint ref;
+    CheckExistType type;
+    char store_id[37];
+    guint8 *ids;                /* raw 20-byte ids */
+    int n_ids;
+    gboolean *exists;
+    gint pending;
+
+    /* NULL after the connection is closed. */
+    evhtp_request_t *req;
+    /* The last finished slice writes to the pipe. */
+    ccnet_pipe_t pipe_fds[2];
+    struct event *done_ev;
+
+    bufferevent_data_cb saved_read_cb;
+    bufferevent_data_cb saved_write_cb;
+    bufferevent_event_cb saved_event_cb;
+    void *saved_cb_arg;
+} CheckExistBatch;
+
+typedef struct CheckExistSlice {
+    CheckExistBatch *batch;
+    int start;
+    int n;
+} CheckExistSlice;
+
+static GThreadPool *check_exist_pool;
+
 const char *GET_PROTO_PATH = "/protocol-version";
 const char *OP_PERM_CHECK_REGEX = "^/repo/[\\da-z]{8}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{12}/permission-check/.*";
 const char *GET_CHECK_QUOTA_REGEX = "^/repo/[\\da-z]{8}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{12}/quota-check/.*";
@@ -71,8 +109,31 @@ const char *GET_FS_OBJ_ID_REGEX = "^/repo/[\\da-z]{8}-[\\da-z]{4}-[\\da-z]{4}-[\
 const char *BLOCK_OPER_REGEX = "^/repo/[\\da-z]{8}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{12}/block/[\\da-z]{40}";
 const char *POST_CHECK_FS_REGEX = "^/repo/[\\da-z]{8}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{12}/check-fs";
 const char *POST_CHECK_BLOCK_REGEX = "^/repo/[\\da-z]{8}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{12}/check-blocks";
+const char *POST_CHECK_FS_BITMAP_REGEX = "^/repo/[\\da-z]{8}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{12}/bitmap-check-fs";
+const char *POST_CHECK_BLOCK_BITMAP_REGEX = "^/repo/[\\da-z]{8}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{12}/bitmap-check-blocks";
 const char *POST_RECV_FS_REGEX = "^/repo/[\\da-z]{8}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{12}/recv-fs";
 const char *POST_PACK_FS_REGEX = "^/repo/[\\da-z]{8}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{12}/pack-fs";
+const char *POST_PACK_BLOCKS_REGEX = "^/repo/[\\da-z]{8}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{4}-[\\da-z]{12}/pack-blocks";
+
+/* Cache sizes are in number of entries. */
+static int
+get_cache_size (SeafileSession *session, char *key, int default_size)
+{
+    GError *error = NULL;
+    int size;
+
+    size = fileserver_config_get_integer (session->config, key, &error);
+    if (error) {
+        g_clear_error (&error);
+        return default_size;
+    }
+    if (size <= 0) {
+        seaf_warning ("[conf] Invalid %s %d, use default %d.\n",
+                      key, size, default_size);
+        return default_size;
+    }
+    return size;
+}
 
 static void
 load_http_config (HttpServer *htp_server, SeafileSession *session)
@@ -82,6 +143,8 @@ load_http_config (HttpServer *htp_server, SeafileSession *session)
     int port = 0;
     int max_upload_size_mb;
     int max_download_dir_size_mb;
+    int zip_cache_size_mb;
+    int worker_threads;
     char *encoding;
 
     host = fileserver_config_get_string (session->config, HOST, &error);
@@ -138,6 +201,44 @@ load_http_config (HttpServer *htp_server, SeafileSession *session)
             htp_server->max_download_dir_size = max_download_dir_size_mb * ((gint64)1 << 20);
     }
 
+    /* Set to 0 to disable caching of directory archives. */
+    zip_cache_size_mb = fileserver_config_get_integer (session->config,
+                                                       "zip_cache_size",
+                                                       &error);
+    if (error) {
+        htp_server->zip_cache_size = DEFAULT_ZIP_CACHE_SIZE;
+        g_clear_error (&error);
+    } else {
+        if (zip_cache_size_mb <= 0)
+            htp_server->zip_cache_size = 0;
+        else
+            htp_server->zip_cache_size = zip_cache_size_mb * ((gint64)1 << 20);
+    }
+
+    /* Number of event loop threads serving requests. */
+    worker_threads = fileserver_config_get_integer (session->config,
+                                                    "worker_threads",
+                                                    &error);
+    if (error) {
+        htp_server->worker_threads = DEFAULT_THREADS;
+        g_clear_error (&error);
+    } else {
+        if (worker_threads <= 0) {
+            seaf_warning ("[conf] Invalid worker_threads %d, use default %d.\n",
+                          worker_threads, DEFAULT_THREADS);
+            htp_server->worker_threads = DEFAULT_THREADS;
+        } else
+            htp_server->worker_threads = worker_threads;
+    }
+
+    htp_server->token_cache_size = get_cache_size (session, "token_cache_size",
+                                                   DEFAULT_TOKEN_CACHE_SIZE);
+    htp_server->perm_cache_size = get_cache_size (session, "perm_cache_size",
+                                                  DEFAULT_PERM_CACHE_SIZE);
+    htp_server->vir_repo_info_cache_size = get_cache_size (session,
+                                                           "repo_info_cache_size",
+                                                           DEFAULT_VIRINFO_CACHE_SIZE);
+
     encoding = g_key_file_get_string (session->config,
                                       "zip", "windows_encoding",
                                       &error);
@@ -154,7 +255,6 @@ validate_token (HttpServer *htp_server, evhtp_request_t *req,
                 const char *repo_id, char **username)
 {
     char *email = NULL;
-    TokenInfo *token_info;
 
     const char *token = evhtp_kv_find (req->headers_in, "Seafile-Repo-Token");
     if (token == NULL) {
@@ -162,109 +262,57 @@ validate_token (HttpServer *htp_server, evhtp_request_t *req,
         return EVHTP_RES_BADREQ;
     }
 
-    pthread_mutex_lock (&htp_server->token_cache_lock);
+    email = ttl_cache_lookup (htp_server->token_cache, token);
+    if (!email) {
+        email = seaf_repo_manager_get_email_by_token (htp_server->seaf_session->repo_mgr,
+                                                      repo_id, token);
+        if (email == NULL)
+            return EVHTP_RES_FORBIDDEN;
 
-    token_info = g_hash_table_lookup (htp_server->token_cache, token);
-    if (token_info) {
-        if (username)
-            *username = g_strdup(token_info->email);
-        pthread_mutex_unlock (&htp_server->token_cache_lock);
-        return EVHTP_RES_OK;
+        ttl_cache_insert (htp_server->token_cache, token, email);
     }
 
-    pthread_mutex_unlock (&htp_server->token_cache_lock);
-
-    email = seaf_repo_manager_get_email_by_token (htp_server->seaf_session->repo_mgr,
-                                                  repo_id, token);
-    if (email == NULL)
-        return EVHTP_RES_FORBIDDEN;
-
-    token_info = g_new0 (TokenInfo, 1);
-    token_info->repo_id = g_strdup (repo_id);
-    token_info->expire_time = (gint64)time(NULL) + TOKEN_EXPIRE_TIME;
-    token_info->email = email;
-
-    pthread_mutex_lock (&htp_server->token_cache_lock);
-    g_hash_table_insert (htp_server->token_cache, g_strdup (token), token_info);
-    pthread_mutex_unlock (&htp_server->token_cache_lock);
-
     if (username)
-        *username = g_strdup(email);
+        *username = email;
+    else
+        g_free (email);
     return EVHTP_RES_OK;
 }
 
-static PermInfo *
-lookup_perm_cache (HttpServer *htp_server, const char *repo_id, const char *username)
-{
-    PermInfo *ret = NULL;
-    char *key = g_strdup_printf ("%s:%s", repo_id, username);
-
-    ret = g_hash_table_lookup (htp_server->perm_cache, key);
-    g_free (key);
-
-    return ret;
-}
-
-static void
-insert_perm_cache (HttpServer *htp_server,
-                   const char *repo_id, const char *username,
-                   PermInfo *perm)
-{
-    char *key = g_strdup_printf ("%s:%s", repo_id, username);
-
-    g_hash_table_insert (htp_server->perm_cache, key, perm);
-}
-
-static void
-remove_perm_cache (HttpServer *htp_server,
-                   const char *repo_id, const char *username)
-{
-    char *key = g_strdup_printf ("%s:%s", repo_id, username);
-
-    g_hash_table_remove (htp_server->perm_cache, key);
-
-    g_free (key);
-}
-
 static int
 check_permission (HttpServer *htp_server, const char *repo_id, const char *username,
                   const char *op, gboolean skip_cache)
 {
-    PermInfo *perm_info = NULL;
+    char *key = g_strdup_printf ("%s:%s", repo_id, username);
+    char *perm = NULL;
+    int ret = EVHTP_RES_OK;
 
     if (!skip_cache)
-        perm_info = lookup_perm_cache (htp_server, repo_id, username);
-
-    if (perm_info) {
-        if (strcmp(perm_info->perm, "r") == 0 && strcmp(op, "upload") == 0)
+        perm = ttl_cache_lookup (htp_server->perm_cache, key);
+
+    if (!perm) {
+        perm = seaf_repo_manager_check_permission (seaf->repo_mgr,
+                                                   repo_id, username, NULL);
+        if (!perm) {
+            /* Invalidate cache if perm not found in db. */
+            ttl_cache_remove (htp_server->perm_cache, key);
+            g_free (key);
             return EVHTP_RES_FORBIDDEN;
-        return EVHTP_RES_OK;
+        }
+        ttl_cache_insert (htp_server->perm_cache, key, perm);
     }
 
-    char *perm = seaf_repo_manager_check_permission (seaf->repo_mgr,
-                                                     repo_id, username, NULL);
-    if (perm) {
-        perm_info = g_new0 (PermInfo, 1);
-        /* Take the reference of perm. */
-        perm_info->perm = perm;
-        perm_info->expire_time = (gint64)time(NULL) + PERM_EXPIRE_TIME;
-        insert_perm_cache (htp_server, repo_id, username, perm_info);
-
-        if ((strcmp (perm, "r") == 0 && strcmp (op, "upload") == 0))
-            return EVHTP_RES_FORBIDDEN;
-        return EVHTP_RES_OK;
-    }
+    if (strcmp (perm, "r") == 0 && strcmp (op, "upload") == 0)
+        ret = EVHTP_RES_FORBIDDEN;
 
-    /* Invalidate cache if perm not found in db. */
-    remove_perm_cache (htp_server, repo_id, username);
-    return EVHTP_RES_FORBIDDEN;
+    g_free (perm);
+    g_free (key);
+    return ret;
 }
 
 static gboolean
 get_vir_repo_info (SeafDBRow *row, void *data)
 {
-    HttpServer *htp_server = data;
-
     const char *repo_id = seaf_db_row_get_column_text (row, 0);
     if (!repo_id)
         return FALSE;
@@ -272,84 +320,37 @@ get_vir_repo_info (SeafDBRow *row, void *data)
     if (!origin_id)
         return FALSE;
 
-    VirRepoInfo **vinfo = data;
-    *vinfo = g_new0 (VirRepoInfo, 1);
-    if (!*vinfo)
-        return FALSE;
-    (*vinfo)->store_id = g_strdup (origin_id);
-    if (!(*vinfo)->store_id)
-        return FALSE;
-    (*vinfo)->expire_time = time (NULL) + VIRINFO_EXPIRE_TIME;
+    char **store_id = data;
+    *store_id = g_strdup (origin_id);
 
     return TRUE;
 }
 
-static char *
-get_store_id_from_vir_repo_info_cache (HttpServer *htp_server, const char *repo_id)
-{
-    char *store_id = NULL;
-    VirRepoInfo *vinfo = NULL;
-
-    pthread_mutex_lock (&htp_server->vir_repo_info_cache_lock);
-    vinfo = g_hash_table_lookup (htp_server->vir_repo_info_cache, repo_id);
-
-    if (vinfo) {
-        if (vinfo->store_id)
-            store_id = g_strdup (vinfo->store_id);
-        else
-            store_id = g_strdup (repo_id);
-
-        vinfo->expire_time = time (NULL) + VIRINFO_EXPIRE_TIME;
-    }
-
-    pthread_mutex_unlock (&htp_server->vir_repo_info_cache_lock);
-
-    return store_id;
-}
-
-static void
-add_vir_info_to_cache (HttpServer *htp_server, const char *repo_id,
-                       VirRepoInfo *vinfo)
-{
-    pthread_mutex_lock (&htp_server->vir_repo_info_cache_lock);
-    g_hash_table_insert (htp_server->vir_repo_info_cache, g_strdup (repo_id), vinfo);
-    pthread_mutex_unlock (&htp_server->vir_repo_info_cache_lock);
-}
-
 static char *
 get_repo_store_id (HttpServer *htp_server, const char *repo_id)
 {
-    char *store_id = get_store_id_from_vir_repo_info_cache (htp_server,
-                                                            repo_id);
+    char *store_id = ttl_cache_lookup (htp_server->vir_repo_info_cache,
+                                       repo_id);
     if (store_id) {
         return store_id;
     }
 
-    VirRepoInfo *vinfo = NULL;
     char *sql = "SELECT repo_id, origin_repo FROM VirtualRepo where repo_id = ?";
     int n_row = seaf_db_statement_foreach_row (seaf->db, sql, get_vir_repo_info,
-                                               &vinfo, 1, "string", repo_id);
+                                               &store_id, 1, "string", repo_id);
     if (n_row < 0) {
         // db error, return NULL
         return NULL;
     } else if (n_row == 0) {
         // repo is not virtual repo
-        vinfo = g_new0 (VirRepoInfo, 1);
-        if (!vinfo)
-            return NULL;
-        vinfo->expire_time = time (NULL) + VIRINFO_EXPIRE_TIME;
-
-        add_vir_info_to_cache (htp_server, repo_id, vinfo);
-
-        return g_strdup (repo_id);
-    } else if (!vinfo || !vinfo->store_id) {
-        // out of memory, return NULL
+        store_id = g_strdup (repo_id);
+    } else if (!store_id) {
         return NULL;
     }
 
-    add_vir_info_to_cache (htp_server, repo_id, vinfo);
+    ttl_cache_insert (htp_server->vir_repo_info_cache, repo_id, store_id);
 
-    return g_strdup (vinfo->store_id);
+    return store_id;
 }
 
 static void
@@ -939,47 +940,386 @@ dirent_same (SeafDirent *denta, SeafDirent *dentb)
     return (strcmp (dentb->id, denta->id) == 0 && denta->mode == dentb->mode);
 }
 
+/*
+ * The fs id list between two root ids never changes, and many clients
+ * ask for the same list after a new commit is uploaded. So the lists
+ * are cached, keyed by store id and the two root ids.
+ *
+ * A list is calculated by the fs id list thread pool, not in the request
+ * callback. Ids are appended to the list as the trees are traversed, and
+ * streamed as a chunked reply to the requests following the list, which
+ * include the ones that arrive while it's being calculated.
+ */
+typedef struct FsIdList {
+    gint ref;
+    gboolean ready;
+    gboolean failed;
+    char *key;
+    GString *buf;               /* JSON array of fs ids */
+    GList *readers;             /* requests following the list */
+    GList *lru_link;            /* NULL if not in the LRU queue */
+} FsIdList;
+
+typedef struct FsIdListReader {
+    HttpServer *htp_server;
+    evhtp_request_t *req;
+    FsIdList *list;
+    size_t sent;
+    /* The calculating thread writes to the pipe when the list grows. */
+    ccnet_pipe_t pipe_fds[2];
+    gboolean notified;
+    struct event *read_ev;
+
+    bufferevent_data_cb saved_read_cb;
+    bufferevent_data_cb saved_write_cb;
+    bufferevent_event_cb saved_event_cb;
+    void *saved_cb_arg;
+} FsIdListReader;
+
+typedef struct CalcFsIdListData {
+    HttpServer *htp_server;
+    FsIdList *list;
+    char repo_id[37];
+    char store_id[37];
+    int version;
+    char master_root[41];
+    char remote_root[41];
+    /* Ids not appended to the list yet. */
+    GString *batch;
+    gint64 n_ids;
+} CalcFsIdListData;
+
+static GThreadPool *fs_id_list_pool;
+
+static void
+fs_id_list_unref (FsIdList *list)
+{
+    if (!list || !g_atomic_int_dec_and_test (&list->ref))
+        return;
+
+    g_free (list->key);
+    g_string_free (list->buf, TRUE);
+    g_free (list);
+}
+
+static void
+fs_id_list_cleanup (const void *data, size_t len, void *extra)
+{
+    fs_id_list_unref (extra);
+}
+
+/* Called with fs_id_list_cache_lock held. */
+static void
+notify_fs_id_list_readers (FsIdList *list)
+{
+    GList *ptr;
+    FsIdListReader *reader;
+
+    for (ptr = list->readers; ptr; ptr = ptr->next) {
+        reader = ptr->data;
+        if (reader->notified)
+            continue;
+        if (pipewrite (reader->pipe_fds[1], "x", 1) == 1)
+            reader->notified = TRUE;
+    }
+}
+
+static void
+flush_fs_ids (CalcFsIdListData *data)
+{
+    HttpServer *htp_server = data->htp_server;
+
+    pthread_mutex_lock (&htp_server->fs_id_list_cache_lock);
+    g_string_append_len (data->list->buf, data->batch->str, data->batch->len);
+    notify_fs_id_list_readers (data->list);
+    pthread_mutex_unlock (&htp_server->fs_id_list_cache_lock);
+
+    g_string_truncate (data->batch, 0);
+}
+
+static void
+append_fs_id (CalcFsIdListData *data, const char *id)
+{
+    GString *batch = data->batch;
+
+    if (data->n_ids++ > 0)
+        g_string_append_c (batch, ',');
+    g_string_append_c (batch, '"');
+    g_string_append (batch, id);
+    g_string_append_c (batch, '"');
+
+    if (batch->len >= FS_ID_LIST_FLUSH_SIZE)
+        flush_fs_ids (data);
+}
+
 static int
-collect_file_ids (int n, const char *basedir, SeafDirent *files[], void *data)
+collect_file_ids (int n, const char *basedir, SeafDirent *files[], void *vdata)
 {
     SeafDirent *file1 = files[0];
     SeafDirent *file2 = files[1];
-    GList **pret = data;
+    CalcFsIdListData *data = vdata;
 
     if (file1 && (!file2 || !dirent_same (file1, file2)) &&
         strcmp (file1->id, EMPTY_SHA1) != 0)
-        *pret = g_list_prepend (*pret, g_strdup(file1->id));
+        append_fs_id (data, file1->id);
 
     return 0;
 }
 
 static int
-collect_dir_ids (int n, const char *basedir, SeafDirent *dirs[], void *data,
+collect_dir_ids (int n, const char *basedir, SeafDirent *dirs[], void *vdata,
                  gboolean *recurse)
 {
     SeafDirent *dir1 = dirs[0];
     SeafDirent *dir2 = dirs[1];
-    GList **pret = data;
+    CalcFsIdListData *data = vdata;
 
     if (dir1 && (!dir2 || !dirent_same (dir1, dir2)) &&
         strcmp (dir1->id, EMPTY_SHA1) != 0)
-        *pret = g_list_prepend (*pret, g_strdup(dir1->id));
+        append_fs_id (data, dir1->id);
+
+    return 0;
+}
+
+static int
+calculate_send_object_list (CalcFsIdListData *data)
+{
+    /* Diff won't traverse the root object itself. */
+    if (strcmp (data->remote_root, data->master_root) != 0 &&
+        strcmp (data->master_root, EMPTY_SHA1) != 0)
+        append_fs_id (data, data->master_root);
+
+    DiffOptions opts;
+    memset (&opts, 0, sizeof(opts));
+    memcpy (opts.store_id, data->store_id, 36);
+    opts.version = data->version;
+    opts.file_cb = collect_file_ids;
+    opts.dir_cb = collect_dir_ids;
+    opts.data = data;
+
+    const char *trees[2];
+    trees[0] = data->master_root;
+    trees[1] = data->remote_root;
+    if (diff_trees (2, trees, &opts) < 0) {
+        seaf_warning ("Failed to diff remote and master head for repo %.8s.\n",
+                      data->repo_id);
+        return -1;
+    }
 
+    g_string_append_c (data->batch, ']');
     return 0;
 }
 
+static void
+evict_fs_id_lists (HttpServer *htp_server)
+{
+    FsIdList *list;
+
+    while (htp_server->fs_id_list_cache_size > FS_ID_LIST_CACHE_SIZE &&
+           !g_queue_is_empty (htp_server->fs_id_list_lru)) {
+        list = g_queue_pop_tail (htp_server->fs_id_list_lru);
+        list->lru_link = NULL;
+        htp_server->fs_id_list_cache_size -= list->buf->len;
+        g_hash_table_remove (htp_server->fs_id_list_cache, list->key);
+    }
+}
+
+static void
+calc_fs_id_list_thread (gpointer vdata, gpointer user_data)
+{
+    CalcFsIdListData *data = vdata;
+    HttpServer *htp_server = data->htp_server;
+    FsIdList *list = data->list;
+    int rc;
+
+    rc = calculate_send_object_list (data);
+
+    pthread_mutex_lock (&htp_server->fs_id_list_cache_lock);
+
+    list->ready = TRUE;
+    if (rc < 0) {
+        list->failed = TRUE;
+        g_hash_table_remove (htp_server->fs_id_list_cache, list->key);
+    } else {
+        g_string_append_len (list->buf, data->batch->str, data->batch->len);
+        g_queue_push_head (htp_server->fs_id_list_lru, list);
+        list->lru_link = htp_server->fs_id_list_lru->head;
+        htp_server->fs_id_list_cache_size += list->buf->len;
+        evict_fs_id_lists (htp_server);
+    }
+    notify_fs_id_list_readers (list);
+
+    pthread_mutex_unlock (&htp_server->fs_id_list_cache_lock);
+
+    fs_id_list_unref (list);
+    g_string_free (data->batch, TRUE);
+    g_free (data);
+}
+
+static void
+free_fs_id_list_reader (HttpServer *htp_server, FsIdListReader *reader)
+{
+    pthread_mutex_lock (&htp_server->fs_id_list_cache_lock);
+    reader->list->readers = g_list_remove (reader->list->readers, reader);
+    pthread_mutex_unlock (&htp_server->fs_id_list_cache_lock);
+
+    if (reader->read_ev)
+        event_free (reader->read_ev);
+    pipeclose (reader->pipe_fds[0]);
+    pipeclose (reader->pipe_fds[1]);
+    fs_id_list_unref (reader->list);
+    g_free (reader);
+}
+
+static void
+fs_id_list_readable_cb (evutil_socket_t fd, short what, void *ctx)
+{
+    FsIdListReader *reader = ctx;
+    evhtp_request_t *req = reader->req;
+    HttpServer *htp_server = reader->htp_server;
+    FsIdList *list = reader->list;
+    struct bufferevent *bev;
+    struct evbuffer *chunk = NULL;
+    gboolean ready, failed;
+    char c;
+
+    pthread_mutex_lock (&htp_server->fs_id_list_cache_lock);
+    while (piperead (reader->pipe_fds[0], &c, 1) == 1)
+        ;
+    reader->notified = FALSE;
+    if (list->buf->len > reader->sent) {
+        chunk = evbuffer_new ();
+        evbuffer_add (chunk, list->buf->str + reader->sent,
+                      list->buf->len - reader->sent);
+        reader->sent = list->buf->len;
+    }
+    ready = list->ready;
+    failed = list->failed;
+    pthread_mutex_unlock (&htp_server->fs_id_list_cache_lock);
+
+    if (failed) {
+        /* Headers are already sent, the client can only tell the
+         * error by the closed connection.
+         */
+        if (chunk)
+            evbuffer_free (chunk);
+        evhtp_connection_free (evhtp_request_get_connection (req));
+        free_fs_id_list_reader (htp_server, reader);
+        return;
+    }
+
+    if (chunk) {
+        evhtp_send_reply_chunk (req, chunk);
+        evbuffer_free (chunk);
+    }
+
+    if (!ready) {
+        event_add (reader->read_ev, NULL);
+        return;
+    }
+
+    /* Recover evhtp's callbacks */
+    bev = evhtp_request_get_bev (req);
+    bev->readcb = reader->saved_read_cb;
+    bev->writecb = reader->saved_write_cb;
+    bev->errorcb = reader->saved_event_cb;
+    bev->cbarg = reader->saved_cb_arg;
+
+    /* Resume reading incomming requests. */
+    evhtp_request_resume (req);
+
+    evhtp_send_reply_chunk_end (req);
+
+    free_fs_id_list_reader (htp_server, reader);
+}
+
+static void
+fs_id_list_event_cb (struct bufferevent *bev, short events, void *ctx)
+{
+    FsIdListReader *reader = ctx;
+
+    reader->saved_event_cb (bev, events, reader->saved_cb_arg);
+
+    free_fs_id_list_reader (reader->htp_server, reader);
+}
+
+/*
+ * Follow a list that is being calculated. Called with
+ * fs_id_list_cache_lock held.
+ */
+static FsIdListReader *
+fs_id_list_reader_new (HttpServer *htp_server, evhtp_request_t *req,
+                       FsIdList *list)
+{
+    FsIdListReader *reader;
+    struct bufferevent *bev = evhtp_request_get_bev (req);
+
+    reader = g_new0 (FsIdListReader, 1);
+    if (ccnet_pipe (reader->pipe_fds) < 0) {
+        seaf_warning ("Failed to create pipe: %s.\n", strerror(errno));
+        g_free (reader);
+        return NULL;
+    }
+    evutil_make_socket_nonblocking (reader->pipe_fds[0]);
+    evutil_make_socket_nonblocking (reader->pipe_fds[1]);
+
+    reader->htp_server = htp_server;
+    reader->req = req;
+    reader->list = list;
+    g_atomic_int_inc (&list->ref);
+    reader->read_ev = event_new (bev->ev_base, reader->pipe_fds[0], EV_READ,
+                                 fs_id_list_readable_cb, reader);
+    list->readers = g_list_prepend (list->readers, reader);
+
+    /* Send what's already in the list. */
+    if (pipewrite (reader->pipe_fds[1], "x", 1) == 1)
+        reader->notified = TRUE;
+
+    return reader;
+}
+
+static void
+start_fs_id_list_reply (evhtp_request_t *req, FsIdListReader *reader)
+{
+    struct bufferevent *bev = evhtp_request_get_bev (req);
+
+    /* We need to overwrite evhtp's callback functions to send the
+     * list piece by piece.
+     */
+    reader->saved_read_cb = bev->readcb;
+    reader->saved_write_cb = bev->writecb;
+    reader->saved_event_cb = bev->errorcb;
+    reader->saved_cb_arg = bev->cbarg;
+    bufferevent_setcb (bev, NULL, NULL, fs_id_list_event_cb, reader);
+
+    /* Block any new request from this connection before finish
+     * handling this request.
+     */
+    evhtp_request_pause (req);
+
+    /* The size of the list is not known in advance. */
+    evhtp_send_reply_chunk_start (req, EVHTP_RES_OK);
+
+    event_add (reader->read_ev, NULL);
+}
+
+/*
+ * Reply with the fs id list. A cached list is sent as a whole; otherwise
+ * the request follows the list being calculated. Returns -1 if nothing
+ * is sent yet.
+ */
 static int
-calculate_send_object_list (SeafRepo *repo,
-                            const char *server_head,
-                            const char *client_head,
-                            GList **results)
+send_object_list (HttpServer *htp_server, evhtp_request_t *req, SeafRepo *repo,
+                  const char *server_head, const char *client_head)
 {
     SeafCommit *remote_head = NULL, *master_head = NULL;
-    char *remote_head_root;
+    const char *remote_head_root;
+    FsIdList *list = NULL;
+    FsIdListReader *reader = NULL;
+    CalcFsIdListData *data = NULL;
+    char *key;
     int ret = 0;
 
-    *results = NULL;
-
     master_head = seaf_commit_manager_get_commit (seaf->commit_mgr,
                                                   repo->id, repo->version,
                                                   server_head);
@@ -1001,29 +1341,74 @@ calculate_send_object_list (SeafRepo *repo,
     } else
         remote_head_root = EMPTY_SHA1;
 
-    /* Diff won't traverse the root object itself. */
-    if (strcmp (remote_head_root, master_head->root_id) != 0 &&
-        strcmp (master_head->root_id, EMPTY_SHA1) != 0)
-        *results = g_list_prepend (*results, g_strdup(master_head->root_id));
+    key = g_strdup_printf ("%s:%s:%s", repo->store_id,
+                           master_head->root_id, remote_head_root);
 
-    DiffOptions opts;
-    memset (&opts, 0, sizeof(opts));
-    memcpy (opts.store_id, repo->store_id, 36);
-    opts.version = repo->version;
-    opts.file_cb = collect_file_ids;
-    opts.dir_cb = collect_dir_ids;
-    opts.data = results;
+    pthread_mutex_lock (&htp_server->fs_id_list_cache_lock);
 
-    const char *trees[2];
-    trees[0] = master_head->root_id;
-    trees[1] = remote_head_root;
-    if (diff_trees (2, trees, &opts) < 0) {
-        seaf_warning ("Failed to diff remote and master head for repo %.8s.\n",
-                      repo->id);
-        string_list_free (*results);
+    list = g_hash_table_lookup (htp_server->fs_id_list_cache, key);
+    if (list && list->ready) {
+        g_free (key);
+        g_atomic_int_inc (&list->ref);
+        /* Evicted lists are not in the queue any more. */
+        if (list->lru_link) {
+            g_queue_unlink (htp_server->fs_id_list_lru, list->lru_link);
+            g_queue_push_head_link (htp_server->fs_id_list_lru, list->lru_link);
+        }
+        pthread_mutex_unlock (&htp_server->fs_id_list_cache_lock);
+
+        /* The list is sent without copying, the reference is dropped
+         * when the data has been written out.
+         */
+        if (evbuffer_add_reference (req->buffer_out, list->buf->str,
+                                    list->buf->len,
+                                    fs_id_list_cleanup, list) < 0) {
+            fs_id_list_unref (list);
+            ret = -1;
+            goto out;
+        }
+        evhtp_send_reply (req, EVHTP_RES_OK);
+        goto out;
+    }
+
+    if (list) {
+        g_free (key);
+    } else {
+        list = g_new0 (FsIdList, 1);
+        list->key = key;
+        list->buf = g_string_new ("[");
+        list->ref = 1;          /* for the cache */
+        g_hash_table_insert (htp_server->fs_id_list_cache, list->key, list);
+
+        data = g_new0 (CalcFsIdListData, 1);
+        data->htp_server = htp_server;
+        data->list = list;
+        g_atomic_int_inc (&list->ref);
+        memcpy (data->repo_id, repo->id, 36);
+        memcpy (data->store_id, repo->store_id, 36);
+        data->version = repo->version;
+        memcpy (data->master_root, master_head->root_id, 40);
+        memcpy (data->remote_root, remote_head_root, 40);
+        data->batch = g_string_new (NULL);
+    }
+
+    reader = fs_id_list_reader_new (htp_server, req, list);
+
+    pthread_mutex_unlock (&htp_server->fs_id_list_cache_lock);
+
+    /* Queue the calculation even without a reader, the lock must not
+     * be held while waiting for the pool.
+     */
+    if (data)
+        g_thread_pool_push (fs_id_list_pool, data, NULL);
+
+    if (!reader) {
         ret = -1;
+        goto out;
     }
 
+    start_fs_id_list_reply (req, reader);
+
 out:
     seaf_commit_unref (remote_head);
     seaf_commit_unref (master_head);
@@ -1057,7 +1442,6 @@ get_fs_obj_id_cb (evhtp_request_t *req, void *arg)
     }
 
     const char *client_head = evhtp_kv_find (req->uri->query, "client-head");
-    GList *list = NULL, *ptr;
 
     repo = seaf_repo_manager_get_repo (seaf->repo_mgr, repo_id);
     if (!repo) {
@@ -1066,29 +1450,46 @@ get_fs_obj_id_cb (evhtp_request_t *req, void *arg)
         goto out;
     }
 
-    if (calculate_send_object_list (repo, server_head, client_head, &list) < 0) {
+    if (send_object_list (htp_server, req, repo, server_head, client_head) < 0)
         evhtp_send_reply (req, EVHTP_RES_SERVERR);
-        goto out;
-    }
 
-    json_t *obj_array = json_array ();
+out:
+    g_strfreev (parts);
+    seaf_repo_unref (repo);
+}
 
-    for (ptr = list; ptr; ptr = ptr->next) {
-        json_array_append_new (obj_array, json_string (ptr->data));
-        g_free (ptr->data);
-    }
-    g_list_free (list);
+/*
+ * Send a block straight from the block file. The content is queued as a
+ * file segment and sent with sendfile(), without being read into memory.
+ */
+static void
+send_block_file (evhtp_request_t *req, const char *store_id,
+                 const char *block_id)
+{
+    gint64 offset, size;
+    int fd;
 
-    char *obj_list = json_dumps (obj_array, JSON_COMPACT);
-    evbuffer_add (req->buffer_out, obj_list, strlen (obj_list));
-    evhtp_send_reply (req, EVHTP_RES_OK);
+    fd = seaf_block_manager_open_block_fd (seaf->block_mgr,
+                                           store_id, 1, block_id,
+                                           &offset, &size);
+    if (fd < 0) {
+        seaf_warning ("Failed to open block %.8s:%s.\n", store_id, block_id);
+        evhtp_send_reply (req, EVHTP_RES_SERVERR);
+        return;
+    }
 
-    g_free (obj_list);
-    json_decref (obj_array);
+    if (size == 0) {
+        close (fd);
+    } else if (evbuffer_add_file (req->buffer_out, fd, offset, size) < 0) {
+        /* Depending on libevent version, the fd may have been closed
+         * on failure. So don't close it here.
+         */
+        seaf_warning ("Failed to send block %.8s:%s.\n", store_id, block_id);
+        evhtp_send_reply (req, EVHTP_RES_SERVERR);
+        return;
+    }
 
-out:
-    g_strfreev (parts);
-    seaf_repo_unref (repo);
+    evhtp_send_reply (req, EVHTP_RES_OK);
 }
 
 static void
@@ -1116,6 +1517,15 @@ get_block_cb (evhtp_request_t *req, void *arg)
         goto out;
     }
 
+    /* On TLS connections the content has to be encrypted in user space
+     * anyway, so only plain connections take the zero-copy path.
+     */
+    if (req->htp->ssl_cfg == NULL &&
+        seaf_block_manager_support_block_fd (seaf->block_mgr)) {
+        send_block_file (req, store_id, block_id);
+        goto out;
+    }
+
     blk_meta = seaf_block_manager_stat_block (seaf->block_mgr,
                                               store_id, 1, block_id);
     if (blk_meta == NULL) {
@@ -1348,6 +1758,271 @@ post_check_block_cb (evhtp_request_t *req, void *arg)
    post_check_exist_cb (req, arg, CHECK_BLOCK_EXIST);
 }
 
+static void
+check_exist_batch_unref (CheckExistBatch *batch)
+{
+    if (!g_atomic_int_dec_and_test (&batch->ref))
+        return;
+
+    if (batch->done_ev)
+        event_free (batch->done_ev);
+    pipeclose (batch->pipe_fds[0]);
+    pipeclose (batch->pipe_fds[1]);
+    g_free (batch->ids);
+    g_free (batch->exists);
+    g_free (batch);
+}
+
+/*
+ * Blocks are checked with one call per slice. Fs objects have no batch
+ * interface in the object backends, they're checked one by one, so for
+ * fs objects the slices only run in parallel.
+ */
+static void
+check_exist_slice (CheckExistBatch *batch, int start, int n)
+{
+    char obj_id[41];
+    int i;
+
+    if (batch->type == CHECK_BLOCK_EXIST) {
+        seaf_block_manager_blocks_exist (seaf->block_mgr, batch->store_id, 1,
+                                         batch->ids + start * 20, n,
+                                         batch->exists + start);
+        return;
+    }
+
+    for (i = start; i < start + n; ++i) {
+        rawdata_to_hex (batch->ids + i * 20, obj_id, 20);
+        batch->exists[i] = seaf_fs_manager_object_exists (seaf->fs_mgr,
+                                                          batch->store_id, 1,
+                                                          obj_id);
+    }
+}
+
+static void
+check_exist_thread (gpointer data, gpointer user_data)
+{
+    CheckExistSlice *slice = data;
+    CheckExistBatch *batch = slice->batch;
+
+    check_exist_slice (batch, slice->start, slice->n);
+
+    if (g_atomic_int_dec_and_test (&batch->pending) &&
+        pipewrite (batch->pipe_fds[1], "x", 1) != 1)
+        seaf_warning ("Failed to notify check exist result: %s.\n",
+                      strerror(errno));
+
+    check_exist_batch_unref (batch);
+    g_free (slice);
+}
+
+/* See post_check_exist_bitmap_cb() for the format. */
+static void
+add_exist_bitmap (struct evbuffer *buf, const gboolean *exists, int n_ids)
+{
+    guint8 *bitmap;
+    int i;
+
+    bitmap = g_new0 (guint8, (n_ids + 7) / 8);
+    for (i = 0; i < n_ids; ++i) {
+        if (!exists[i])
+            bitmap[i >> 3] |= (1 << (i & 7));
+    }
+
+    evbuffer_add (buf, bitmap, (n_ids + 7) / 8);
+    g_free (bitmap);
+}
+
+static void
+check_exist_done_cb (evutil_socket_t fd, short what, void *ctx)
+{
+    CheckExistBatch *batch = ctx;
+    evhtp_request_t *req = batch->req;
+    struct bufferevent *bev = evhtp_request_get_bev (req);
+
+    add_exist_bitmap (bufferevent_get_output (bev),
+                      batch->exists, batch->n_ids);
+
+    /* Recover evhtp's callbacks */
+    bev->readcb = batch->saved_read_cb;
+    bev->writecb = batch->saved_write_cb;
+    bev->errorcb = batch->saved_event_cb;
+    bev->cbarg = batch->saved_cb_arg;
+
+    /* Resume reading incomming requests. */
+    evhtp_request_resume (req);
+
+    evhtp_send_reply_end (req);
+
+    batch->req = NULL;
+    check_exist_batch_unref (batch);
+}
+
+static void
+check_exist_event_cb (struct bufferevent *bev, short events, void *ctx)
+{
+    CheckExistBatch *batch = ctx;
+
+    batch->saved_event_cb (bev, events, batch->saved_cb_arg);
+
+    /* The slices still being checked hold their own references. */
+    event_del (batch->done_ev);
+    batch->req = NULL;
+    check_exist_batch_unref (batch);
+}
+
+/*
+ * Check the ids in the thread pool, without blocking the evhtp thread.
+ * The headers are sent now, the bitmap when all slices are checked.
+ */
+static int
+start_check_exist_reply (evhtp_request_t *req, CheckExistType type,
+                         const char *store_id, const guint8 *ids, int n_ids)
+{
+    CheckExistBatch *batch;
+    CheckExistSlice *slice;
+    struct bufferevent *bev = evhtp_request_get_bev (req);
+    char len_str[32];
+    int start;
+
+    batch = g_new0 (CheckExistBatch, 1);
+    if (ccnet_pipe (batch->pipe_fds) < 0) {
+        seaf_warning ("Failed to create pipe: %s.\n", strerror(errno));
+        g_free (batch);
+        return -1;
+    }
+    evutil_make_socket_nonblocking (batch->pipe_fds[0]);
+    evutil_make_socket_nonblocking (batch->pipe_fds[1]);
+
+    batch->ref = 1;
+    batch->type = type;
+    memcpy (batch->store_id, store_id, 36);
+    batch->ids = g_memdup (ids, n_ids * 20);
+    batch->n_ids = n_ids;
+    batch->exists = g_new0 (gboolean, n_ids);
+    batch->req = req;
+    batch->done_ev = event_new (bev->ev_base, batch->pipe_fds[0], EV_READ,
+                                check_exist_done_cb, batch);
+
+    snprintf (len_str, sizeof(len_str), "%d", (n_ids + 7) / 8);
+    evhtp_headers_add_header (req->headers_out,
+                              evhtp_header_new ("Content-Length",
+                                                len_str, 1, 1));
+
+    /* We need to overwrite evhtp's callback functions to send the
+     * bitmap when it's ready.
+     */
+    batch->saved_read_cb = bev->readcb;
+    batch->saved_write_cb = bev->writecb;
+    batch->saved_event_cb = bev->errorcb;
+    batch->saved_cb_arg = bev->cbarg;
+    bufferevent_setcb (bev, NULL, NULL, check_exist_event_cb, batch);
+
+    /* Block any new request from this connection before finish
+     * handling this request.
+     */
+    evhtp_request_pause (req);
+
+    evhtp_send_reply_start (req, EVHTP_RES_OK);
+
+    event_add (batch->done_ev, NULL);
+
+    batch->pending = (n_ids + CHECK_EXIST_SLICE_SIZE - 1) / CHECK_EXIST_SLICE_SIZE;
+    for (start = 0; start < n_ids; start += CHECK_EXIST_SLICE_SIZE) {
+        slice = g_new0 (CheckExistSlice, 1);
+        slice->batch = batch;
+        slice->start = start;
+        slice->n = MIN (CHECK_EXIST_SLICE_SIZE, n_ids - start);
+        g_atomic_int_inc (&batch->ref);
+        g_thread_pool_push (check_exist_pool, slice, NULL);
+    }
+
+    return 0;
+}
+
+/*
+ * Binary variant of check-fs and check-blocks, for long id lists.
+ * The request body is a sequence of raw 20-byte object ids. The response
+ * is a bitmap with one bit for each id in the request, in the same order.
+ * Bit i (bit i % 8 of byte i / 8) is set if the i-th object doesn't exist
+ * on the server and needs to be uploaded.
+ */
+static void
+post_check_exist_bitmap_cb (evhtp_request_t *req, void *arg, CheckExistType type)
+{
+    HttpServer *htp_server = arg;
+    char **parts = g_strsplit (req->uri->path->full + 1, "/", 0);
+    char *repo_id = parts[1];
+    char *store_id = NULL;
+    gboolean *exists = NULL;
+    const guint8 *ids;
+    int n_ids;
+
+    int token_status = validate_token (htp_server, req, repo_id, NULL);
+    if (token_status != EVHTP_RES_OK) {
+        evhtp_send_reply (req, token_status);
+        goto out;
+    }
+
+    store_id = get_repo_store_id (htp_server, repo_id);
+    if (!store_id) {
+        evhtp_send_reply (req, EVHTP_RES_SERVERR);
+        goto out;
+    }
+
+    size_t list_len = evbuffer_get_length (req->buffer_in);
+    if (list_len == 0 || list_len % 20 != 0) {
+        evhtp_send_reply (req, EVHTP_RES_BADREQ);
+        goto out;
+    }
+    if (list_len > CHECK_EXIST_MAX_IDS * 20) {
+        evhtp_send_reply (req, EVHTP_RES_ENTOOLARGE);
+        goto out;
+    }
+    n_ids = list_len / 20;
+
+    ids = evbuffer_pullup (req->buffer_in, -1);
+
+    evhtp_headers_add_header (req->headers_out,
+                              evhtp_header_new ("Content-Type",
+                                                "application/octet-stream", 1, 1));
+
+    if (n_ids > CHECK_EXIST_SLICE_SIZE &&
+        start_check_exist_reply (req, type, store_id, ids, n_ids) == 0)
+        goto out;
+
+    /* Short lists are checked right away. */
+    CheckExistBatch batch;
+    memset (&batch, 0, sizeof(batch));
+    batch.type = type;
+    memcpy (batch.store_id, store_id, 36);
+    batch.ids = (guint8 *)ids;
+    batch.n_ids = n_ids;
+    exists = g_new0 (gboolean, n_ids);
+    batch.exists = exists;
+    check_exist_slice (&batch, 0, n_ids);
+
+    add_exist_bitmap (req->buffer_out, exists, n_ids);
+    evhtp_send_reply (req, EVHTP_RES_OK);
+
+out:
+    g_free (exists);
+    g_free (store_id);
+    g_strfreev (parts);
+}
+
+static void
+post_check_fs_bitmap_cb (evhtp_request_t *req, void *arg)
+{
+   post_check_exist_bitmap_cb (req, arg, CHECK_FS_EXIST);
+}
+
+static void
+post_check_block_bitmap_cb (evhtp_request_t *req, void *arg)
+{
+   post_check_exist_bitmap_cb (req, arg, CHECK_BLOCK_EXIST);
+}
+
 static void
 post_recv_fs_cb (evhtp_request_t *req, void *arg)
 {
@@ -1532,9 +2207,186 @@ out:
     g_strfreev (parts);
 }
 
+#define MAX_BLOCK_PACK_SIZE (8 << 20) /* 8MB */
+#define MAX_BLOCK_PACK_N 256
+
+static gboolean
+is_block_id_valid (const char *block_id)
+{
+    int i;
+
+    if (!block_id || strlen (block_id) != 40)
+        return FALSE;
+    for (i = 0; i < 40; ++i)
+        if (!g_ascii_isxdigit (block_id[i]))
+            return FALSE;
+    return TRUE;
+}
+
+static void
+add_block_header (struct evbuffer *buf, const char *block_id, gint64 size)
+{
+    guint32 size_net = htonl ((guint32)size);
+
+    evbuffer_add (buf, block_id, 40);
+    evbuffer_add (buf, &size_net, 4);
+}
+
+/*
+ * Append a block frame to @buf. With @zero_copy the content is queued as
+ * a file segment, otherwise it's read into memory.
+ */
+static int
+pack_block (struct evbuffer *buf, const char *store_id,
+            const char *block_id, gboolean zero_copy, gint64 *size)
+{
+    gint64 offset;
+    int fd;
+
+    if (zero_copy) {
+        fd = seaf_block_manager_open_block_fd (seaf->block_mgr,
+                                               store_id, 1, block_id,
+                                               &offset, size);
+        if (fd < 0)
+            return -1;
+        add_block_header (buf, block_id, *size);
+        if (*size == 0) {
+            close (fd);
+            return 0;
+        }
+        /* The fd is owned by the buffer from now on. */
+        return evbuffer_add_file (buf, fd, offset, *size);
+    }
+
+    BlockMetadata *blk_meta;
+    BlockHandle *handle;
+    char *content;
+    int rsize;
+
+    blk_meta = seaf_block_manager_stat_block (seaf->block_mgr,
+                                              store_id, 1, block_id);
+    if (!blk_meta)
+        return -1;
+    *size = blk_meta->size;
+    g_free (blk_meta);
+
+    handle = seaf_block_manager_open_block (seaf->block_mgr,
+                                            store_id, 1, block_id, BLOCK_READ);
+    if (!handle)
+        return -1;
+
+    content = g_new (char, *size);
+    rsize = seaf_block_manager_read_block (seaf->block_mgr, handle,
+                                           content, *size);
+    seaf_block_manager_close_block (seaf->block_mgr, handle);
+    seaf_block_manager_block_handle_free (seaf->block_mgr, handle);
+
+    if (rsize != *size) {
+        g_free (content);
+        return -1;
+    }
+
+    add_block_header (buf, block_id, *size);
+    evbuffer_add (buf, content, *size);
+    g_free (content);
+    return 0;
+}
+
+/*
+ * Send the blocks in the posted id list in one response. Each block is
+ * framed the same way as in pack-fs: 40 bytes block id, 4 bytes size in
+ * network order, then the content. Not all blocks may be returned, the
+ * client requests the remaining ones again.
+ */
+static void
+post_pack_blocks_cb (evhtp_request_t *req, void *arg)
+{
+    HttpServer *htp_server = arg;
+    char **parts = g_strsplit (req->uri->path->full + 1, "/", 0);
+    const char *repo_id = parts[1];
+    char *store_id = NULL;
+    json_t *block_id_array = NULL;
+
+    int token_status = validate_token (htp_server, req, repo_id, NULL);
+    if (token_status != EVHTP_RES_OK) {
+        evhtp_send_reply (req, token_status);
+        goto out;
+    }
+
+    store_id = get_repo_store_id (htp_server, repo_id);
+    if (!store_id) {
+        evhtp_send_reply (req, EVHTP_RES_SERVERR);
+        goto out;
+    }
+
+    int block_id_list_len = evbuffer_get_length (req->buffer_in);
+    if (block_id_list_len == 0) {
+        evhtp_send_reply (req, EVHTP_RES_BADREQ);
+        goto out;
+    }
+
+    char *block_id_list = g_new0 (char, block_id_list_len);
+    json_error_t jerror;
+    evbuffer_remove (req->buffer_in, block_id_list, block_id_list_len);
+    block_id_array = json_loadb (block_id_list, block_id_list_len, 0, &jerror);
+    g_free (block_id_list);
+
+    if (!block_id_array || !json_is_array (block_id_array)) {
+        seaf_warning ("Failed to load block id list: %s.\n",
+                      block_id_array ? "not an array" : jerror.text);
+        evhtp_send_reply (req, EVHTP_RES_BADREQ);
+        goto out;
+    }
+
+    gboolean zero_copy = (req->htp->ssl_cfg == NULL &&
+                          seaf_block_manager_support_block_fd (seaf->block_mgr));
+    const char *block_id;
+    gint64 size;
+    gint64 total_size = 0;
+    int array_size = json_array_size (block_id_array);
+    int i;
+
+    for (i = 0; i < array_size && i < MAX_BLOCK_PACK_N; ++i) {
+        block_id = json_string_value (json_array_get (block_id_array, i));
+        if (!is_block_id_valid (block_id)) {
+            seaf_warning ("Invalid block id %s.\n", block_id);
+            evbuffer_drain (req->buffer_out,
+                            evbuffer_get_length (req->buffer_out));
+            evhtp_send_reply (req, EVHTP_RES_BADREQ);
+            goto out;
+        }
+
+        if (pack_block (req->buffer_out, store_id,
+                        block_id, zero_copy, &size) < 0) {
+            seaf_warning ("Failed to pack block %.8s:%s.\n", store_id, block_id);
+            evbuffer_drain (req->buffer_out,
+                            evbuffer_get_length (req->buffer_out));
+            evhtp_send_reply (req, EVHTP_RES_SERVERR);
+            goto out;
+        }
+
+        total_size += size;
+        if (total_size >= MAX_BLOCK_PACK_SIZE)
+            break;
+    }
+
+    evhtp_send_reply (req, EVHTP_RES_OK);
+
+out:
+    if (block_id_array)
+        json_decref (block_id_array);
+    g_free (store_id);
+    g_strfreev (parts);
+}
+
 static void
 http_request_init (HttpServer *htp_server)
 {
+    check_exist_pool = g_thread_pool_new (check_exist_thread, NULL,
+                                          CHECK_EXIST_THREADS, FALSE, NULL);
+    fs_id_list_pool = g_thread_pool_new (calc_fs_id_list_thread, NULL,
+                                         FS_ID_LIST_THREADS, FALSE, NULL);
+
     evhtp_set_cb (htp_server->evhtp,
                   GET_PROTO_PATH, get_protocol_cb,
                   NULL);
@@ -1571,6 +2423,14 @@ http_request_init (HttpServer *htp_server)
                         POST_CHECK_BLOCK_REGEX, post_check_block_cb,
                         htp_server);
 
+    evhtp_set_regex_cb (htp_server->evhtp,
+                        POST_CHECK_FS_BITMAP_REGEX, post_check_fs_bitmap_cb,
+                        htp_server);
+
+    evhtp_set_regex_cb (htp_server->evhtp,
+                        POST_CHECK_BLOCK_BITMAP_REGEX, post_check_block_bitmap_cb,
+                        htp_server);
+
     evhtp_set_regex_cb (htp_server->evhtp,
                         POST_RECV_FS_REGEX, post_recv_fs_cb,
                         htp_server);
@@ -1579,80 +2439,18 @@ http_request_init (HttpServer *htp_server)
                         POST_PACK_FS_REGEX, post_pack_fs_cb,
                         htp_server);
 
+    evhtp_set_regex_cb (htp_server->evhtp,
+                        POST_PACK_BLOCKS_REGEX, post_pack_blocks_cb,
+                        htp_server);
+
     /* Web access file */
     access_file_init (htp_server->evhtp);
 
     /* Web upload file */
     upload_file_init (htp_server);
-}
 
-static void
-token_cache_value_free (gpointer data)
-{
-    TokenInfo *token_info = (TokenInfo *)data;
-    if (token_info != NULL) {
-        g_free (token_info->repo_id);
-        g_free (token_info->email);
-        g_free (token_info);
-    }
-}
-
-static gboolean
-is_token_expire (gpointer key, gpointer value, gpointer arg)
-{
-    TokenInfo *token_info = (TokenInfo *)value;
-
-    if(token_info && token_info->expire_time <= (gint64)time(NULL)) {
-        return TRUE;
-    }
-
-    return FALSE;
-}
-
-static void
-perm_cache_value_free (gpointer data)
-{
-    PermInfo *perm_info = data;
-    g_free (perm_info->perm);
-    g_free (perm_info);
-}
-
-static gboolean
-is_perm_expire (gpointer key, gpointer value, gpointer arg)
-{
-    PermInfo *perm_info = (PermInfo *)value;
-
-    if(perm_info && perm_info->expire_time <= (gint64)time(NULL)) {
-        return TRUE;
-    }
-
-    return FALSE;
-}
-
-static gboolean
-is_vir_repo_info_expire (gpointer key, gpointer value, gpointer arg)
-{
-    VirRepoInfo *vinfo = (VirRepoInfo *)value;
-
-    if(vinfo && vinfo->expire_time <= (gint64)time(NULL)) {
-        return TRUE;
-    }
-
-    return FALSE;
-}
-
-static void
-free_vir_repo_info (gpointer data)
-{
-    if (!data)
-        return;
-
-    VirRepoInfo *vinfo = data;
-
-    if (vinfo->store_id)
-        g_free (vinfo->store_id);
-
-    g_free (vinfo);
+    /* Resumable upload */
+    upload_session_init (htp_server);
 }
 
 static void
@@ -1660,18 +2458,11 @@ remove_expire_cache_cb (evutil_socket_t sock, short type, void *data)
 {
     HttpServer *htp_server = data;
 
-    pthread_mutex_lock (&htp_server->token_cache_lock);
-    g_hash_table_foreach_remove (htp_server->token_cache, is_token_expire, NULL);
-    pthread_mutex_unlock (&htp_server->token_cache_lock);
-
-    pthread_mutex_lock (&htp_server->perm_cache_lock);
-    g_hash_table_foreach_remove (htp_server->perm_cache, is_perm_expire, NULL);
-    pthread_mutex_unlock (&htp_server->perm_cache_lock);
+    ttl_cache_remove_expired (htp_server->token_cache);
+    ttl_cache_remove_expired (htp_server->perm_cache);
+    ttl_cache_remove_expired (htp_server->vir_repo_info_cache);
 
-    pthread_mutex_lock (&htp_server->vir_repo_info_cache_lock);
-    g_hash_table_foreach_remove (htp_server->vir_repo_info_cache,
-                                 is_vir_repo_info_expire, NULL);
-    pthread_mutex_unlock (&htp_server->vir_repo_info_cache_lock);
+    upload_session_remove_expired ();
 }
 
 static void *
@@ -1692,14 +2483,16 @@ http_server_run (void *arg)
 
     http_request_init (htp_server);
 
-    evhtp_use_threads (htp_server->evhtp, NULL, DEFAULT_THREADS, NULL);
+    seaf_message ("Starting fileserver with %d worker threads.\n",
+                  htp_server->worker_threads);
+    evhtp_use_threads (htp_server->evhtp, NULL, htp_server->worker_threads, NULL);
 
     struct timeval tv;
     tv.tv_sec = CLEANING_INTERVAL_SEC;
     tv.tv_usec = 0;
-    htp_server->reap_timer = evtimer_new (htp_server->evbase,
-                                          remove_expire_cache_cb,
-                                          htp_server);
+    htp_server->reap_timer = event_new (htp_server->evbase, -1, EV_PERSIST,
+                                        remove_expire_cache_cb,
+                                        htp_server);
     evtimer_add (htp_server->reap_timer, &tv);
 
     event_base_loop (htp_server->evbase, 0);
@@ -1721,20 +2514,29 @@ seaf_http_server_new (struct _SeafileSession *session)
     session->http_server = http_server;
     http_server->seaf_session = session;
 
-    http_server->token_cache = g_hash_table_new_full (g_str_hash, g_str_equal,
-                                                      g_free, token_cache_value_free);
-    pthread_mutex_init (&http_server->token_cache_lock, NULL);
+    http_server->token_cache = ttl_cache_new (http_server->token_cache_size,
+                                              TOKEN_EXPIRE_TIME, FALSE);
+    http_server->perm_cache = ttl_cache_new (http_server->perm_cache_size,
+                                             PERM_EXPIRE_TIME, FALSE);
+    http_server->vir_repo_info_cache = ttl_cache_new (http_server->vir_repo_info_cache_size,
+                                                      VIRINFO_EXPIRE_TIME, TRUE);
 
-    http_server->perm_cache = g_hash_table_new_full (g_str_hash, g_str_equal,
-                                                     g_free, perm_cache_value_free);
-    pthread_mutex_init (&http_server->perm_cache_lock, NULL);
-
-    http_server->vir_repo_info_cache = g_hash_table_new_full (g_str_hash, g_str_equal,
-                                                              g_free, free_vir_repo_info);
-    pthread_mutex_init (&http_server->vir_repo_info_cache_lock, NULL);
+    http_server->fs_id_list_cache = g_hash_table_new_full (g_str_hash, g_str_equal,
+                                                           NULL,
+                                                           (GDestroyNotify)fs_id_list_unref);
+    http_server->fs_id_list_lru = g_queue_new ();
+    pthread_mutex_init (&http_server->fs_id_list_cache_lock, NULL);
 
     http_server->http_temp_dir = g_build_filename (session->seaf_dir, "httptemp", NULL);
 
+    if (http_server->zip_cache_size > 0) {
+        char *zip_cache_dir = g_build_filename (http_server->http_temp_dir,
+                                                "zip-cache", NULL);
+        if (pack_dir_cache_init (zip_cache_dir, http_server->zip_cache_size) < 0)
+            seaf_warning ("Failed to init zip cache, archives are not cached.\n");
+        g_free (zip_cache_dir);
+    }
+
     return http_server;
 }
 
@@ -1751,14 +2553,12 @@ void seaf_http_server_release (HttpServer *htp_server)
         if (htp_server->evbase) {
             event_base_free (htp_server->evbase);
         }
-        if (htp_server->token_cache) {
-            g_hash_table_destroy (htp_server->token_cache);
-        }
-        if (htp_server->perm_cache) {
-            g_hash_table_destroy (htp_server->perm_cache);
-        }
-        if (htp_server->vir_repo_info_cache) {
-            g_hash_table_destroy (htp_server->vir_repo_info_cache);
+        ttl_cache_free (htp_server->token_cache);
+        ttl_cache_free (htp_server->perm_cache);
+        ttl_cache_free (htp_server->vir_repo_info_cache);
+        if (htp_server->fs_id_list_cache) {
+            g_queue_free (htp_server->fs_id_list_lru);
+            g_hash_table_destroy (htp_server->fs_id_list_cache);
         }
         if (htp_server->reap_timer) {
             event_del (htp_server->reap_timer);
@@ -19,14 +19,17 @@ typedef struct HttpServer {
     evhtp_t *evhtp;
     pthread_t thread_id;
 
-    GHashTable *token_cache;
-    pthread_mutex_t token_cache_lock; /* token -> username */
-
-    GHashTable *perm_cache;
-    pthread_mutex_t perm_cache_lock; /* repo_id:username -> permission */
-
-    GHashTable *vir_repo_info_cache;
-    pthread_mutex_t vir_repo_info_cache_lock;
+    struct TTLCache *token_cache; /* token -> username */
+    struct TTLCache *perm_cache; /* repo_id:username -> permission */
+    struct TTLCache *vir_repo_info_cache; /* repo_id -> store_id */
+    int token_cache_size;
+    int perm_cache_size;
+    int vir_repo_info_cache_size;
+
+    GHashTable *fs_id_list_cache; /* store_id:root1:root2 -> FsIdList */
+    GQueue *fs_id_list_lru;
+    gint64 fs_id_list_cache_size;
+    pthread_mutex_t fs_id_list_cache_lock;
 
     uint32_t cevent_id;         /* Used for sending activity events. */
 
@@ -38,6 +41,8 @@ typedef struct HttpServer {
     char *windows_encoding;
     gint64 max_upload_size;
     gint64 max_download_dir_size;
+    gint64 zip_cache_size;
+    int worker_threads;
 } HttpServer;
 
 HttpServer *
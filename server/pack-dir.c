@@ -16,6 +16,16 @@
 #include <archive.h>
 #include <archive_entry.h>
 #include <iconv.h>
+#include <pthread.h>
+#include <fcntl.h>
+
+#if defined(__FreeBSD__) || defined(__NetBSD__) || defined(__OpenBSD__)
+#include <event2/util.h>
+#else
+#include <event.h>
+#endif
+
+#include "pack-dir.h"
 
 #ifdef WIN32
 #define S_IFLNK    0120000 /* Symbolic link */
@@ -23,16 +33,141 @@
 #endif
 
 
+/*
+ * An archive being generated or already generated. The packing thread
+ * writes the archive to the pipes of all streams reading it, which share
+ * one key-less entry. Cached archives also have an entry in the cache.
+ */
+typedef struct ArchiveEntry {
+    /* NULL for the entry of the pipes. */
+    char *key;
+    /* Cache file, the temp file while the archive is being generated. */
+    char *path;
+    gint64 size;                /* bytes written so far */
+    gboolean finished;
+    gboolean success;
+    int ref_count;
+    GList *lru_link;            /* only for finished cached archives */
+
+    /* While a cached archive is being generated: the entry of its pipes,
+     * and write ends of the pipes of requests joining the build.
+     */
+    struct ArchiveEntry *pipe_entry;
+    GList *joiners;
+} ArchiveEntry;
+
+/*
+ * Cache of finished archives on disk. Archives are keyed by everything
+ * that goes into them, so a cached archive never changes. Since cache
+ * files can be unlinked while being read, entries are evicted regardless
+ * of readers.
+ */
+typedef struct ArchiveCache {
+    char *dir;
+    gint64 max_size;
+    /* Including the bytes of archives being generated. */
+    gint64 size;
+    /* key -> ArchiveEntry, including archives being generated. */
+    GHashTable *entries;
+    /* Finished archives, the most recently used first. */
+    GQueue *lru;
+} ArchiveCache;
+
+/* Protects the cache and the state of all archive entries. */
+static pthread_mutex_t cache_lock = PTHREAD_MUTEX_INITIALIZER;
+static ArchiveCache *cache;
+
+struct PackDirStream {
+    ArchiveEntry *entry;
+    /* Read end of the pipe, or the cache file of a finished archive. */
+    int fd;
+    gint64 pos;
+};
+
+typedef struct PackJob {
+    char *store_id;
+    int repo_version;
+    char *dirname;
+    char *root_id;
+    SeafileCrypt *crypt;
+    gboolean is_windows;
+    gint64 max_size;
+
+    /* Shared by the streams reading the pipes. */
+    ArchiveEntry *entry;
+    /* Write ends of the pipes. */
+    GList *fds;
+
+    /* The cache entry the archive is copied to, NULL if it's not cached. */
+    ArchiveEntry *cached;
+    /* The temp cache file, and the bytes written to it. */
+    int cache_fd;
+    gint64 cache_written;
+} PackJob;
+
+/* Number of blocks read ahead while packing a directory. */
+#define READ_AHEAD_BLOCKS 4
+
+/* Threads shared by all packing jobs for reading blocks. */
+#define BLOCK_READER_THREADS 16
+
+/* Max number of archives generated at the same time. Later jobs wait in
+ * the queue of the packing thread pool.
+ */
+#define PACK_THREADS 16
+
+typedef struct BlockReadAhead BlockReadAhead;
+
+/* A block being read or already read by a reader thread. */
+typedef struct BlockFetch {
+    BlockReadAhead *ra;
+    char blk_id[41];
+    /* Decrypted content if the repo is encrypted. */
+    char *data;
+    int len;
+    gboolean done;
+    gboolean success;
+} BlockFetch;
+
+/*
+ * Blocks of the files to be archived are read, and decrypted, by reader
+ * threads up to READ_AHEAD_BLOCKS ahead of the one being written into the
+ * archive. Files are queued in the order they're archived.
+ */
+struct BlockReadAhead {
+    char store_id[37];
+    int version;
+    SeafileCrypt *crypt;
+
+    /* Files queued for archiving, and ids of their blocks not read yet. */
+    GQueue *files;
+    GQueue *blk_ids;
+    /* Blocks being read or already read, in order. */
+    GQueue *fetches;
+
+    pthread_mutex_t lock;
+    pthread_cond_t cond;
+};
+
 typedef struct {
     struct archive *a;
-    SeafileCrypt *crypt;
     const char *top_dir_name;
     gboolean is_windows;
     time_t mtime;
     char store_id[37];
     int repo_version;
+    BlockReadAhead *ra;
+    /* Size of the files archived so far, packing fails above max_size. */
+    gint64 total_size;
+    gint64 max_size;
 } PackDirData;
 
+static GThreadPool *block_reader_pool;
+static pthread_once_t block_reader_once = PTHREAD_ONCE_INIT;
+
+static GThreadPool *pack_pool;
+static pthread_once_t pack_pool_once = PTHREAD_ONCE_INIT;
+
 static char *
 do_iconv (char *fromcode, char *tocode, char *in)
 {
@@ -62,39 +197,262 @@ do_iconv (char *fromcode, char *tocode, char *in)
     return g_strndup(out, outlen);
 }
 
+static void
+read_block_thread (gpointer vdata, gpointer user_data)
+{
+    BlockFetch *fetch = vdata;
+    BlockReadAhead *ra = fetch->ra;
+    BlockHandle *handle = NULL;
+    BlockMetadata *bmd;
+    char *data = NULL, *dec_out = NULL;
+    int len = 0, dec_out_len = -1;
+    gboolean success = FALSE;
+
+    handle = seaf_block_manager_open_block (seaf->block_mgr,
+                                            ra->store_id, ra->version,
+                                            fetch->blk_id, BLOCK_READ);
+    if (!handle) {
+        seaf_warning ("Failed to open block %s\n", fetch->blk_id);
+        goto out;
+    }
+
+    bmd = seaf_block_manager_stat_block_by_handle (seaf->block_mgr, handle);
+    if (!bmd) {
+        seaf_warning ("Failed to stat block %s\n", fetch->blk_id);
+        goto out;
+    }
+    len = bmd->size;
+    g_free (bmd);
+
+    data = g_malloc (len);
+    if (seaf_block_manager_read_block (seaf->block_mgr, handle,
+                                       data, len) != len) {
+        seaf_warning ("failed to read block %s\n", fetch->blk_id);
+        goto out;
+    }
+
+    if (ra->crypt) {
+        if (seafile_decrypt (&dec_out, &dec_out_len, data, len, ra->crypt) < 0) {
+            seaf_warning ("Decrypt block %s failed.\n", fetch->blk_id);
+            goto out;
+        }
+        g_free (data);
+        data = dec_out;
+        len = dec_out_len;
+    }
+
+    success = TRUE;
+
+out:
+    if (handle) {
+        seaf_block_manager_close_block (seaf->block_mgr, handle);
+        seaf_block_manager_block_handle_free (seaf->block_mgr, handle);
+    }
+    if (!success) {
+        g_free (data);
+        data = NULL;
+        len = 0;
+    }
+
+    pthread_mutex_lock (&ra->lock);
+    fetch->data = data;
+    fetch->len = len;
+    fetch->success = success;
+    fetch->done = TRUE;
+    pthread_cond_broadcast (&ra->cond);
+    pthread_mutex_unlock (&ra->lock);
+}
+
+static void
+create_block_reader_pool ()
+{
+    block_reader_pool = g_thread_pool_new (read_block_thread, NULL,
+                                           BLOCK_READER_THREADS, FALSE, NULL);
+}
+
+static BlockReadAhead *
+block_read_ahead_new (const char *store_id, int version, SeafileCrypt *crypt)
+{
+    BlockReadAhead *ra = g_new0 (BlockReadAhead, 1);
+
+    pthread_once (&block_reader_once, create_block_reader_pool);
+
+    memcpy (ra->store_id, store_id, 36);
+    ra->version = version;
+    ra->crypt = crypt;
+    ra->files = g_queue_new ();
+    ra->blk_ids = g_queue_new ();
+    ra->fetches = g_queue_new ();
+    pthread_mutex_init (&ra->lock, NULL);
+    pthread_cond_init (&ra->cond, NULL);
+
+    return ra;
+}
+
+/* Start reading queued blocks until READ_AHEAD_BLOCKS are in flight. */
+static void
+block_read_ahead_fill (BlockReadAhead *ra)
+{
+    BlockFetch *fetch;
+    char *blk_id;
+
+    while (g_queue_get_length (ra->fetches) < READ_AHEAD_BLOCKS &&
+           !g_queue_is_empty (ra->blk_ids)) {
+        blk_id = g_queue_pop_head (ra->blk_ids);
+
+        fetch = g_new0 (BlockFetch, 1);
+        fetch->ra = ra;
+        memcpy (fetch->blk_id, blk_id, 41);
+        g_queue_push_tail (ra->fetches, fetch);
+
+        g_thread_pool_push (block_reader_pool, fetch, NULL);
+    }
+}
+
+/* Queue a file to be archived. Takes over @file. */
+static void
+block_read_ahead_add_file (BlockReadAhead *ra, Seafile *file)
+{
+    int i;
+
+    g_queue_push_tail (ra->files, file);
+    for (i = 0; i < file->n_blocks; ++i)
+        g_queue_push_tail (ra->blk_ids, file->blk_sha1s[i]);
+
+    block_read_ahead_fill (ra);
+}
+
+/* Get the next queued file. The caller should unref it. */
+static Seafile *
+block_read_ahead_next_file (BlockReadAhead *ra)
+{
+    return g_queue_pop_head (ra->files);
+}
+
+/* Wait for the next block. Returns a fetch to be freed by the caller. */
+static BlockFetch *
+block_read_ahead_next_block (BlockReadAhead *ra)
+{
+    BlockFetch *fetch;
+
+    fetch = g_queue_pop_head (ra->fetches);
+    if (!fetch)
+        return NULL;
+
+    pthread_mutex_lock (&ra->lock);
+    while (!fetch->done)
+        pthread_cond_wait (&ra->cond, &ra->lock);
+    pthread_mutex_unlock (&ra->lock);
+
+    block_read_ahead_fill (ra);
+
+    return fetch;
+}
+
+static void
+block_fetch_free (BlockFetch *fetch)
+{
+    g_free (fetch->data);
+    g_free (fetch);
+}
+
+static void
+block_read_ahead_free (BlockReadAhead *ra)
+{
+    BlockFetch *fetch;
+    Seafile *file;
+
+    /* Fetches in reader threads refer to @ra. */
+    g_queue_clear (ra->blk_ids);
+    while ((fetch = block_read_ahead_next_block (ra)) != NULL)
+        block_fetch_free (fetch);
+
+    /* Block ids point into the files, free them last. */
+    while ((file = g_queue_pop_head (ra->files)) != NULL)
+        seafile_unref (file);
+
+    g_queue_free (ra->files);
+    g_queue_free (ra->blk_ids);
+    g_queue_free (ra->fetches);
+    pthread_mutex_destroy (&ra->lock);
+    pthread_cond_destroy (&ra->cond);
+    g_free (ra);
+}
+
+static gboolean
+is_archived_file (SeafDirent *dent)
+{
+    if (S_ISREG(dent->mode))
+        return TRUE;
+
+    /* Symlink in zip arhive is not supported in earlier version
+     * of libarchive */
+    if (S_ISLNK(dent->mode) && archive_version_number() >= 3000001)
+        return TRUE;
+
+    return FALSE;
+}
+
+/* Queue @ptr and the files following it, up to the next sub-dir. */
+static int
+queue_files (PackDirData *data, GList *ptr)
+{
+    SeafDirent *dent;
+    Seafile *file;
+
+    for (; ptr; ptr = ptr->next) {
+        dent = ptr->data;
+        if (S_ISDIR(dent->mode))
+            break;
+        if (!is_archived_file (dent))
+            continue;
+
+        file = seaf_fs_manager_get_seafile (seaf->fs_mgr,
+                                            data->store_id, data->repo_version,
+                                            dent->id);
+        if (!file) {
+            seaf_warning ("Failed to get file %s\n", dent->id);
+            return -1;
+        }
+        block_read_ahead_add_file (data->ra, file);
+    }
+
+    return 0;
+}
+
+/* The file of @dent should be the next one queued for read ahead. */
 static int
 add_file_to_archive (PackDirData *data,
                      const char *parent_dir,
                      SeafDirent *dent)
 {
     struct archive *a = data->a;
-    struct SeafileCrypt *crypt = data->crypt;
     gboolean is_windows = data->is_windows;
     const char *top_dir_name = data->top_dir_name;
     
     struct archive_entry *entry = NULL;
     Seafile *file = NULL;
     char *pathname = NULL;
-    char buf[64 * 1024];
     int len = 0;
     int n = 0;
     int idx = 0;
-    BlockHandle *handle = NULL;
-    BlockMetadata *bmd = NULL;
-    char *blk_id = NULL;
-    uint32_t remain = 0;
-    EVP_CIPHER_CTX ctx;
-    gboolean enc_init = FALSE;
-    char *dec_out = NULL;
-    int dec_out_len = -1;
+    BlockFetch *fetch = NULL;
     int ret = 0;
 
     pathname = g_build_filename (top_dir_name, parent_dir, dent->name, NULL);
 
-    file = seaf_fs_manager_get_seafile (seaf->fs_mgr,
-                                        data->store_id, data->repo_version,
-                                        dent->id);
-    if (!file) {
+    file = block_read_ahead_next_file (data->ra);
+    if (!file || memcmp (file->file_id, dent->id, 40) != 0) {
+        seaf_warning ("File %s is not queued for read ahead.\n", dent->id);
+        ret = -1;
+        goto out;
+    }
+
+    /* The size of the dir is not known in advance. */
+    data->total_size += file->file_size;
+    if (data->total_size > data->max_size) {
+        seaf_warning ("Dir is larger than %"G_GINT64_FORMAT" bytes, "
+                      "stop packing it.\n", data->max_size);
         ret = -1;
         goto out;
     }
@@ -131,120 +489,25 @@ add_file_to_archive (PackDirData *data,
         goto out;
     }
 
-    /* Read data of this entry block by block */
+    /* Blocks are read and decrypted by reader threads. */
     while (idx < file->n_blocks) {
-        blk_id = file->blk_sha1s[idx];
-        handle = seaf_block_manager_open_block (seaf->block_mgr,
-                                                data->store_id,
-                                                data->repo_version,
-                                                blk_id, BLOCK_READ);
-        if (!handle) {
-            seaf_warning ("Failed to open block %s\n", blk_id);
-            ret = -1;
-            goto out;
-        }
-
-        bmd = seaf_block_manager_stat_block_by_handle (seaf->block_mgr,
-                                                       handle);
-        if (!bmd) {
-            seaf_warning ("Failed to stat block %s\n", blk_id);
+        fetch = block_read_ahead_next_block (data->ra);
+        if (!fetch || !fetch->success) {
             ret = -1;
             goto out;
         }
-        remain = bmd->size;
-        g_free (bmd);
 
-        if (crypt) {
-            if (seafile_decrypt_init (&ctx, crypt->version,
-                                      crypt->key, crypt->iv) < 0) {
-                seaf_warning ("Failed to init decrypt.\n");
+        if (fetch->len > 0) {
+            len = archive_write_data (a, fetch->data, fetch->len);
+            if (len <= 0) {
+                seaf_warning ("archive_write_data error: %s\n", archive_error_string(a));
                 ret = -1;
                 goto out;
             }
-            enc_init = TRUE;
         }
 
-        while (remain != 0) {
-            n = seaf_block_manager_read_block (seaf->block_mgr, handle,
-                                               buf, sizeof(buf));
-            if (n <= 0) {
-                seaf_warning ("failed to read block %s\n", blk_id);
-                ret = -1;
-                goto out;
-            }
-            remain -= n;
-
-            /* OK, We're read some data of this block  */
-            if (crypt == NULL) {
-                /* not encrypted */
-                len = archive_write_data (a, buf, n);
-                if (len <= 0) {
-                    seaf_warning ("archive_write_data error: %s\n", archive_error_string(a));
-                    ret = -1;
-                    goto out;
-                }
-
-            } else {
-                /* an encrypted block */
-                dec_out = g_new (char, n + 16);
-                if (!dec_out) {
-                    seaf_warning ("Failed to alloc memory.\n");
-                    ret = -1;
-                    goto out;
-                }
-
-                int r = EVP_DecryptUpdate (&ctx,
-                                           (unsigned char *)dec_out,
-                                           &dec_out_len,
-                                           (unsigned char *)buf,
-                                           n);
-
-                /* EVP_DecryptUpdate returns 1 on success, 0 on failure */
-                if (r != 1) {
-                    seaf_warning ("Decrypt block %s failed.\n", blk_id);
-                    ret = -1;
-                    goto out;
-                }
-
-                if (dec_out_len > 0) {
-                    len = archive_write_data (a, dec_out, dec_out_len);
-                    if (len <= 0) {
-                        seaf_warning ("archive_write_data error: %s\n", archive_error_string(a));
-                        ret = -1;
-                        goto out;
-                    }
-                }
-
-                /* If it's the last piece of a block, call decrypt_final()
-                 * to decrypt the possible partial block. */
-                if (remain == 0) {
-                    r = EVP_DecryptFinal_ex (&ctx,
-                                             (unsigned char *)dec_out,
-                                             &dec_out_len);
-                    if (r != 1) {
-                        seaf_warning ("Decrypt block %s failed.\n", blk_id);
-                        ret = -1;
-                        goto out;
-                    }
-
-                    if (dec_out_len != 0) {
-                        len = archive_write_data (a, dec_out, dec_out_len);
-                        if (len <= 0) {
-                            seaf_warning ("archive_write_data error: %s\n", archive_error_string(a));
-                            ret = -1;
-                            goto out;
-                        }
-                    }
-                }
-
-                g_free (dec_out);
-                dec_out = NULL;
-            }
-        }
-
-        seaf_block_manager_close_block (seaf->block_mgr, handle);
-        seaf_block_manager_block_handle_free (seaf->block_mgr, handle);
-        handle = NULL;
+        block_fetch_free (fetch);
+        fetch = NULL;
 
         /* turn to next block */
         idx++;
@@ -256,13 +519,8 @@ out:
         archive_entry_free (entry);
     if (file)
         seafile_unref (file);
-    if (handle) {
-        seaf_block_manager_close_block (seaf->block_mgr, handle);
-        seaf_block_manager_block_handle_free(seaf->block_mgr, handle);
-    }
-    if (crypt != NULL && enc_init)
-        EVP_CIPHER_CTX_cleanup (&ctx);
-    g_free (dec_out);
+    if (fetch)
+        block_fetch_free (fetch);
 
     return ret;
 }
@@ -276,6 +534,8 @@ archive_dir (PackDirData *data,
     SeafDir *dir = NULL;
     SeafDirent *dent;
     GList *ptr;
+    GPtrArray *file_ids, *dir_ids;
+    gboolean queued = FALSE;
     char *subpath = NULL;
     int ret = 0;
 
@@ -287,19 +547,44 @@ archive_dir (PackDirData *data,
         goto out;
     }
 
+    /* Read objects of files and sub-dirs concurrently into the cache. */
+    file_ids = g_ptr_array_new ();
+    dir_ids = g_ptr_array_new ();
     for (ptr = dir->entries; ptr; ptr = ptr->next) {
         dent = ptr->data;
-        if (S_ISREG(dent->mode)) {
-            ret = add_file_to_archive (data, dirpath, dent);
+        if (S_ISDIR(dent->mode))
+            g_ptr_array_add (dir_ids, dent->id);
+        else if (is_archived_file (dent))
+            g_ptr_array_add (file_ids, dent->id);
+    }
+    seaf_fs_manager_prefetch_files (seaf->fs_mgr,
+                                    data->store_id, data->repo_version,
+                                    (const char **)file_ids->pdata,
+                                    file_ids->len);
+    seaf_fs_manager_prefetch_dirs (seaf->fs_mgr,
+                                   data->store_id, data->repo_version,
+                                   (const char **)dir_ids->pdata,
+                                   dir_ids->len);
+    g_ptr_array_free (file_ids, TRUE);
+    g_ptr_array_free (dir_ids, TRUE);
 
-        } else if (S_ISLNK(dent->mode)) {
-            if (archive_version_number() >= 3000001) {
-                /* Symlink in zip arhive is not supported in earlier version
-                 * of libarchive */
-                ret = add_file_to_archive (data, dirpath, dent);
+    for (ptr = dir->entries; ptr; ptr = ptr->next) {
+        dent = ptr->data;
+        if (is_archived_file (dent)) {
+            /* Files up to the next sub-dir are queued together, so that
+             * reading blocks goes on across files.
+             */
+            if (!queued) {
+                if (queue_files (data, ptr) < 0) {
+                    ret = -1;
+                    goto out;
+                }
+                queued = TRUE;
             }
+            ret = add_file_to_archive (data, dirpath, dent);
 
         } else if (S_ISDIR(dent->mode)) {
+            queued = FALSE;
             subpath = g_build_filename (dirpath, dent->name, NULL);
             ret = archive_dir (data, dent->id, subpath);
             g_free (subpath);
@@ -317,58 +602,653 @@ out:
     return ret;
 }
 
-char *pack_dir (const char *store_id,
-                int repo_version,
-                const char *dirname,
-                const char *root_id,
-                SeafileCrypt *crypt,
-                gboolean is_windows)
+static void
+archive_entry_unref (ArchiveEntry *entry)
 {
-    struct archive *a = NULL;
-    char *tmpfile_name = NULL ;
-    char *ret = NULL;
-    int fd = -1;
-    PackDirData *data = NULL;
+    if (!g_atomic_int_dec_and_test (&entry->ref_count))
+        return;
 
-    fd = g_file_open_tmp ("seafile-XXXXXX.zip", &tmpfile_name, NULL);
-    if (fd < 0) {
-        goto out;
+    g_free (entry->key);
+    g_free (entry->path);
+    g_free (entry);
+}
+
+static void
+pack_job_free (PackJob *job)
+{
+    g_free (job->store_id);
+    g_free (job->dirname);
+    g_free (job->root_id);
+    g_free (job->crypt);
+    g_free (job);
+}
+
+/* Drop oldest archives until the cache fits. Called with cache_lock held.
+ * Returns paths to be unlinked.
+ */
+static GList *
+evict_archives ()
+{
+    ArchiveEntry *entry;
+    GList *paths = NULL;
+
+    while (cache->size > cache->max_size &&
+           !g_queue_is_empty (cache->lru)) {
+        entry = g_queue_pop_tail (cache->lru);
+        entry->lru_link = NULL;
+        cache->size -= entry->size;
+        paths = g_list_prepend (paths, g_strdup (entry->path));
+        /* Drops the ref of the hash table. */
+        g_hash_table_remove (cache->entries, entry->key);
     }
 
+    return paths;
+}
+
+static void
+unlink_paths (GList *paths)
+{
+    GList *ptr;
+
+    for (ptr = paths; ptr; ptr = ptr->next) {
+        g_unlink ((char *)ptr->data);
+        g_free (ptr->data);
+    }
+    g_list_free (paths);
+}
+
+/* Send what's been written to the cache file to a request joining the
+ * build. Called by the packing thread.
+ */
+static int
+catch_up_joiner (PackJob *job, int fd)
+{
+    char buf[64 * 1024];
+    gint64 pos = 0;
+    ssize_t n;
+
+    while (pos < job->cache_written) {
+        n = pread (job->cache_fd, buf,
+                   MIN ((gint64)sizeof(buf), job->cache_written - pos), pos);
+        if (n <= 0 || writen (fd, buf, n) < 0)
+            return -1;
+        pos += n;
+    }
+
+    return 0;
+}
+
+/* Start writing to the pipes of requests that joined the build. */
+static void
+add_joiners (PackJob *job, GList *joiners, gboolean catch_up)
+{
+    GList *ptr;
+    int fd;
+
+    for (ptr = joiners; ptr; ptr = ptr->next) {
+        fd = GPOINTER_TO_INT (ptr->data);
+        if (catch_up && catch_up_joiner (job, fd) < 0) {
+            pipeclose (fd);
+            continue;
+        }
+        job->fds = g_list_prepend (job->fds, ptr->data);
+    }
+    g_list_free (joiners);
+}
+
+/*
+ * Stop caching the archive, because it's too large or packing failed.
+ * Requests can't join the build any more, those that already joined
+ * keep reading their pipes.
+ */
+static void
+drop_cached_archive (PackJob *job, gboolean failed)
+{
+    ArchiveEntry *entry = job->cached;
+    GList *joiners;
+
+    pthread_mutex_lock (&cache_lock);
+    cache->size -= entry->size;
+    if (g_hash_table_lookup (cache->entries, entry->key) == entry)
+        g_hash_table_remove (cache->entries, entry->key);
+    entry->pipe_entry = NULL;
+    joiners = entry->joiners;
+    entry->joiners = NULL;
+    pthread_mutex_unlock (&cache_lock);
+
+    add_joiners (job, joiners, !failed);
+
+    close (job->cache_fd);
+    job->cache_fd = -1;
+    g_unlink (entry->path);
+    archive_entry_unref (entry);
+    job->cached = NULL;
+}
+
+/*
+ * Copy archive data to the cache file. Archives being generated count
+ * against the cache size, so finished archives are evicted to make room.
+ * If the archive doesn't fit in the cache or can't be written, it's not
+ * cached and only goes to the pipes.
+ */
+static void
+write_to_cache (PackJob *job, const void *buff, size_t length)
+{
+    ArchiveEntry *entry = job->cached;
+    GList *paths;
+    gboolean fits;
+
+    pthread_mutex_lock (&cache_lock);
+    entry->size += length;
+    cache->size += length;
+    paths = evict_archives ();
+    fits = (cache->size <= cache->max_size);
+    pthread_mutex_unlock (&cache_lock);
+
+    unlink_paths (paths);
+
+    if (!fits) {
+        seaf_message ("Archive %s doesn't fit in the zip cache, "
+                      "not caching it.\n", entry->key);
+    } else if (writen (job->cache_fd, buff, length) < 0) {
+        seaf_warning ("Failed to write %s: %s.\n", entry->path, strerror(errno));
+    } else {
+        job->cache_written += length;
+        return;
+    }
+
+    drop_cached_archive (job, FALSE);
+}
+
+static ssize_t
+archive_write_cb (struct archive *a, void *client_data,
+                  const void *buff, size_t length)
+{
+    PackJob *job = client_data;
+    GList *joiners, *ptr, *next;
+    int fd;
+
+    if (job->cached) {
+        pthread_mutex_lock (&cache_lock);
+        joiners = job->cached->joiners;
+        job->cached->joiners = NULL;
+        pthread_mutex_unlock (&cache_lock);
+
+        add_joiners (job, joiners, TRUE);
+
+        write_to_cache (job, buff, length);
+    }
+
+    /* Writing fails with EPIPE if the reader has gone away. Packing stops
+     * when no reader is left. The slowest reader sets the pace.
+     */
+    for (ptr = job->fds; ptr; ptr = next) {
+        next = ptr->next;
+        fd = GPOINTER_TO_INT (ptr->data);
+        if (writen (fd, buff, length) < 0) {
+            pipeclose (fd);
+            job->fds = g_list_delete_link (job->fds, ptr);
+        }
+    }
+
+    if (!job->fds) {
+        archive_set_error (a, EPIPE, "All readers have gone away");
+        return -1;
+    }
+
+    return length;
+}
+
+/* Publish the cached copy of the archive, or drop it on failure. */
+static void
+finish_cached_archive (PackJob *job, gboolean success)
+{
+    ArchiveEntry *entry = job->cached;
+    GList *paths, *joiners;
+    char *zip_path;
+
+    if (!success) {
+        drop_cached_archive (job, TRUE);
+        return;
+    }
+
+    zip_path = g_strdup_printf ("%s/%s.zip", cache->dir, entry->key);
+    if (g_rename (entry->path, zip_path) < 0) {
+        seaf_warning ("Failed to rename %s: %s.\n", entry->path, strerror(errno));
+        g_free (zip_path);
+        drop_cached_archive (job, FALSE);
+        return;
+    }
+
+    pthread_mutex_lock (&cache_lock);
+
+    /* Readers open entry->path with the lock held. From now on requests
+     * read the finished archive instead of joining the build.
+     */
+    g_free (entry->path);
+    entry->path = zip_path;
+    entry->finished = TRUE;
+    entry->success = TRUE;
+    entry->pipe_entry = NULL;
+    joiners = entry->joiners;
+    entry->joiners = NULL;
+
+    /* The size is already counted. */
+    g_queue_push_head (cache->lru, entry);
+    entry->lru_link = cache->lru->head;
+    paths = evict_archives ();
+
+    pthread_mutex_unlock (&cache_lock);
+
+    unlink_paths (paths);
+
+    add_joiners (job, joiners, TRUE);
+
+    close (job->cache_fd);
+    job->cache_fd = -1;
+    archive_entry_unref (entry);
+    job->cached = NULL;
+}
+
+/* Tell the streams packing is done, they see EOF after this. */
+static void
+finish_archive (PackJob *job, gboolean success)
+{
+    GList *ptr;
+
+    pthread_mutex_lock (&cache_lock);
+    job->entry->finished = TRUE;
+    job->entry->success = success;
+    pthread_mutex_unlock (&cache_lock);
+
+    for (ptr = job->fds; ptr; ptr = ptr->next)
+        pipeclose (GPOINTER_TO_INT (ptr->data));
+    g_list_free (job->fds);
+    job->fds = NULL;
+}
+
+static void
+pack_dir_thread (gpointer vdata, gpointer user_data)
+{
+    PackJob *job = vdata;
+    struct archive *a;
+    PackDirData *data;
+    gboolean success = FALSE;
+
     a = archive_write_new ();
     archive_write_set_compression_none (a);
     archive_write_set_format_zip (a);
-    archive_write_open_fd (a, fd);
+    /* Don't pad the end of the archive. */
+    archive_write_set_bytes_in_last_block (a, 1);
+
+    if (archive_write_open (a, job, NULL, archive_write_cb, NULL)
+        != ARCHIVE_OK) {
+        seaf_warning ("Failed to open archive: %s.\n", archive_error_string(a));
+        archive_write_finish (a);
+        goto out;
+    }
 
     data = g_new0 (PackDirData, 1);
-    data->crypt = crypt;
-    data->is_windows = is_windows;
+    data->is_windows = job->is_windows;
     data->a = a;
-    data->top_dir_name = dirname;
+    data->top_dir_name = job->dirname;
     data->mtime = time(NULL);
-    memcpy (data->store_id, store_id, 36);
-    data->repo_version = repo_version;
+    memcpy (data->store_id, job->store_id, 36);
+    data->repo_version = job->repo_version;
+    data->max_size = job->max_size;
+    data->ra = block_read_ahead_new (job->store_id, job->repo_version,
+                                     job->crypt);
 
-    if (archive_dir (data, root_id, "") < 0) {
+    if (archive_dir (data, job->root_id, "") < 0) {
         g_debug ("failed to archive_dir\n");
-        goto out;
+        archive_write_finish (a);
+    } else if (archive_write_finish (a) == ARCHIVE_OK) {
+        success = TRUE;
     }
 
-    if (archive_write_finish(a) < 0) {
-        goto out;
+    block_read_ahead_free (data->ra);
+    g_free (data);
+
+out:
+    if (job->cached)
+        finish_cached_archive (job, success);
+    finish_archive (job, success);
+
+    archive_entry_unref (job->entry);
+    pack_job_free (job);
+}
+
+static void
+create_pack_pool ()
+{
+    pack_pool = g_thread_pool_new (pack_dir_thread, NULL,
+                                   PACK_THREADS, FALSE, NULL);
+}
+
+/*
+ * Everything that affects the content of the archive is in the key. The
+ * file names are converted to windows_encoding for windows clients.
+ */
+static char *
+archive_key (const char *store_id, const char *root_id,
+             const char *dirname, gboolean is_windows)
+{
+    const char *flavor = "utf-8";
+    char *str, *key;
+
+    if (is_windows && seaf->http_server->windows_encoding)
+        flavor = seaf->http_server->windows_encoding;
+
+    str = g_strconcat (store_id, "/", root_id, "/", flavor, "/", dirname, NULL);
+    key = g_compute_checksum_for_string (G_CHECKSUM_SHA1, str, -1);
+    g_free (str);
+
+    return key;
+}
+
+static PackDirStream *
+pipe_stream_new (ArchiveEntry *pipe_entry, int *wfd)
+{
+    PackDirStream *stream;
+    ccnet_pipe_t fds[2];
+
+    if (ccnet_pipe (fds) < 0) {
+        seaf_warning ("Failed to create pipe: %s.\n", strerror(errno));
+        return NULL;
     }
+    evutil_make_socket_nonblocking (fds[0]);
+
+    stream = g_new0 (PackDirStream, 1);
+    stream->entry = pipe_entry;
+    stream->fd = fds[0];
+    g_atomic_int_inc (&pipe_entry->ref_count);
+
+    *wfd = fds[1];
+    return stream;
+}
+
+/*
+ * Open the archive if it's in the cache, or join the build if it's being
+ * generated. Otherwise add an entry to the cache for the build of
+ * @pipe_entry and return it in @cached, with the temp file to copy the
+ * archive to in @cache_fd.
+ */
+static PackDirStream *
+open_cached_archive (const char *key, ArchiveEntry *pipe_entry,
+                     ArchiveEntry **cached, int *cache_fd)
+{
+    ArchiveEntry *entry;
+    PackDirStream *stream = NULL;
+    int fd;
+
+    *cached = NULL;
+    *cache_fd = -1;
+
+    pthread_mutex_lock (&cache_lock);
+
+    entry = g_hash_table_lookup (cache->entries, key);
+    if (entry && entry->finished) {
+        fd = g_open (entry->path, O_RDONLY | O_BINARY, 0);
+        if (fd < 0) {
+            seaf_warning ("Failed to open %s: %s.\n", entry->path, strerror(errno));
+            goto out;
+        }
+        g_queue_unlink (cache->lru, entry->lru_link);
+        g_queue_push_head_link (cache->lru, entry->lru_link);
+
+        stream = g_new0 (PackDirStream, 1);
+        stream->entry = entry;
+        stream->fd = fd;
+        g_atomic_int_inc (&entry->ref_count);
+    } else if (entry) {
+        /* The packing thread sends what it has generated so far before
+         * writing more to the pipe.
+         */
+        stream = pipe_stream_new (entry->pipe_entry, &fd);
+        if (stream)
+            entry->joiners = g_list_prepend (entry->joiners,
+                                             GINT_TO_POINTER(fd));
+    } else {
+        entry = g_new0 (ArchiveEntry, 1);
+        entry->key = g_strdup (key);
+        entry->path = g_strdup_printf ("%s/%s.tmp", cache->dir, key);
+
+        /* Read back for requests joining the build. */
+        fd = g_open (entry->path, O_RDWR | O_CREAT | O_TRUNC | O_BINARY, 0666);
+        if (fd < 0) {
+            seaf_warning ("Failed to create %s: %s.\n", entry->path, strerror(errno));
+            archive_entry_unref (entry);
+            goto out;
+        }
 
-    ret = g_strdup (tmpfile_name);
+        /* One for the hash table and one for the packing job. */
+        entry->ref_count = 2;
+        entry->pipe_entry = pipe_entry;
+        g_hash_table_insert (cache->entries, entry->key, entry);
+
+        *cached = entry;
+        *cache_fd = fd;
+    }
 
 out:
-    if (data) g_free (data);
-    if (fd > 0) close (fd);
-    
-    if (!ret && tmpfile_name) {
-        /* zip failed: remove tmp file */
-        g_unlink (tmpfile_name);
+    pthread_mutex_unlock (&cache_lock);
+    return stream;
+}
+
+PackDirStream *
+pack_dir_stream_start (const char *store_id,
+                       int repo_version,
+                       const char *dirname,
+                       const char *root_id,
+                       SeafileCrypt *crypt,
+                       gboolean is_windows,
+                       gint64 max_size)
+{
+    PackDirStream *stream;
+    PackJob *job;
+    GError *error = NULL;
+    char *key;
+    int fd;
+
+    pthread_once (&pack_pool_once, create_pack_pool);
+
+    /* The archive is always generated into pipes, so that it's only
+     * generated as fast as it's read, and packing stops if the readers
+     * go away.
+     */
+    job = g_new0 (PackJob, 1);
+    job->entry = g_new0 (ArchiveEntry, 1);
+    /* The packing thread's ref. */
+    job->entry->ref_count = 1;
+    job->cache_fd = -1;
+
+    /* Decrypted content is never written to disk. */
+    if (cache && !crypt) {
+        key = archive_key (store_id, root_id, dirname, is_windows);
+        stream = open_cached_archive (key, job->entry,
+                                      &job->cached, &job->cache_fd);
+        g_free (key);
+        if (stream) {
+            archive_entry_unref (job->entry);
+            g_free (job);
+            return stream;
+        }
     }
-    g_free (tmpfile_name);
 
-    return ret;
+    stream = pipe_stream_new (job->entry, &fd);
+    if (!stream) {
+        /* Requests that joined in the meantime fail too. */
+        if (job->cached)
+            drop_cached_archive (job, TRUE);
+        finish_archive (job, FALSE);
+        archive_entry_unref (job->entry);
+        pack_job_free (job);
+        return NULL;
+    }
+    job->fds = g_list_prepend (NULL, GINT_TO_POINTER(fd));
+
+    job->store_id = g_strdup (store_id);
+    job->repo_version = repo_version;
+    job->dirname = g_strdup (dirname);
+    job->root_id = g_strdup (root_id);
+    if (crypt)
+        job->crypt = g_memdup (crypt, sizeof(SeafileCrypt));
+    job->is_windows = is_windows;
+    job->max_size = max_size;
+
+    /* The stream waits for data until a packing thread is free. */
+    g_thread_pool_push (pack_pool, job, &error);
+    if (error) {
+        seaf_warning ("Failed to start packing dir %s: %s.\n",
+                      root_id, error->message);
+        g_clear_error (&error);
+        if (job->cached)
+            drop_cached_archive (job, TRUE);
+        finish_archive (job, FALSE);
+        archive_entry_unref (job->entry);
+        pack_job_free (job);
+        pack_dir_stream_free (stream);
+        return NULL;
+    }
+
+    return stream;
+}
+
+int
+pack_dir_stream_get_fd (PackDirStream *stream)
+{
+    return stream->entry->key ? -1 : stream->fd;
+}
+
+int
+pack_dir_stream_read (PackDirStream *stream, void *buf, int len)
+{
+    ArchiveEntry *entry = stream->entry;
+    gboolean success;
+    int n;
+
+    /* Finished archives in the cache don't change. */
+    if (entry->key) {
+        if (stream->pos >= entry->size)
+            return 0;
+        n = pread (stream->fd, buf, MIN ((gint64)len, entry->size - stream->pos),
+                   stream->pos);
+        if (n > 0)
+            stream->pos += n;
+        return n;
+    }
+
+    n = piperead (stream->fd, buf, len);
+    if (n != 0)
+        return n;
+
+    /* The pipe is closed after packing is done. */
+    pthread_mutex_lock (&cache_lock);
+    success = entry->success;
+    pthread_mutex_unlock (&cache_lock);
+
+    if (!success) {
+        errno = EIO;
+        return -1;
+    }
+    return 0;
+}
+
+void
+pack_dir_stream_free (PackDirStream *stream)
+{
+    /* If the archive is not finished yet, the packing thread fails on
+     * next write to the pipe, and quits if no other stream reads it.
+     */
+    if (stream->entry->key)
+        close (stream->fd);
+    else
+        pipeclose (stream->fd);
+    archive_entry_unref (stream->entry);
+    g_free (stream);
+}
+
+typedef struct CachedArchive {
+    ArchiveEntry *entry;
+    gint64 mtime;
+} CachedArchive;
+
+static gint
+compare_mtime (gconstpointer a, gconstpointer b)
+{
+    const CachedArchive *ca = a, *cb = b;
+
+    /* The newest first. */
+    return (ca->mtime < cb->mtime) - (ca->mtime > cb->mtime);
+}
+
+int
+pack_dir_cache_init (const char *cache_dir, gint64 max_size)
+{
+    GDir *dir;
+    const char *dname;
+    char *path;
+    SeafStat st;
+    GList *archives = NULL, *ptr;
+    CachedArchive *archive;
+    ArchiveEntry *entry;
+
+    if (g_mkdir_with_parents (cache_dir, 0777) < 0) {
+        seaf_warning ("Failed to create zip cache dir %s.\n", cache_dir);
+        return -1;
+    }
+
+    dir = g_dir_open (cache_dir, 0, NULL);
+    if (!dir) {
+        seaf_warning ("Failed to open zip cache dir %s.\n", cache_dir);
+        return -1;
+    }
+
+    cache = g_new0 (ArchiveCache, 1);
+    cache->dir = g_strdup (cache_dir);
+    cache->max_size = max_size;
+    cache->entries = g_hash_table_new_full (g_str_hash, g_str_equal, NULL,
+                                            (GDestroyNotify)archive_entry_unref);
+    cache->lru = g_queue_new ();
+
+    /* Pick up archives of last run. Unfinished ones are removed. */
+    while ((dname = g_dir_read_name (dir)) != NULL) {
+        path = g_build_filename (cache_dir, dname, NULL);
+        if (!g_str_has_suffix (dname, ".zip") || strlen(dname) != 44 ||
+            seaf_stat (path, &st) < 0) {
+            g_unlink (path);
+            g_free (path);
+            continue;
+        }
+
+        entry = g_new0 (ArchiveEntry, 1);
+        entry->key = g_strndup (dname, 40);
+        entry->path = path;
+        entry->size = st.st_size;
+        entry->finished = TRUE;
+        entry->success = TRUE;
+        entry->ref_count = 1;
+
+        archive = g_new0 (CachedArchive, 1);
+        archive->entry = entry;
+        archive->mtime = st.st_mtime;
+        archives = g_list_prepend (archives, archive);
+    }
+    g_dir_close (dir);
+
+    archives = g_list_sort (archives, compare_mtime);
+    for (ptr = archives; ptr; ptr = ptr->next) {
+        archive = ptr->data;
+        entry = archive->entry;
+        g_queue_push_tail (cache->lru, entry);
+        entry->lru_link = cache->lru->tail;
+        cache->size += entry->size;
+        g_hash_table_insert (cache->entries, entry->key, entry);
+        g_free (archive);
+    }
+    g_list_free (archives);
+
+    unlink_paths (evict_archives ());
+
+    return 0;
 }
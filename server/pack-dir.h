@@ -1,13 +1,57 @@
 #ifndef PACK_DIR_H
 #define PACK_DIR_H
 
-/* Pack a seafile directory to a zipped archive, saved in a temporary file.
-   Return the path of this temporary file.
+/*
+ * Stream a seafile directory as a zip archive.
+ *
+ * The archive is generated by a thread of a bounded pool while it's being
+ * read, so memory use doesn't depend on the size of the directory.
+ * Packing fails once the files archived so far are larger than @max_size,
+ * so the size of the directory doesn't need to be computed in advance.
+ *
+ * The archive is written to a pipe, and the thread blocks when the pipe is
+ * full, so the archive is generated only as fast as it's read. Packing
+ * stops if the stream is freed before the archive is finished.
+ *
+ * If the archive cache is enabled, archives of unencrypted directories are
+ * also copied to the cache on disk, and later requests read the finished
+ * archive from there. Requests for an archive that is being generated join
+ * the build: the thread sends them what's in the cache file so far, then
+ * writes to their pipes as well. Archives being generated count against
+ * the cache size; one that doesn't fit is not cached, and only requests
+ * that already joined its build share it.
  */
-char *pack_dir (const char *repo_id,
-                int repo_version,
-                const char *dirname,
-                const char *root_id,
-                SeafileCrypt *crypt,
-                gboolean is_windows);
+typedef struct PackDirStream PackDirStream;
+
+PackDirStream *
+pack_dir_stream_start (const char *store_id,
+                       int repo_version,
+                       const char *dirname,
+                       const char *root_id,
+                       SeafileCrypt *crypt,
+                       gboolean is_windows,
+                       gint64 max_size);
+
+/*
+ * Read the next part of the archive. Returns the number of bytes read, 0
+ * at the end of the archive, or -1 on error. If no more data is available
+ * yet, returns -1 with errno set to EAGAIN.
+ */
+int
+pack_dir_stream_read (PackDirStream *stream, void *buf, int len);
+
+/* An fd that becomes readable when more data is available, or -1 if the
+ * stream never has to wait, i.e. the archive is read from the cache.
+ */
+int
+pack_dir_stream_get_fd (PackDirStream *stream);
+
+/* Can be called before the archive is finished, then packing stops. */
+void
+pack_dir_stream_free (PackDirStream *stream);
+
+/* Enable the archive cache, bounded by @max_size bytes. */
+int
+pack_dir_cache_init (const char *cache_dir, gint64 max_size);
+
 #endif
@@ -22,8 +22,14 @@ enum {
 };
 
 typedef struct {
-    guint32 writer_id;
-    gboolean registered;
+    /* Commits are made durable together when all of them are received. */
+    OSWriteBatch *batch;
+
+    /* The commit being written by save_commit_thread. */
+    char        obj_id[41];
+    void        *obj_data;
+    int         obj_len;
+    gboolean    write_success;
 
     /* Used for getting repo info */
     char        repo_id[37];
@@ -38,12 +44,30 @@ typedef struct {
     RecvcommitPriv *priv = GET_PRIV(processor);
 
 static int recv_commit_start (CcnetProcessor *processor, int argc, char **argv);
+static void *
+commit_batch_thread (void *data)
+{
+    CcnetProcessor *processor = data;
+    USE_PRIV;
+
+    priv->success = (seaf_obj_store_write_batch_commit (priv->batch) == 0);
+    return data;
+}
+
+static void
+commit_batch_done (void *data)
+{
+    CcnetProcessor *processor = data;
+    USE_PRIV;
+
+    if (!priv->success)
+        g_warning ("[recvcommit] Failed to sync commit objects.\n");
+    ccnet_processor_done (processor, priv->success);
+}
+
 static void handle_update (CcnetProcessor *processor,
                            char *code, char *code_msg,
                            char *content, int clen);
-static void
-write_done_cb (OSAsyncResult *res, void *cb_data);
-
 
 G_DEFINE_TYPE (SeafileRecvcommitV3Proc, seafile_recvcommit_v3_proc, CCNET_TYPE_PROCESSOR)
 
@@ -52,9 +76,8 @@ release_resource (CcnetProcessor *processor)
 {
     USE_PRIV;
 
-    if (priv->registered)
-        seaf_obj_store_unregister_async_write (seaf->commit_mgr->obj_store,
-                                               priv->writer_id);
+    seaf_obj_store_write_batch_free (priv->batch);
+    g_free (priv->obj_data);
 
     CCNET_PROCESSOR_CLASS (seafile_recvcommit_v3_proc_parent_class)->release_resource (processor);
 }
@@ -107,13 +130,10 @@ get_repo_info_done (void *data)
     if (priv->success) {
         ccnet_processor_send_response (processor, SC_OK, SS_OK, NULL, 0);
         processor->state = RECV_OBJECT;
-        priv->writer_id =
-            seaf_obj_store_register_async_write (seaf->commit_mgr->obj_store,
-                                                 priv->repo_id,
-                                                 priv->repo_version,
-                                                 write_done_cb,
-                                                 processor);
-        priv->registered = TRUE;
+        priv->batch =
+            seaf_obj_store_write_batch_new (seaf->commit_mgr->obj_store,
+                                            priv->repo_id,
+                                            priv->repo_version);
     } else {
         ccnet_processor_send_response (processor, SC_SHUTDOWN, SS_SHUTDOWN,
                                        NULL, 0);
@@ -153,57 +173,79 @@ recv_commit_start (CcnetProcessor *processor, int argc, char **argv)
     }
 }
 
+/*
+ * The sender waits for our ACK before sending the next commit, so there is
+ * at most one write running and the batch is only used by one thread at a time.
+ */
+static void *
+save_commit_thread (void *data)
+{
+    CcnetProcessor *processor = data;
+    USE_PRIV;
+
+    priv->write_success = (seaf_obj_store_write_batch_add (priv->batch,
+                                                           priv->obj_id,
+                                                           priv->obj_data,
+                                                           priv->obj_len) == 0);
+    return data;
+}
+
 static void
-write_done_cb (OSAsyncResult *res, void *cb_data)
+save_commit_done (void *data)
 {
-    CcnetProcessor *processor = cb_data;
+    CcnetProcessor *processor = data;
+    USE_PRIV;
 
-    if (!res->success) {
+    g_free (priv->obj_data);
+    priv->obj_data = NULL;
+
+    if (!priv->write_success) {
         ccnet_processor_send_response (processor, SC_BAD_OBJECT, SS_BAD_OBJECT,
                                        NULL, 0);
         g_warning ("[recvcommit] Failed to write commit object.\n");
         ccnet_processor_done (processor, FALSE);
-    } else {
-        ccnet_processor_send_response (processor, SC_ACK, SS_ACK, NULL, 0);
+        return;
     }
-}
-
-static int
-save_commit (CcnetProcessor *processor, ObjectPack *pack, int len)
-{
-    USE_PRIV;
 
-    return seaf_obj_store_async_write (seaf->commit_mgr->obj_store,
-                                       priv->writer_id,
-                                       pack->id,
-                                       pack->object,
-                                       len - 41,
-                                       TRUE);
+    ccnet_processor_send_response (processor, SC_ACK, SS_ACK, NULL, 0);
 }
 
 static void
 receive_commit (CcnetProcessor *processor, char *content, int clen)
 {
+    USE_PRIV;
     ObjectPack *pack = (ObjectPack *)content;
 
     if (clen < sizeof(ObjectPack)) {
         g_warning ("[recvcommit] invalid object id.\n");
-        goto bad;
+        ccnet_processor_send_response (processor, SC_BAD_OBJECT, SS_BAD_OBJECT,
+                                       NULL, 0);
+        ccnet_processor_done (processor, FALSE);
+        return;
     }
 
-    seaf_debug ("[recvcommit] recv commit object %.8s\n", pack->id);
-
-    if (save_commit (processor, pack, clen) < 0) {
-        goto bad;
+    if (priv->obj_data) {
+        g_warning ("[recvcommit] Got commit before the last one was acked.\n");
+        ccnet_processor_send_response (processor,
+                                       SC_BAD_UPDATE_CODE, SS_BAD_UPDATE_CODE,
+                                       NULL, 0);
+        ccnet_processor_done (processor, FALSE);
+        return;
     }
 
-    return;
+    seaf_debug ("[recvcommit] recv commit object %.8s\n", pack->id);
 
-bad:
-    ccnet_processor_send_response (processor, SC_BAD_OBJECT, SS_BAD_OBJECT,
-                                   NULL, 0);
-    g_warning ("[recvcommit] Failed to write commit object.\n");
-    ccnet_processor_done (processor, FALSE);
+    /* Don't block the main loop on the backend, e.g. a riak PUT. */
+    memcpy (priv->obj_id, pack->id, 40);
+    priv->obj_id[40] = 0;
+    priv->obj_len = clen - 41;
+    priv->obj_data = g_memdup (pack->object, priv->obj_len);
+
+    ccnet_processor_thread_create (processor,
+                                   seaf->job_mgr,
+                                   save_commit_thread,
+                                   save_commit_done,
+                                   processor);
 }
 
 static void handle_update (CcnetProcessor *processor,
@@ -216,7 +258,12 @@ static void handle_update (CcnetProcessor *processor,
             receive_commit (processor, content, clen);
         } else if (strncmp(code, SC_END, 3) == 0) {
             seaf_debug ("[recvcommit] Recv commit end.\n");
-            ccnet_processor_done (processor, TRUE);
+            /* Only report success after all commits are on disk. */
+            ccnet_processor_thread_create (processor,
+                                           seaf->job_mgr,
+                                           commit_batch_thread,
+                                           commit_batch_done,
+                                           processor);
         } else {
             g_warning ("[recvcommit] Bad update: %s %s\n", code, code_msg);
             ccnet_processor_send_response (processor,
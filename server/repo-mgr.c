@@ -38,6 +38,8 @@ struct _SeafRepoManagerPriv {
     GHashTable *decrypted_tokens;
     pthread_rwlock_t lock;
     CcnetTimer *reap_token_timer;
+    /* Version of newly created repos. */
+    int new_repo_version;
 };
 
 static const char *ignore_table[] = {
@@ -251,6 +253,32 @@ should_ignore_file(const char *filename, void *data)
     return FALSE;
 }
 
+/*
+ * New repos can be created with BINARY_FS_REPO_VERSION by setting
+ * "repo_version" in the [library] group. Only do this when all clients
+ * support the binary fs object format.
+ */
+static int
+load_new_repo_version (GKeyFile *config)
+{
+    int version;
+    GError *error = NULL;
+
+    version = g_key_file_get_integer (config, "library", "repo_version", &error);
+    if (error) {
+        g_clear_error (&error);
+        return CURRENT_REPO_VERSION;
+    }
+
+    if (version != CURRENT_REPO_VERSION && version != BINARY_FS_REPO_VERSION) {
+        seaf_warning ("Unsupported repo version %d, use %d instead.\n",
+                      version, CURRENT_REPO_VERSION);
+        return CURRENT_REPO_VERSION;
+    }
+
+    return version;
+}
+
 SeafRepoManager*
 seaf_repo_manager_new (SeafileSession *seaf)
 {
@@ -266,6 +294,8 @@ seaf_repo_manager_new (SeafileSession *seaf)
     mgr->priv->reap_token_timer = ccnet_timer_new (reap_token, mgr,
                                                    REAP_TOKEN_INTERVAL * 1000);
 
+    mgr->priv->new_repo_version = load_new_repo_version (seaf->config);
+
     /* ignore_patterns = g_new0 (GPatternSpec*, G_N_ELEMENTS(ignore_table)); */
     /* int i; */
     /* for (i = 0; ignore_table[i] != NULL; i++) { */
@@ -2201,7 +2231,7 @@ create_repo_common (SeafRepoManager *mgr,
         memcpy (repo->random_key, random_key, 96);
     }
 
-    repo->version = CURRENT_REPO_VERSION;
+    repo->version = mgr->priv->new_repo_version;
     memcpy (repo->store_id, repo_id, 36);
 
     commit = seaf_commit_new (NULL, repo->id,
@@ -275,6 +275,24 @@ seaf_repo_manager_post_multi_files (SeafRepoManager *mgr,
                                     char **new_ids,
                                     GError **error);
 
+/*
+ * Same as seaf_repo_manager_post_multi_files, but the files have
+ * already been indexed, e.g. while they were uploaded.
+ * @file_ids: file ids in the same order as @filenames.
+ * @file_sizes: list of gint64 pointers, in the same order as @filenames.
+ */
+int
+seaf_repo_manager_post_multi_indexed_files (SeafRepoManager *mgr,
+                                            const char *repo_id,
+                                            const char *parent_dir,
+                                            GList *filenames,
+                                            GList *file_ids,
+                                            GList *file_sizes,
+                                            const char *user,
+                                            int replace_existed,
+                                            char **new_ids,
+                                            GError **error);
+
 int
 seaf_repo_manager_post_file_blocks (SeafRepoManager *mgr,
                                     const char *repo_id,
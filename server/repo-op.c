@@ -946,6 +946,90 @@ format_json_ret (GList *name_list, GList *id_list, GList *size_list)
     return ret;
 }
 
+static gboolean
+check_post_multi_files_args (GList *filenames,
+                             const char *parent_dir,
+                             GError **error)
+{
+    GList *ptr;
+    char *filename;
+
+    for (ptr = filenames; ptr; ptr = ptr->next) {
+        filename = ptr->data;
+        if (should_ignore_file (filename, NULL)) {
+            seaf_warning ("[post files] Invalid filename %s.\n", filename);
+            g_set_error (error, SEAFILE_DOMAIN, POST_FILE_ERR_FILENAME,
+                         "%s", filename);
+            return FALSE;
+        }
+    }
+
+    if (strstr (parent_dir, "//") != NULL) {
+        seaf_warning ("[post file] parent_dir cantains // sequence.\n");
+        g_set_error (error, SEAFILE_DOMAIN, SEAF_ERR_BAD_ARGS,
+                     "Invalid parent dir");
+        return FALSE;
+    }
+
+    return TRUE;
+}
+
+/* Add indexed files to parent dir and commit. */
+static int
+commit_multi_files (SeafRepoManager *mgr,
+                    SeafRepo *repo,
+                    SeafCommit *head_commit,
+                    const char *canon_path,
+                    GList *filenames,
+                    GList *id_list,
+                    GList *size_list,
+                    const char *user,
+                    int replace_existed,
+                    char **ret_json,
+                    GError **error)
+{
+    GList *name_list = NULL;
+    GString *buf = g_string_new (NULL);
+    char *root_id = NULL;
+    int ret = 0;
+
+    root_id = do_post_multi_files (repo, head_commit->root_id, canon_path,
+                                   filenames, id_list, size_list, user,
+                                   replace_existed, &name_list);
+    if (!root_id) {
+        seaf_warning ("[post file] Failed to put file.\n");
+        g_set_error (error, SEAFILE_DOMAIN, SEAF_ERR_INTERNAL,
+                     "Failed to put file");
+        ret = -1;
+        goto out;
+    }
+
+    guint len = g_list_length (filenames);
+    if (len > 1)
+        g_string_printf (buf, "Added \"%s\" and %u more files.",
+                         (char *)(filenames->data), len - 1);
+    else
+        g_string_printf (buf, "Added \"%s\".", (char *)(filenames->data));
+
+    if (gen_new_commit (repo->id, head_commit, root_id,
+                        user, buf->str, NULL, error) < 0) {
+        ret = -1;
+        goto out;
+    }
+
+    seaf_repo_manager_merge_virtual_repo (mgr, repo->id, NULL);
+
+    if (ret_json)
+        *ret_json = format_json_ret (name_list, id_list, size_list);
+
+out:
+    string_list_free (name_list);
+    g_string_free (buf, TRUE);
+    g_free (root_id);
+
+    return ret;
+}
+
 int
 seaf_repo_manager_post_multi_files (SeafRepoManager *mgr,
                                     const char *repo_id,
@@ -960,12 +1044,10 @@ seaf_repo_manager_post_multi_files (SeafRepoManager *mgr,
     SeafRepo *repo = NULL;
     SeafCommit *head_commit = NULL;
     char *canon_path = NULL;
-    GList *filenames = NULL, *paths = NULL, *id_list = NULL, *name_list = NULL,
+    GList *filenames = NULL, *paths = NULL, *id_list = NULL,
         *size_list = NULL, *ptr;
-    char *filename, *path;
+    char *path;
     unsigned char sha1[20];
-    GString *buf = g_string_new (NULL);
-    char *root_id = NULL;
     SeafileCrypt *crypt = NULL;
     char hex[41];
     int ret = 0;
@@ -986,21 +1068,7 @@ seaf_repo_manager_post_multi_files (SeafRepoManager *mgr,
     }
 
     /* Check inputs. */
-    for (ptr = filenames; ptr; ptr = ptr->next) {
-        filename = ptr->data;
-        if (should_ignore_file (filename, NULL)) {
-            seaf_warning ("[post files] Invalid filename %s.\n", filename);
-            g_set_error (error, SEAFILE_DOMAIN, POST_FILE_ERR_FILENAME,
-                         "%s", filename);
-            ret = -1;
-            goto out;
-        }
-    }
-
-    if (strstr (parent_dir, "//") != NULL) {
-        seaf_warning ("[post file] parent_dir cantains // sequence.\n");
-        g_set_error (error, SEAFILE_DOMAIN, SEAF_ERR_BAD_ARGS,
-                     "Invalid parent dir");
+    if (!check_post_multi_files_args (filenames, parent_dir, error)) {
         ret = -1;
         goto out;
     }
@@ -1031,6 +1099,7 @@ seaf_repo_manager_post_multi_files (SeafRepoManager *mgr,
             seaf_warning ("failed to index blocks");
             g_set_error (error, SEAFILE_DOMAIN, SEAF_ERR_GENERAL,
                          "Failed to index blocks");
+            g_free (size);
             ret = -1;
             goto out;
         }
@@ -1042,52 +1111,76 @@ seaf_repo_manager_post_multi_files (SeafRepoManager *mgr,
     id_list = g_list_reverse (id_list);
     size_list = g_list_reverse (size_list);
 
-    /* Add the files to parent dir and commit. */
-    root_id = do_post_multi_files (repo, head_commit->root_id, canon_path,
-                                   filenames, id_list, size_list, user,
-                                   replace_existed, &name_list);
-    if (!root_id) {
-        seaf_warning ("[post file] Failed to put file.\n");
-        g_set_error (error, SEAFILE_DOMAIN, SEAF_ERR_INTERNAL,
-                     "Failed to put file");
+    ret = commit_multi_files (mgr, repo, head_commit, canon_path,
+                              filenames, id_list, size_list, user,
+                              replace_existed, ret_json, error);
+
+out:
+    if (repo)
+        seaf_repo_unref (repo);
+    if (head_commit)
+        seaf_commit_unref(head_commit);
+    string_list_free (filenames);
+    string_list_free (paths);
+    string_list_free (id_list);
+    for (ptr = size_list; ptr; ptr = ptr->next)
+        g_free (ptr->data);
+    g_list_free (size_list);
+    g_free (canon_path);
+    g_free (crypt);
+
+    if (ret == 0)
+        update_repo_size(repo_id);
+
+    return ret;
+}
+
+int
+seaf_repo_manager_post_multi_indexed_files (SeafRepoManager *mgr,
+                                            const char *repo_id,
+                                            const char *parent_dir,
+                                            GList *filenames,
+                                            GList *file_ids,
+                                            GList *file_sizes,
+                                            const char *user,
+                                            int replace_existed,
+                                            char **ret_json,
+                                            GError **error)
+{
+    SeafRepo *repo = NULL;
+    SeafCommit *head_commit = NULL;
+    char *canon_path = NULL;
+    int ret = 0;
+
+    GET_REPO_OR_FAIL(repo, repo_id);
+    GET_COMMIT_OR_FAIL(head_commit, repo->id, repo->version, repo->head->commit_id);
+
+    canon_path = get_canonical_path (parent_dir);
+
+    if (!filenames ||
+        g_list_length (filenames) != g_list_length (file_ids) ||
+        g_list_length (filenames) != g_list_length (file_sizes)) {
+        seaf_warning ("[post files] Invalid filenames or file ids.\n");
+        g_set_error (error, SEAFILE_DOMAIN, SEAF_ERR_BAD_ARGS, "Invalid files");
         ret = -1;
         goto out;
     }
 
-    guint len = g_list_length (filenames);
-    if (len > 1)
-        g_string_printf (buf, "Added \"%s\" and %u more files.",
-                         (char *)(filenames->data), len - 1);
-    else
-        g_string_printf (buf, "Added \"%s\".", (char *)(filenames->data));
-
-    if (gen_new_commit (repo_id, head_commit, root_id,
-                        user, buf->str, NULL, error) < 0) {
+    if (!check_post_multi_files_args (filenames, parent_dir, error)) {
         ret = -1;
         goto out;
     }
 
-    seaf_repo_manager_merge_virtual_repo (mgr, repo_id, NULL);
-
-    if (ret_json)
-        *ret_json = format_json_ret (name_list, id_list, size_list);
+    ret = commit_multi_files (mgr, repo, head_commit, canon_path,
+                              filenames, file_ids, file_sizes, user,
+                              replace_existed, ret_json, error);
 
 out:
     if (repo)
         seaf_repo_unref (repo);
     if (head_commit)
         seaf_commit_unref(head_commit);
-    string_list_free (filenames);
-    string_list_free (paths);
-    string_list_free (id_list);
-    string_list_free (name_list);
-    for (ptr = size_list; ptr; ptr = ptr->next)
-        g_free (ptr->data);
-    g_list_free (size_list);
-    g_string_free (buf, TRUE);
-    g_free (root_id);
     g_free (canon_path);
-    g_free (crypt);
 
     if (ret == 0)
         update_repo_size(repo_id);
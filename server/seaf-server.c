@@ -597,6 +597,12 @@ static void start_rpc_service (CcnetClient *client, int cloud_mode)
                                      seafile_get_system_default_repo_id,
                                      "get_system_default_repo_id",
                                      searpc_signature_string__void());
+
+    /* Monitoring */
+    searpc_server_register_function ("seafserv-threaded-rpcserver",
+                                     seafile_get_cache_stats,
+                                     "get_cache_stats",
+                                     searpc_signature_string__void());
 }
 
 static struct event sigusr1;
@@ -36,6 +36,9 @@
 static int
 load_thread_pool_config (SeafileSession *session);
 
+static void
+schedule_obj_cache_warmup (SeafileSession *session);
+
 SeafileSession *
 seafile_session_new(const char *seafile_dir,
                     CcnetClient *ccnet_session)
@@ -243,6 +246,8 @@ seafile_session_start (SeafileSession *session)
         return -1;
     }
 
+    schedule_obj_cache_warmup (session);
+
     return 0;
 }
 
@@ -394,3 +399,87 @@ schedule_create_system_default_repo (SeafileSession *session)
                                     create_system_default_repo,
                                     NULL, session);
 }
+
+static gboolean
+warmup_dir_cb (SeafFSManager *mgr,
+               const char *repo_id,
+               int version,
+               const char *obj_id,
+               int type,
+               void *user_data,
+               gboolean *stop)
+{
+    /* Dirs are read by the traversal. */
+    return TRUE;
+}
+
+/*
+ * Read the dir objects of libraries changed in the last warmup_days days,
+ * so that their listings are served from the local object cache.
+ */
+static void *
+warmup_obj_cache (void *data)
+{
+    SeafileSession *session = data;
+    int days;
+    gint64 since;
+    GList *repo_ids, *ptr;
+    SeafRepo *repo;
+    SeafCommit *head;
+    int n_warmed = 0;
+
+    days = g_key_file_get_integer (session->config,
+                                   "object_cache", "warmup_days", NULL);
+    since = (gint64)time(NULL) - (gint64)days * 24 * 3600;
+
+    repo_ids = seaf_repo_manager_get_repo_id_list (session->repo_mgr);
+    for (ptr = repo_ids; ptr; ptr = ptr->next) {
+        repo = seaf_repo_manager_get_repo (session->repo_mgr, ptr->data);
+        if (!repo)
+            continue;
+
+        /* Virtual repos share the fs objects of their origin repos. */
+        if (repo->virtual_info) {
+            seaf_repo_unref (repo);
+            continue;
+        }
+
+        head = seaf_commit_manager_get_commit (session->commit_mgr,
+                                               repo->id, repo->version,
+                                               repo->head->commit_id);
+        if (head && head->ctime >= since) {
+            seaf_fs_manager_traverse_tree (session->fs_mgr,
+                                           repo->store_id, repo->version,
+                                           head->root_id,
+                                           warmup_dir_cb, NULL, TRUE);
+            ++n_warmed;
+        }
+
+        if (head)
+            seaf_commit_unref (head);
+        seaf_repo_unref (repo);
+    }
+
+    string_list_free (repo_ids);
+
+    seaf_message ("Warmed up object cache for %d libraries.\n", n_warmed);
+    return data;
+}
+
+static void
+schedule_obj_cache_warmup (SeafileSession *session)
+{
+    int days;
+
+    if (!seaf_obj_store_is_cached (session->fs_mgr->obj_store))
+        return;
+
+    days = g_key_file_get_integer (session->config,
+                                   "object_cache", "warmup_days", NULL);
+    if (days <= 0)
+        return;
+
+    ccnet_job_manager_schedule_job (session->job_mgr,
+                                    warmup_obj_cache,
+                                    NULL, session);
+}
@@ -0,0 +1,221 @@
+/* -*- Mode: C; tab-width: 4; indent-tabs-mode: nil; c-basic-offset: 4 -*- */
+
+#include "common.h"
+
+#include <pthread.h>
+#include <time.h>
+
+#include "ttl-cache.h"
+
+#define N_SHARDS 16
+
+typedef struct CacheEntry {
+    char       *key;
+    char       *value;
+    gint64      expire_time;
+    /* Link in the LRU queue, most recently used first. */
+    GList      *lru_link;
+    /* Link in the expire queue, latest expire time first. */
+    GList      *expire_link;
+} CacheEntry;
+
+/*
+ * All entries in a cache have the same life time, so the expire queue is
+ * kept sorted by just pushing to the head when an entry's expire time is
+ * set. Expired entries are then always at the tail.
+ */
+typedef struct CacheShard {
+    pthread_mutex_t     lock;
+    GHashTable         *entries;
+    GQueue             *lru;
+    GQueue             *expire;
+} CacheShard;
+
+struct TTLCache {
+    int                 max_shard_entries;
+    int                 ttl;
+    gboolean            refresh_on_hit;
+    CacheShard          shards[N_SHARDS];
+};
+
+static CacheShard *
+get_shard (TTLCache *cache, const char *key)
+{
+    return &cache->shards[g_str_hash (key) % N_SHARDS];
+}
+
+/* Must be called with the shard lock held. */
+static void
+remove_entry (CacheShard *shard, CacheEntry *entry)
+{
+    g_hash_table_remove (shard->entries, entry->key);
+    g_queue_delete_link (shard->lru, entry->lru_link);
+    g_queue_delete_link (shard->expire, entry->expire_link);
+
+    g_free (entry->key);
+    g_free (entry->value);
+    g_free (entry);
+}
+
+static void
+remove_expired (CacheShard *shard, gint64 now)
+{
+    CacheEntry *entry;
+
+    while ((entry = g_queue_peek_tail (shard->expire)) != NULL &&
+           entry->expire_time <= now)
+        remove_entry (shard, entry);
+}
+
+static void
+set_expire_time (TTLCache *cache, CacheShard *shard,
+                 CacheEntry *entry, gint64 now)
+{
+    entry->expire_time = now + cache->ttl;
+    g_queue_unlink (shard->expire, entry->expire_link);
+    g_queue_push_head_link (shard->expire, entry->expire_link);
+}
+
+TTLCache *
+ttl_cache_new (int max_entries, int ttl, gboolean refresh_on_hit)
+{
+    TTLCache *cache = g_new0 (TTLCache, 1);
+    CacheShard *shard;
+    int i;
+
+    cache->max_shard_entries = MAX (max_entries / N_SHARDS, 1);
+    cache->ttl = ttl;
+    cache->refresh_on_hit = refresh_on_hit;
+
+    for (i = 0; i < N_SHARDS; ++i) {
+        shard = &cache->shards[i];
+        pthread_mutex_init (&shard->lock, NULL);
+        shard->entries = g_hash_table_new (g_str_hash, g_str_equal);
+        shard->lru = g_queue_new ();
+        shard->expire = g_queue_new ();
+    }
+
+    return cache;
+}
+
+void
+ttl_cache_free (TTLCache *cache)
+{
+    CacheShard *shard;
+    int i;
+
+    if (!cache)
+        return;
+
+    for (i = 0; i < N_SHARDS; ++i) {
+        shard = &cache->shards[i];
+        while (!g_queue_is_empty (shard->lru))
+            remove_entry (shard, g_queue_peek_tail (shard->lru));
+        g_hash_table_destroy (shard->entries);
+        g_queue_free (shard->lru);
+        g_queue_free (shard->expire);
+        pthread_mutex_destroy (&shard->lock);
+    }
+
+    g_free (cache);
+}
+
+char *
+ttl_cache_lookup (TTLCache *cache, const char *key)
+{
+    CacheShard *shard = get_shard (cache, key);
+    CacheEntry *entry;
+    gint64 now = (gint64)time(NULL);
+    char *value = NULL;
+
+    pthread_mutex_lock (&shard->lock);
+
+    entry = g_hash_table_lookup (shard->entries, key);
+    if (entry && entry->expire_time <= now) {
+        remove_entry (shard, entry);
+        entry = NULL;
+    }
+
+    if (entry) {
+        value = g_strdup (entry->value);
+        g_queue_unlink (shard->lru, entry->lru_link);
+        g_queue_push_head_link (shard->lru, entry->lru_link);
+        if (cache->refresh_on_hit)
+            set_expire_time (cache, shard, entry, now);
+    }
+
+    pthread_mutex_unlock (&shard->lock);
+
+    return value;
+}
+
+void
+ttl_cache_insert (TTLCache *cache, const char *key, const char *value)
+{
+    CacheShard *shard = get_shard (cache, key);
+    CacheEntry *entry;
+    gint64 now = (gint64)time(NULL);
+
+    pthread_mutex_lock (&shard->lock);
+
+    entry = g_hash_table_lookup (shard->entries, key);
+    if (entry) {
+        g_free (entry->value);
+        entry->value = g_strdup (value);
+        g_queue_unlink (shard->lru, entry->lru_link);
+        g_queue_push_head_link (shard->lru, entry->lru_link);
+        set_expire_time (cache, shard, entry, now);
+        pthread_mutex_unlock (&shard->lock);
+        return;
+    }
+
+    /* Make room by dropping expired entries first. */
+    if (g_hash_table_size (shard->entries) >= cache->max_shard_entries) {
+        remove_expired (shard, now);
+        while (g_hash_table_size (shard->entries) >= cache->max_shard_entries)
+            remove_entry (shard, g_queue_peek_tail (shard->lru));
+    }
+
+    entry = g_new0 (CacheEntry, 1);
+    entry->key = g_strdup (key);
+    entry->value = g_strdup (value);
+    entry->expire_time = now + cache->ttl;
+
+    g_queue_push_head (shard->lru, entry);
+    entry->lru_link = g_queue_peek_head_link (shard->lru);
+    g_queue_push_head (shard->expire, entry);
+    entry->expire_link = g_queue_peek_head_link (shard->expire);
+    g_hash_table_insert (shard->entries, entry->key, entry);
+
+    pthread_mutex_unlock (&shard->lock);
+}
+
+void
+ttl_cache_remove (TTLCache *cache, const char *key)
+{
+    CacheShard *shard = get_shard (cache, key);
+    CacheEntry *entry;
+
+    pthread_mutex_lock (&shard->lock);
+
+    entry = g_hash_table_lookup (shard->entries, key);
+    if (entry)
+        remove_entry (shard, entry);
+
+    pthread_mutex_unlock (&shard->lock);
+}
+
+void
+ttl_cache_remove_expired (TTLCache *cache)
+{
+    gint64 now = (gint64)time(NULL);
+    CacheShard *shard;
+    int i;
+
+    for (i = 0; i < N_SHARDS; ++i) {
+        shard = &cache->shards[i];
+        pthread_mutex_lock (&shard->lock);
+        remove_expired (shard, now);
+        pthread_mutex_unlock (&shard->lock);
+    }
+}
@@ -0,0 +1,48 @@
+/* -*- Mode: C; tab-width: 4; indent-tabs-mode: nil; c-basic-offset: 4 -*- */
+
+#ifndef TTL_CACHE_H
+#define TTL_CACHE_H
+
+#include <glib.h>
+
+/*
+ * A thread-safe string cache whose entries expire after a fixed time.
+ *
+ * Keys are spread over a number of shards, each with its own lock, so
+ * lookups of different keys rarely wait for each other. Each shard holds
+ * at most max_entries / n_shards entries and evicts the least recently
+ * used one when it's full.
+ */
+
+typedef struct TTLCache TTLCache;
+
+/*
+ * @ttl is the life time of an entry in seconds. If @refresh_on_hit is TRUE,
+ * an entry expires @ttl seconds after it's last looked up instead of after
+ * it's inserted.
+ */
+TTLCache *
+ttl_cache_new (int max_entries, int ttl, gboolean refresh_on_hit);
+
+void
+ttl_cache_free (TTLCache *cache);
+
+/* Returns a copy of the cached value, or NULL if @key is not cached. */
+char *
+ttl_cache_lookup (TTLCache *cache, const char *key);
+
+/* Add or replace @key. The value is copied. */
+void
+ttl_cache_insert (TTLCache *cache, const char *key, const char *value);
+
+void
+ttl_cache_remove (TTLCache *cache, const char *key);
+
+/*
+ * Drop expired entries. Only the expired entries are visited, so this is
+ * cheap to call periodically.
+ */
+void
+ttl_cache_remove_expired (TTLCache *cache);
+
+#endif
@@ -67,6 +67,24 @@ typedef struct RecvFSM {
     int fd;
     GList *tmp_files;           /* tmp files for each uploading file */
 
+    /* If set, uploaded files are chunked into blocks as they're received,
+     * instead of being saved to temp files and indexed afterwards.
+     */
+    gboolean index_on_recv;
+    char *store_id;
+    int repo_version;
+    SeafileCrypt *crypt;
+    gint64 content_len;         /* used to choose the block size */
+    gint64 recved_size;         /* total size of indexed files */
+    SeafFileIndexer *indexer;
+    GList *file_ids;            /* ids of indexed files */
+    GList *file_sizes;          /* sizes of indexed files, gint64 pointers */
+    /* If set, file data is dropped instead of being indexed, and the
+     * upload fails with drop_error when it finishes.
+     */
+    gboolean drop_files;
+    int drop_error;
+
     /* For upload progress. */
     char *progress_id;
     Progress *progress;
@@ -247,6 +265,53 @@ file_list_to_json (GList *files)
     return ret;
 }
 
+/* Add the uploaded files to @parent_dir and commit. */
+static int
+post_uploaded_files (RecvFSM *fsm, const char *parent_dir, int replace,
+                     char **ret_json, GError **error)
+{
+    char *filenames_json, *tmp_files_json;
+    int rc;
+
+    if (fsm->index_on_recv) {
+        /* The lists are built in reverse order of the uploaded files. */
+        GList *filenames = g_list_reverse (g_list_copy (fsm->filenames));
+        GList *file_ids = g_list_reverse (g_list_copy (fsm->file_ids));
+        GList *file_sizes = g_list_reverse (g_list_copy (fsm->file_sizes));
+
+        rc = seaf_repo_manager_post_multi_indexed_files (seaf->repo_mgr,
+                                                         fsm->repo_id,
+                                                         parent_dir,
+                                                         filenames,
+                                                         file_ids,
+                                                         file_sizes,
+                                                         fsm->user,
+                                                         replace,
+                                                         ret_json,
+                                                         error);
+        g_list_free (filenames);
+        g_list_free (file_ids);
+        g_list_free (file_sizes);
+        return rc;
+    }
+
+    filenames_json = file_list_to_json (fsm->filenames);
+    tmp_files_json = file_list_to_json (fsm->files);
+
+    rc = seaf_repo_manager_post_multi_files (seaf->repo_mgr,
+                                             fsm->repo_id,
+                                             parent_dir,
+                                             filenames_json,
+                                             tmp_files_json,
+                                             fsm->user,
+                                             replace,
+                                             ret_json,
+                                             error);
+    g_free (filenames_json);
+    g_free (tmp_files_json);
+    return rc;
+}
+
 static void
 upload_cb(evhtp_request_t *req, void *arg)
 {
@@ -255,7 +320,6 @@ upload_cb(evhtp_request_t *req, void *arg)
     GError *error = NULL;
     int error_code = ERROR_INTERNAL;
     char *err_file = NULL;
-    char *filenames_json, *tmp_files_json;
 
     /* After upload_headers_cb() returns an error, libevhtp may still
      * receive data from the web browser and call into this cb.
@@ -264,7 +328,7 @@ upload_cb(evhtp_request_t *req, void *arg)
     if (!fsm || fsm->state == RECV_ERROR)
         return;
 
-    if (!fsm->files) {
+    if (!fsm->filenames) {
         seaf_warning ("[upload] No file uploaded.\n");
         set_content_length_header (req);
         evhtp_send_reply (req, EVHTP_RES_BADREQ);
@@ -280,6 +344,11 @@ upload_cb(evhtp_request_t *req, void *arg)
         return;
     }
 
+    if (fsm->drop_files) {
+        error_code = fsm->drop_error;
+        goto error;
+    }
+
     if (!check_tmp_file_list (fsm->files, &error_code))
         goto error;
 
@@ -288,20 +357,7 @@ upload_cb(evhtp_request_t *req, void *arg)
         goto error;
     }
 
-    filenames_json = file_list_to_json (fsm->filenames);
-    tmp_files_json = file_list_to_json (fsm->files);
-
-    int rc = seaf_repo_manager_post_multi_files (seaf->repo_mgr,
-                                                 fsm->repo_id,
-                                                 parent_dir,
-                                                 filenames_json,
-                                                 tmp_files_json,
-                                                 fsm->user,
-                                                 0,
-                                                 NULL,
-                                                 &error);
-    g_free (filenames_json);
-    g_free (tmp_files_json);
+    int rc = post_uploaded_files (fsm, parent_dir, 0, NULL, &error);
     if (rc < 0) {
         if (error) {
             if (error->code == POST_FILE_ERR_FILENAME) {
@@ -359,7 +415,6 @@ upload_api_cb(evhtp_request_t *req, void *arg)
     char *parent_dir, *replace_str;
     GError *error = NULL;
     int error_code = ERROR_INTERNAL;
-    char *filenames_json, *tmp_files_json;
     int replace = 0;
 
     /* After upload_headers_cb() returns an error, libevhtp may still
@@ -369,7 +424,7 @@ upload_api_cb(evhtp_request_t *req, void *arg)
     if (!fsm || fsm->state == RECV_ERROR)
         return;
 
-    if (!fsm->files) {
+    if (!fsm->filenames) {
         seaf_warning ("[upload] No file uploaded.\n");
         set_content_length_header (req);
         evhtp_send_reply (req, EVHTP_RES_BADREQ);
@@ -396,6 +451,11 @@ upload_api_cb(evhtp_request_t *req, void *arg)
         return;
     }
 
+    if (fsm->drop_files) {
+        error_code = fsm->drop_error;
+        goto error;
+    }
+
     if (!check_tmp_file_list (fsm->files, &error_code))
         goto error;
 
@@ -404,21 +464,8 @@ upload_api_cb(evhtp_request_t *req, void *arg)
         goto error;
     }
 
-    filenames_json = file_list_to_json (fsm->filenames);
-    tmp_files_json = file_list_to_json (fsm->files);
-
     char *ret_json = NULL;
-    int rc = seaf_repo_manager_post_multi_files (seaf->repo_mgr,
-                                                 fsm->repo_id,
-                                                 parent_dir,
-                                                 filenames_json,
-                                                 tmp_files_json,
-                                                 fsm->user,
-                                                 replace,
-                                                 &ret_json,
-                                                 &error);
-    g_free (filenames_json);
-    g_free (tmp_files_json);
+    int rc = post_uploaded_files (fsm, parent_dir, replace, &ret_json, &error);
     if (rc < 0) {
         if (error) {
             if (error->code == POST_FILE_ERR_FILENAME) {
@@ -722,7 +769,6 @@ upload_ajax_cb(evhtp_request_t *req, void *arg)
     char *parent_dir;
     GError *error = NULL;
     int error_code = ERROR_INTERNAL;
-    char *filenames_json, *tmp_files_json;
 
     evhtp_headers_add_header (req->headers_out,
                               evhtp_header_new("Access-Control-Allow-Headers",
@@ -758,7 +804,7 @@ upload_ajax_cb(evhtp_request_t *req, void *arg)
     if (!fsm || fsm->state == RECV_ERROR)
         return;
 
-    if (!fsm->files) {
+    if (!fsm->filenames) {
         seaf_warning ("[upload] No file uploaded.\n");
         set_content_length_header (req);
         evhtp_send_reply (req, EVHTP_RES_BADREQ);
@@ -774,6 +820,11 @@ upload_ajax_cb(evhtp_request_t *req, void *arg)
         return;
     }
 
+    if (fsm->drop_files) {
+        error_code = fsm->drop_error;
+        goto error;
+    }
+
     if (!check_tmp_file_list (fsm->files, &error_code))
         goto error;
 
@@ -782,21 +833,8 @@ upload_ajax_cb(evhtp_request_t *req, void *arg)
         goto error;
     }
 
-    filenames_json = file_list_to_json (fsm->filenames);
-    tmp_files_json = file_list_to_json (fsm->files);
-
     char *ret_json = NULL;
-    int rc = seaf_repo_manager_post_multi_files (seaf->repo_mgr,
-                                                 fsm->repo_id,
-                                                 parent_dir,
-                                                 filenames_json,
-                                                 tmp_files_json,
-                                                 fsm->user,
-                                                 0,
-                                                 &ret_json,
-                                                 &error);
-    g_free (filenames_json);
-    g_free (tmp_files_json);
+    int rc = post_uploaded_files (fsm, parent_dir, 0, &ret_json, &error);
     if (rc < 0) {
         if (error) {
             if (error->code == POST_FILE_ERR_FILENAME) {
@@ -1469,6 +1507,14 @@ upload_finish_cb (evhtp_request_t *req, void *arg)
     string_list_free (fsm->filenames);
     string_list_free (fsm->files);
 
+    seaf_file_indexer_free (fsm->indexer);
+    g_free (fsm->store_id);
+    g_free (fsm->crypt);
+    string_list_free (fsm->file_ids);
+    for (ptr = fsm->file_sizes; ptr; ptr = ptr->next)
+        g_free (ptr->data);
+    g_list_free (fsm->file_sizes);
+
     evbuffer_free (fsm->line);
 
     if (fsm->progress_id) {
@@ -1583,6 +1629,58 @@ open_temp_file (RecvFSM *fsm)
     return 0;
 }
 
+static int
+start_index_file (RecvFSM *fsm)
+{
+    fsm->indexer = seaf_fs_manager_file_indexer_new (seaf->fs_mgr,
+                                                     fsm->store_id,
+                                                     fsm->repo_version,
+                                                     fsm->content_len,
+                                                     fsm->crypt);
+    if (!fsm->indexer)
+        return -1;
+
+    return 0;
+}
+
+static evhtp_res
+write_file_data (RecvFSM *fsm, const char *buf, size_t len)
+{
+    if (fsm->drop_files)
+        return EVHTP_RES_OK;
+
+    if (!fsm->indexer) {
+        if (writen (fsm->fd, buf, len) < 0) {
+            seaf_warning ("[upload] Failed to write temp file: %s.\n",
+                          strerror(errno));
+            return EVHTP_RES_SERVERR;
+        }
+        return EVHTP_RES_OK;
+    }
+
+    /* Blocks are written as data arrives, so check the size limit now
+     * rather than after the upload finishes. The rest of the upload is
+     * dropped and the error is reported when it finishes.
+     */
+    fsm->recved_size += (gint64)len;
+    if (seaf->http_server->max_upload_size != -1 &&
+        fsm->recved_size > seaf->http_server->max_upload_size) {
+        seaf_warning ("[upload] File size is too large.\n");
+        seaf_file_indexer_free (fsm->indexer);
+        fsm->indexer = NULL;
+        fsm->drop_files = TRUE;
+        fsm->drop_error = ERROR_SIZE;
+        return EVHTP_RES_OK;
+    }
+
+    if (seaf_file_indexer_feed (fsm->indexer, buf, len) < 0) {
+        seaf_warning ("[upload] Failed to index uploaded file.\n");
+        return EVHTP_RES_SERVERR;
+    }
+
+    return EVHTP_RES_OK;
+}
+
 static evhtp_res
 recv_form_field (RecvFSM *fsm, gboolean *no_line)
 {
@@ -1614,19 +1712,40 @@ recv_form_field (RecvFSM *fsm, gboolean *no_line)
     return EVHTP_RES_OK;
 }
 
-static void
+static int
 add_uploaded_file (RecvFSM *fsm)
 {
+    if (fsm->indexer) {
+        unsigned char sha1[20];
+        char hex[41];
+        gint64 *size = g_new (gint64, 1);
+
+        if (seaf_file_indexer_finish (fsm->indexer, sha1, size) < 0) {
+            seaf_warning ("[upload] Failed to index uploaded file.\n");
+            g_free (size);
+            return -1;
+        }
+        seaf_file_indexer_free (fsm->indexer);
+        fsm->indexer = NULL;
+
+        rawdata_to_hex (sha1, hex, 20);
+        fsm->file_ids = g_list_prepend (fsm->file_ids, g_strdup(hex));
+        fsm->file_sizes = g_list_prepend (fsm->file_sizes, size);
+    } else if (!fsm->index_on_recv) {
+        fsm->files = g_list_prepend (fsm->files, g_strdup(fsm->tmp_file));
+
+        g_free (fsm->tmp_file);
+        close (fsm->fd);
+        fsm->tmp_file = NULL;
+    }
+
     fsm->filenames = g_list_prepend (fsm->filenames,
                                      get_basename(fsm->file_name));
-    fsm->files = g_list_prepend (fsm->files, g_strdup(fsm->tmp_file));
-
     g_free (fsm->file_name);
-    g_free (fsm->tmp_file);
-    close (fsm->fd);
     fsm->file_name = NULL;
-    fsm->tmp_file = NULL;
     fsm->recved_crlf = FALSE;
+
+    return 0;
 }
 
 static evhtp_res
@@ -1634,6 +1753,7 @@ recv_file_data (RecvFSM *fsm, gboolean *no_line)
 {
     char *line;
     size_t len;
+    evhtp_res res;
 
     *no_line = FALSE;
 
@@ -1648,30 +1768,28 @@ recv_file_data (RecvFSM *fsm, gboolean *no_line)
             seaf_debug ("[upload] recv file data %d bytes.\n",
                      evbuffer_get_length(fsm->line));
             if (fsm->recved_crlf) {
-                if (writen (fsm->fd, "\r\n", 2) < 0) {
-                    seaf_warning ("[upload] Failed to write temp file: %s.\n",
-                               strerror(errno));
-                    return EVHTP_RES_SERVERR;
-                }
+                res = write_file_data (fsm, "\r\n", 2);
+                if (res != EVHTP_RES_OK)
+                    return res;
             }
 
             size_t size = evbuffer_get_length (fsm->line);
             char *buf = g_new (char, size);
             evbuffer_remove (fsm->line, buf, size);
-            if (writen (fsm->fd, buf, size) < 0) {
-                seaf_warning ("[upload] Failed to write temp file: %s.\n",
-                           strerror(errno));
-                g_free (buf);
-                return EVHTP_RES_SERVERR;
-            }
+            res = write_file_data (fsm, buf, size);
             g_free (buf);
+            if (res != EVHTP_RES_OK)
+                return res;
             fsm->recved_crlf = FALSE;
         }
         *no_line = TRUE;
     } else if (strstr (line, fsm->boundary) != NULL) {
         seaf_debug ("[upload] file data ends.\n");
 
-        add_uploaded_file (fsm);
+        if (add_uploaded_file (fsm) < 0) {
+            free (line);
+            return EVHTP_RES_SERVERR;
+        }
 
         g_free (fsm->input_name);
         fsm->input_name = NULL;
@@ -1680,19 +1798,16 @@ recv_file_data (RecvFSM *fsm, gboolean *no_line)
     } else {
         seaf_debug ("[upload] recv file data %d bytes.\n", len + 2);
         if (fsm->recved_crlf) {
-            if (writen (fsm->fd, "\r\n", 2) < 0) {
-                seaf_warning ("[upload] Failed to write temp file: %s.\n",
-                           strerror(errno));
-                return EVHTP_RES_SERVERR;
+            res = write_file_data (fsm, "\r\n", 2);
+            if (res != EVHTP_RES_OK) {
+                free (line);
+                return res;
             }
         }
-        if (writen (fsm->fd, line, len) < 0) {
-            seaf_warning ("[upload] Failed to write temp file: %s.\n",
-                       strerror(errno));
-            free (line);
-            return EVHTP_RES_SERVERR;
-        }
+        res = write_file_data (fsm, line, len);
         free (line);
+        if (res != EVHTP_RES_OK)
+            return res;
         fsm->recved_crlf = TRUE;
     }
 
@@ -1766,7 +1881,13 @@ upload_read_cb (evhtp_request_t *req, evbuf_t *buf, void *arg)
                     /* Read an blank line, headers end. */
                     free (line);
                     if (g_strcmp0 (fsm->input_name, "file") == 0) {
-                        if (open_temp_file (fsm) < 0) {
+                        if (fsm->index_on_recv) {
+                            if (!fsm->drop_files && start_index_file (fsm) < 0) {
+                                seaf_warning ("[upload] Failed to start indexing file.\n");
+                                res = EVHTP_RES_SERVERR;
+                                goto out;
+                            }
+                        } else if (open_temp_file (fsm) < 0) {
                             seaf_warning ("[upload] Failed open temp file.\n");
                             res = EVHTP_RES_SERVERR;
                             goto out;
@@ -1925,11 +2046,51 @@ get_progress_info (evhtp_request_t *req,
     return 0;
 }
 
+/* Prepare to index uploaded files as they're received. If the repo is
+ * encrypted and the password is not set, files are saved to temp files
+ * as before, and the error is reported after the upload finishes.
+ */
+static void
+init_index_on_recv (RecvFSM *fsm)
+{
+    SeafRepo *repo;
+
+    /* Check the quota before any block is written. */
+    if (seaf_quota_manager_check_quota (seaf->quota_mgr, fsm->repo_id) < 0) {
+        fsm->index_on_recv = TRUE;
+        fsm->drop_files = TRUE;
+        fsm->drop_error = ERROR_QUOTA;
+        return;
+    }
+
+    repo = seaf_repo_manager_get_repo (seaf->repo_mgr, fsm->repo_id);
+    if (!repo)
+        return;
+
+    if (repo->encrypted) {
+        unsigned char key[32], iv[16];
+        if (seaf_passwd_manager_get_decrypt_key_raw (seaf->passwd_mgr,
+                                                     fsm->repo_id, fsm->user,
+                                                     key, iv) < 0) {
+            seaf_repo_unref (repo);
+            return;
+        }
+        fsm->crypt = seafile_crypt_new (repo->enc_version, key, iv);
+    }
+
+    fsm->store_id = g_strdup (repo->store_id);
+    fsm->repo_version = repo->version;
+    fsm->index_on_recv = TRUE;
+
+    seaf_repo_unref (repo);
+}
+
 static evhtp_res
-upload_headers_cb (evhtp_request_t *req, evhtp_headers_t *hdr, void *arg)
+start_recv (evhtp_request_t *req, evhtp_headers_t *hdr, gboolean index_on_recv)
 {
     char *token, *repo_id = NULL, *user = NULL;
     char *boundary = NULL;
+    const char *content_len_str;
     gint64 content_len;
     char *progress_id = NULL;
     char *err_msg = NULL;
@@ -1979,6 +2140,13 @@ upload_headers_cb (evhtp_request_t *req, evhtp_headers_t *hdr, void *arg)
     fsm->form_kvs = g_hash_table_new_full (g_str_hash, g_str_equal,
                                            g_free, g_free);
 
+    if (index_on_recv) {
+        content_len_str = evhtp_kv_find (hdr, "Content-Length");
+        if (content_len_str)
+            fsm->content_len = strtoll (content_len_str, NULL, 10);
+        init_index_on_recv (fsm);
+    }
+
     if (progress_id != NULL) {
         progress = g_new0 (Progress, 1);
         progress->size = content_len;
@@ -2018,6 +2186,21 @@ err:
     return EVHTP_RES_OK;
 }
 
+static evhtp_res
+upload_headers_cb (evhtp_request_t *req, evhtp_headers_t *hdr, void *arg)
+{
+    return start_recv (req, hdr, FALSE);
+}
+
+/* For uploads that add new files to a dir. Files uploaded to update
+ * existing files, or as raw blocks, are still saved to temp files.
+ */
+static evhtp_res
+upload_index_headers_cb (evhtp_request_t *req, evhtp_headers_t *hdr, void *arg)
+{
+    return start_recv (req, hdr, TRUE);
+}
+
 static void
 upload_progress_cb(evhtp_request_t *req, void *arg)
 {
@@ -2076,11 +2259,11 @@ upload_file_init (HttpServer *http_server)
     }
 
     cb = evhtp_set_regex_cb (htp, "^/upload/.*", upload_cb, NULL);
-    /* upload_headers_cb() will be called after evhtp parsed all http headers. */
-    evhtp_set_hook(&cb->hooks, evhtp_hook_on_headers, upload_headers_cb, NULL);
+    /* The headers hook will be called after evhtp parsed all http headers. */
+    evhtp_set_hook(&cb->hooks, evhtp_hook_on_headers, upload_index_headers_cb, NULL);
 
     cb = evhtp_set_regex_cb (htp, "^/upload-api/.*", upload_api_cb, NULL);
-    evhtp_set_hook(&cb->hooks, evhtp_hook_on_headers, upload_headers_cb, NULL);
+    evhtp_set_hook(&cb->hooks, evhtp_hook_on_headers, upload_index_headers_cb, NULL);
 
     cb = evhtp_set_regex_cb (htp, "^/upload-blks-api/.*", upload_blks_api_cb, NULL);
     evhtp_set_hook(&cb->hooks, evhtp_hook_on_headers, upload_headers_cb, NULL);
@@ -2089,7 +2272,7 @@ upload_file_init (HttpServer *http_server)
     evhtp_set_hook(&cb->hooks, evhtp_hook_on_headers, upload_headers_cb, NULL);
     
     cb = evhtp_set_regex_cb (htp, "^/upload-aj/.*", upload_ajax_cb, NULL);
-    evhtp_set_hook(&cb->hooks, evhtp_hook_on_headers, upload_headers_cb, NULL);
+    evhtp_set_hook(&cb->hooks, evhtp_hook_on_headers, upload_index_headers_cb, NULL);
     
     cb = evhtp_set_regex_cb (htp, "^/update/.*", update_cb, NULL);
     evhtp_set_hook(&cb->hooks, evhtp_hook_on_headers, upload_headers_cb, NULL);
@@ -0,0 +1,1011 @@
+#include "common.h"
+
+#define DEBUG_FLAG SEAFILE_DEBUG_HTTP
+#include "log.h"
+
+#include <fcntl.h>
+
+#if defined(__FreeBSD__) || defined(__NetBSD__) || defined(__OpenBSD__)
+#include <event2/event.h>
+#else
+#include <event.h>
+#endif
+
+#include <evhtp.h>
+
+#include <jansson.h>
+
+#include <pthread.h>
+
+#include "seafile-object.h"
+
+#include "utils.h"
+
+#include "seafile-session.h"
+#include "upload-session.h"
+#include "http-status-codes.h"
+
+/*
+ * Resumable uploads.
+ *
+ * POST   /upload-session/<token>?parent_dir=<dir>&file_name=<name>&size=<size>[&replace=1]
+ *        Creates a session, returns {"session_id": "<id>"}.
+ * PUT    /upload-session/<id>
+ *        Uploads a byte range of the file, given by the Content-Range header
+ *        ("bytes <start>-<end>/<size>"). Ranges may be sent in any order.
+ * GET    /upload-session/<id>
+ *        Returns {"size": <size>, "ranges": [[<start>, <end>], ...]},
+ *        the byte ranges received so far. Ends are inclusive.
+ * POST   /upload-session/<id>/commit
+ *        Adds the file to the repo after all bytes are received. Returns the
+ *        same json as upload-api with ret-json.
+ * DELETE /upload-session/<id>
+ *        Aborts the session.
+ *
+ * File content is written into a sparse file under the http temp dir, the
+ * session info and received ranges are saved next to it, so that sessions
+ * survive server restarts. If a PUT is interrupted, the bytes received
+ * before the interruption are kept.
+ */
+
+#define SESSION_DIR_NAME "upload-sessions"
+
+#define POST_FILE_ERR_FILENAME 401
+
+/* Sessions without activity for this long are removed. */
+#define SESSION_TTL_SEC (24 * 3600)
+
+typedef struct ByteRange {
+    gint64 start;
+    gint64 end;                 /* exclusive */
+} ByteRange;
+
+typedef struct UploadSession {
+    char *id;
+    char *repo_id;
+    char *user;
+    char *parent_dir;
+    char *file_name;
+    gint64 size;
+    int replace;
+
+    /* Protected by sessions_lock. */
+    gint64 mtime;
+    int ref_count;
+    gboolean committing;
+
+    /* Protects ranges, removed and the info file. */
+    pthread_mutex_t lock;
+    GList *ranges;              /* sorted, non-overlapping ByteRange's */
+    gboolean removed;           /* the session files have been deleted */
+} UploadSession;
+
+typedef struct PutData {
+    UploadSession *session;
+    int fd;
+    gint64 start;
+    gint64 len;
+    gint64 written;
+    gboolean error;
+    gboolean recorded;
+} PutData;
+
+static char *session_dir;
+static GHashTable *sessions;
+static pthread_mutex_t sessions_lock;
+
+static void
+set_content_length_header (evhtp_request_t *req)
+{
+    char lstr[128];
+
+    snprintf(lstr, sizeof(lstr), "%zu", evbuffer_get_length(req->buffer_out));
+
+    evhtp_headers_add_header(req->headers_out,
+                             evhtp_header_new("Content-Length", lstr, 1, 1));
+}
+
+static void
+send_reply (evhtp_request_t *req, int code, const char *msg)
+{
+    if (msg)
+        evbuffer_add_printf (req->buffer_out, "%s\n", msg);
+    set_content_length_header (req);
+    evhtp_send_reply (req, code);
+}
+
+static void
+send_json_reply (evhtp_request_t *req, json_t *object)
+{
+    char *json_data = json_dumps (object, 0);
+
+    evhtp_headers_add_header (req->headers_out,
+                              evhtp_header_new("Content-Type",
+                                               "application/json; charset=utf-8", 1, 1));
+    evbuffer_add (req->buffer_out, json_data, strlen(json_data));
+    free (json_data);
+    send_reply (req, EVHTP_RES_OK, NULL);
+}
+
+static char *
+session_file_path (const char *id, const char *ext)
+{
+    char *name = g_strconcat (id, ext, NULL);
+    char *path = g_build_filename (session_dir, name, NULL);
+
+    g_free (name);
+    return path;
+}
+
+/* Ranges */
+
+static GList *
+add_range (GList *ranges, gint64 start, gint64 end)
+{
+    GList *ptr, *next;
+    ByteRange *range, *new_range;
+
+    new_range = g_new0 (ByteRange, 1);
+    new_range->start = start;
+    new_range->end = end;
+
+    /* Merge with all ranges that overlap or touch the new range. */
+    for (ptr = ranges; ptr; ptr = next) {
+        next = ptr->next;
+        range = ptr->data;
+        if (range->end < new_range->start || range->start > new_range->end)
+            continue;
+        new_range->start = MIN (new_range->start, range->start);
+        new_range->end = MAX (new_range->end, range->end);
+        g_free (range);
+        ranges = g_list_delete_link (ranges, ptr);
+    }
+
+    for (ptr = ranges; ptr; ptr = ptr->next) {
+        range = ptr->data;
+        if (range->start > new_range->start)
+            break;
+    }
+
+    return g_list_insert_before (ranges, ptr, new_range);
+}
+
+static void
+free_ranges (GList *ranges)
+{
+    GList *ptr;
+
+    for (ptr = ranges; ptr; ptr = ptr->next)
+        g_free (ptr->data);
+    g_list_free (ranges);
+}
+
+static char *
+ranges_to_string (GList *ranges)
+{
+    GString *buf = g_string_new (NULL);
+    GList *ptr;
+    ByteRange *range;
+
+    for (ptr = ranges; ptr; ptr = ptr->next) {
+        range = ptr->data;
+        g_string_append_printf (buf, "%s%"G_GINT64_FORMAT"-%"G_GINT64_FORMAT,
+                                ptr == ranges ? "" : ";",
+                                range->start, range->end);
+    }
+
+    return g_string_free (buf, FALSE);
+}
+
+static GList *
+ranges_from_string (const char *str, gint64 size)
+{
+    char **pieces, **p;
+    gint64 start, end;
+    GList *ranges = NULL;
+
+    pieces = g_strsplit (str, ";", 0);
+    for (p = pieces; *p != NULL; ++p) {
+        if (**p == '\0')
+            continue;
+        if (sscanf (*p, "%"G_GINT64_FORMAT"-%"G_GINT64_FORMAT, &start, &end) != 2 ||
+            start < 0 || start >= end || end > size) {
+            seaf_warning ("[upload session] Invalid range %s.\n", *p);
+            continue;
+        }
+        ranges = add_range (ranges, start, end);
+    }
+    g_strfreev (pieces);
+
+    return ranges;
+}
+
+static gboolean
+is_complete (UploadSession *session)
+{
+    ByteRange *range;
+
+    if (session->size == 0)
+        return TRUE;
+    if (!session->ranges || session->ranges->next)
+        return FALSE;
+
+    range = session->ranges->data;
+    return (range->start == 0 && range->end == session->size);
+}
+
+/* Sessions */
+
+static UploadSession *
+upload_session_new (const char *id)
+{
+    UploadSession *session = g_new0 (UploadSession, 1);
+
+    session->id = g_strdup (id);
+    session->mtime = (gint64)time(NULL);
+    pthread_mutex_init (&session->lock, NULL);
+
+    return session;
+}
+
+static void
+upload_session_free (UploadSession *session)
+{
+    g_free (session->id);
+    g_free (session->repo_id);
+    g_free (session->user);
+    g_free (session->parent_dir);
+    g_free (session->file_name);
+    free_ranges (session->ranges);
+    pthread_mutex_destroy (&session->lock);
+    g_free (session);
+}
+
+static void
+remove_session_files (const char *id)
+{
+    char *path;
+
+    path = session_file_path (id, ".data");
+    g_unlink (path);
+    g_free (path);
+
+    path = session_file_path (id, ".info");
+    g_unlink (path);
+    g_free (path);
+}
+
+/* Must be called with session->lock held. */
+static int
+save_session_info (UploadSession *session)
+{
+    GKeyFile *key_file = g_key_file_new ();
+    char *ranges_str, *data, *path;
+    gsize len;
+    GError *error = NULL;
+    int ret = 0;
+
+    g_key_file_set_string (key_file, "session", "repo_id", session->repo_id);
+    g_key_file_set_string (key_file, "session", "user", session->user);
+    g_key_file_set_string (key_file, "session", "parent_dir", session->parent_dir);
+    g_key_file_set_string (key_file, "session", "file_name", session->file_name);
+    g_key_file_set_int64 (key_file, "session", "size", session->size);
+    g_key_file_set_integer (key_file, "session", "replace", session->replace);
+
+    ranges_str = ranges_to_string (session->ranges);
+    g_key_file_set_string (key_file, "session", "ranges", ranges_str);
+    g_free (ranges_str);
+
+    data = g_key_file_to_data (key_file, &len, NULL);
+    g_key_file_free (key_file);
+
+    /* g_file_set_contents() writes to a temp file and renames it, the old
+     * info stays valid if we crash in between.
+     */
+    path = session_file_path (session->id, ".info");
+    if (!g_file_set_contents (path, data, len, &error)) {
+        seaf_warning ("[upload session] Failed to save %s: %s.\n",
+                      path, error->message);
+        g_clear_error (&error);
+        ret = -1;
+    }
+
+    g_free (path);
+    g_free (data);
+    return ret;
+}
+
+static UploadSession *
+load_session_info (const char *id, const char *path)
+{
+    GKeyFile *key_file = g_key_file_new ();
+    UploadSession *session = NULL;
+    char *ranges_str = NULL;
+    GError *error = NULL;
+
+    if (!g_key_file_load_from_file (key_file, path, 0, &error)) {
+        seaf_warning ("[upload session] Failed to load %s: %s.\n",
+                      path, error->message);
+        g_clear_error (&error);
+        goto out;
+    }
+
+    session = upload_session_new (id);
+    session->repo_id = g_key_file_get_string (key_file, "session", "repo_id", NULL);
+    session->user = g_key_file_get_string (key_file, "session", "user", NULL);
+    session->parent_dir = g_key_file_get_string (key_file, "session", "parent_dir", NULL);
+    session->file_name = g_key_file_get_string (key_file, "session", "file_name", NULL);
+    session->size = g_key_file_get_int64 (key_file, "session", "size", &error);
+    if (error) {
+        g_clear_error (&error);
+        session->size = -1;
+    }
+    session->replace = g_key_file_get_integer (key_file, "session", "replace", NULL);
+
+    if (!session->repo_id || !session->user || !session->parent_dir ||
+        !session->file_name || session->size < 0) {
+        seaf_warning ("[upload session] Invalid session info %s.\n", path);
+        upload_session_free (session);
+        session = NULL;
+        goto out;
+    }
+
+    ranges_str = g_key_file_get_string (key_file, "session", "ranges", NULL);
+    if (ranges_str)
+        session->ranges = ranges_from_string (ranges_str, session->size);
+
+out:
+    g_free (ranges_str);
+    g_key_file_free (key_file);
+    return session;
+}
+
+static UploadSession *
+get_session (const char *id)
+{
+    UploadSession *session;
+
+    pthread_mutex_lock (&sessions_lock);
+    session = g_hash_table_lookup (sessions, id);
+    if (session) {
+        ++(session->ref_count);
+        session->mtime = (gint64)time(NULL);
+    }
+    pthread_mutex_unlock (&sessions_lock);
+
+    return session;
+}
+
+static void
+put_session (UploadSession *session)
+{
+    gboolean removed;
+
+    pthread_mutex_lock (&sessions_lock);
+    removed = (g_hash_table_lookup (sessions, session->id) != session);
+    if (--(session->ref_count) > 0)
+        removed = FALSE;
+    pthread_mutex_unlock (&sessions_lock);
+
+    /* The last reference of a removed session. */
+    if (removed)
+        upload_session_free (session);
+}
+
+/* Removes @session from the session table and deletes its files. The
+ * session is freed when the last reference is put.
+ */
+static void
+remove_session (UploadSession *session)
+{
+    pthread_mutex_lock (&sessions_lock);
+    if (g_hash_table_lookup (sessions, session->id) == session)
+        g_hash_table_remove (sessions, session->id);
+    pthread_mutex_unlock (&sessions_lock);
+
+    pthread_mutex_lock (&session->lock);
+    session->removed = TRUE;
+    remove_session_files (session->id);
+    pthread_mutex_unlock (&session->lock);
+}
+
+static gboolean
+is_session_expired (gpointer key, gpointer value, gpointer arg)
+{
+    UploadSession *session = value;
+    gint64 now = *(gint64 *)arg;
+
+    if (session->ref_count > 0 || session->mtime + SESSION_TTL_SEC > now)
+        return FALSE;
+
+    seaf_message ("[upload session] Session %s expired.\n", session->id);
+    remove_session_files (session->id);
+    upload_session_free (session);
+    return TRUE;
+}
+
+void
+upload_session_remove_expired ()
+{
+    gint64 now = (gint64)time(NULL);
+
+    pthread_mutex_lock (&sessions_lock);
+    g_hash_table_foreach_remove (sessions, is_session_expired, &now);
+    pthread_mutex_unlock (&sessions_lock);
+}
+
+/* Returns the session id from the url, and the action after it, if any. */
+static char *
+parse_session_path (evhtp_request_t *req, char **action)
+{
+    const char *path = req->uri->path->full;
+    char **pieces;
+    char *id = NULL;
+    int n;
+
+    *action = NULL;
+
+    /* /upload-session/<id>[/<action>] */
+    pieces = g_strsplit (path + strlen("/upload-session/"), "/", 0);
+    n = g_strv_length (pieces);
+    if (n == 0 || n > 2 || *pieces[0] == '\0') {
+        g_strfreev (pieces);
+        return NULL;
+    }
+
+    id = g_strdup (pieces[0]);
+    if (n == 2 && *pieces[1] != '\0')
+        *action = g_strdup (pieces[1]);
+    g_strfreev (pieces);
+
+    return id;
+}
+
+/* Create session */
+
+static void
+create_session (evhtp_request_t *req, const char *token)
+{
+    SeafileWebAccess *webaccess;
+    const char *parent_dir, *file_name, *size_str, *replace_str;
+    gint64 size;
+    int replace = 0;
+    char *id = NULL, *path = NULL;
+    UploadSession *session;
+    int fd;
+    json_t *object;
+
+    webaccess = (SeafileWebAccess *)
+        seaf_web_at_manager_query_access_token (seaf->web_at_mgr, token);
+    if (!webaccess) {
+        send_reply (req, EVHTP_RES_FORBIDDEN, "Access denied");
+        return;
+    }
+    if (g_strcmp0 (seafile_web_access_get_op (webaccess), "upload") != 0) {
+        g_object_unref (webaccess);
+        send_reply (req, EVHTP_RES_FORBIDDEN, "Access denied");
+        return;
+    }
+
+    parent_dir = evhtp_kv_find (req->uri->query, "parent_dir");
+    file_name = evhtp_kv_find (req->uri->query, "file_name");
+    size_str = evhtp_kv_find (req->uri->query, "size");
+    replace_str = evhtp_kv_find (req->uri->query, "replace");
+    size = size_str ? strtoll (size_str, NULL, 10) : -1;
+    if (replace_str)
+        replace = atoi (replace_str);
+    if (!parent_dir || !file_name || size < 0 || (replace != 0 && replace != 1)) {
+        g_object_unref (webaccess);
+        send_reply (req, EVHTP_RES_BADREQ, "Invalid argument");
+        return;
+    }
+
+    if (seaf->http_server->max_upload_size != -1 &&
+        size > seaf->http_server->max_upload_size) {
+        g_object_unref (webaccess);
+        send_reply (req, SEAF_HTTP_RES_TOOLARGE, "File size is too large");
+        return;
+    }
+
+    id = gen_uuid ();
+    session = upload_session_new (id);
+    session->repo_id = g_strdup (seafile_web_access_get_repo_id (webaccess));
+    session->user = g_strdup (seafile_web_access_get_username (webaccess));
+    session->parent_dir = g_uri_unescape_string (parent_dir, NULL);
+    session->file_name = g_uri_unescape_string (file_name, NULL);
+    session->size = size;
+    session->replace = replace;
+    g_object_unref (webaccess);
+
+    if (!session->parent_dir || !session->file_name) {
+        send_reply (req, EVHTP_RES_BADREQ, "Invalid argument");
+        goto error;
+    }
+
+    /* Data file is sparse, ranges can be written in any order. */
+    path = session_file_path (id, ".data");
+    fd = g_open (path, O_WRONLY | O_CREAT | O_EXCL | O_BINARY, 0666);
+    if (fd < 0) {
+        seaf_warning ("[upload session] Failed to create %s: %s.\n",
+                      path, strerror(errno));
+        send_reply (req, EVHTP_RES_SERVERR, "Internal server error");
+        goto error;
+    }
+    if (ftruncate (fd, size) < 0) {
+        seaf_warning ("[upload session] Failed to truncate %s: %s.\n",
+                      path, strerror(errno));
+        close (fd);
+        send_reply (req, EVHTP_RES_SERVERR, "Internal server error");
+        goto error;
+    }
+    close (fd);
+
+    if (save_session_info (session) < 0) {
+        send_reply (req, EVHTP_RES_SERVERR, "Internal server error");
+        goto error;
+    }
+
+    pthread_mutex_lock (&sessions_lock);
+    g_hash_table_insert (sessions, session->id, session);
+    pthread_mutex_unlock (&sessions_lock);
+
+    object = json_object ();
+    json_object_set_new (object, "session_id", json_string (id));
+    send_json_reply (req, object);
+    json_decref (object);
+
+    g_free (path);
+    g_free (id);
+    return;
+
+error:
+    remove_session_files (id);
+    upload_session_free (session);
+    g_free (path);
+    g_free (id);
+}
+
+/* Query session */
+
+static void
+get_session_status (evhtp_request_t *req, UploadSession *session)
+{
+    json_t *object, *array, *pair;
+    GList *ptr;
+    ByteRange *range;
+
+    object = json_object ();
+    json_object_set_new (object, "size", json_integer (session->size));
+
+    array = json_array ();
+    pthread_mutex_lock (&session->lock);
+    for (ptr = session->ranges; ptr; ptr = ptr->next) {
+        range = ptr->data;
+        pair = json_array ();
+        json_array_append_new (pair, json_integer (range->start));
+        json_array_append_new (pair, json_integer (range->end - 1));
+        json_array_append_new (array, pair);
+    }
+    pthread_mutex_unlock (&session->lock);
+    json_object_set_new (object, "ranges", array);
+
+    send_json_reply (req, object);
+    json_decref (object);
+}
+
+/* Upload data */
+
+static int
+parse_content_range (const char *str, gint64 size, gint64 *start, gint64 *end)
+{
+    gint64 total;
+
+    if (!str)
+        return -1;
+
+    /* bytes <start>-<end>/<size> */
+    if (sscanf (str, "bytes %"G_GINT64_FORMAT"-%"G_GINT64_FORMAT"/%"G_GINT64_FORMAT,
+                start, end, &total) != 3)
+        return -1;
+
+    if (total != size || *start < 0 || *start > *end || *end >= size)
+        return -1;
+
+    return 0;
+}
+
+/* Records the bytes written by a PUT request, even if the request didn't
+ * finish. Data is synced before it's recorded as received.
+ */
+static int
+record_put_data (PutData *data)
+{
+    UploadSession *session = data->session;
+    int ret = 0;
+
+    data->recorded = TRUE;
+    if (data->written == 0)
+        return 0;
+
+    if (fsync (data->fd) < 0) {
+        seaf_warning ("[upload session] Failed to sync data of session %s: %s.\n",
+                      session->id, strerror(errno));
+        return -1;
+    }
+
+    pthread_mutex_lock (&session->lock);
+    if (!session->removed) {
+        session->ranges = add_range (session->ranges,
+                                     data->start, data->start + data->written);
+        ret = save_session_info (session);
+    }
+    pthread_mutex_unlock (&session->lock);
+
+    return ret;
+}
+
+static evhtp_res
+put_read_cb (evhtp_request_t *req, evbuf_t *buf, void *arg)
+{
+    PutData *data = arg;
+    size_t len = evbuffer_get_length (buf);
+    unsigned char *p;
+    ssize_t n;
+
+    if (data->error) {
+        evbuffer_drain (buf, len);
+        return EVHTP_RES_OK;
+    }
+
+    if (data->written + (gint64)len > data->len) {
+        seaf_warning ("[upload session] More data than the given range.\n");
+        goto error;
+    }
+
+    p = evbuffer_pullup (buf, -1);
+    while (len > 0) {
+        n = pwrite (data->fd, p, len, data->start + data->written);
+        if (n < 0) {
+            if (errno == EINTR)
+                continue;
+            seaf_warning ("[upload session] Failed to write data: %s.\n",
+                          strerror(errno));
+            goto error;
+        }
+        data->written += n;
+        p += n;
+        len -= n;
+    }
+
+    /* Drain the buffer so that evhtp don't copy it to another buffer
+     * after this callback returns.
+     */
+    evbuffer_drain (buf, evbuffer_get_length (buf));
+    return EVHTP_RES_OK;
+
+error:
+    evbuffer_drain (buf, evbuffer_get_length (buf));
+    data->error = TRUE;
+
+    /* Don't receive any data before the connection is closed. */
+    evhtp_request_pause (req);
+    req->keepalive = 0;
+    send_reply (req, EVHTP_RES_BADREQ, NULL);
+    return EVHTP_RES_OK;
+}
+
+static evhtp_res
+put_finish_cb (evhtp_request_t *req, void *arg)
+{
+    PutData *data = arg;
+
+    if (!data->recorded)
+        record_put_data (data);
+
+    close (data->fd);
+    put_session (data->session);
+    g_free (data);
+
+    return EVHTP_RES_OK;
+}
+
+static evhtp_res
+put_headers_cb (evhtp_request_t *req, UploadSession *session)
+{
+    const char *range_str;
+    gint64 start, end;
+    char *path;
+    PutData *data;
+    int fd;
+
+    range_str = evhtp_kv_find (req->headers_in, "Content-Range");
+    if (parse_content_range (range_str, session->size, &start, &end) < 0) {
+        seaf_warning ("[upload session] Invalid Content-Range %s.\n",
+                      range_str ? range_str : "");
+        return EVHTP_RES_BADREQ;
+    }
+
+    path = session_file_path (session->id, ".data");
+    fd = g_open (path, O_WRONLY | O_BINARY, 0);
+    if (fd < 0) {
+        seaf_warning ("[upload session] Failed to open %s: %s.\n",
+                      path, strerror(errno));
+        g_free (path);
+        return EVHTP_RES_SERVERR;
+    }
+    g_free (path);
+
+    data = g_new0 (PutData, 1);
+    data->session = session;
+    data->fd = fd;
+    data->start = start;
+    data->len = end - start + 1;
+
+    /* Write data to the session file as it's received. */
+    evhtp_set_hook (&req->hooks, evhtp_hook_on_read, put_read_cb, data);
+    evhtp_set_hook (&req->hooks, evhtp_hook_on_request_fini, put_finish_cb, data);
+    req->cbarg = data;
+
+    return EVHTP_RES_OK;
+}
+
+static void
+put_data (evhtp_request_t *req, PutData *data)
+{
+    if (data->error)
+        return;
+
+    if (data->written != data->len) {
+        seaf_warning ("[upload session] Received %"G_GINT64_FORMAT
+                      " bytes, range length is %"G_GINT64_FORMAT".\n",
+                      data->written, data->len);
+        send_reply (req, EVHTP_RES_BADREQ, "Incomplete range");
+        return;
+    }
+
+    if (record_put_data (data) < 0) {
+        send_reply (req, EVHTP_RES_SERVERR, "Internal server error");
+        return;
+    }
+
+    get_session_status (req, data->session);
+}
+
+/* Commit */
+
+static void
+commit_session (evhtp_request_t *req, UploadSession *session)
+{
+    char *path = NULL, *filenames_json = NULL, *paths_json = NULL;
+    char *ret_json = NULL;
+    json_t *array;
+    GError *error = NULL;
+    gboolean complete;
+
+    pthread_mutex_lock (&session->lock);
+    complete = is_complete (session);
+    pthread_mutex_unlock (&session->lock);
+    if (!complete) {
+        send_reply (req, EVHTP_RES_BADREQ, "Upload is not complete");
+        return;
+    }
+
+    pthread_mutex_lock (&sessions_lock);
+    if (session->committing) {
+        pthread_mutex_unlock (&sessions_lock);
+        send_reply (req, EVHTP_RES_CONFLICT, "Session is being committed");
+        return;
+    }
+    session->committing = TRUE;
+    pthread_mutex_unlock (&sessions_lock);
+
+    if (seaf_quota_manager_check_quota (seaf->quota_mgr, session->repo_id) < 0) {
+        send_reply (req, SEAF_HTTP_RES_NOQUOTA, "Out of quota");
+        goto out;
+    }
+
+    path = session_file_path (session->id, ".data");
+
+    array = json_array ();
+    json_array_append_new (array, json_string (session->file_name));
+    filenames_json = json_dumps (array, 0);
+    json_decref (array);
+
+    array = json_array ();
+    json_array_append_new (array, json_string (path));
+    paths_json = json_dumps (array, 0);
+    json_decref (array);
+
+    if (seaf_repo_manager_post_multi_files (seaf->repo_mgr,
+                                            session->repo_id,
+                                            session->parent_dir,
+                                            filenames_json,
+                                            paths_json,
+                                            session->user,
+                                            session->replace,
+                                            &ret_json,
+                                            &error) < 0) {
+        if (error && error->code == POST_FILE_ERR_FILENAME)
+            send_reply (req, SEAF_HTTP_RES_BADFILENAME, "Invalid filename");
+        else
+            send_reply (req, EVHTP_RES_SERVERR, "Internal server error");
+        g_clear_error (&error);
+        goto out;
+    }
+
+    remove_session (session);
+
+    evhtp_headers_add_header (req->headers_out,
+                              evhtp_header_new("Content-Type",
+                                               "application/json; charset=utf-8", 1, 1));
+    evbuffer_add (req->buffer_out, ret_json, strlen(ret_json));
+    send_reply (req, EVHTP_RES_OK, NULL);
+
+out:
+    pthread_mutex_lock (&sessions_lock);
+    session->committing = FALSE;
+    pthread_mutex_unlock (&sessions_lock);
+
+    g_free (path);
+    free (filenames_json);
+    free (paths_json);
+    g_free (ret_json);
+}
+
+/* Request handlers */
+
+static evhtp_res
+upload_session_headers_cb (evhtp_request_t *req, evhtp_headers_t *hdr, void *arg)
+{
+    char *id, *action;
+    UploadSession *session;
+    evhtp_res res;
+
+    if (evhtp_request_get_method(req) != htp_method_PUT)
+        return EVHTP_RES_OK;
+
+    id = parse_session_path (req, &action);
+    if (!id || action) {
+        res = EVHTP_RES_BADREQ;
+        goto err;
+    }
+
+    session = get_session (id);
+    if (!session) {
+        res = EVHTP_RES_NOTFOUND;
+        goto err;
+    }
+
+    res = put_headers_cb (req, session);
+    if (res != EVHTP_RES_OK) {
+        put_session (session);
+        goto err;
+    }
+
+    g_free (id);
+    g_free (action);
+    return EVHTP_RES_OK;
+
+err:
+    /* Don't receive any data before the connection is closed. */
+    evhtp_request_pause (req);
+    req->keepalive = 0;
+    send_reply (req, res, NULL);
+
+    g_free (id);
+    g_free (action);
+    return EVHTP_RES_OK;
+}
+
+static void
+upload_session_cb (evhtp_request_t *req, void *arg)
+{
+    htp_method method = evhtp_request_get_method (req);
+    char *id, *action;
+    UploadSession *session;
+
+    if (method == htp_method_PUT) {
+        /* If the headers cb failed, the reply has been sent. */
+        if (req->cbarg)
+            put_data (req, req->cbarg);
+        return;
+    }
+
+    id = parse_session_path (req, &action);
+    if (!id) {
+        send_reply (req, EVHTP_RES_BADREQ, "Invalid URL");
+        return;
+    }
+
+    if (method == htp_method_POST && !action) {
+        /* The id is an upload token. */
+        create_session (req, id);
+        goto out;
+    }
+
+    session = get_session (id);
+    if (!session) {
+        send_reply (req, EVHTP_RES_NOTFOUND, "Session not found");
+        goto out;
+    }
+
+    if (method == htp_method_GET && !action)
+        get_session_status (req, session);
+    else if (method == htp_method_POST && g_strcmp0 (action, "commit") == 0)
+        commit_session (req, session);
+    else if (method == htp_method_DELETE && !action) {
+        remove_session (session);
+        send_reply (req, EVHTP_RES_OK, NULL);
+    } else
+        send_reply (req, EVHTP_RES_METHNALLOWED, NULL);
+
+    put_session (session);
+
+out:
+    g_free (id);
+    g_free (action);
+}
+
+/* Init */
+
+static void
+load_sessions ()
+{
+    GDir *dir;
+    const char *dname;
+    char *id, *path, *data_path;
+    UploadSession *session;
+    gint64 now = (gint64)time(NULL);
+    SeafStat st;
+
+    dir = g_dir_open (session_dir, 0, NULL);
+    if (!dir)
+        return;
+
+    while ((dname = g_dir_read_name (dir)) != NULL) {
+        if (!g_str_has_suffix (dname, ".info"))
+            continue;
+
+        id = g_strndup (dname, strlen(dname) - strlen(".info"));
+        path = g_build_filename (session_dir, dname, NULL);
+        data_path = session_file_path (id, ".data");
+
+        /* Session info is saved whenever data is received. */
+        if (seaf_stat (path, &st) < 0 || st.st_mtime + SESSION_TTL_SEC <= now ||
+            !g_file_test (data_path, G_FILE_TEST_IS_REGULAR) ||
+            !(session = load_session_info (id, path))) {
+            remove_session_files (id);
+        } else
+            g_hash_table_insert (sessions, session->id, session);
+
+        g_free (id);
+        g_free (path);
+        g_free (data_path);
+    }
+
+    g_dir_close (dir);
+}
+
+int
+upload_session_init (HttpServer *http_server)
+{
+    session_dir = g_build_filename (http_server->http_temp_dir,
+                                    SESSION_DIR_NAME, NULL);
+    if (g_mkdir_with_parents (session_dir, 0777) < 0) {
+        seaf_warning ("Failed to create upload session dir %s.\n", session_dir);
+        return -1;
+    }
+
+    sessions = g_hash_table_new (g_str_hash, g_str_equal);
+    pthread_mutex_init (&sessions_lock, NULL);
+
+    load_sessions ();
+
+    evhtp_callback_t *cb = evhtp_set_regex_cb (http_server->evhtp,
+                                               "^/upload-session/.*",
+                                               upload_session_cb, NULL);
+    evhtp_set_hook (&cb->hooks, evhtp_hook_on_headers,
+                    upload_session_headers_cb, NULL);
+
+    return 0;
+}
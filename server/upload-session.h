@@ -0,0 +1,13 @@
+#ifndef UPLOAD_SESSION_H
+#define UPLOAD_SESSION_H
+
+struct HttpServer;
+
+int
+upload_session_init (struct HttpServer *http_server);
+
+/* Called periodically to remove sessions that are not used for a day. */
+void
+upload_session_remove_expired ();
+
+#endif
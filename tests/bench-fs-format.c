@@ -0,0 +1,438 @@
+/* -*- Mode: C; tab-width: 4; indent-tabs-mode: nil; c-basic-offset: 4 -*- */
+
+/*
+ * Compare the json (version 1) and binary (version 2) fs object formats.
+ *
+ * bench-fs-format [n_dirents] [n_blocks] [iterations]
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/stat.h>
+
+#include <glib.h>
+#include <jansson.h>
+
+#include "utils.h"
+#include "fs-binary.h"
+
+#define N_MODIFIERS 5
+
+typedef struct TestDirent {
+    guint32 mode;
+    guint8  raw_id[20];
+    char    id[41];
+    char    *name;
+    gint64  mtime;
+    char    *modifier;
+    gint64  size;
+} TestDirent;
+
+typedef struct Result {
+    const char *name;
+    int         size;
+    double      encode;
+    double      decode;
+} Result;
+
+static void
+random_id (guint8 *raw_id, char *id)
+{
+    int i;
+
+    for (i = 0; i < 20; ++i)
+        raw_id[i] = (guint8)g_random_int_range (0, 256);
+    rawdata_to_hex (raw_id, id, 20);
+}
+
+static TestDirent *
+make_dirents (int n)
+{
+    TestDirent *dents = g_new0 (TestDirent, n);
+    int i;
+
+    /* Names are generated in descending order, like dirents in dir objects. */
+    for (i = 0; i < n; ++i) {
+        TestDirent *d = &dents[i];
+        random_id (d->raw_id, d->id);
+        if (i % 10 == 0) {
+            d->mode = S_IFDIR;
+            d->name = g_strdup_printf ("item %06d", n - i);
+        } else {
+            d->mode = S_IFREG | 0644;
+            d->name = g_strdup_printf ("item %06d.docx", n - i);
+            d->modifier = g_strdup_printf ("user%d@example.com",
+                                           i % N_MODIFIERS);
+            d->size = g_random_int ();
+        }
+        d->mtime = 1400000000 + g_random_int_range (0, 100000000);
+    }
+
+    return dents;
+}
+
+/* Encoders and decoders following fs-mgr.c. */
+
+static guint8 *
+dir_to_json (TestDirent *dents, int n, int *len)
+{
+    json_t *object, *array, *dent;
+    guint8 *compressed;
+    unsigned char sha1[20];
+    char *data;
+    int i;
+
+    object = json_object ();
+    json_object_set_int_member (object, "type", SEAF_BIN_TYPE_DIR);
+    json_object_set_int_member (object, "version", 1);
+
+    array = json_array ();
+    for (i = 0; i < n; ++i) {
+        dent = json_object ();
+        json_object_set_int_member (dent, "mode", dents[i].mode);
+        json_object_set_string_member (dent, "id", dents[i].id);
+        json_object_set_string_member (dent, "name", dents[i].name);
+        json_object_set_int_member (dent, "mtime", dents[i].mtime);
+        if (S_ISREG(dents[i].mode)) {
+            json_object_set_string_member (dent, "modifier", dents[i].modifier);
+            json_object_set_int_member (dent, "size", dents[i].size);
+        }
+        json_array_append_new (array, dent);
+    }
+    json_object_set_new (object, "dirents", array);
+
+    data = json_dumps (object, JSON_SORT_KEYS);
+    calculate_sha1 (sha1, data, strlen(data));
+    seaf_compress ((guint8 *)data, strlen(data), &compressed, len);
+
+    free (data);
+    json_decref (object);
+    return compressed;
+}
+
+static int
+dir_from_json (guint8 *data, int len)
+{
+    guint8 *decompressed;
+    int outlen;
+    json_t *object, *array, *dent;
+    json_error_t error;
+    GList *names = NULL, *ptr;
+    int i, n;
+
+    if (seaf_decompress (data, len, &decompressed, &outlen) < 0)
+        return -1;
+
+    object = json_loadb ((const char *)decompressed, outlen, 0, &error);
+    g_free (decompressed);
+    if (!object)
+        return -1;
+
+    array = json_object_get (object, "dirents");
+    n = json_array_size (array);
+    for (i = 0; i < n; ++i) {
+        dent = json_array_get (array, i);
+        names = g_list_prepend (names,
+            g_strdup (json_object_get_string_member (dent, "id")));
+        names = g_list_prepend (names,
+            g_strdup (json_object_get_string_member (dent, "name")));
+        if (S_ISREG(json_object_get_int_member (dent, "mode")))
+            names = g_list_prepend (names,
+                g_strdup (json_object_get_string_member (dent, "modifier")));
+    }
+    json_decref (object);
+
+    for (ptr = names; ptr; ptr = ptr->next)
+        g_free (ptr->data);
+    g_list_free (names);
+
+    return n;
+}
+
+static guint8 *
+dir_to_binary (TestDirent *dents, int n, int *len)
+{
+    SeafBinDirWriter *writer;
+    unsigned char sha1[20];
+    guint8 *data;
+    int i;
+
+    writer = seaf_bin_dir_writer_new (2);
+    for (i = 0; i < n; ++i)
+        seaf_bin_dir_writer_add (writer, dents[i].mode, dents[i].raw_id,
+                                 dents[i].name, strlen(dents[i].name),
+                                 dents[i].mtime, dents[i].modifier,
+                                 dents[i].size);
+    data = seaf_bin_dir_writer_finish (writer, len);
+    calculate_sha1 (sha1, (const char *)data, *len);
+
+    return data;
+}
+
+static int
+dir_from_binary (guint8 *data, int len, gboolean copy)
+{
+    SeafBinDirReader reader;
+    SeafBinDirent dent;
+    GList *names = NULL, *ptr;
+    char id[41];
+    int n = 0;
+
+    if (seaf_bin_dir_reader_init (&reader, data, len) < 0)
+        return -1;
+
+    while (seaf_bin_dir_reader_next (&reader, &dent) > 0) {
+        ++n;
+        if (!copy)
+            continue;
+        rawdata_to_hex (dent.id, id, 20);
+        names = g_list_prepend (names, g_strdup (id));
+        names = g_list_prepend (names, g_strndup (dent.name, dent.name_len));
+        if (S_ISREG(dent.mode))
+            names = g_list_prepend (names,
+                g_strndup (dent.modifier, dent.modifier_len));
+    }
+    seaf_bin_dir_reader_clear (&reader);
+
+    for (ptr = names; ptr; ptr = ptr->next)
+        g_free (ptr->data);
+    g_list_free (names);
+
+    return n;
+}
+
+static int
+lookup_binary (guint8 *data, int len, const char *name)
+{
+    SeafBinDirReader reader;
+    SeafBinDirent dent;
+    int rc;
+
+    if (seaf_bin_dir_reader_init (&reader, data, len) < 0)
+        return -1;
+    rc = seaf_bin_dir_lookup (&reader, name, strlen(name), &dent);
+    seaf_bin_dir_reader_clear (&reader);
+
+    return rc;
+}
+
+static guint8 *
+file_to_json (guint8 *raw_ids, int n, int *len)
+{
+    json_t *object, *array;
+    guint8 *compressed;
+    char block_id[41];
+    char *data;
+    int i;
+
+    object = json_object ();
+    json_object_set_int_member (object, "type", SEAF_BIN_TYPE_FILE);
+    json_object_set_int_member (object, "version", 1);
+    json_object_set_int_member (object, "size", (gint64)n << 20);
+
+    array = json_array ();
+    for (i = 0; i < n; ++i) {
+        rawdata_to_hex (raw_ids + i * 20, block_id, 20);
+        json_array_append_new (array, json_string (block_id));
+    }
+    json_object_set_new (object, "block_ids", array);
+
+    data = json_dumps (object, JSON_SORT_KEYS);
+    seaf_compress ((guint8 *)data, strlen(data), &compressed, len);
+
+    free (data);
+    json_decref (object);
+    return compressed;
+}
+
+static int
+file_from_json (guint8 *data, int len)
+{
+    guint8 *decompressed;
+    int outlen;
+    json_t *object, *array;
+    json_error_t error;
+    char **ids;
+    int i, n;
+
+    if (seaf_decompress (data, len, &decompressed, &outlen) < 0)
+        return -1;
+
+    object = json_loadb ((const char *)decompressed, outlen, 0, &error);
+    g_free (decompressed);
+    if (!object)
+        return -1;
+
+    array = json_object_get (object, "block_ids");
+    n = json_array_size (array);
+    ids = g_new0 (char *, n);
+    for (i = 0; i < n; ++i)
+        ids[i] = g_strdup (json_string_value (json_array_get (array, i)));
+    json_decref (object);
+
+    for (i = 0; i < n; ++i)
+        g_free (ids[i]);
+    g_free (ids);
+
+    return n;
+}
+
+static int
+file_from_binary (guint8 *data, int len)
+{
+    int version;
+    guint64 file_size;
+    const guint8 *block_ids;
+    guint32 n_blocks, i;
+    char **ids;
+
+    if (seaf_bin_file_parse (data, len, &version, &file_size,
+                             &block_ids, &n_blocks) < 0)
+        return -1;
+
+    ids = g_new0 (char *, n_blocks);
+    for (i = 0; i < n_blocks; ++i) {
+        ids[i] = g_new0 (char, 41);
+        rawdata_to_hex (block_ids + i * 20, ids[i], 20);
+    }
+
+    for (i = 0; i < n_blocks; ++i)
+        g_free (ids[i]);
+    g_free (ids);
+
+    return n_blocks;
+}
+
+static void
+print_result (Result *r, int iterations)
+{
+    printf ("%-20s %10d %12.2f %12.2f\n", r->name, r->size,
+            r->encode * 1e6 / iterations, r->decode * 1e6 / iterations);
+}
+
+int
+main (int argc, char **argv)
+{
+    int n_dirents = 1000, n_blocks = 1000, iterations = 200;
+    TestDirent *dents;
+    guint8 *raw_ids;
+    guint8 *json_dir, *bin_dir, *json_file, *bin_file;
+    int json_dir_len, bin_dir_len, json_file_len, bin_file_len;
+    Result results[6];
+    GTimer *timer;
+    int i, j;
+
+    if (argc > 1)
+        n_dirents = atoi (argv[1]);
+    if (argc > 2)
+        n_blocks = atoi (argv[2]);
+    if (argc > 3)
+        iterations = atoi (argv[3]);
+    if (n_dirents <= 0 || n_blocks <= 0 || iterations <= 0) {
+        printf ("bench-fs-format [n_dirents] [n_blocks] [iterations]\n");
+        exit (1);
+    }
+
+    dents = make_dirents (n_dirents);
+    raw_ids = g_new (guint8, n_blocks * 20);
+    for (i = 0; i < n_blocks * 20; ++i)
+        raw_ids[i] = (guint8)g_random_int_range (0, 256);
+
+    memset (results, 0, sizeof(results));
+    results[0].name = "dir json";
+    results[1].name = "dir binary";
+    results[2].name = "dir binary (view)";
+    results[3].name = "file json";
+    results[4].name = "file binary";
+    results[5].name = "dir binary lookup";
+
+    timer = g_timer_new ();
+
+    for (i = 0; i < iterations; ++i) {
+        g_timer_start (timer);
+        json_dir = dir_to_json (dents, n_dirents, &json_dir_len);
+        results[0].encode += g_timer_elapsed (timer, NULL);
+
+        g_timer_start (timer);
+        bin_dir = dir_to_binary (dents, n_dirents, &bin_dir_len);
+        results[1].encode += g_timer_elapsed (timer, NULL);
+        results[2].encode = results[5].encode = results[1].encode;
+
+        g_timer_start (timer);
+        if (dir_from_json (json_dir, json_dir_len) != n_dirents) {
+            printf ("Failed to parse json dir.\n");
+            exit (1);
+        }
+        results[0].decode += g_timer_elapsed (timer, NULL);
+
+        g_timer_start (timer);
+        if (dir_from_binary (bin_dir, bin_dir_len, TRUE) != n_dirents) {
+            printf ("Failed to parse binary dir.\n");
+            exit (1);
+        }
+        results[1].decode += g_timer_elapsed (timer, NULL);
+
+        g_timer_start (timer);
+        dir_from_binary (bin_dir, bin_dir_len, FALSE);
+        results[2].decode += g_timer_elapsed (timer, NULL);
+
+        /* Dirents are sorted, so the binary dir is indexed. */
+        g_timer_start (timer);
+        if (lookup_binary (bin_dir, bin_dir_len,
+                           dents[i % n_dirents].name) != 1) {
+            printf ("Failed to look up binary dir.\n");
+            exit (1);
+        }
+        results[5].decode += g_timer_elapsed (timer, NULL);
+
+        g_timer_start (timer);
+        json_file = file_to_json (raw_ids, n_blocks, &json_file_len);
+        results[3].encode += g_timer_elapsed (timer, NULL);
+
+        g_timer_start (timer);
+        bin_file = seaf_bin_file_encode (2, (guint64)n_blocks << 20,
+                                         raw_ids, n_blocks, &bin_file_len);
+        results[4].encode += g_timer_elapsed (timer, NULL);
+
+        g_timer_start (timer);
+        if (file_from_json (json_file, json_file_len) != n_blocks) {
+            printf ("Failed to parse json file.\n");
+            exit (1);
+        }
+        results[3].decode += g_timer_elapsed (timer, NULL);
+
+        g_timer_start (timer);
+        if (file_from_binary (bin_file, bin_file_len) != n_blocks) {
+            printf ("Failed to parse binary file.\n");
+            exit (1);
+        }
+        results[4].decode += g_timer_elapsed (timer, NULL);
+
+        results[0].size = json_dir_len;
+        results[1].size = results[2].size = results[5].size = bin_dir_len;
+        results[3].size = json_file_len;
+        results[4].size = bin_file_len;
+
+        g_free (json_dir);
+        g_free (bin_dir);
+        g_free (json_file);
+        g_free (bin_file);
+    }
+
+    printf ("%d dirents, %d blocks, %d iterations\n\n",
+            n_dirents, n_blocks, iterations);
+    printf ("%-20s %10s %12s %12s\n", "format", "bytes", "encode(us)", "decode(us)");
+    for (j = 0; j < G_N_ELEMENTS(results); ++j)
+        print_result (&results[j], iterations);
+
+    g_timer_destroy (timer);
+    for (i = 0; i < n_dirents; ++i) {
+        g_free (dents[i].name);
+        g_free (dents[i].modifier);
+    }
+    g_free (dents);
+    g_free (raw_ids);
+
+    return 0;
+}
@@ -92,6 +92,99 @@ int test_write_chunk (CDCDescriptor *chunk_descr,
     return ret;
 }
 
+static int
+checksum_chunk (const char *repo_id,
+                int version,
+                CDCDescriptor *chunk_descr,
+                struct SeafileCrypt *crypt,
+                uint8_t *checksum,
+                gboolean write_data)
+{
+    SHA_CTX ctx;
+
+    SHA1_Init (&ctx);
+    SHA1_Update (&ctx, chunk_descr->block_buf, chunk_descr->len);
+    SHA1_Final (checksum, &ctx);
+    return 0;
+}
+
+/* Feed the file to a CDCStream in pieces of varying sizes, and check
+ * that it's cut into the same blocks as by file_chunk_cdc().
+ */
+int test_stream (const char *src_filename)
+{
+    static const size_t piece_sizes[] = {
+        1, 47, 4096, 4097, 65536 + 13, 1024 * 1024 * 3 + 5
+    };
+    CDCFileDescriptor file_descr, stream_descr;
+    CDCStream *stream;
+    char *buf;
+    ssize_t n;
+    int fd, i = 0, ret = 0;
+
+    memset (&file_descr, 0, sizeof (file_descr));
+    file_descr.write_block = checksum_chunk;
+    if (filename_chunk_cdc (src_filename, &file_descr, NULL, FALSE) < 0) {
+        fprintf (stderr, "file chunk failed\n");
+        return -1;
+    }
+
+    memset (&stream_descr, 0, sizeof (stream_descr));
+    stream_descr.write_block = checksum_chunk;
+    stream = cdc_stream_new (&stream_descr, NULL, FALSE);
+    if (!stream) {
+        fprintf (stderr, "failed to create cdc stream\n");
+        return -1;
+    }
+
+    fd = open (src_filename, O_RDONLY | O_BINARY);
+    if (fd < 0) {
+        perror ("open");
+        cdc_stream_free (stream);
+        return -1;
+    }
+
+    buf = malloc (piece_sizes[G_N_ELEMENTS(piece_sizes) - 1]);
+    while ((n = read (fd, buf, piece_sizes[i % G_N_ELEMENTS(piece_sizes)])) > 0) {
+        if (cdc_stream_update (stream, buf, n) < 0) {
+            fprintf (stderr, "stream chunk failed\n");
+            ret = -1;
+            goto out;
+        }
+        ++i;
+    }
+    if (n < 0) {
+        perror ("read");
+        ret = -1;
+        goto out;
+    }
+    if (cdc_stream_finish (stream) < 0) {
+        fprintf (stderr, "stream chunk failed\n");
+        ret = -1;
+        goto out;
+    }
+
+    printf ("%d chunks from stream.\n", stream_descr.block_nr);
+
+    if (stream_descr.file_size != file_descr.file_size ||
+        stream_descr.block_nr != file_descr.block_nr ||
+        memcmp (stream_descr.blk_sha1s, file_descr.blk_sha1s,
+                file_descr.block_nr * CHECKSUM_LENGTH) != 0 ||
+        memcmp (stream_descr.file_sum, file_descr.file_sum,
+                CHECKSUM_LENGTH) != 0) {
+        fprintf (stderr, "stream chunks differ from file chunks.\n");
+        ret = -1;
+    }
+
+out:
+    close (fd);
+    free (buf);
+    cdc_stream_free (stream);
+    free (stream_descr.blk_sha1s);
+    free (file_descr.blk_sha1s);
+    return ret;
+}
+
 int main (int argc, char *argv[])
 {
     char *src_filename = NULL;
@@ -105,6 +198,8 @@ int main (int argc, char *argv[])
         src_filename = argv[1];
         dest_dir = argv[2];
     }
+
+    cdc_init ();
     
     memset (&file_descr, 0, sizeof (file_descr));
     file_descr.write_block = test_write_chunk;
@@ -120,6 +215,12 @@ int main (int argc, char *argv[])
         exit(1);
     }
 
+    ret = test_stream (src_filename);
+    if (ret < 0) {
+        fprintf (stderr, "stream chunk test failed.\n");
+        exit(1);
+    }
+
     printf ("test passed.\n");
     return 0;
 }